@@ -0,0 +1,620 @@
+#!/usr/bin/python
+
+# Stores the state of a cluster - its nodes, their roles, IP addresses, hostnames and
+# statuses - in an SQLite database with indexed lookups, instead of a sectioned text file
+# that has to be scanned with sed and grep for every lookup.
+#
+# The database is stored next to the cluster's status file, as "<cluster>.db" for a
+# "<cluster>.info" status file. The status file itself is still written out after every
+# change, in the same sectioned format as before, so that it remains readable by people and
+# by scripts like cluster_info.sh. It should be treated as a read-only view.
+# If there's no database but there's a status file, such as for clusters created by earlier
+# versions, the status file is imported the first time the database is needed.
+#
+# Hashes of the files last copied to each node, like its zoo.cfg or iptables rules, are
+# stored too, so that unchanged files need not be copied again. See ssh_fanout.py.
+#
+# Every change is a single transaction made while holding an exclusive lock on the database
+# file, so concurrent invocations don't lose each other's changes. Commands that change
+# multiple nodes can be applied together in one transaction with the 'apply' command.
+#
+# Usage: cluster_state.py <status file> <command> [<args>]
+# See the comments of each command below for its args and output.
+
+import os
+import sys
+import fcntl
+import shlex
+import sqlite3
+import tempfile
+
+SECTION_START_PREFIX = '#START:'
+SECTION_END_PREFIX = '#END:'
+
+# Node fields. 'listed' is whether the node is in the 'nodes' section.
+NODE_FIELDS = ('linode_id', 'role', 'new', 'private_ip', 'public_ip',
+	'private_hostname', 'public_hostname', 'myid')
+
+# Sections derived from node fields, and the fields that make up each line of them.
+# A node has a line in a section only if it has values for all the fields of that section.
+NODE_SECTIONS = {
+	'ipaddresses' : ('private_ip', 'public_ip'),
+	'hostnames' : ('private_hostname', 'public_hostname'),
+	'myids' : ('myid',)
+}
+
+# Sections whose lines are "name:value" settings, like "status:running".
+SETTING_SECTIONS = ('status', 'security', 'conf')
+
+# Section whose lines are "<linode id> <remote path> <hash>" of files copied to nodes.
+ARTIFACTS_SECTION = 'artifacts'
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS nodes (
+	seq INTEGER PRIMARY KEY AUTOINCREMENT,
+	linode_id TEXT NOT NULL UNIQUE,
+	listed INTEGER NOT NULL DEFAULT 0,
+	role TEXT,
+	new INTEGER NOT NULL DEFAULT 0,
+	private_ip TEXT,
+	public_ip TEXT,
+	private_hostname TEXT,
+	public_hostname TEXT,
+	myid TEXT
+);
+CREATE INDEX IF NOT EXISTS nodes_role ON nodes(role);
+CREATE INDEX IF NOT EXISTS nodes_private_hostname ON nodes(private_hostname);
+CREATE INDEX IF NOT EXISTS nodes_public_hostname ON nodes(public_hostname);
+CREATE INDEX IF NOT EXISTS nodes_private_ip ON nodes(private_ip);
+CREATE INDEX IF NOT EXISTS nodes_public_ip ON nodes(public_ip);
+
+CREATE TABLE IF NOT EXISTS sections (
+	seq INTEGER PRIMARY KEY AUTOINCREMENT,
+	name TEXT NOT NULL UNIQUE
+);
+
+CREATE TABLE IF NOT EXISTS settings (
+	section TEXT NOT NULL,
+	name TEXT NOT NULL,
+	value TEXT NOT NULL,
+	PRIMARY KEY (section, name)
+);
+
+CREATE TABLE IF NOT EXISTS lines (
+	seq INTEGER PRIMARY KEY AUTOINCREMENT,
+	section TEXT NOT NULL,
+	key TEXT NOT NULL,
+	line TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS lines_section_key ON lines(section, key);
+
+CREATE TABLE IF NOT EXISTS artifacts (
+	linode_id TEXT NOT NULL,
+	path TEXT NOT NULL,
+	hash TEXT NOT NULL,
+	PRIMARY KEY (linode_id, path)
+);
+'''
+
+
+class StateError(Exception):
+	pass
+
+
+
+class ClusterState(object):
+
+	# 'status_file' is the path of the cluster's .info status file.
+	def __init__(self, status_file):
+		self.status_file = status_file
+		base = status_file[:-len('.info')] if status_file.endswith('.info') else status_file
+		self.db_file = base + '.db'
+		self.lock_fd = None
+		self.conn = None
+
+
+
+	# Opens the database while holding a lock on it, that's exclusive if 'write' is True and
+	# shared otherwise. The status file is imported if there's no database yet.
+	def open(self, write):
+		needs_import = not os.path.exists(self.db_file) or os.path.getsize(self.db_file) == 0
+		if needs_import and not write and not os.path.exists(self.status_file):
+			return False
+
+		# The lock is an flock on the database file itself, which doesn't interfere with
+		# SQLite's own fcntl locks.
+		self.lock_fd = os.open(self.db_file, os.O_RDWR | os.O_CREAT, 0660)
+		fcntl.flock(self.lock_fd, fcntl.LOCK_EX if (write or needs_import) else fcntl.LOCK_SH)
+
+		self.conn = sqlite3.connect(self.db_file, isolation_level=None)
+		self.conn.row_factory = sqlite3.Row
+
+		# Check again now that lock is held, because another process may have done it meanwhile.
+		needs_import = os.path.getsize(self.db_file) == 0
+
+		# The schema is created in every database, so that tables added later are created in
+		# databases of existing clusters too.
+		# executescript() commits any open transaction, so the schema is created before it.
+		self.conn.executescript(SCHEMA)
+		if needs_import:
+			self.begin()
+			if os.path.exists(self.status_file):
+				with open(self.status_file, 'r') as f:
+					self.import_text(f.read())
+			self.commit()
+		return True
+
+
+
+	def close(self):
+		if self.conn is not None:
+			self.conn.close()
+			self.conn = None
+		if self.lock_fd is not None:
+			os.close(self.lock_fd)
+			self.lock_fd = None
+
+
+
+	def begin(self):
+		self.conn.execute('BEGIN IMMEDIATE')
+
+
+
+	# Commits the transaction and rewrites the status file from the committed state.
+	def commit(self):
+		text = self.export_text()
+		self.conn.execute('COMMIT')
+		write_atomically(self.status_file, text)
+
+
+
+	def rollback(self):
+		self.conn.execute('ROLLBACK')
+
+
+
+	def add_section(self, section):
+		self.conn.execute('INSERT OR IGNORE INTO sections(name) VALUES (?)', (section,))
+
+
+
+	def has_section(self, section):
+		return self.conn.execute('SELECT 1 FROM sections WHERE name = ?', (section,)).fetchone() is not None
+
+
+
+	# Inserts or updates a node with the given fields. 'fields' is a dict of field names to
+	# values, where a value of None clears the field.
+	def set_node(self, linode_id, fields):
+		for name in fields:
+			if name not in NODE_FIELDS or name == 'linode_id':
+				raise StateError("Invalid node field '%s'" % name)
+
+		self.conn.execute('INSERT OR IGNORE INTO nodes(linode_id) VALUES (?)', (linode_id,))
+
+		# Setting a node's role or marking it as new lists it in the 'nodes' section.
+		updates = dict(fields)
+		if 'role' in updates or updates.get('new'):
+			updates['listed'] = 1
+		if 'new' in updates:
+			updates['new'] = 1 if updates['new'] in (1, '1', 'true') else 0
+
+		if updates:
+			names = sorted(updates.keys())
+			self.conn.execute('UPDATE nodes SET %s WHERE linode_id = ?' % ', '.join('%s = ?' % n for n in names),
+				[updates[n] for n in names] + [linode_id])
+
+		self.add_section('nodes')
+		for section, section_fields in sorted(NODE_SECTIONS.items()):
+			if any(f in fields for f in section_fields):
+				self.add_section(section)
+
+
+
+	# Lists a node in the 'nodes' section without changing any of its fields.
+	def list_node(self, linode_id):
+		self.set_node(linode_id, {})
+		self.conn.execute('UPDATE nodes SET listed = 1 WHERE linode_id = ?', (linode_id,))
+
+
+
+	def remove_node(self, linode_id):
+		self.conn.execute('DELETE FROM nodes WHERE linode_id = ?', (linode_id,))
+		self.conn.execute('DELETE FROM artifacts WHERE linode_id = ?', (linode_id,))
+
+
+
+	def clear_new(self):
+		self.conn.execute('UPDATE nodes SET new = 0')
+
+
+
+	def get_setting(self, section, name):
+		row = self.conn.execute('SELECT value FROM settings WHERE section = ? AND name = ?',
+			(section, name)).fetchone()
+		return row['value'] if row else None
+
+
+
+	def set_setting(self, section, name, value):
+		self.add_section(section)
+		self.conn.execute('INSERT OR REPLACE INTO settings(section, name, value) VALUES (?, ?, ?)',
+			(section, name, value))
+
+
+
+	# Inserts a line into a plain section, or replaces the line that has the same key.
+	def put_line(self, section, key, line):
+		self.add_section(section)
+		cur = self.conn.execute('UPDATE lines SET line = ? WHERE section = ? AND key = ?', (line, section, key))
+		if cur.rowcount == 0:
+			self.conn.execute('INSERT INTO lines(section, key, line) VALUES (?, ?, ?)', (section, key, line))
+
+
+
+	def delete_line(self, section, key):
+		self.conn.execute('DELETE FROM lines WHERE section = ? AND key = ?', (section, key))
+
+
+
+	# Returns a dict of remote paths to hashes of files last copied to a node.
+	def get_artifacts(self, linode_id):
+		return dict((row['path'], row['hash']) for row in self.conn.execute(
+			'SELECT path, hash FROM artifacts WHERE linode_id = ?', (linode_id,)))
+
+
+
+	def set_artifact(self, linode_id, path, hash):
+		self.add_section(ARTIFACTS_SECTION)
+		self.conn.execute('INSERT OR REPLACE INTO artifacts(linode_id, path, hash) VALUES (?, ?, ?)',
+			(linode_id, path, hash))
+
+
+
+	# Forgets hashes of files copied to the given nodes, or to all nodes if none are given,
+	# so that their files are copied again next time.
+	def forget_artifacts(self, linode_ids):
+		if linode_ids:
+			for linode_id in linode_ids:
+				self.conn.execute('DELETE FROM artifacts WHERE linode_id = ?', (linode_id,))
+		else:
+			self.conn.execute('DELETE FROM artifacts')
+
+
+
+	# Returns nodes, in the order they were added, that have values for all of 'fields' and
+	# match all of 'filters'. A field whose name ends with '?' is optional, and is None for
+	# nodes that don't have a value for it. 'filters' is a list of (field, operator, value)
+	# where operator is '=' or '!='.
+	def query_nodes(self, fields, filters):
+		required = [name for name in fields if not name.endswith('?')]
+		fields = [name.rstrip('?') for name in fields]
+		for name in fields + [f[0] for f in filters]:
+			if name not in NODE_FIELDS:
+				raise StateError("Invalid node field '%s'" % name)
+
+		conditions = ['%s IS NOT NULL' % name for name in required]
+		params = []
+		for name, op, value in filters:
+			if op == '=':
+				conditions.append('%s = ?' % name)
+			else:
+				conditions.append('(%s IS NULL OR %s != ?)' % (name, name))
+			params.append(value)
+
+		sql = 'SELECT %s FROM nodes' % ', '.join(fields)
+		if conditions:
+			sql += ' WHERE ' + ' AND '.join(conditions)
+		sql += ' ORDER BY seq'
+		return [tuple(row) for row in self.conn.execute(sql, params)]
+
+
+
+	# Returns lines of a section in the status file format, or None if there's no such section.
+	def section_lines(self, section):
+		if not self.has_section(section):
+			return None
+
+		if section == 'nodes':
+			lines = []
+			for linode_id, role, new in self.conn.execute(
+					'SELECT linode_id, role, new FROM nodes WHERE listed = 1 ORDER BY seq'):
+				line = linode_id
+				if role:
+					line += ':' + role
+				if new:
+					line += ':new'
+				lines.append(line)
+			return lines
+
+		if section in NODE_SECTIONS:
+			return [' '.join(row) for row in self.query_nodes(('linode_id',) + NODE_SECTIONS[section], [])]
+
+		if section in SETTING_SECTIONS:
+			return ['%s:%s' % (row['name'], row['value']) for row in self.conn.execute(
+				'SELECT name, value FROM settings WHERE section = ? ORDER BY rowid', (section,))]
+
+		if section == ARTIFACTS_SECTION:
+			return ['%s %s %s' % (row['linode_id'], row['path'], row['hash']) for row in self.conn.execute(
+				'SELECT linode_id, path, hash FROM artifacts ORDER BY linode_id, path')]
+
+		return [row['line'] for row in self.conn.execute(
+			'SELECT line FROM lines WHERE section = ? ORDER BY seq', (section,))]
+
+
+
+	def export_text(self):
+		text = ''
+		for row in self.conn.execute('SELECT name FROM sections ORDER BY seq').fetchall():
+			section = row['name']
+			text += '\n\n%s%s\n' % (SECTION_START_PREFIX, section)
+			for line in self.section_lines(section):
+				text += line + '\n'
+			text += '%s%s\n' % (SECTION_END_PREFIX, section)
+		return text
+
+
+
+	# Imports a status file in the sectioned text format, replacing the current state.
+	def import_text(self, text):
+		for table in ('nodes', 'sections', 'settings', 'lines', 'artifacts'):
+			self.conn.execute('DELETE FROM %s' % table)
+
+		section = None
+		for line in text.splitlines():
+			if line.startswith(SECTION_START_PREFIX):
+				section = line[len(SECTION_START_PREFIX):].strip()
+				self.add_section(section)
+				continue
+			if line.startswith(SECTION_END_PREFIX):
+				section = None
+				continue
+			if section is None or not line.strip():
+				continue
+
+			if section == 'nodes':
+				fields = line.strip().split(':')
+				self.list_node(fields[0])
+				if len(fields) > 1 and fields[1]:
+					self.set_node(fields[0], {'role' : fields[1]})
+				if 'new' in fields[2:]:
+					self.set_node(fields[0], {'new' : 1})
+
+			elif section in NODE_SECTIONS:
+				fields = line.split()
+				section_fields = NODE_SECTIONS[section]
+				if len(fields) != len(section_fields) + 1:
+					raise StateError("Invalid line in section %s: '%s'" % (section, line))
+				self.set_node(fields[0], dict(zip(section_fields, fields[1:])))
+
+			elif section in SETTING_SECTIONS:
+				name, sep, value = line.partition(':')
+				if not sep:
+					raise StateError("Invalid line in section %s: '%s'" % (section, line))
+				self.set_setting(section, name.strip(), value.strip())
+
+			elif section == ARTIFACTS_SECTION:
+				# Remote paths may contain spaces, but IDs and hashes don't.
+				linode_id, sep, rest = line.strip().partition(' ')
+				path, sep, hash = rest.rpartition(' ')
+				if not path:
+					raise StateError("Invalid line in section %s: '%s'" % (section, line))
+				self.set_artifact(linode_id, path, hash)
+
+			else:
+				fields = line.split()
+				self.put_line(section, fields[0], line)
+
+
+
+	# Applies a write command in the current transaction. 'args' are the command and its args.
+	def apply_command(self, args):
+		if not args:
+			return
+		cmd = args[0]
+
+		if cmd == 'set-node' and len(args) >= 2:
+			fields = {}
+			for assignment in args[2:]:
+				name, sep, value = assignment.partition('=')
+				if not sep:
+					raise StateError("Invalid node field assignment '%s'" % assignment)
+				fields[name] = value if value else None
+			self.set_node(args[1], fields)
+
+		elif cmd == 'list-node' and len(args) == 2:
+			self.list_node(args[1])
+
+		elif cmd == 'remove-node' and len(args) >= 2:
+			for linode_id in args[1:]:
+				self.remove_node(linode_id)
+
+		elif cmd == 'clear-new' and len(args) == 1:
+			self.clear_new()
+
+		elif cmd == 'set' and len(args) == 4:
+			if args[1] not in SETTING_SECTIONS:
+				raise StateError("Invalid settings section '%s'" % args[1])
+			self.set_setting(args[1], args[2], args[3])
+
+		elif cmd == 'add-section' and len(args) == 2:
+			self.add_section(args[1])
+
+		elif cmd == 'put-line' and len(args) == 4:
+			self.put_line(args[1], args[2], args[3])
+
+		elif cmd == 'delete-line' and len(args) == 3:
+			self.delete_line(args[1], args[2])
+
+		elif cmd == 'set-artifact' and len(args) == 4:
+			self.set_artifact(args[1], args[2], args[3])
+
+		elif cmd == 'forget-artifacts':
+			self.forget_artifacts(args[1:])
+
+		else:
+			raise StateError("Invalid command '%s'" % ' '.join(args))
+
+
+
+# Writes to a temporary file and renames it over the target, so that readers never see a
+# partially written file. Permissions of an existing file are retained.
+def write_atomically(path, text):
+	dirname = os.path.dirname(os.path.abspath(path))
+	fd, tmp_path = tempfile.mkstemp(prefix='.' + os.path.basename(path), dir=dirname)
+	try:
+		with os.fdopen(fd, 'w') as f:
+			f.write(text)
+		if os.path.exists(path):
+			os.chmod(tmp_path, os.stat(path).st_mode & 0777)
+		else:
+			os.chmod(tmp_path, 0664)
+		os.rename(tmp_path, path)
+	except:
+		os.remove(tmp_path)
+		raise
+
+
+
+def parse_filters(args):
+	filters = []
+	for arg in args:
+		if '!=' in arg:
+			name, value = arg.split('!=', 1)
+			filters.append((name, '!=', value))
+		elif '=' in arg:
+			name, value = arg.split('=', 1)
+			filters.append((name, '=', value))
+		else:
+			raise StateError("Invalid filter '%s'" % arg)
+	return filters
+
+
+
+# Commands that only read state, and the minimum number of args after the command name.
+READ_COMMANDS = {
+	'section' : 1,
+	'get' : 2,
+	'query' : 1,
+	'export' : 0
+}
+
+
+
+def main():
+	if len(sys.argv) < 3:
+		print >> sys.stderr, "Usage: cluster_state.py <status file> <command> [<args>]"
+		sys.exit(2)
+
+	state = ClusterState(sys.argv[1])
+	cmd = sys.argv[2]
+	args = sys.argv[3:]
+
+	try:
+		# Deletes the database and the status file.
+		# Args: none
+		if cmd == 'delete':
+			if os.path.exists(state.db_file):
+				state.open(True)
+				for path in (state.status_file, state.db_file):
+					if os.path.exists(path):
+						os.remove(path)
+				state.close()
+			elif os.path.exists(state.status_file):
+				os.remove(state.status_file)
+			return 0
+
+		if cmd in READ_COMMANDS:
+			if len(args) < READ_COMMANDS[cmd]:
+				raise StateError("Missing arguments for '%s'" % cmd)
+			if not state.open(False):
+				return 1
+
+			# Prints lines of a section in the status file format.
+			# Args: <section>
+			# Returns: 1 if there's no such section.
+			if cmd == 'section':
+				lines = state.section_lines(args[0])
+				if lines is None:
+					return 1
+				for line in lines:
+					print line
+
+			# Prints a setting, like "get status status".
+			# Args: <section> <name>
+			# Returns: 1 if the setting is not set.
+			elif cmd == 'get':
+				value = state.get_setting(args[0], args[1])
+				if value is None:
+					return 1
+				print value
+
+			# Prints space separated fields of nodes, one node per line in the order they were added.
+			# Nodes which don't have a value for any of the fields are skipped, except for optional
+			# fields suffixed with '?' which are printed as '-' instead.
+			# Args: <comma separated fields> [<field>=<value> | <field>!=<value> ...]
+			#	Fields: linode_id, role, new, private_ip, public_ip, private_hostname, public_hostname, myid
+			#	Example: query linode_id,private_ip,private_hostname? role=supervisor new=1
+			elif cmd == 'query':
+				rows = state.query_nodes(args[0].split(','), parse_filters(args[1:]))
+				for row in rows:
+					print ' '.join('-' if v is None else str(v) for v in row)
+
+			# Prints the complete state in the status file format.
+			elif cmd == 'export':
+				sys.stdout.write(state.export_text())
+
+			return 0
+
+		state.open(True)
+		state.begin()
+		try:
+			# Applies write commands read from stdin, one per line, in a single transaction.
+			# Args: none
+			if cmd == 'apply':
+				for line in sys.stdin:
+					state.apply_command(shlex.split(line))
+
+			# Replaces the state with contents of the status file, such as after it's been
+			# edited by hand.
+			# Args: none
+			elif cmd == 'import':
+				text = ''
+				if os.path.exists(state.status_file):
+					with open(state.status_file, 'r') as f:
+						text = f.read()
+				state.import_text(text)
+
+			# Write commands:
+			#	set-node <linode id> [<field>=<value> ...] : Add or update a node. Empty value clears a field.
+			#	list-node <linode id> : Add a node to the 'nodes' section without a role.
+			#	remove-node <linode id> [<linode id> ...] : Remove nodes and all their fields.
+			#	clear-new : Unmark all new nodes.
+			#	set <status|security|conf> <name> <value> : Set a setting.
+			#	add-section <section> : Add an empty section if it doesn't exist.
+			#	put-line <section> <key> <line> : Insert or replace the line with this key in a plain section.
+			#	delete-line <section> <key> : Delete the line with this key from a plain section.
+			#	set-artifact <linode id> <remote path> <hash> : Record hash of a file copied to a node.
+			#	forget-artifacts [<linode id> ...] : Forget hashes of files copied to nodes, or to all nodes
+			#		if none are given, so that they're copied again by the next incremental copy.
+			else:
+				state.apply_command([cmd] + args)
+
+			state.commit()
+		except:
+			state.rollback()
+			raise
+		return 0
+
+	except (StateError, sqlite3.Error, IOError, OSError) as e:
+		print >> sys.stderr, "Error: %s" % e
+		return 1
+
+	finally:
+		state.close()
+
+
+
+if __name__ == '__main__':
+	sys.exit(main())
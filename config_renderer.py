@@ -0,0 +1,275 @@
+#!/usr/bin/python
+
+# Renders cluster configuration files - storm.yaml, zoo.cfg, stormproxy.conf, iptables rules
+# and ipsets whitelists - from their templates and the cluster state, in a single pass.
+#
+# Cluster state is loaded once, and each template is read once, substituted and expanded
+# in memory, instead of being copied and then rewritten in place by a series of sed
+# commands. Output files are written atomically, and only if their contents have changed,
+# so that unchanged files keep their timestamps and callers can skip distributing them.
+#
+# Usage: config_renderer.py <status file>
+# Reads what to render from stdin, one item per line. Fields are separated by whitespace,
+# and can be quoted like shell arguments:
+#	var <name> <value> :
+#		Variable that's substituted for "$<name>" in all templates. Other "$..." text is left as is.
+#	text <output> <template> :
+#		Template with variables substituted.
+#	storm-yaml <output> <template> <nimbus hostname> <zk status file> <zk client port> :
+#		storm.yaml with nimbus host and zookeeper servers sections added.
+#	stormproxy <output> <template> <client public IP> :
+#		stormproxy.conf with a JSON URL substitution at the ###JSONREPLACE marker line and a
+#		proxied location for each supervisor node.
+#	zoo-cfg <output> <template> <leader connection port> <leader election port> :
+#		zoo.cfg with a "server.<myid>=" line for each zookeeper node.
+#	whitelist <output> <ipset name> :
+#		ipsets file with a set of private IP addresses of all nodes.
+#	ipset-list <output> <list name> <input> [<input> ...] :
+#		ipsets file with a list:set of the sets created in input ipsets files.
+#	concat <output> <input> [<input> ...] :
+#		Concatenation of input files, which may be outputs rendered earlier.
+#
+# Output: Paths of output files that were changed, one per line.
+# Returns: 0 on success, 1 on error.
+
+import os
+import re
+import sys
+import shlex
+import tempfile
+
+import cluster_state
+
+VARIABLE_PATTERN = re.compile(r'\$([A-Za-z_][A-Za-z0-9_]*)')
+
+JSON_REPLACE_MARKER = '###JSONREPLACE'
+
+# Output files contain cluster details, so they're readable only by owner like before.
+OUTPUT_MODE = 0600
+
+
+class RenderError(Exception):
+	pass
+
+
+
+def substitute(text, variables):
+	return VARIABLE_PATTERN.sub(lambda m: variables.get(m.group(1), m.group(0)), text)
+
+
+
+# Returns lines of a section in the format of textfileops.sh add_section, so that
+# files look the same as the ones created by the earlier shell functions.
+def section(name, lines):
+	return '\n\n%s%s\n%s%s%s\n' % (cluster_state.SECTION_START_PREFIX, name,
+		''.join(line + '\n' for line in lines), cluster_state.SECTION_END_PREFIX, name)
+
+
+
+class Renderer(object):
+
+	def __init__(self, state):
+		self.state = state
+		self.variables = {}
+		# Rendered contents of outputs, by path, for concat inputs.
+		self.outputs = {}
+
+
+
+	def read(self, path):
+		if path in self.outputs:
+			return self.outputs[path]
+		with open(path, 'r') as f:
+			return f.read()
+
+
+
+	def template(self, path):
+		return substitute(self.read(path), self.variables)
+
+
+
+	def storm_yaml(self, template, nimbus_hostname, zk_status_file, zk_client_port):
+		zk_state = cluster_state.ClusterState(zk_status_file)
+		if not zk_state.open(False):
+			raise RenderError("Zookeeper cluster status file %s not found" % zk_status_file)
+		try:
+			zk_hostnames = [row[0] for row in zk_state.query_nodes(('private_hostname',), [])]
+		finally:
+			zk_state.close()
+
+		text = self.template(template)
+		text += section('nimbus', ["nimbus.host: '%s'" % nimbus_hostname])
+		text += section('zookeeper', ['storm.zookeeper.servers:'] +
+			["  - '%s'" % hostname for hostname in zk_hostnames] +
+			['storm.zookeeper.port: %s' % zk_client_port])
+		return text
+
+
+
+	def stormproxy(self, template, client_public_ip):
+		sup_hostnames = [row[0] for row in
+			self.state.query_nodes(('private_hostname',), [('role', '=', 'supervisor')])]
+
+		# For every supervisor node's URL in the REST API JSON response, replace with
+		# corresponding proxied URL like http://client/<supervisor_hostname>/
+		# Slashes are escaped in JSON.
+		substitutions = ['\tSubstitute "s|http:\\/\\/%s:8000|http:\\/\\/%s/%s|nq"' %
+			(hostname, client_public_ip, hostname) for hostname in sup_hostnames]
+
+		lines = []
+		for line in self.template(template).splitlines(True):
+			if JSON_REPLACE_MARKER in line:
+				lines.extend(s + '\n' for s in substitutions)
+			lines.append(line)
+
+		# For every supervisor node's logviewer app, create a corresponding proxied URL
+		# like http://client/<supervisor_hostname>/
+		#
+		# Accept-Encoding request header is unset to avoid accepting gzip, because it bypasses substitution filter.
+		# Substitute HTML too does not work unless encoding is unset.
+		#
+		# The Substitute directive strips the leading slashes from URLs, thus turning them into relative
+		# URLs.
+		# For example, URLs like href="/download/..." which wrongly resolves to http://client/download
+		# is substituted href="download/..." which correctly resolves to http://client/<supervisor>/download...
+		for hostname in sup_hostnames:
+			lines.append('<Location "/%s/">\n' % hostname)
+			lines.append('    ProxyPass "http://%s:8000/"\n' % hostname)
+			lines.append('\n')
+			lines.append('    RequestHeader unset Accept-Encoding\n')
+			lines.append('    AddOutputFilterByType SUBSTITUTE text/html\n')
+			lines.append('    Substitute \'s|href="/|href="|nq\'\n')
+			lines.append('</Location>\n')
+			lines.append('\n')
+		return ''.join(lines)
+
+
+
+	def zoo_cfg(self, template, leader_port, election_port):
+		# Every node's zoo.cfg lists all the nodes in the format
+		# server.<myid>=<host>:<port_to_connect_to_leader>:<leader_election_port>
+		servers = ['server.%s=%s:%s:%s' % (myid, hostname, leader_port, election_port)
+			for myid, hostname in self.state.query_nodes(('myid', 'private_hostname'), [])]
+		return self.template(template) + section('nodes', servers)
+
+
+
+	def whitelist(self, ipset_name):
+		lines = ['create %s hash:ip family inet hashsize 1024 maxelem 65536' % ipset_name]
+		lines.extend('add %s %s' % (ipset_name, row[0]) for row in self.state.query_nodes(('private_ip',), []))
+		return ''.join(line + '\n' for line in lines)
+
+
+
+	def ipset_list(self, list_name, inputs):
+		lines = ['create %s list:set size 32' % list_name]
+		for path in inputs:
+			for line in self.read(path).splitlines():
+				fields = line.split()
+				if len(fields) >= 2 and fields[0] == 'create':
+					lines.append('add %s %s' % (list_name, fields[1]))
+		return ''.join(line + '\n' for line in lines)
+
+
+
+	def concat(self, inputs):
+		return ''.join(self.read(path) for path in inputs)
+
+
+
+	# Renders an item and returns (output path, contents), or None for a variable.
+	def render(self, fields):
+		kind = fields[0]
+		args = fields[1:]
+
+		if kind == 'var' and len(args) == 2:
+			self.variables[args[0]] = args[1]
+			return None
+		elif kind == 'text' and len(args) == 2:
+			text = self.template(args[1])
+		elif kind == 'storm-yaml' and len(args) == 5:
+			text = self.storm_yaml(*args[1:])
+		elif kind == 'stormproxy' and len(args) == 3:
+			text = self.stormproxy(*args[1:])
+		elif kind == 'zoo-cfg' and len(args) == 4:
+			text = self.zoo_cfg(*args[1:])
+		elif kind == 'whitelist' and len(args) == 2:
+			text = self.whitelist(args[1])
+		elif kind == 'ipset-list' and len(args) >= 3:
+			text = self.ipset_list(args[1], args[2:])
+		elif kind == 'concat' and len(args) >= 2:
+			text = self.concat(args[1:])
+		else:
+			raise RenderError("Invalid item '%s'" % ' '.join(fields))
+
+		self.outputs[args[0]] = text
+		return (args[0], text)
+
+
+
+# Writes 'text' to 'path' atomically, unless the file already has the same contents.
+# Returns True if the file was written.
+def write_if_changed(path, text):
+	try:
+		with open(path, 'r') as f:
+			if f.read() == text:
+				return False
+	except IOError:
+		pass
+
+	dirname = os.path.dirname(os.path.abspath(path))
+	fd, tmp_path = tempfile.mkstemp(prefix='.' + os.path.basename(path), dir=dirname)
+	try:
+		with os.fdopen(fd, 'w') as f:
+			f.write(text)
+		os.chmod(tmp_path, OUTPUT_MODE)
+		os.rename(tmp_path, path)
+	except:
+		os.remove(tmp_path)
+		raise
+	return True
+
+
+
+def main():
+	if len(sys.argv) != 2:
+		print >> sys.stderr, "Usage: config_renderer.py <status file> < items"
+		sys.exit(1)
+
+	state = cluster_state.ClusterState(sys.argv[1])
+	try:
+		if not state.open(False):
+			raise RenderError("Cluster status file %s not found" % sys.argv[1])
+
+		# Everything is rendered before anything is written, so that an error in any item
+		# leaves all files as they were.
+		renderer = Renderer(state)
+		rendered = []
+		for line in sys.stdin:
+			fields = shlex.split(line)
+			if not fields:
+				continue
+			result = renderer.render(fields)
+			if result is not None:
+				rendered.append(result)
+
+	except (RenderError, cluster_state.StateError, IOError, OSError) as e:
+		print >> sys.stderr, "Error: %s" % e
+		sys.exit(1)
+
+	finally:
+		state.close()
+
+	try:
+		for path, text in rendered:
+			if write_if_changed(path, text):
+				print path
+	except (IOError, OSError) as e:
+		print >> sys.stderr, "Error: %s" % e
+		sys.exit(1)
+
+
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,342 @@
+#!/usr/bin/python
+
+# Builds Storm and Zookeeper template images, several at the same time, on a single thread.
+#
+# Each image is built on a temporary linode that's taken through the same stages as the
+# earlier shell functions - create the linode and its disk, create a configuration, boot,
+# install software over SSH, shut down, create an image of the disk, and delete the linode.
+# But stages that don't depend on each other are overlapped: the label update and public IP
+# lookup run alongside disk creation, and the configuration is created while the disk job is
+# still running. Jobs are waited for by coroutines of linode_api_async, with the same backoff
+# as wait-jobs, and SSH is probed every fraction of a second, so that a stage starts as soon
+# as the one before it is done instead of at the next 10 second poll.
+#
+# Software is installed by the cluster script's "install-image" command, which runs as a
+# subprocess while the event loop carries on with the other images.
+#
+# The start and duration of each stage are printed at the end, and also saved in a "timings"
+# section of the image status file, as lines of "<stage> <start seconds> <seconds>".
+#
+# Usage: image_builder.py < builds
+# Reads the images to build from stdin, one per line. Fields are separated by whitespace, and
+# can be quoted like shell arguments:
+#	<name> <image status file> <datacenter> <distribution> <disk size> <root password>
+#	<root SSH public key file> <kernel> <temporary linode label prefix> <image label>
+#	<image description> <install command> [<install command args> ...]
+# The install command is run with the public IP address of the temporary linode appended.
+#
+# Requires LINODE_KEY and LINODE_API_URL environment variables like linode_api.py.
+#
+# Output: Progress of each image prefixed with its name, followed by stage timings.
+# Returns: 0 if all images were created, 1 otherwise.
+
+import os
+import sys
+import time
+import errno
+import shlex
+import socket
+import subprocess
+
+import linode_api
+import linode_api_async
+from linode_api_async import Return
+import readiness_probe
+import config_renderer
+
+# Plan of the temporary linodes. Only the disk is imaged, so the cheapest plan is enough.
+TEMPORARY_PLAN = 1
+TEMPORARY_DISPLAY_GROUP = 'temporary'
+CONFIG_LABEL = 'template-configuration'
+
+# Seconds to wait for each job, and for SSH to become available after boot.
+JOB_TIMEOUT = linode_api.PROVISION_JOB_TIMEOUT
+SSH_TIMEOUT = 240
+
+# Number of fields before the install command in a build line.
+SPEC_FIELDS = 11
+
+
+
+class BuildError(Exception):
+	pass
+
+
+
+class ImageBuild(object):
+
+	def __init__(self, fields):
+		(self.name, self.status_file, self.datacenter, self.distribution, disk_size, self.root_password,
+			self.root_ssh_key_file, self.kernel, self.label_prefix, self.image_label, 
+			self.image_description) = fields[:SPEC_FIELDS]
+		self.disk_size = int(disk_size)
+		self.install_command = fields[SPEC_FIELDS:]
+
+		self.linode_id = None
+		self.image_id = None
+		self.error = None
+		self.start = None
+		self.elapsed = 0.0
+		# (stage, start seconds, seconds) of each stage.
+		self.timings = []
+
+
+	# Checks that the datacenter, distribution and kernel are valid before anything is
+	# created, and resolves them to their IDs.
+	def validate(self):
+		self.datacenter_id = linode_api.get_datacenter(self.datacenter)
+		if self.datacenter_id is None:
+			raise BuildError("Invalid datacenter '%s'" % self.datacenter)
+
+		self.distribution_id, self.distribution_label = linode_api.find_distribution(self.distribution)
+		if self.distribution_id is None:
+			raise BuildError("Invalid distribution '%s'" % self.distribution)
+
+		self.kernel_id, kernel_label = linode_api.find_kernel(self.kernel)
+		if self.kernel_id is None:
+			raise BuildError("Invalid kernel '%s'" % self.kernel)
+
+
+	def log(self, message):
+		print '[%s] %s' % (self.name, message)
+		sys.stdout.flush()
+
+
+	# Runs a stage's coroutine and records its timing.
+	def stage(self, name, coro):
+		start = time.time()
+		result = yield coro
+		self.timings.append((name, start - self.start, time.time() - start))
+		self.timings.sort(key=lambda timing: timing[1])
+		raise Return(result)
+
+
+
+def check(success, data, what):
+	if not success:
+		raise BuildError('Failed to %s. Error:%s' % (what, data))
+	return data
+
+
+
+def wait_for_job(api, build, job_id, what):
+	status = yield linode_api_async.wait_for_job(api, build.linode_id, job_id, JOB_TIMEOUT)
+	if status == 0:
+		raise BuildError('%s did not complete even after %d seconds' % (what, JOB_TIMEOUT))
+	elif status == 2:
+		raise BuildError('%s failed' % what)
+	elif status == 3:
+		raise BuildError('Failed to find status of %s job %s' % (what, job_id))
+
+
+
+def shutdown(api, build):
+	job_id = check(*(yield linode_api_async.shutdown_node(api, build.linode_id)), what='shut down')
+	yield wait_for_job(api, build, job_id, 'Shutdown')
+
+
+
+def create_image(api, build, disk_id):
+	image_id, job_id = check(*(yield linode_api_async.create_diskimage(api, build.linode_id, disk_id,
+		build.image_label, build.image_description)), what='create image of disk')
+	yield wait_for_job(api, build, job_id, 'Imaging')
+	raise Return(image_id)
+
+
+
+# Same check as the "ssh" probe of readiness_probe.py, on a non-blocking socket.
+def probe_ssh(loop, host, port, timeout):
+	sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+	sock.setblocking(0)
+	try:
+		err = sock.connect_ex((host, port))
+		if err not in (0, errno.EINPROGRESS, errno.EWOULDBLOCK):
+			raise Return(False)
+		yield loop.wait_writable(sock, timeout)
+		if sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR) != 0:
+			raise Return(False)
+		yield loop.wait_readable(sock, timeout)
+		raise Return(sock.recv(256).startswith('SSH-'))
+	except (socket.error, socket.timeout):
+		raise Return(False)
+	finally:
+		sock.close()
+
+
+
+def wait_for_ssh(loop, build, host):
+	deadline = time.time() + SSH_TIMEOUT
+	while True:
+		remaining = deadline - time.time()
+		if remaining <= 0:
+			raise BuildError('SSH is still not available after %d seconds' % SSH_TIMEOUT)
+		ready = yield probe_ssh(loop, host, readiness_probe.DEFAULT_PORTS['ssh'],
+			min(readiness_probe.PROBE_TIMEOUT, remaining))
+		if ready:
+			return
+		yield loop.sleep(max(0, min(readiness_probe.POLL_INTERVAL, deadline - time.time())))
+
+
+
+# Runs the install command, with its output logged line by line as it arrives.
+def install(loop, build, ipaddr):
+	with open(os.devnull, 'r') as devnull:
+		proc = subprocess.Popen(build.install_command + [ipaddr], stdin=devnull,
+			stdout=subprocess.PIPE, stderr=subprocess.STDOUT, close_fds=True)
+
+	pending = ''
+	while True:
+		yield loop.wait_readable(proc.stdout)
+		data = os.read(proc.stdout.fileno(), 65536)
+		if not data:
+			break
+		lines = (pending + data).split('\n')
+		pending = lines.pop()
+		for line in lines:
+			build.log(line)
+	if pending:
+		build.log(pending)
+
+	proc.stdout.close()
+	if proc.wait() != 0:
+		raise BuildError('Install command failed with exit code %d' % proc.returncode)
+
+
+
+def save_section(build, name, lines):
+	with open(build.status_file, 'a') as f:
+		f.write(config_renderer.section(name, lines))
+
+
+
+def build_image(loop, api, build):
+	build.log('Creating temporary linode')
+	build.linode_id = check(*(yield build.stage('create-node',
+		linode_api_async.create_node(api, TEMPORARY_PLAN, build.datacenter_id))), what='create temporary linode')
+	build.log('Created temporary linode %d' % build.linode_id)
+
+	build.log('Creating disk')
+	(label_result, disk_result, ipaddr) = yield [
+		build.stage('update-label', linode_api_async.update_node(api, build.linode_id,
+			'%s-%d' % (build.label_prefix, build.linode_id), TEMPORARY_DISPLAY_GROUP)),
+		build.stage('create-disk', linode_api_async.create_disk_from_distribution(api, build.linode_id,
+			build.distribution_id, build.distribution_label, build.disk_size, build.root_password,
+			build.root_ssh_key_file)),
+		build.stage('public-ip', linode_api_async.get_public_ip_address(api, build.linode_id))
+	]
+	check(*label_result, what='update node label')
+	disk_id, disk_job_id = check(*disk_result, what='create disk')
+	if ipaddr is None:
+		raise BuildError('Failed to get IP address')
+	build.log('IP address: %s' % ipaddr)
+
+	# The configuration only refers to the disk, so it's created while the disk job runs.
+	build.log('Creating a configuration')
+	(disk_job_result, config_result) = yield [
+		build.stage('disk-job', wait_for_job(api, build, disk_job_id, 'Create disk')),
+		build.stage('create-config', linode_api_async.create_config(api, build.linode_id, build.kernel_id,
+			str(disk_id), CONFIG_LABEL))
+	]
+	config_id = check(*config_result, what='create configuration')
+
+	build.log('Booting the linode')
+	boot_job_id = check(*(yield linode_api_async.boot_node(api, build.linode_id, config_id)), what='boot')
+	yield build.stage('boot-job', wait_for_job(api, build, boot_job_id, 'Boot'))
+
+	yield build.stage('ssh-ready', wait_for_ssh(loop, build, ipaddr))
+	build.log('SSH is available')
+
+	yield build.stage('install', install(loop, build, ipaddr))
+
+	build.log('Shutting down the linode')
+	yield build.stage('shutdown', shutdown(api, build))
+
+	build.log('Creating image of disk %d' % disk_id)
+	build.image_id = yield build.stage('create-image', create_image(api, build, disk_id))
+	build.log('Template image %d successfully created' % build.image_id)
+	save_section(build, 'image', [str(build.image_id)])
+
+	# 'skipChecks' is 1 (true) because it's much easier than detaching disk from config and then deleting.
+	build.log('Deleting the temporary linode %d' % build.linode_id)
+	check(*(yield build.stage('delete-node', linode_api_async.delete_node(api, build.linode_id, 1))),
+		what='delete temporary linode')
+
+	save_section(build, 'timings', ['%s %.1f %.1f' % timing for timing in build.timings])
+
+
+
+# Runs a build, and records its error instead of raising it so that other builds carry on.
+def run_build(loop, api, build):
+	build.start = time.time()
+	try:
+		yield build_image(loop, api, build)
+	except (BuildError, linode_api.urllib2.URLError, linode_api.httplib.HTTPException,
+			socket.error, IOError, OSError, ValueError, KeyError) as e:
+		build.error = str(e) or e.__class__.__name__
+		build.log('Error: %s' % build.error)
+	build.elapsed = time.time() - build.start
+
+
+
+def print_timings(builds):
+	print 'Stage timings:'
+	for build in builds:
+		for stage, start, secs in build.timings:
+			print '%-10s %-14s start %7.1fs  took %7.1fs' % (build.name, stage, start, secs)
+
+	for build in builds:
+		if build.error is None:
+			print '%-10s image %d created in %.1fs' % (build.name, build.image_id, build.elapsed)
+		elif build.linode_id is not None:
+			print '%-10s FAILED after %.1fs, temporary linode %d is left for inspection: %s' % (
+				build.name, build.elapsed, build.linode_id, build.error)
+		else:
+			print '%-10s FAILED: %s' % (build.name, build.error)
+
+
+
+def main():
+	if len(sys.argv) != 1:
+		print "Usage: image_builder.py < builds"
+		sys.exit(1)
+
+	linode_api.api_key = os.getenv('LINODE_KEY', None)
+	linode_api.url = os.getenv('LINODE_API_URL', None)
+	if not linode_api.api_key or not linode_api.url:
+		print "Error : LINODE_KEY and LINODE_API_URL environment vars should be defined"
+		sys.exit(1)
+
+	builds = []
+	try:
+		for line in sys.stdin:
+			fields = shlex.split(line)
+			if not fields:
+				continue
+			if len(fields) <= SPEC_FIELDS:
+				raise BuildError("Invalid build '%s'" % line.strip())
+			builds.append(ImageBuild(fields))
+
+		if not builds:
+			raise BuildError('No images to build')
+
+		for build in builds:
+			build.validate()
+
+	except (BuildError, ValueError, linode_api.urllib2.URLError, socket.error) as e:
+		print "Error: %s" % e
+		sys.exit(1)
+
+	loop = linode_api_async.get_event_loop()
+	api = linode_api_async.AsyncLinodeClient(linode_api.url, linode_api.api_key)
+	try:
+		loop.run_until_complete(linode_api_async.gather(loop, [run_build(loop, api, build) for build in builds]))
+	finally:
+		api.close()
+
+	print_timings(builds)
+	sys.exit(1 if any(build.error is not None for build in builds) else 0)
+
+
+
+if __name__ == '__main__':
+	main()
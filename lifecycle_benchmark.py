@@ -0,0 +1,842 @@
+#!/usr/bin/python
+
+# Measures how long the cluster lifecycle operations of storm-cluster-linode.sh or
+# zookeeper-cluster-linode.sh take, and which of their steps the time goes to.
+#
+# For each cluster size, a fresh linode_api_simulator is started in this process and the cluster
+# is taken through create, start, stop, add-nodes (Storm only) and destroy, by running the real
+# scripts in a temporary workspace. Only what's outside this machine is stood in for:
+#	- The Linode API is the simulator, with jobs that take their usual durations times --job-scale.
+#	- ssh, scp, sleep and sudo are stub commands put first in PATH. ssh and scp take --ssh-latency
+#	  for every connection, except for ssh sessions over a multiplexed master connection.
+#	  sleep sleeps for the requested time times --sleep-scale, which is --job-scale by default so
+#	  that polls keep their proportion to jobs. sudo runs nothing, so /etc/hosts isn't touched.
+#	- Nodes get loopback addresses, at which an SSH banner on port 22 answers readiness probes.
+#	  If port 22 is taken, as on a cluster manager, its SSH daemon answers instead.
+#	- The Storm and Zookeeper distribution archives of the images are small stand-in archives,
+#	  since they're only validated and never installed.
+#
+# The cluster directories are created in the storm-linode directory with unique names, because
+# the scripts refer to files of other clusters by paths relative to it. They're removed along
+# with the rest of the workspace.
+#
+# Each operation's timeline is built from
+#	- Calls of the script's functions, from bash's xtrace, upto STEP_DEPTH levels deep. A nested
+#	  call of the other cluster script, like Storm's create running Zookeeper's create, is one step.
+#	- Calls of wait_for_job(s) (job-wait), wait_until_ready(_on_node) (probe) and linode_api
+#	  (api-command, which includes starting linode_api.py) at any depth.
+#	- Every API request, from the trace written by linode_api.py (api).
+#	- Every call of the stub commands (ssh, scp, sleep, sudo).
+# Times include the overhead of tracing, which is small next to the API calls and stubs.
+# An operation fails if its script exits with an error, or prints an "Error:" line even if 
+# it carries on.
+#
+# Usage: lifecycle_benchmark.py [<option> <value> ...]
+#	--cluster <storm|zookeeper>	: Cluster script to benchmark. Default is storm. Storm clusters get a
+#								  3 node Zookeeper cluster, which is created with them.
+#	--sizes <n>[,<n>...]		: Numbers of nodes of the clusters. Default is 3,10,30,100. Storm clusters
+#								  have a nimbus node, a client node and n-2 supervisor nodes.
+#	--job-scale <factor>		: Multiplier of the simulated durations of jobs. Default is 0.02.
+#	--sleep-scale <factor>		: Multiplier of the durations of sleep. Default is --job-scale.
+#	--api-latency <ms>			: Latency of every API request. Default is 0.
+#	--ssh-latency <ms>			: Latency of every SSH connection and scp. Default is 100.
+#	--clone <0|1>				: 1 to create nodes by cloning a golden node of each role, instead of from
+#								  the image. Default is 0. It needn't match the baseline's, so that runs
+#								  with 1 can be compared with a baseline of creating nodes from the image.
+#	--warm-pool <0|1>			: 1 to give Storm clusters a warm pool of as many nodes as add-nodes adds,
+#								  filled by a fill-pool operation before add-nodes. Default is 0. Like
+#								  --clone, it needn't match the baseline's.
+#	--report <file>				: Saves the report as JSON in this file.
+#	--baseline <file>			: Compares every operation with a report saved earlier with the same
+#								  settings, and fails if it's slower than the baseline by more than
+#								  --tolerance and by more than REGRESSION_MIN_SECONDS.
+#	--tolerance <fraction>		: Default is 0.2.
+#	--events <0|1>				: 1 to include every event in the report, not just the steps. Default is 0.
+#	--keep <0|1>				: 1 to keep the workspaces, with the scripts' output, for inspection. Default is 0.
+#
+# Scripts are run from the current directory, which should be the storm-linode directory.
+#
+# Output: A Gantt chart of every operation's steps and of time spent in API calls, job waits,
+#		probes, SSH and sleeps, followed by the comparison with the baseline if there's one.
+# Returns: 0 if every operation succeeded and none regressed, 1 otherwise.
+
+import SocketServer
+import threading
+import subprocess
+import distutils.spawn
+import tempfile
+import socket
+import shutil
+import tarfile
+import errno
+import json
+import math
+import time
+import sys
+import os
+import re
+
+import linode_api_simulator
+import readiness_probe
+import config_renderer
+
+OPTIONS = {
+	'cluster' : 'storm',
+	'sizes' : '3,10,30,100',
+	'job-scale' : 0.02,
+	'sleep-scale' : -1.0,
+	'api-latency' : 0.0,
+	'ssh-latency' : 100.0,
+	'clone' : 0,
+	'warm-pool' : 0,
+	'report' : '',
+	'baseline' : '',
+	'tolerance' : 0.2,
+	'events' : 0,
+	'keep' : 0
+}
+
+# Options that make reports comparable only with reports made with the same values.
+SETTINGS = ('cluster', 'job-scale', 'sleep-scale', 'api-latency', 'ssh-latency')
+
+SCRIPTS = {
+	'storm' : 'storm-cluster-linode.sh',
+	'zookeeper' : 'zookeeper-cluster-linode.sh'
+}
+
+OPERATIONS = {
+	'storm' : ['create', 'start', 'stop', 'add-nodes', 'destroy'],
+	'zookeeper' : ['create', 'start', 'stop', 'destroy']
+}
+
+PLAN = '2GB'
+PLAN_ID = 1
+GOLDEN_NODE_DATACENTER = 6
+GOLDEN_NODE_DISK_SIZE = 5000
+STORM_ZK_NODES = 3
+STORM_CLUSTER = 'bench-storm'
+ZK_CLUSTER = 'bench-zk'
+BENCH_PASSWORD = 'Bench-passw0rd'
+
+# Stand-in distribution archives, with the names they have in the image conf examples.
+DISTRIBUTIONS = {
+	'storm' : ('INSTALL_STORM_DISTRIBUTION', 'apache-storm-0.9.5'),
+	'zookeeper' : ('INSTALL_ZOOKEEPER_DISTRIBUTION', 'zookeeper-3.4.7')
+}
+
+ZK_IMAGE_TEMPLATES = [
+	('template_zoo.cfg', 'zoo.cfg'),
+	('template_zk_log4j.properties', 'log4j.properties'),
+	('template-zk-supervisord.conf', 'zk-supervisord.conf')
+]
+
+# A run is a regression if it's slower than its baseline by more than the tolerance and by
+# more than these seconds, so that operations of a few seconds don't fail on noise.
+REGRESSION_MIN_SECONDS = 0.5
+
+STEP_DEPTH = 2
+GANTT_WIDTH = 50
+
+# Functions of the cluster scripts whose calls are timed at any depth.
+FUNCTION_CATEGORIES = {
+	'linode_api' : 'api-command',
+	'wait_for_job' : 'job-wait',
+	'wait_for_jobs' : 'job-wait',
+	'wait_until_ready' : 'probe',
+	'wait_until_ready_on_node' : 'probe'
+}
+
+CATEGORIES = ('api-command', 'api', 'job-wait', 'probe', 'ssh', 'scp', 'sleep', 'sudo')
+
+# Every traced line of the scripts starts with its time, shell and function call stack.
+XTRACE_PS4 = '+|BENCH|${EPOCHREALTIME}|$$|${FUNCNAME[*]}| '
+XTRACE_LINE = re.compile(r'^\++\|BENCH\|([0-9.]+)\|(\d+)\|([^|]*)\| (.*)$')
+FUNCTION_NAME = re.compile(r'[\w.-]+')
+NESTED_SCRIPT = re.compile(r'^\./((?:storm|zookeeper)-cluster-linode\.sh) (\S+)')
+
+SSH_PORT = readiness_probe.DEFAULT_PORTS['ssh']
+SSH_BANNER = 'SSH-2.0-OpenSSH_6.6.1p1 lifecycle-benchmark\r\n'
+
+# Stub commands. Each appends a line of "<command> <start> <end> <details>" to $BENCH_EVENTS.
+STUB_HEADER = r'''#!/bin/bash
+# Stand-in for __NAME__, written by lifecycle_benchmark.py.
+bench_start=${EPOCHREALTIME:-$(date +%s.%N)}
+bench_event() {
+	local details="${2//[$'\t\n']/ }"
+	printf '%s\t%s\t%s\t%s\n' "$1" "$bench_start" "${EPOCHREALTIME:-$(date +%s.%N)}" "${details:0:200}" >> "$BENCH_EVENTS"
+}
+'''
+
+STUBS = {
+	'ssh' : r'''
+host=
+control=
+multiplexed=0
+read_stdin=1
+while [ $# -gt 0 ]; do
+	case "$1" in
+		-n) read_stdin=0; shift ;;
+		-M) control=master; shift ;;
+		-O) control=$2; shift 2 ;;
+		-o) if [[ "$2" == ControlPath=* ]]; then multiplexed=1; fi; shift 2 ;;
+		-[bcDEeFIiJLlmpQRSWw]) shift 2 ;;
+		-*) shift ;;
+		*) host=${1#*@}; shift; break ;;
+	esac
+done
+state="$BENCH_STATE/$host"
+
+if [ "$control" == "check" ]; then
+	[ $multiplexed -eq 1 -a -f "$state.master" ]
+	exit $?
+elif [ "$control" == "master" ]; then
+	__SLEEP__ $BENCH_SSH_SECONDS
+	touch "$state.master"
+	bench_event ssh "$host (master connection)"
+	exit 0
+fi
+
+if [ $multiplexed -eq 0 -o ! -f "$state.master" ]; then
+	__SLEEP__ $BENCH_SSH_SECONDS
+fi
+if [ $read_stdin -eq 1 ]; then
+	cat > /dev/null
+fi
+
+# Nodes remember the hostnames they're given, since set_hostname checks them.
+args=($*)
+for ((i = 0; i < ${#args[@]}; i++)); do
+	if [ "${args[$i]}" == "change-hostname" ]; then
+		echo "${args[$((i + 3))]}" > "$state.hostname"
+	fi
+done
+if [ "$*" == "hostname" ]; then
+	cat "$state.hostname" 2> /dev/null
+fi
+
+bench_event ssh "$host $*"
+exit 0
+''',
+
+	'scp' : r'''
+__SLEEP__ $BENCH_SSH_SECONDS
+bench_event scp "${@: -1}"
+exit 0
+''',
+
+	'sleep' : r'''
+__SLEEP__ $(awk "BEGIN { print $1 * $BENCH_SLEEP_SCALE }")
+bench_event sleep "$1"
+exit 0
+''',
+
+	'sudo' : r'''
+if [ "$1" == "-S" ]; then
+	cat > /dev/null
+	shift
+fi
+bench_event sudo "$*"
+exit 0
+'''
+}
+
+
+
+class BenchmarkError(Exception):
+	pass
+
+
+
+class BannerHandler(SocketServer.BaseRequestHandler):
+
+	def handle(self):
+		self.request.sendall(SSH_BANNER)
+
+
+
+class BannerServer(SocketServer.ThreadingMixIn, SocketServer.TCPServer):
+	daemon_threads = True
+	allow_reuse_address = True
+	request_queue_size = linode_api_simulator.LISTEN_BACKLOG
+
+
+
+# Returns a server that answers SSH probes of all loopback addresses, or None if an SSH
+# daemon that's already listening on all addresses will answer them.
+def start_ssh_banner():
+	try:
+		server = BannerServer(('', SSH_PORT), BannerHandler)
+	except socket.error as e:
+		try:
+			if e.errno == errno.EADDRINUSE and readiness_probe.probe_ssh('127.1.0.1', SSH_PORT, readiness_probe.PROBE_TIMEOUT):
+				return None
+		except (socket.error, socket.timeout):
+			pass
+		raise BenchmarkError("Unable to answer SSH probes of nodes on port %d: %s. Run as root, or with an SSH "
+			"daemon listening on all addresses." % (SSH_PORT, e))
+
+	thread = threading.Thread(target=server.serve_forever)
+	thread.daemon = True
+	thread.start()
+	return server
+
+
+
+def start_simulator(options):
+	sim_options = dict(linode_api_simulator.OPTIONS)
+	sim_options['job-scale'] = options['job-scale']
+	sim_options['latency'] = options['api-latency']
+	sim_options['loopback-ips'] = 1
+	simulator = linode_api_simulator.Simulator(sim_options)
+	server = linode_api_simulator.SimulatorServer(('127.0.0.1', 0), simulator)
+	thread = threading.Thread(target=server.serve_forever)
+	thread.daemon = True
+	thread.start()
+	return (simulator, server)
+
+
+
+def write_file(path, content, mode=0644):
+	with open(path, 'w') as f:
+		f.write(content)
+	os.chmod(path, mode)
+
+
+
+# Writes a configuration file as a copy of the example, with some of its values overridden.
+# Since the files are sourced, later assignments take precedence.
+def write_conf(path, example, values):
+	with open(example, 'r') as f:
+		content = f.read()
+	write_file(path, content + '\n# lifecycle_benchmark.py settings\n' +
+		''.join('%s="%s"\n' % (name, value) for name, value in values), 0600)
+
+
+
+class Workspace(object):
+
+	def __init__(self, options, size, api_url):
+		self.options = options
+		self.size = size
+		self.script_dir = os.getcwd()
+		self.dir = tempfile.mkdtemp(prefix='lifecycle-benchmark-')
+		self.bin_dir = self.path('bin')
+		self.state_dir = self.path('state')
+		self.cluster_dirs = []
+		for d in (self.bin_dir, self.state_dir, self.path('keys'), self.path('images'), self.path('dist')):
+			os.mkdir(d)
+
+		real_sleep = distutils.spawn.find_executable('sleep')
+		for name, body in STUBS.items():
+			write_file(os.path.join(self.bin_dir, name),
+				STUB_HEADER.replace('__NAME__', name) + body.replace('__SLEEP__', real_sleep), 0755)
+
+		self.private_key = self.path('keys/root')
+		self.public_key = self.path('keys/root.pub')
+		write_file(self.private_key, 'lifecycle benchmark private key\n', 0600)
+		write_file(self.public_key, 'ssh-rsa AAAAB3NzaC1yc2EAAAADAQABAAAAgQC0 bench@localhost\n')
+		write_file(self.path('keys/admin.pub'), 'ssh-rsa AAAAB3NzaC1yc2EAAAADAQABAAAAgQC1 admin@localhost\n')
+
+		self.api_env = self.path('api_env.conf')
+		write_file(self.api_env, 'export LINODE_KEY=bench\nexport LINODE_API_URL="%s"\n'
+			'export CLUSTER_MANAGER_NODE_PASSWORD=bench\n' % api_url, 0600)
+
+
+	def path(self, name):
+		return os.path.join(self.dir, name)
+
+
+	def script_path(self, name):
+		return os.path.join(self.script_dir, name)
+
+
+	# Creates a cluster directory in the scripts directory, named 'name' with a unique suffix.
+	def make_cluster_dir(self, name):
+		while True:
+			cluster_dir = self.script_path('%s-%s' % (name, os.urandom(3).encode('hex')))
+			try:
+				os.mkdir(cluster_dir)
+				break
+			except OSError as e:
+				if e.errno != errno.EEXIST:
+					raise
+		self.cluster_dirs.append(cluster_dir)
+		return cluster_dir
+
+
+	# Writes a stand-in distribution archive, with just the top directory of the real one.
+	def distribution(self, kind):
+		name, top_dir = DISTRIBUTIONS[kind]
+		path = self.path('dist/%s.tar.gz' % top_dir)
+		if not os.path.exists(path):
+			with tarfile.open(path, 'w:gz') as archive:
+				info = tarfile.TarInfo(top_dir)
+				info.type = tarfile.DIRTYPE
+				info.mode = 0755
+				archive.addfile(info)
+		return (name, path)
+
+
+	def create_image(self, simulator, kind, name):
+		image_dir = self.path('images/%s' % name)
+		os.mkdir(image_dir)
+		values = [
+			('IMAGE_ROOT_PASSWORD', BENCH_PASSWORD),
+			('IMAGE_ROOT_SSH_PUBLIC_KEY', self.public_key),
+			('IMAGE_ROOT_SSH_PRIVATE_KEY', self.private_key),
+			('IMAGE_ADMIN_PASSWORD', BENCH_PASSWORD),
+			('IMAGE_ADMIN_SSH_AUTHORIZED_KEYS', self.path('keys/admin.pub')),
+			self.distribution(kind)
+		]
+		if kind == 'storm':
+			values += [
+				('STORM_YAML_TEMPLATE', self.script_path('template-storm.yaml')),
+				('SUPERVISORD_TEMPLATE_CONF', self.script_path('template-storm-supervisord.conf'))
+			]
+		else:
+			# The zookeeper scripts expect these next to the image conf, as "new-image-conf" leaves them.
+			for template, copy in ZK_IMAGE_TEMPLATES:
+				shutil.copy(self.script_path(template), os.path.join(image_dir, copy))
+		example = 'storm-image-example.conf' if kind == 'storm' else 'zk-image-example.conf'
+		write_conf(os.path.join(image_dir, '%s.conf' % name), self.script_path(example), values)
+
+		image_id = simulator.add_image('%s image' % kind, 5000)
+		write_file(os.path.join(image_dir, '%s.info' % name), config_renderer.section('image', [str(image_id)]))
+		return image_dir
+
+
+	# Golden nodes are used only with --clone 1.
+	def golden_node_values(self, simulator, names):
+		if not self.options['clone']:
+			return []
+		return [(name, str(simulator.add_golden_node(PLAN_ID, GOLDEN_NODE_DATACENTER, GOLDEN_NODE_DISK_SIZE)))
+			for name in names]
+
+
+	def create_zk_cluster(self, simulator, image_dir, nodes):
+		cluster_dir = self.make_cluster_dir(ZK_CLUSTER)
+		write_conf(os.path.join(cluster_dir, '%s.conf' % os.path.basename(cluster_dir)), self.script_path('zk-cluster-example.conf'), self.golden_node_values(simulator, ['GOLDEN_NODE']) + [
+			('CLUSTER_SIZE', '%s:%d' % (PLAN, nodes)),
+			('ZK_IMAGE_CONF', image_dir),
+			('NODE_ROOT_PASSWORD', BENCH_PASSWORD),
+			('NODE_ROOT_SSH_PUBLIC_KEY', self.public_key),
+			('NODE_ROOT_SSH_PRIVATE_KEY', self.private_key),
+			('IPTABLES_V4_RULES_TEMPLATE', self.script_path('template-zk-iptables-rules.v4')),
+			('IPTABLES_V6_RULES_TEMPLATE', self.script_path('template-zk-iptables-rules.v6'))
+		])
+		return cluster_dir
+
+
+	def create_storm_cluster(self, simulator, image_dir, zk_cluster_dir, supervisors):
+		cluster_dir = self.make_cluster_dir(STORM_CLUSTER)
+		golden_nodes = self.golden_node_values(simulator, ['NIMBUS_GOLDEN_NODE', 'SUPERVISOR_GOLDEN_NODE', 'CLIENT_GOLDEN_NODE'])
+		if self.options['warm-pool']:
+			golden_nodes.append(('WARM_POOL_NODES', added_nodes_plan(supervisors + 2)))
+		write_conf(os.path.join(cluster_dir, '%s.conf' % os.path.basename(cluster_dir)), self.script_path('storm-cluster-example.conf'), golden_nodes + [
+			('NIMBUS_NODE', PLAN),
+			('SUPERVISOR_NODES', '%s:%d' % (PLAN, supervisors)),
+			('CLIENT_NODE', PLAN),
+			('STORM_IMAGE_CONF', image_dir),
+			('ZOOKEEPER_CLUSTER', zk_cluster_dir),
+			('NODE_ROOT_PASSWORD', BENCH_PASSWORD),
+			('NODE_ROOT_SSH_PUBLIC_KEY', self.public_key),
+			('NODE_ROOT_SSH_PRIVATE_KEY', self.private_key),
+			('IPTABLES_V4_RULES_TEMPLATE', self.script_path('template-storm-iptables-rules.v4')),
+			('IPTABLES_CLIENT_V4_RULES_TEMPLATE', self.script_path('template-storm-client-iptables-rules.v4')),
+			('IPTABLES_V6_RULES_TEMPLATE', self.script_path('template-storm-iptables-rules.v6'))
+		])
+		return cluster_dir
+
+
+	# Runs an operation of a cluster script with tracing, and returns (start, end, exit code).
+	def run(self, script, args, name):
+		env = dict(os.environ)
+		env.update({
+			'PATH' : self.bin_dir + os.pathsep + env.get('PATH', ''),
+			'BENCH_EVENTS' : self.path('%s.events' % name),
+			'BENCH_STATE' : self.state_dir,
+			'BENCH_SSH_SECONDS' : str(self.options['ssh-latency'] / 1000.0),
+			'BENCH_SLEEP_SCALE' : str(self.options['sleep-scale']),
+			'BENCH_XTRACE' : self.path('%s.xtrace' % name),
+			'LINODE_API_TRACE' : self.path('%s.api.jsonl' % name),
+			'LINODE_API_CACHE_DIR' : self.path('cache')
+		})
+		env.pop('LINODE_API_SOCKET', None)
+		open(env['BENCH_EVENTS'], 'a').close()
+
+		# The script is sourced by a shell that traces to its own file, so that its output isn't
+		# mixed with the trace. Nested scripts aren't traced, since they're run by a new shell.
+		command = 'exec 19>>"$BENCH_XTRACE"; BASH_XTRACEFD=19; PS4=\'%s\'; set -x; . ./"$0" "$@"' % XTRACE_PS4
+		with open(self.path('%s.log' % name), 'w') as log:
+			start = time.time()
+			exit_code = subprocess.call(['bash', '-c', command, script] + args, cwd=self.script_dir, env=env,
+				stdin=open(os.devnull, 'r'), stdout=log, stderr=subprocess.STDOUT)
+			end = time.time()
+		return (start, end, exit_code)
+
+
+	def output_tail(self, name, lines=20):
+		with open(self.path('%s.log' % name), 'r') as f:
+			return ''.join(f.readlines()[-lines:])
+
+
+	# Returns the lines of an operation's output that report errors, including those of nested
+	# scripts that the operation carried on after.
+	def error_lines(self, name):
+		with open(self.path('%s.log' % name), 'r') as f:
+			return [line.rstrip('\n') for line in f if 'Error:' in line]
+
+
+	def remove(self):
+		shutil.rmtree(self.dir, True)
+		for cluster_dir in self.cluster_dirs:
+			shutil.rmtree(cluster_dir, True)
+
+
+
+# Returns the events of an operation's xtrace: call spans of functions and nested scripts.
+def parse_xtrace(path, end):
+	events = []
+	# [name, start] of functions being called, outermost first.
+	frames = []
+	nested = None
+
+	def add(category, name, start, finish, depth):
+		events.append({'category' : category, 'name' : name, 'start' : start, 'end' : finish, 'depth' : depth})
+
+	def close(name, start, finish, depth):
+		if depth <= STEP_DEPTH:
+			add('step', name, start, finish, depth)
+		if name in FUNCTION_CATEGORIES:
+			add(FUNCTION_CATEGORIES[name], name, start, finish, depth)
+
+	with open(path, 'r') as f:
+		for line in f:
+			match = XTRACE_LINE.match(line.rstrip('\n'))
+			if match is None:
+				continue
+			t = float(match.group(1))
+			# FUNCNAME lists the innermost function first, and ends with "source" for the script itself.
+			# It's joined with the first character of IFS, which some functions change.
+			stack = [name for name in reversed(FUNCTION_NAME.findall(match.group(3))) if name not in ('source', 'main')]
+
+			# A nested script ends when its caller's next command starts.
+			if nested is not None:
+				add('step', nested[0], nested[1], t, nested[2])
+				nested = None
+
+			common = 0
+			while common < min(len(frames), len(stack)) and frames[common][0] == stack[common]:
+				common += 1
+			for depth in range(len(frames), common, -1):
+				close(frames[depth - 1][0], frames[depth - 1][1], t, depth)
+			frames = frames[:common] + [[name, t] for name in stack[common:]]
+
+			script = NESTED_SCRIPT.match(match.group(4))
+			if script is not None and len(stack) + 1 <= STEP_DEPTH:
+				nested = ('%s %s' % script.groups(), t, len(stack) + 1)
+
+	if nested is not None:
+		add('step', nested[0], nested[1], end, nested[2])
+	for depth in range(len(frames), 0, -1):
+		close(frames[depth - 1][0], frames[depth - 1][1], end, depth)
+	return events
+
+
+
+def parse_api_trace(path):
+	events = []
+	if os.path.exists(path):
+		with open(path, 'r') as f:
+			for line in f:
+				record = json.loads(line)
+				events.append({'category' : 'api', 'name' : record['action'], 'start' : record['start'],
+					'end' : record['start'] + record['ms'] / 1000.0})
+	return events
+
+
+
+def parse_stub_events(path):
+	events = []
+	with open(path, 'r') as f:
+		for line in f:
+			fields = line.rstrip('\n').split('\t', 3)
+			if len(fields) == 4:
+				events.append({'category' : fields[0], 'name' : fields[3], 'start' : float(fields[1]),
+					'end' : float(fields[2])})
+	return events
+
+
+
+# Returns the total length of the union of intervals.
+def busy_seconds(intervals):
+	busy = 0.0
+	current_start = current_end = None
+	for start, end in sorted(intervals):
+		if current_end is None or start > current_end:
+			if current_end is not None:
+				busy += current_end - current_start
+			current_start, current_end = start, end
+		else:
+			current_end = max(current_end, end)
+	if current_end is not None:
+		busy += current_end - current_start
+	return busy
+
+
+
+def run_operation(workspace, cluster, size, operation, args, keep_events):
+	name = operation
+	start, end, exit_code = workspace.run(SCRIPTS[cluster], [operation] + args, name)
+
+	events = parse_xtrace(workspace.path('%s.xtrace' % name), end) + \
+		parse_api_trace(workspace.path('%s.api.jsonl' % name)) + \
+		parse_stub_events(workspace.path('%s.events' % name))
+	for event in events:
+		event['start'] = round(event['start'] - start, 3)
+		event['seconds'] = round(max(0.0, event.pop('end') - start - event['start']), 3)
+	events.sort(key=lambda event: event['start'])
+
+	categories = {}
+	for category in CATEGORIES:
+		intervals = [(e['start'], e['start'] + e['seconds']) for e in events if e['category'] == category]
+		categories[category] = {
+			'count' : len(intervals),
+			'seconds' : round(sum(e - s for s, e in intervals), 3),
+			'busy' : round(busy_seconds(intervals), 3)
+		}
+
+	run = {
+		'cluster' : cluster,
+		'nodes' : size,
+		'operation' : operation,
+		'seconds' : round(end - start, 3),
+		'exit_code' : exit_code,
+		'errors' : workspace.error_lines(name),
+		'categories' : categories,
+		'steps' : [dict((k, e[k]) for k in ('name', 'depth', 'start', 'seconds')) for e in events if e['category'] == 'step']
+	}
+	if keep_events:
+		run['events'] = [e for e in events if e['category'] != 'step']
+	if run_failed(run):
+		run['output'] = workspace.output_tail(name)
+	return run
+
+
+
+# Reports saved before errors were recorded have no 'errors'.
+def run_failed(run):
+	return run['exit_code'] != 0 or bool(run.get('errors'))
+
+
+
+def bar(intervals, total):
+	cells = [' '] * GANTT_WIDTH
+	for start, seconds in intervals:
+		first = min(GANTT_WIDTH - 1, int(start / total * GANTT_WIDTH))
+		last = max(first + 1, int(math.ceil((start + seconds) / total * GANTT_WIDTH)))
+		for i in range(first, min(last, GANTT_WIDTH)):
+			cells[i] = '#'
+	return '|%s|' % ''.join(cells)
+
+
+
+def print_gantt(run):
+	total = max(run['seconds'], 0.001)
+	print
+	print '%s %s with %d nodes: %.1f seconds, exit code %d' % (run['cluster'], run['operation'], run['nodes'],
+		run['seconds'], run['exit_code'])
+	print '%-44s %8s %8s  %s' % ('Step', 'start', 'secs', '0s'.ljust(GANTT_WIDTH - 5) + ('%.0fs' % total).rjust(7))
+	for step in run['steps']:
+		print '%-44s %8.1f %8.1f  %s' % (('  ' * (step['depth'] - 1) + step['name'])[:44], step['start'],
+			step['seconds'], bar([(step['start'], step['seconds'])], total))
+
+	# Category rows show when any of their events was in progress, and for how long in all.
+	events = run.get('events')
+	print '%-44s %8s %8s' % ('Category', 'count', 'busy')
+	for category in CATEGORIES:
+		summary = run['categories'][category]
+		if summary['count'] == 0:
+			continue
+		intervals = [(e['start'], e['seconds']) for e in events if e['category'] == category] if events is not None \
+			else None
+		print '%-44s %8d %8.1f  %s' % (category, summary['count'], summary['busy'],
+			bar(intervals, total) if intervals is not None else '')
+
+	if run_failed(run):
+		if run['errors']:
+			print 'Errors:'
+			print '\n'.join(run['errors'])
+		print 'Output:'
+		print run['output']
+
+
+
+# Plan of the supervisor nodes that add-nodes adds to a cluster of 'size' nodes.
+def added_nodes_plan(size):
+	return '%s:%d' % (PLAN, max(1, size / 10))
+
+
+
+def benchmark_size(options, size):
+	cluster = options['cluster']
+	simulator, server = start_simulator(options)
+	workspace = Workspace(options, size, 'http://127.0.0.1:%d/' % server.server_address[1])
+	runs = []
+	try:
+		zk_image = workspace.create_image(simulator, 'zookeeper', 'bench-zk-image')
+		if cluster == 'storm':
+			zk_cluster = workspace.create_zk_cluster(simulator, zk_image, STORM_ZK_NODES)
+			storm_image = workspace.create_image(simulator, 'storm', 'bench-storm-image')
+			cluster_dir = workspace.create_storm_cluster(simulator, storm_image, zk_cluster, max(1, size - 2))
+		else:
+			cluster_dir = workspace.create_zk_cluster(simulator, zk_image, size)
+
+		operations = list(OPERATIONS[cluster])
+		if cluster == 'storm' and options['warm-pool']:
+			operations.insert(operations.index('add-nodes'), 'fill-pool')
+
+		for operation in operations:
+			args = [cluster_dir, workspace.api_env]
+			if operation == 'add-nodes':
+				args.append(added_nodes_plan(size))
+
+			# All events are needed for the chart, even if they're left out of the report.
+			run = run_operation(workspace, cluster, size, operation, args, True)
+			print_gantt(run)
+			if not options['events']:
+				del run['events']
+			runs.append(run)
+			sys.stdout.flush()
+			if run_failed(run):
+				break
+
+	finally:
+		server.shutdown()
+		server.server_close()
+		if options['keep']:
+			print 'Workspace of %d nodes kept in %s, with cluster directories %s' % (size, workspace.dir,
+				' '.join(workspace.cluster_dirs))
+		else:
+			workspace.remove()
+	return runs
+
+
+
+# Prints how each run compares with its baseline, and returns the number of regressions.
+def compare(runs, baseline, tolerance):
+	baseline_runs = dict(((run['cluster'], run['nodes'], run['operation']), run) for run in baseline['runs'])
+	regressions = 0
+	print
+	print '%-10s %-10s %6s %10s %10s %8s' % ('Cluster', 'Operation', 'Nodes', 'Baseline', 'Now', 'Change')
+	for run in runs:
+		base = baseline_runs.get((run['cluster'], run['nodes'], run['operation']))
+		if base is None:
+			print '%-10s %-10s %6d %10s %9.1fs %8s' % (run['cluster'], run['operation'], run['nodes'], '-', run['seconds'], 'new')
+			continue
+
+		change = run['seconds'] - base['seconds']
+		regressed = change > base['seconds'] * tolerance and change > REGRESSION_MIN_SECONDS
+		print '%-10s %-10s %6d %9.1fs %9.1fs %+7.0f%%%s' % (run['cluster'], run['operation'], run['nodes'],
+			base['seconds'], run['seconds'], 100.0 * change / max(base['seconds'], 0.001), '  REGRESSION' if regressed else '')
+		if regressed:
+			regressions += 1
+			# The categories that account for most of the slowdown.
+			growth = sorted(((run['categories'][c]['busy'] - base['categories'].get(c, {}).get('busy', 0), c)
+				for c in CATEGORIES), reverse=True)
+			print '    ' + ', '.join('%s %+.1fs' % (c, secs) for secs, c in growth[:3] if secs > 0)
+	return regressions
+
+
+
+def parse_options(args):
+	options = dict(OPTIONS)
+	while args:
+		name = args[0][2:] if args[0].startswith('--') else None
+		if name not in options or len(args) < 2:
+			raise ValueError("Invalid option '%s'" % args[0])
+		try:
+			options[name] = type(OPTIONS[name])(args[1])
+		except ValueError:
+			raise ValueError("Invalid value '%s' of option %s" % (args[1], args[0]))
+		args = args[2:]
+
+	if options['cluster'] not in SCRIPTS:
+		raise ValueError("Invalid cluster '%s'. It should be storm or zookeeper" % options['cluster'])
+	sizes = options['sizes']
+	options['sizes'] = [int(size) for size in sizes.split(',')]
+	if min(options['sizes']) < (3 if options['cluster'] == 'storm' else 1):
+		raise ValueError("Invalid sizes '%s'. Storm clusters need at least 3 nodes" % sizes)
+	if options['sleep-scale'] < 0:
+		options['sleep-scale'] = options['job-scale']
+	return options
+
+
+
+def main():
+	try:
+		options = parse_options(sys.argv[1:])
+	except ValueError as e:
+		print "Error: %s" % e
+		print "Usage: lifecycle_benchmark.py [--cluster storm|zookeeper] [--sizes <n>[,<n>...]] [--job-scale <factor>] " \
+			"[--sleep-scale <factor>] [--api-latency <ms>] [--ssh-latency <ms>] [--clone 0|1] [--warm-pool 0|1] [--report <file>] [--baseline <file>] " \
+			"[--tolerance <fraction>] [--events 0|1] [--keep 0|1]"
+		sys.exit(1)
+
+	settings = dict((name, options[name]) for name in SETTINGS)
+	try:
+		baseline = None
+		if options['baseline']:
+			with open(options['baseline'], 'r') as f:
+				baseline = json.load(f)
+			if baseline.get('settings') != settings:
+				raise BenchmarkError("Baseline %s was made with different settings %s" % (options['baseline'],
+					json.dumps(baseline.get('settings'), sort_keys=True)))
+
+		script = SCRIPTS[options['cluster']]
+		if not os.access(script, os.X_OK) or not os.access('linode_api.py', os.X_OK):
+			raise BenchmarkError("Run from the storm-linode directory, after making its scripts executable")
+
+		threading.stack_size(linode_api_simulator.THREAD_STACK_SIZE)
+		banner = start_ssh_banner()
+
+	except (BenchmarkError, IOError, OSError, ValueError) as e:
+		print "Error: %s" % e
+		sys.exit(1)
+
+	runs = []
+	try:
+		for size in options['sizes']:
+			runs += benchmark_size(options, size)
+	except (BenchmarkError, IOError, OSError) as e:
+		print "Error: %s" % e
+		sys.exit(1)
+	finally:
+		if banner is not None:
+			banner.shutdown()
+			banner.server_close()
+
+	report = {
+		'created' : time.strftime('%Y-%m-%d %H:%M:%S'),
+		'settings' : settings,
+		'clone' : options['clone'],
+		'warm-pool' : options['warm-pool'],
+		'runs' : runs
+	}
+	if options['report']:
+		with open(options['report'], 'w') as f:
+			json.dump(report, f, indent=1, sort_keys=True)
+		print 'Report saved in %s' % options['report']
+
+	failed = len([run for run in runs if run_failed(run)])
+	regressions = compare(runs, baseline, options['tolerance']) if baseline is not None else 0
+	if failed:
+		print '%d operations failed' % failed
+	if regressions:
+		print '%d operations regressed from baseline %s' % (regressions, options['baseline'])
+	sys.exit(1 if failed or regressions else 0)
+
+
+
+if __name__ == '__main__':
+	main()
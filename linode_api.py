@@ -2,37 +2,820 @@
 
 import urllib
 import urllib2
+import httplib
+import urlparse
+import socket
+import errno
+import hashlib
+import tempfile
+import threading
+import Queue
+import SocketServer
+import StringIO
+import traceback
+import time
 import json
 import os
 import sys
 import re
-import datetime
+import atexit
+import fcntl
 import operator
-
-# TODO Check out the requests module which claims it's better than ("the thoroughly broken") urllib2
+import random
+import math
 
 
 API_PRODUCTION_URL = 'https://api.linode.com/'
 API_SIMULATOR_URL = 'http://localhost:5000/'
 api_key = None
 url = API_SIMULATOR_URL
-LOG = False
 
-def linode_request(action, params):
-	data={
-		'api_key' : api_key,
-		'api_action' : action
+# Connection pool settings of the shared API client. They can be overridden with
+# the LINODE_API_POOL_SIZE, LINODE_API_TIMEOUT and LINODE_API_RETRIES environment variables.
+POOL_SIZE = 4
+TIMEOUT = 60
+RETRIES = 2
+
+# Maximum number of actions sent in a single 'api.batch' request. It can be overridden
+# with the LINODE_API_BATCH_SIZE environment variable.
+BATCH_SIZE = 25
+
+# Requests are paced by a token bucket shared by all threads, that allows RATE_LIMIT requests
+# per second on average with bursts of upto RATE_BURST requests. A RATE_LIMIT of 0 disables pacing.
+# Requests that are throttled by the API, or fail with one of the RETRY_HTTP_STATUSES (or for
+# read-only actions, READ_ONLY_RETRY_HTTP_STATUSES), are retried upto MAX_RETRIES times, with
+# exponential backoff from RETRY_BASE_DELAY seconds upto RETRY_MAX_DELAY seconds, and jitter
+# so that concurrent threads don't retry in lockstep.
+# They can be overridden with LINODE_API_RATE_LIMIT, LINODE_API_RATE_BURST and 
+# LINODE_API_MAX_RETRIES environment variables.
+RATE_LIMIT = 5
+RATE_BURST = 10
+MAX_RETRIES = 5
+RETRY_BASE_DELAY = 1.0
+RETRY_MAX_DELAY = 30.0
+
+# Linode API error codes which mean the request was not acted upon and can be sent again:
+# 12 (batch approaching timeout, for the remaining actions of a batch) and 14 (rate limit exceeded).
+RETRY_ERROR_CODES = (12, 14)
+# HTTP statuses for rate limiting and unavailability, which mean the request was not acted upon.
+RETRY_HTTP_STATUSES = (429, 503)
+# HTTP statuses from proxies, which may be returned even after the API acted on a request.
+# They're retried only for actions that don't change anything, so that a linode or disk 
+# isn't created twice.
+READ_ONLY_RETRY_HTTP_STATUSES = (502, 504)
+
+# Size of chunks in which list responses are read by RecordStream.
+STREAM_CHUNK_SIZE = 65536
+
+# Every API request is traced as a line of JSON in the file given by the LINODE_API_TRACE
+# environment variable, if it's set. Each record has the action, start time, latency, bytes
+# sent and received, and error codes, along with the request parameters except for the values
+# of TRACE_REDACTED_PARAMS. Records are buffered, and appended to the file when TRACE_BUFFER_RECORDS
+# of them are pending or the oldest is TRACE_BUFFER_SECONDS old, and at exit.
+# Run "./linode_api.py stats <trace file>" to summarize a trace.
+TRACE_REDACTED_PARAMS = ('api_key', 'rootPass', 'rootSSHKey')
+TRACE_BUFFER_RECORDS = 100
+TRACE_BUFFER_SECONDS = 5
+
+# Poll intervals in seconds used by wait_jobs. The interval doubles after every poll
+# from the first interval until it reaches the maximum.
+WAIT_JOBS_FIRST_INTERVAL = 2
+WAIT_JOBS_MAX_INTERVAL = 15
+
+# Plan IDs of the plan names used in cluster configuration files.
+PLAN_IDS = {
+	'2GB' : 1,
+	'4GB' : 2,
+	'8GB' : 4,
+	'12GB' : 6,
+	'24GB' : 7,
+	'48GB' : 8,
+	'64GB' : 9,
+	'80GB' : 10,
+	'120GB' : 12
+}
+
+# Maximum number of nodes that provision-nodes takes through their stages at the same time,
+# and how long it waits for each node's disk jobs.
+PROVISION_CONCURRENCY = 8
+PROVISION_JOB_TIMEOUT = 480
+
+# Statuses in linode.list of linodes that can be cloned: 0 (brand new, never booted) and 2 (powered off).
+CLONEABLE_NODE_STATUSES = (0, 2)
+
+# Linodes of a warm pool are provisioned from an image and left powered off in the pool's
+# display group, so that a cluster can claim them with just a relabel. While being provisioned,
+# they're in the pool's display group suffixed with this, and moved into the pool only when
+# they're ready, so that half provisioned linodes are never claimed.
+WARM_POOL_FILLING_SUFFIX = '-filling'
+# Linodes being provisioned for a pool are labelled filling-<start time>-<linode ID>. One that's
+# still there this many seconds after it was started was left behind by an interrupted fill. It's
+# not counted as being provisioned, and the next fill deletes it.
+WARM_POOL_FILLING_TIMEOUT = PROVISION_JOB_TIMEOUT + 300
+
+# The shared client used by all the API functions below. It's created on first use,
+# because api_key and url are known only after the environment is read.
+client = None
+client_lock = threading.Lock()
+
+# The operations that create, change and wait for linodes run the coroutines of the same name in
+# linode_api_async. All threads run them on one event loop thread with one async client, so that
+# commands of a server share its pooled connections. Both are created on first use.
+loop_thread = None
+async_client = None
+async_lock = threading.Lock()
+
+# The shared token bucket, created on first use like the client.
+rate_limiter = None
+
+# The shared tracer, created on first use like the client.
+tracer = None
+
+# Counters of requests, retries, waits for the rate limiter and requests that were given up
+# after all retries, for this process. In serve mode, they're cumulative for the server.
+counters = {
+	'requests' : 0,
+	'retries' : 0,
+	'throttle_waits' : 0,
+	'throttle_wait_seconds' : 0.0,
+	'give_ups' : 0
+}
+counters_lock = threading.Lock()
+
+# Catalogs returned by these actions rarely change, so their responses are cached on disk
+# in CATALOG_CACHE_DIR for CATALOG_CACHE_TTL seconds, shared across invocations. Cache files
+# are separate for each API URL so that simulator and production catalogs don't mix.
+# Both can be overridden with the LINODE_API_CACHE_DIR and LINODE_API_CACHE_TTL environment
+# variables. A TTL of 0 disables the cache.
+CATALOG_ACTIONS = ('avail.datacenters', 'avail.distributions', 'avail.kernels', 'avail.linodeplans')
+CATALOG_CACHE_DIR = '~/.storm-linode'
+CATALOG_CACHE_TTL = 24 * 3600
+
+# image.list is cached the same way, but for no more than IMAGE_CACHE_TTL seconds since images
+# change more often. It's invalidated whenever an image is created or deleted through this module.
+IMAGE_CACHE_TTL = 3600
+
+# Key fields of each catalog's records used to index them: the ID field, followed by
+# label fields that can be used to look up a record. The first label field is the
+# one that's searched for partial matches. Descriptions of records that have them are
+# indexed separately, so that a label lookup never matches another record's description.
+CATALOG_INDEX_KEYS = {
+	'avail.datacenters' : ('DATACENTERID', ('LOCATION', 'ABBR')),
+	'avail.distributions' : ('DISTRIBUTIONID', ('LABEL',)),
+	'avail.kernels' : ('KERNELID', ('LABEL',)),
+	'avail.linodeplans' : ('PLANID', ('LABEL',)),
+	'image.list' : ('IMAGEID', ('LABEL',))
+}
+
+# Images built by the cluster scripts have a fingerprint of everything they were built from
+# in their description, as IMAGE_FINGERPRINT_PREFIX followed by the fingerprint, so that an 
+# image built from the same inputs can be found and reused.
+IMAGE_FINGERPRINT_PREFIX = 'fingerprint:'
+
+# Account limit on total size of images, in MB. Before an image is built, least recently
+# used images with fingerprints are deleted until all images, along with the new one, fit
+# within IMAGE_GC_THRESHOLD of the limit. 
+IMAGE_QUOTA_MB = 10240
+IMAGE_GC_THRESHOLD = 0.9
+
+# Catalog responses and their indexes already loaded by this process, keyed by (url, action).
+loaded_catalogs = {}
+catalog_indexes = {}
+
+
+# A HTTP client which keeps a pool of persistent (keep-alive) connections to the
+# API endpoint, so that successive API calls reuse an open TCP/TLS connection instead
+# of paying for a new connection and TLS handshake every time.
+# It's thread safe; at most 'pool_size' requests are in flight at any time, and callers
+# beyond that wait for a connection to be released.
+class LinodeClient(object):
+
+	def __init__(self, api_url, key, pool_size=POOL_SIZE, timeout=TIMEOUT, retries=RETRIES, keep_alive=True):
+		self.api_url = api_url
+		self.key = key
+		self.pool_size = pool_size
+		self.timeout = timeout
+		self.retries = retries
+		self.keep_alive = keep_alive
+		
+		parts = urlparse.urlsplit(api_url)
+		self.scheme = parts.scheme
+		self.host = parts.hostname
+		self.port = parts.port
+		self.path = parts.path or '/'
+		
+		self._idle = Queue.LifoQueue()
+		self._slots = threading.BoundedSemaphore(pool_size)
+
+	
+	def _new_connection(self):
+		if self.scheme == 'https':
+			return httplib.HTTPSConnection(self.host, self.port, timeout=self.timeout)
+		return httplib.HTTPConnection(self.host, self.port, timeout=self.timeout)
+
+
+	def _acquire(self):
+		self._slots.acquire()
+		try:
+			return self._idle.get_nowait(), True
+		except Queue.Empty:
+			return self._new_connection(), False
+
+
+	def _release(self, conn, reusable):
+		if reusable and self.keep_alive:
+			self._idle.put(conn)
+		else:
+			conn.close()
+		self._slots.release()
+
+
+	def _headers(self):
+		return {
+			'Content-Type' : 'application/x-www-form-urlencoded',
+			'Connection' : 'keep-alive' if self.keep_alive else 'close'
+		}
+
+
+	# Sends an already urlencoded request body and returns the raw response body.
+	# A request that fails because the server closed or reset a connection is retried
+	# on a fresh connection, up to 'retries' times.
+	def send(self, body):
+		attempt = 0
+		while True:
+			conn, reused = self._acquire()
+			try:
+				conn.request('POST', self.path, body, self._headers())
+				response = conn.getresponse()
+				data = response.read()
+				
+			except (httplib.BadStatusLine, httplib.IncompleteRead, socket.error) as e:
+				self._release(conn, False)
+				if attempt >= self.retries or not is_connection_reset(e, reused):
+					raise
+				attempt += 1
+				continue
+				
+			except:
+				self._release(conn, False)
+				raise
+			
+			self._release(conn, not response.will_close)
+			
+			if response.status != 200:
+				raise urllib2.HTTPError(self.api_url, response.status, response.reason, response.msg, None)
+			
+			return data
+
+
+	# Like send(), but yields the response body in chunks of upto 'chunk_size' bytes as they
+	# arrive, instead of reading all of it into memory. A request is retried only if it fails
+	# before any of the body is received. If the caller stops iterating early, rest of the 
+	# body is read and discarded, so that the connection can still be reused.
+	def stream(self, body, chunk_size=STREAM_CHUNK_SIZE):
+		attempt = 0
+		while True:
+			conn, reused = self._acquire()
+			try:
+				conn.request('POST', self.path, body, self._headers())
+				response = conn.getresponse()
+				
+			except (httplib.BadStatusLine, socket.error) as e:
+				self._release(conn, False)
+				if attempt >= self.retries or not is_connection_reset(e, reused):
+					raise
+				attempt += 1
+				continue
+				
+			except:
+				self._release(conn, False)
+				raise
+				
+			break
+			
+		if response.status != 200:
+			response.read()
+			self._release(conn, not response.will_close)
+			raise urllib2.HTTPError(self.api_url, response.status, response.reason, response.msg, None)
+		
+		reusable = False
+		try:
+			while True:
+				chunk = response.read(chunk_size)
+				if not chunk:
+					break
+				yield chunk
+			reusable = not response.will_close
+			
+		except GeneratorExit:
+			try:
+				while response.read(chunk_size):
+					pass
+				reusable = not response.will_close
+			except (httplib.HTTPException, socket.error):
+				pass
+			raise
+			
+		finally:
+			self._release(conn, reusable)
+
+
+	def encode_request(self, action, params):
+		data={
+			'api_key' : self.key,
+			'api_action' : action
+		}
+		if params is not None:
+			data.update(params)
+		return urllib.urlencode(data)
+
+
+	def request(self, action, params):
+		body = self.encode_request(action, params)
+		start = time.time()
+		try:
+			data = self.send(body)
+		except Exception as e:
+			trace(action, params, start, len(body), 0, [exception_error_code(e)])
+			raise
+		
+		resp = json.loads(data)
+		trace(action, params, start, len(body), len(data), response_error_codes(resp))
+		return resp
+
+
+	def close(self):
+		while True:
+			try:
+				self._idle.get_nowait().close()
+			except Queue.Empty:
+				return
+
+
+
+# A stale keep-alive connection that the server has already closed shows up as an
+# empty status line or a connection reset. Those, and failures to connect at all,
+# are safe to retry. Timeouts are not, because the server may still act on the request.
+def is_connection_reset(e, reused):
+	if isinstance(e, (httplib.BadStatusLine, httplib.IncompleteRead)):
+		return reused
+	if isinstance(e, socket.timeout):
+		return False
+	return e.errno in (errno.ECONNRESET, errno.EPIPE, errno.ECONNREFUSED, errno.ECONNABORTED)
+
+
+
+def get_client():
+	global client
+	with client_lock:
+		if client is None:
+			client = LinodeClient(url, api_key, 
+				pool_size=int(os.getenv('LINODE_API_POOL_SIZE', POOL_SIZE)),
+				timeout=float(os.getenv('LINODE_API_TIMEOUT', TIMEOUT)),
+				retries=int(os.getenv('LINODE_API_RETRIES', RETRIES)))
+		return client
+
+
+
+# linode_api_async imports this module, so it's imported on first use rather than at the top.
+def async_module():
+	import linode_api_async
+	return linode_api_async
+
+
+
+def get_loop_thread():
+	global loop_thread
+	with async_lock:
+		if loop_thread is None:
+			loop_thread = async_module().LoopThread()
+		return loop_thread
+
+
+
+# Returns the async client on the shared event loop thread. A new one is created if the
+# API environment has changed since the last one was created.
+def get_async_client():
+	global async_client
+	loop = get_loop_thread()
+	with async_lock:
+		if async_client is not None and (async_client.api_url, async_client.key) != (url, api_key):
+			# Its connections are closed by the loop, since they may still be in use there.
+			loop.call_soon_threadsafe(async_client.close)
+			async_client = None
+			
+		if async_client is None:
+			async_client = async_module().AsyncLinodeClient(url, api_key, 
+				pool_size=int(os.getenv('LINODE_API_POOL_SIZE', POOL_SIZE)),
+				timeout=float(os.getenv('LINODE_API_TIMEOUT', TIMEOUT)),
+				retries=int(os.getenv('LINODE_API_RETRIES', RETRIES)),
+				loop=loop.loop)
+		return async_client
+
+
+
+# Runs operation(api, *args), one of the coroutines of linode_api_async, to completion on the
+# shared event loop thread and returns its result. Calls that the operation puts in the 
+# 'calls' queue are run on this thread while it waits, as described in LoopThread.run().
+def run_async(operation, *args, **kwargs):
+	return get_loop_thread().run(operation(get_async_client(), *args), kwargs.get('calls'))
+
+
+
+# Token bucket rate limiter. It's thread safe, and threads get tokens in the order
+# they ask for them, because a token can be reserved before it's available.
+class TokenBucket(object):
+
+	def __init__(self, rate, burst):
+		self.rate = float(rate)
+		self.burst = float(burst)
+		self.tokens = self.burst
+		self.updated = time.time()
+		self.lock = threading.Lock()
+
+
+	# Reserves a token and returns the number of seconds to wait before using it.
+	def reserve(self):
+		with self.lock:
+			now = time.time()
+			self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+			self.updated = now
+			self.tokens -= 1
+			return -self.tokens / self.rate if self.tokens < 0 else 0
+
+
+	# Takes a token, waiting till one is available. Returns the number of seconds waited.
+	def take(self):
+		wait = self.reserve()
+		if wait > 0:
+			time.sleep(wait)
+		return wait
+
+
+
+def count(name, value=1):
+	with counters_lock:
+		counters[name] += value
+
+
+# Returns the shared rate limiter, or None if pacing is disabled.
+def get_rate_limiter():
+	global rate_limiter
+	with client_lock:
+		if rate_limiter is None:
+			rate = float(os.getenv('LINODE_API_RATE_LIMIT', RATE_LIMIT))
+			burst = float(os.getenv('LINODE_API_RATE_BURST', RATE_BURST))
+			rate_limiter = TokenBucket(rate, burst) if rate > 0 else False
+		return rate_limiter or None
+
+
+# Buffers trace records of API requests and appends them to a trace file in one write.
+# It's thread safe, and the file is opened only once.
+class Tracer(object):
+
+	def __init__(self, path):
+		self.path = path
+		self.file = None
+		self.pending = []
+		self.oldest = None
+		self.lock = threading.Lock()
+
+
+	def record(self, rec):
+		line = json.dumps(rec, separators=(',',':'), sort_keys=True) + '\n'
+		with self.lock:
+			if not self.pending:
+				self.oldest = time.time()
+			self.pending.append(line)
+			if len(self.pending) >= TRACE_BUFFER_RECORDS or time.time() - self.oldest >= TRACE_BUFFER_SECONDS:
+				self._write()
+
+
+	def flush(self):
+		with self.lock:
+			self._write()
+
+
+	def _write(self):
+		if not self.pending:
+			return
+		try:
+			if self.file is None:
+				self.file = open(self.path, 'a')
+			self.file.write(''.join(self.pending))
+			self.file.flush()
+		except IOError as e:
+			print >> sys.stderr, "Unable to write API trace to %s: %s" % (self.path, e)
+		self.pending = []
+
+
+
+# Returns the shared tracer, or None if tracing is disabled.
+def get_tracer():
+	global tracer
+	with client_lock:
+		if tracer is None:
+			path = os.getenv('LINODE_API_TRACE', '')
+			tracer = Tracer(os.path.expanduser(path)) if path else False
+			if tracer:
+				atexit.register(tracer.flush)
+		return tracer or None
+
+
+def flush_trace():
+	if tracer:
+		tracer.flush()
+
+
+# Returns a copy of request parameters safe to write to a trace. Actions of a batch
+# request are redacted too.
+def redact_params(params):
+	redacted = {}
+	for key, value in params.items():
+		if key in TRACE_REDACTED_PARAMS:
+			value = '***'
+		elif key == 'api_requestArray':
+			try:
+				value = [redact_params(req) for req in json.loads(value)]
+			except (ValueError, TypeError, AttributeError):
+				value = '***'
+		redacted[key] = value
+	return redacted
+
+
+# Returns the error codes in a response, or in each response of a batch.
+def response_error_codes(resp):
+	responses = resp if isinstance(resp, list) else [resp]
+	codes = []
+	for r in responses:
+		if isinstance(r, dict):
+			codes.extend(error.get('ERRORCODE') for error in r.get('ERRORARRAY', []))
+	return codes
+
+
+# Returns the error code recorded in a trace for a request that failed with an exception.
+def exception_error_code(e):
+	if isinstance(e, urllib2.HTTPError):
+		return 'http-%d' % e.code
+	if isinstance(e, socket.timeout):
+		return 'timeout'
+	if isinstance(e, EnvironmentError) and e.errno in errno.errorcode:
+		return errno.errorcode[e.errno]
+	return e.__class__.__name__
+
+
+# Records a request in the trace, if tracing is enabled.
+#	start : Time when the request was sent.
+#	errors : Error codes from the response, or the exception that failed the request.
+def trace(action, params, start, bytes_out, bytes_in, errors):
+	t = get_tracer()
+	if t is None:
+		return
+	rec = {
+		'action' : action,
+		'start' : round(start, 3),
+		'ms' : round((time.time() - start) * 1000, 2),
+		'out' : bytes_out,
+		'in' : bytes_in
 	}
-	if params is not None:
-		data.update(params)
-	data = urllib.urlencode(data)
-	req = urllib2.Request(url, data)
-	response = urllib2.urlopen(req)
-	response = response.read()	
-	respobj = json.loads(response)
-	if LOG:
-		log(req, respobj)
-	return respobj
+	if errors:
+		rec['errors'] = errors
+	if params:
+		rec['params'] = redact_params(params)
+	t.record(rec)
+
+
+# Waits for the shared rate limiter before a request is sent.
+def throttle():
+	count('requests')
+	limiter = get_rate_limiter()
+	if limiter:
+		waited = limiter.take()
+		if waited > 0:
+			count('throttle_waits')
+			count('throttle_wait_seconds', waited)
+
+
+# Returns True if the response says the request was rate limited or otherwise not acted upon.
+def is_throttled(response):
+	if not isinstance(response, dict):
+		return False
+	for error in response.get('ERRORARRAY', []):
+		if error.get('ERRORCODE') in RETRY_ERROR_CODES:
+			return True
+	return False
+
+
+# Returns True if an action only reads, like linode.list or avail.datacenters. A batch is
+# read-only if all its actions are.
+def is_read_only_action(action, params=None):
+	if action == 'api.batch':
+		try:
+			requests = json.loads(params['api_requestArray'])
+			return all(is_read_only_action(req['api_action']) for req in requests)
+		except (ValueError, KeyError, TypeError):
+			return False
+			
+	return action.endswith('.list') or action.startswith('avail.') or action == 'test.echo'
+
+
+def is_retryable_http_error(e, action, params=None):
+	if not isinstance(e, urllib2.HTTPError):
+		return False
+	if e.code in RETRY_HTTP_STATUSES:
+		return True
+	return e.code in READ_ONLY_RETRY_HTTP_STATUSES and is_read_only_action(action, params)
+	
+
+# Returns seconds to wait before retry number 'attempt' + 1 of a request, or None if all 
+# retries have been used up. 'http_error' may be the HTTPError that failed the request, 
+# whose Retry-After header is honored. 
+def retry_delay(attempt, http_error=None):
+	if attempt >= int(os.getenv('LINODE_API_MAX_RETRIES', MAX_RETRIES)):
+		return None
+		
+	delay = min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * (2 ** attempt))
+	delay = delay / 2 + random.uniform(0, delay / 2)
+	if http_error is not None and http_error.hdrs is not None:
+		retry_after = http_error.hdrs.get('Retry-After')
+		if retry_after and retry_after.isdigit():
+			delay = max(delay, float(retry_after))
+	return delay
+
+
+# Waits before retry number 'attempt' + 1 of a request.
+# Returns: True after waiting, or False without waiting if all retries have been used up.
+def retry_wait(attempt, http_error=None):
+	delay = retry_delay(attempt, http_error)
+	if delay is None:
+		count('give_ups')
+		return False
+	
+	count('retries')
+	time.sleep(delay)
+	return True
+
+
+
+def linode_request(action, params):
+	attempt = 0
+	while True:
+		throttle()
+		try:
+			respobj = get_client().request(action, params)
+		except urllib2.HTTPError as e:
+			if not is_retryable_http_error(e, action, params) or not retry_wait(attempt, e):
+				raise
+			attempt += 1
+			continue
+			
+		if is_throttled(respobj) and retry_wait(attempt):
+			attempt += 1
+			continue
+			
+		return respobj
+
+
+def catalog_cache_file():
+	cache_dir = os.path.expanduser(os.getenv('LINODE_API_CACHE_DIR', CATALOG_CACHE_DIR))
+	return os.path.join(cache_dir, 'catalog-%s.json' % hashlib.sha1(url).hexdigest()[:16])
+
+
+def read_catalog_cache():
+	try:
+		with open(catalog_cache_file(), 'r') as cache_file:
+			return json.load(cache_file)
+	except (IOError, ValueError):
+		return {}
+		
+
+# Replaces the cache file atomically, so concurrent readers never see a partial file.
+def write_catalog_cache(cache):
+	cache_path = catalog_cache_file()
+	cache_dir = os.path.dirname(cache_path)
+	try:
+		if not os.path.isdir(cache_dir):
+			os.makedirs(cache_dir, 0700)
+		fd, temp_path = tempfile.mkstemp(dir=cache_dir, prefix='.catalog')
+		with os.fdopen(fd, 'w') as cache_file:
+			json.dump(cache, cache_file, separators=(',',':'))
+		os.rename(temp_path, cache_path)
+	except (IOError, OSError) as e:
+		# Caching is only an optimization, so failure to write the cache isn't an error.
+		print >> sys.stderr, "Warning: Unable to write catalog cache:", e
+
+
+# Returns the response of a catalog action from the cache if it's not older than
+# the TTL, or else fetches it and updates the cache. Error responses are not cached.
+def catalog_request(action):
+	ttl = float(os.getenv('LINODE_API_CACHE_TTL', CATALOG_CACHE_TTL))
+	if action == 'image.list':
+		ttl = min(ttl, IMAGE_CACHE_TTL)
+	if ttl <= 0:
+		return linode_request(action, None)
+	
+	now = time.time()
+	entry = loaded_catalogs.get((url, action))
+	if entry is None or not 0 <= now - entry['time'] < ttl:
+		cache = read_catalog_cache()
+		entry = cache.get(action)
+		if entry is None or not 0 <= now - entry['time'] < ttl:
+			resp = linode_request(action, None)
+			iserr, errors = is_error(resp)
+			if iserr:
+				return resp
+			
+			entry = {'time' : now, 'response' : resp}
+			cache[action] = entry
+			write_catalog_cache(cache)
+			
+		loaded_catalogs[(url, action)] = entry
+		
+	return entry['response']
+
+
+# Returns the CatalogIndex of a cached catalog. It's rebuilt only when the catalog is refetched.
+def catalog_index(action):
+	resp = catalog_request(action)
+	cached = catalog_indexes.get((url, action))
+	if cached is None or cached[0] is not resp:
+		id_key, label_keys = CATALOG_INDEX_KEYS[action]
+		cached = (resp, CatalogIndex(resp['DATA'], id_key, label_keys))
+		catalog_indexes[(url, action)] = cached
+	return cached[1]
+
+
+# Deletes the cached catalog of 'action', or of all actions if it's None.
+def invalidate_catalog_cache(action=None):
+	if action is not None:
+		loaded_catalogs.pop((url, action), None)
+		cache = read_catalog_cache()
+		if cache.pop(action, None) is not None:
+			write_catalog_cache(cache)
+		return
+	
+	for key in [key for key in loaded_catalogs if key[0] == url]:
+		del loaded_catalogs[key]
+	try:
+		os.remove(catalog_cache_file())
+	except OSError as e:
+		if e.errno != errno.ENOENT:
+			raise
+
+
+
+# Indexes the records of a catalog like avail.kernels or image.list, so that lookups
+# by ID or label take constant time instead of a scan of the whole catalog.
+# Labels are indexed in lowercase, since lookups ignore case. When several records have
+# the same ID or label, the first one in catalog order wins, as it did with a scan.
+class CatalogIndex(object):
+
+	def __init__(self, records, id_key, label_keys):
+		self.records = records
+		self.label_key = label_keys[0]
+		self.by_id = {}
+		self.by_label = {}
+		self.by_description = {}
+		self.labels = []
+		self.searches = {}
+		for record in records:
+			self.by_id.setdefault(record[id_key], record)
+			for key in label_keys:
+				if record.get(key):
+					self.by_label.setdefault(record[key].lower(), record)
+			if record.get('DESCRIPTION'):
+				self.by_description.setdefault(record['DESCRIPTION'], record)
+			self.labels.append((record[self.label_key].lower(), record))
+
+
+	# Returns the record with ID 'value' if it's numeric, or else the record with any
+	# label equal to 'value' ignoring case. Returns None if there's no such record.
+	def find(self, value):
+		if value.isdigit():
+			return self.by_id.get(int(value))
+		return self.by_label.get(value.lower())
+
+
+	# Returns the record whose description is exactly 'value', or None if there's no such record.
+	def find_description(self, value):
+		return self.by_description.get(value)
+
+
+	# Returns records whose label contains 'text' ignoring case, in catalog order.
+	# Results are remembered, since the same partial labels are looked up repeatedly.
+	def search(self, text):
+		text = text.lower()
+		matches = self.searches.get(text)
+		if matches is None:
+			matches = [record for label, record in self.labels if text in label]
+			self.searches[text] = matches
+		return matches
+
+
+	# Returns records whose label matches the regular expression 'pattern', in catalog order.
+	def filter(self, pattern):
+		regex = re.compile(pattern)
+		return [record for record in self.records if regex.search(record[self.label_key])]
 
 
 def is_error(response):
@@ -41,15 +824,232 @@ def is_error(response):
 		
 	return (False, None)
 	
-def log(req, resp):
-	with open('linode_api.log', 'a') as log_file:
-		log_file.write("\n\n----%s\n[REQUEST] %s %s\n[RESPONSE]\n" 
-			% (str(datetime.datetime.now()), req.get_full_url(), req.get_data()))
-		json.dump(resp, log_file, indent=4, separators=(',',':'))
+# Parses JSON text incrementally from an iterator of string chunks, reading more
+# chunks only as values need them, so that large values can be parsed one element 
+# at a time.
+class JSONStreamReader(object):
+
+	WHITESPACE = re.compile(r'[ \t\n\r]*')
+
+	def __init__(self, chunks):
+		self.chunks = iter(chunks)
+		self.received = 0
+		self.buf = ''
+		self.pos = 0
+		self.eof = False
+		self.decoder = json.JSONDecoder()
+
+
+	# Appends the next chunk to the buffer, discarding already parsed text.
+	def _read_more(self):
+		try:
+			chunk = next(self.chunks)
+		except StopIteration:
+			self.eof = True
+			return False
+		self.received += len(chunk)
+		self.buf = self.buf[self.pos:] + chunk
+		self.pos = 0
+		return True
+
+
+	# Skips whitespace and returns the next character without consuming it, or '' at the end.
+	def peek(self):
+		while True:
+			self.pos = self.WHITESPACE.match(self.buf, self.pos).end()
+			if self.pos < len(self.buf):
+				return self.buf[self.pos]
+			if not self._read_more():
+				return ''
+
+
+	def expect(self, char):
+		if self.peek() != char:
+			raise ValueError('Expected %r at offset %d of JSON stream' % (char, self.pos))
+		self.pos += 1
+
+
+	# Parses the complete JSON value at the current position. A value that ends exactly at
+	# the end of buffer, like a number, may continue in the next chunk, so it's parsed again
+	# after reading more.
+	def value(self):
+		self.peek()
+		while True:
+			try:
+				value, end = self.decoder.raw_decode(self.buf, self.pos)
+				if end < len(self.buf) or self.eof:
+					self.pos = end
+					return value
+			except ValueError:
+				if self.eof:
+					raise
+			self._read_more()
+
+
+
+# Iterates the records in DATA of a list action's response as they're received and parsed,
+# without reading the whole response into memory. If 'fields' is given, only those fields
+# of each record are kept. Other top level keys of the response, like ERRORARRAY, are 
+# available in 'response' after iteration.
+class RecordStream(object):
+
+	def __init__(self, action, params, fields=None):
+		self.action = action
+		self.params = params
+		self.fields = fields
+		self.response = {}
+		
+		
+	# Throttled or failed requests are retried like in linode_request, but only if
+	# no records have been yielded yet.
+	def __iter__(self):
+		attempt = 0
+		while True:
+			self.response = {}
+			received = 0
+			try:
+				for record in self._records():
+					received += 1
+					yield record
+					
+			except urllib2.HTTPError as e:
+				if received or not is_retryable_http_error(e, self.action, self.params) or not retry_wait(attempt, e):
+					raise
+				attempt += 1
+				continue
+				
+			if not received and is_throttled(self.response) and retry_wait(attempt):
+				attempt += 1
+				continue
+				
+			return
+
+
+	def _records(self):
+		throttle()
+		body = get_client().encode_request(self.action, self.params)
+		start = time.time()
+		chunks = get_client().stream(body)
+		reader = JSONStreamReader(chunks)
+		errors = []
+		try:
+			reader.expect('{')
+			while reader.peek() != '}':
+				if reader.peek() == ',':
+					reader.expect(',')
+					continue
+					
+				key = reader.value()
+				reader.expect(':')
+				if key != 'DATA' or reader.peek() != '[':
+					self.response[key] = reader.value()
+					continue
+				
+				reader.expect('[')
+				while reader.peek() != ']':
+					if reader.peek() == ',':
+						reader.expect(',')
+						continue
+					
+					record = reader.value()
+					if self.fields is not None:
+						record = dict([(f, record[f]) for f in self.fields if f in record])
+					yield record
+				reader.expect(']')
+			
+			errors = response_error_codes(self.response)
+			
+		except Exception as e:
+			errors = [exception_error_code(e)]
+			raise
+			
+		finally:
+			chunks.close()
+			trace(self.action, self.params, start, len(body), reader.received, errors)
+
+
+	def errors(self):
+		return self.response.get('ERRORARRAY', [])
+
+
+
+# Prints records in the same format as json.dumps(records, indent=4, separators=(',',':')),
+# but one record at a time, so that records can be streamed.
+def print_json_records(records):
+	first = True
+	for record in records:
+		text = json.dumps(record, indent=4, separators=(',',':')).replace('\n', '\n    ')
+		sys.stdout.write('[\n    ' if first else ',\n    ')
+		sys.stdout.write(text)
+		first = False
 		
+	print '[]' if first else '\n]'
+	
+
+
+# Sends several API actions in as few round-trips as possible, using 'api.batch'.
+# 'requests' is a list of (action, params) tuples. They're sent in chunks of at most
+# 'batch_size' actions, because the API rejects batches that are too large.
+# Returns: A list with one (success, data) tuple per request, in the same order.
+#	On success, data is the action's DATA. On failure, it's the action's ERRORARRAY.
+def batch_request(requests, batch_size=None):
+	if batch_size is None:
+		batch_size = int(os.getenv('LINODE_API_BATCH_SIZE', BATCH_SIZE))
+	
+	results = []
+	for start in range(0, len(requests), batch_size):
+		chunk = requests[start:start + batch_size]
 		
+		request_array = []
+		for action, params in chunk:
+			req = {'api_action' : action}
+			if params is not None:
+				req.update(params)
+			request_array.append(req)
+			
+		# Actions that were throttled, or not run because the batch was about to time out,
+		# are sent again in another batch after a backoff.
+		chunk_results = [None] * len(chunk)
+		todo = range(len(chunk))
+		attempt = 0
+		while todo:
+			resp = linode_request('api.batch', 
+				{'api_requestArray' : json.dumps([request_array[i] for i in todo])})
+			
+			# An error in the batch request itself, like an invalid API key, is 
+			# returned as a single response instead of a list, and applies to all actions.
+			if isinstance(resp, dict):
+				iserr, errors = is_error(resp)
+				for i in todo:
+					chunk_results[i] = (False, errors)
+				break
+			
+			retry = []
+			for i, action_resp in zip(todo, resp):
+				iserr, errors = is_error(action_resp)
+				if iserr:
+					chunk_results[i] = (False, errors)
+					if is_throttled(action_resp):
+						retry.append(i)
+				else:
+					chunk_results[i] = (True, action_resp['DATA'])
+			
+			for i in todo[len(resp):]:
+				action = chunk[i][0]
+				chunk_results[i] = (False, [{'ERRORCODE' : -1, 'ERRORMESSAGE' : 'No response for %s in batch' % action}])
+			
+			if not retry or not retry_wait(attempt):
+				break
+			todo = retry
+			attempt += 1
+			
+		results.extend(chunk_results)
+			
+	return results
+
+
 def list_datacenters(format='raw'):
-	data = linode_request('avail.datacenters', None)
+	data = catalog_request('avail.datacenters')
 	dcs = data['DATA']
 	
 	if format == 'table':
@@ -66,25 +1066,15 @@ def list_datacenters(format='raw'):
 	
 # This returns the data centter id given a location or abbr or the ID itself.
 def get_datacenter(datacenter):
-	dcs = linode_request('avail.datacenters', None)['DATA']
-	if datacenter.isdigit():
-		datacenter = int(datacenter)
-		for dc in dcs:
-			if dc['DATACENTERID'] == datacenter:
-				# It's a valid datacenter.
-				return datacenter
+	dc = catalog_index('avail.datacenters').find(datacenter)
+	if dc is None:
 		return None
-	
-	datacenter = datacenter.lower()
-	for dc in dcs:
-		if dc['LOCATION'].lower() == datacenter or dc['ABBR'].lower() == datacenter:
-			return dc['DATACENTERID']
-	
-	return None
+		
+	return dc['DATACENTERID']
 
 
 def list_plans(format='table'):
-	data=linode_request('avail.linodeplans', None)
+	data=catalog_request('avail.linodeplans')
 	plans=data['DATA']
 	if format=='table':
 		for plan in plans:
@@ -95,15 +1085,10 @@ def list_plans(format='table'):
 
 
 def list_distributions(filter=None, format='raw'):
-	data=linode_request('avail.distributions', None)
-	distros=data['DATA']
+	index = catalog_index('avail.distributions')
+	distros = index.records
 	if filter and filter is not '':
-		filter=filter.lower()
-		filtered=list()
-		for distro in distros:
-			if (filter in distro['LABEL'].lower()):
-				filtered.append(distro)
-		distros = filtered
+		distros = index.search(filter)
 		
 	if format=='table':
 		print '%-5s%-30s%-9s' % ('ID', 'LABEL', '64/32-bit')
@@ -118,22 +1103,11 @@ def list_distributions(filter=None, format='raw'):
 
 # This returns the distribution id and label given its label or just the ID itself.
 def find_distribution(distribution):
-	distros = linode_request('avail.distributions', None)['DATA']
-	if distribution.isdigit():
-		distribution = int(distribution)
-		for distro in distros:
-			if distro['DISTRIBUTIONID'] == distribution:
-				# It's a valid distribution.
-				return (distribution, distro['LABEL'])
-				
+	distro = catalog_index('avail.distributions').find(distribution)
+	if distro is None:
 		return (None, None)
-	
-	distribution = distribution.lower()
-	for distro in distros:
-		if distro['LABEL'].lower() == distribution:
-			return (distro['DISTRIBUTIONID'], distro['LABEL'])
-	
-	return (None, None)
+		
+	return (distro['DISTRIBUTIONID'], distro['LABEL'])
 
 
 def list_all_stackscripts(filter=None):
@@ -168,14 +1142,10 @@ def stackscript(script_id):
 
 
 def list_kernels(version_filter_regex=None, format='raw'):
-	data=linode_request('avail.kernels', None)
-	kernels=data['DATA']
+	index = catalog_index('avail.kernels')
+	kernels = index.records
 	if version_filter_regex and version_filter_regex is not '':
-		filtered=list()
-		for kernel in kernels:
-			if re.search(version_filter_regex, kernel['LABEL']):
-				filtered.append(kernel)
-		kernels = filtered
+		kernels = index.filter(version_filter_regex)
 		
 	if format == 'table':
 		print '%-5s%-50s%-5s%-5s' % ('ID', 'LABEL', 'KVM', 'Xen')
@@ -190,44 +1160,34 @@ def list_kernels(version_filter_regex=None, format='raw'):
 
 
 # This returns the kernel id and label given its partial/full label or just the ID itself.
+# A full label match is preferred over partial matches.
 def find_kernel(kernel):
-	kernels = linode_request('avail.kernels', None)['DATA']
-	if kernel.isdigit():
-		kernel = int(kernel)
-		for k in kernels:
-			if k['KERNELID'] == kernel:
-				# It's a valid kernel.
-				return (kernel, k['LABEL'])
-				
+	index = catalog_index('avail.kernels')
+	k = index.find(kernel)
+	if k is None and not kernel.isdigit():
+		# Return the first partial match
+		matches = index.search(kernel)
+		if matches:
+			k = matches[0]
+			
+	if k is None:
 		return (None, None)
 	
-	kernel = kernel.lower()
-	for k in kernels:
-		# Return the first partial or full match
-		if kernel in k['LABEL'].lower():
-			return (k['KERNELID'], k['LABEL'])
-	
-	return (None, None)
+	return (k['KERNELID'], k['LABEL'])
 
 
 
 def list_nodes(linode_id=None):
 	if linode_id:
-		data=linode_request('linode.list', {'LinodeID':linode_id})
+		nodes=RecordStream('linode.list', {'LinodeID':linode_id})
 	else:
-		data=linode_request('linode.list', None)
+		nodes=RecordStream('linode.list', None)
 		
-	nodes=data['DATA']
-	print json.dumps(nodes, indent=4, separators=(',',':'))
+	print_json_records(nodes)
 
 
 def get_node_memory(linode_id):
-	resp = linode_request('linode.list', {'LinodeID':linode_id})
-	nodes = resp['DATA']
-	if nodes and len(nodes) > 0:
-		return nodes[0]["TOTALRAM"]
-		
-	return None
+	return run_async(async_module().get_node_memory, linode_id)
 
 
 def list_jobs(linode_id):
@@ -239,31 +1199,17 @@ def list_jobs(linode_id):
 
 def list_ip_addresses(linode_id):
 	if linode_id == -1:
-		data=linode_request('linode.ip.list', None)
+		addresses=RecordStream('linode.ip.list', None)
 	else:
-		data=linode_request('linode.ip.list', {'LinodeID':linode_id})
-	addresses=data['DATA']
-	print json.dumps(addresses, indent=4, separators=(',',':'))
+		addresses=RecordStream('linode.ip.list', {'LinodeID':linode_id})
+	print_json_records(addresses)
 
 
 def get_public_ip_address(linode_id):
-	resp = linode_request('linode.ip.list', {'LinodeID':linode_id})
-	addresses = resp['DATA']
-	for address in addresses:
-		if address['ISPUBLIC'] == 1:
-			return address['IPADDRESS']
-			
-	return None
+	return run_async(async_module().get_public_ip_address, linode_id)
 
 def add_private_ip(linode_id):
-	resp = linode_request('linode.ip.addprivate', {'LinodeID':linode_id})
-	iserr, errors = is_error(resp)
-	if iserr:
-		return (False, errors)
-	
-	address = resp['DATA']
-		
-	return (True, address['IPADDRESS'])
+	return run_async(async_module().add_private_ip, linode_id)
 		
 
 def job(linode_id, job_id):
@@ -278,16 +1224,76 @@ def is_job_finished(linode_id, job_id):
 	#	True, True : Job is successfully completed
 	#	True, False: Job failed
 	#	None, None : No such job
-	data = linode_request('linode.job.list', {'LinodeID':linode_id, 'JobID':job_id})
-	jobs = data['DATA']
-	if jobs: 
-		job = jobs[0]
-		if job['HOST_SUCCESS'] == '':
-			return (False, None)
-	
-		return (True, False if job['HOST_SUCCESS'] == 0 else True)
+	return run_async(async_module().is_job_finished, linode_id, job_id)
+	
+
+# Returns the (finished, success) state of a job record from linode.job.list,
+# with the same values as is_job_finished.
+def job_state(job):
+	if job['HOST_SUCCESS'] == '':
+		return (False, None)
+
+	return (True, False if job['HOST_SUCCESS'] == 0 else True)
+
+
+# Waits for several jobs together, possibly across many linodes. Each poll 
+# fetches only the pending jobs of each linode, all in one batched request, and then
+# the results of just the jobs that have finished since the last poll.
+# The first polls are quick because jobs like boot and shutdown often finish
+# in a few seconds, and later polls back off up to WAIT_JOBS_MAX_INTERVAL.
+#
+# 'jobs' is a list of (linode_id, job_id) tuples.
+# 'on_finished' is called as on_finished(linode_id, job_id, status) as each job finishes,
+#	where status is 1 if job completed, 2 if it failed, and 3 if its status could not be found.
+# Returns: List of (linode_id, job_id) tuples of jobs that are still pending after timeout.
+def wait_jobs(jobs, timeout, on_finished):
+	pending = list(jobs)
+	deadline = time.time() + timeout
+	interval = WAIT_JOBS_FIRST_INTERVAL
+	
+	while pending:
+		linode_ids = sorted(set([linode_id for linode_id, job_id in pending]))
+		results = batch_request([('linode.job.list', {'LinodeID' : linode_id, 'pendingOnly' : 1}) 
+			for linode_id in linode_ids])
+		
+		still_pending = set()
+		failed_linodes = set()
+		for linode_id, (success, data) in zip(linode_ids, results):
+			if not success:
+				failed_linodes.add(linode_id)
+				continue
+			still_pending.update([(linode_id, job['JOBID']) for job in data])
+		
+		finished = []
+		for linode_id, job_id in pending:
+			if linode_id in failed_linodes:
+				on_finished(linode_id, job_id, 3)
+			elif (linode_id, job_id) not in still_pending:
+				finished.append((linode_id, job_id))
+		pending = [job for job in pending if job in still_pending]
+		
+		# Pending job lists don't say whether a finished job succeeded, so fetch those.
+		results = batch_request([('linode.job.list', {'LinodeID' : linode_id, 'JobID' : job_id}) 
+			for linode_id, job_id in finished])
+		for (linode_id, job_id), (success, data) in zip(finished, results):
+			if not success or not data:
+				on_finished(linode_id, job_id, 3)
+				continue
+				
+			done, job_success = job_state(data[0])
+			if not done:
+				pending.append((linode_id, job_id))
+			else:
+				on_finished(linode_id, job_id, 1 if job_success else 2)
 		
-	return (None,None)
+		remaining = deadline - time.time()
+		if not pending or remaining <= 0:
+			break
+			
+		time.sleep(min(interval, remaining))
+		interval = min(interval * 2, WAIT_JOBS_MAX_INTERVAL)
+		
+	return pending
 		
 
 def list_disks(linode_id):
@@ -309,81 +1315,78 @@ def create_node(plan, datacenter, do_validations=True):
 		if datacenter is None:
 			return (False, ['Invalid datacenter'])
 		
-	resp = linode_request('linode.create', 
-		{
-			'PLANID' : plan,
-			'DATACENTERID' : datacenter
-		}
-	)
-	
-	iserr, errors = is_error(resp)
-	if iserr:
-		return (False, errors)
-		
-	linode_id = resp['DATA']['LinodeID']
-	return (True, linode_id)
+	return run_async(async_module().create_node, plan, datacenter)
 
 
 
 def update_node(linode_id, label, display_group):
-	resp = linode_request('linode.update', 
-		{
-			'LinodeID' : linode_id,
-			'Label' : label,
-			'lpm_displayGroup' : display_group
-		}
-	)
-	
-	iserr, errors = is_error(resp)
-	if iserr:
-		return (False, errors)
-		
-	linode_id = resp['DATA']['LinodeID']
-	return (True, linode_id)
+	return run_async(async_module().update_node, linode_id, label, display_group)
 
 
 
 def delete_node(linode_id, skip_checks):
-	resp = linode_request('linode.delete', 
-		{
-			'LinodeID' : linode_id,
-			'skipChecks' : skip_checks
-		}
-	)
-	
-	iserr, errors = is_error(resp)
-	if iserr:
-		return (False, errors)
-		
-	linode_id = resp['DATA']['LinodeID']
-	return (True, linode_id)
+	return run_async(async_module().delete_node, linode_id, skip_checks)
 
 
 # skip_checks should be 0 to not skip checks, or 1 to skip.
-def delete_all_nodes(skip_checks):
-	linodes = linode_request('linode.list', None)['DATA']
+def delete_nodes(linode_ids, skip_checks):
+	results = batch_request([('linode.delete', {'LinodeID' : linode_id, 'skipChecks' : skip_checks}) 
+		for linode_id in linode_ids])
 	
 	deleted_linodes = []
 	all_errors = []
 	
-	for linode in linodes:
-		linode_id = linode['LINODEID']
-		resp = linode_request('linode.delete', 
-			{
-				'LinodeID' : linode_id,
-				'skipChecks' : skip_checks
-			}
-		)
-		
-		iserr, errors = is_error(resp)
-		if iserr:
-			all_errors.append(errors)
-		else:	
+	for linode_id, (success, data) in zip(linode_ids, results):
+		if success:
 			deleted_linodes.append(linode_id)
+		else:
+			all_errors.append(data)
 	
 	return (deleted_linodes, all_errors)
 
 
+# skip_checks should be 0 to not skip checks, or 1 to skip.
+def delete_all_nodes(skip_checks):
+	linodes = RecordStream('linode.list', None, ('LINODEID',))
+	
+	return delete_nodes([linode['LINODEID'] for linode in linodes], skip_checks)
+
+
+# Gets the linode.list details of each linode, along with its IP addresses
+# under an 'IPADDRESSES' key, using batched requests.
+def get_nodes_info(linode_ids):
+	requests = []
+	for linode_id in linode_ids:
+		requests.append(('linode.list', {'LinodeID' : linode_id}))
+		requests.append(('linode.ip.list', {'LinodeID' : linode_id}))
+	
+	results = batch_request(requests)
+	
+	nodes = []
+	all_errors = []
+	
+	for i, linode_id in enumerate(linode_ids):
+		node_success, node_data = results[2 * i]
+		ip_success, ip_data = results[2 * i + 1]
+		if not node_success:
+			all_errors.append(node_data)
+			continue
+			
+		if not ip_success:
+			all_errors.append(ip_data)
+			continue
+			
+		if not node_data:
+			all_errors.append('No such linode: %d' % linode_id)
+			continue
+			
+		node = node_data[0]
+		node['IPADDRESSES'] = ip_data
+		nodes.append(node)
+	
+	return (nodes, all_errors)
+
+
 def create_disk(linode_id, distribution, disk_size, root_password, root_ssh_key_file):
 	# From https://www.linode.com/api/linode/linode.disk.create
 	# 'distribution' is optional. If distribID is not included, it boots up, goes 
@@ -418,18 +1421,7 @@ def create_disk(linode_id, distribution, disk_size, root_password, root_ssh_key_
 
 
 
-def create_swap_disk(linode_id):
-	# From https://www.linode.com/api/linode/linode.disk.create
-	
-	# Calculate swap size based on RAM.
-	# - 2GB of RAM or less            = 2 x RAM
-	# - 2GB to 8GB of RAM             = RAM
-	# - 8GB to 64GB of RAM            = At least 4 GB to 0.5 x RAM
-	# - 64GB of RAM or more           = At least 4 GB
-	# References:
-	#	http://askubuntu.com/questions/49109/i-have-16gb-ram-do-i-need-32gb-swap and 
-	#	https://access.redhat.com/documentation/en-US/Red_Hat_Enterprise_Linux/7/html/Installation_Guide/sect-disk-partitioning-setup-x86.html#sect-recommended-partitioning-scheme-x86
-	ram_mb = int(get_node_memory(linode_id))
+def swap_disk_size(ram_mb):
 	swap_disk_size_mb = 2048
 	if 1024 <= ram_mb <= 2048:
 		swap_disk_size_mb = 2 * ram_mb
@@ -442,21 +1434,20 @@ def create_swap_disk(linode_id):
 	
 	elif ram_mb > 32768:
 		swap_disk_size_mb = 32768;
-	
-	params={
-		'LinodeID' : linode_id,
-		'Type' : 'swap',
-		'Size' : swap_disk_size_mb,
-		'Label' : 'swapdisk'
-	}
-	resp = linode_request('linode.disk.create', params)
-	iserr, errors = is_error(resp)
-	if iserr:
-		return (False, errors)
-	
-	job_id = resp['DATA']['JobID']
-	disk_id = resp['DATA']['DiskID']
-	return (True, (disk_id, job_id) )
+		
+	return swap_disk_size_mb
+
+
+def create_swap_disk(linode_id):
+	# Calculate swap size based on RAM.
+	# - 2GB of RAM or less            = 2 x RAM
+	# - 2GB to 8GB of RAM             = RAM
+	# - 8GB to 64GB of RAM            = At least 4 GB to 0.5 x RAM
+	# - 64GB of RAM or more           = At least 4 GB
+	# References:
+	#	http://askubuntu.com/questions/49109/i-have-16gb-ram-do-i-need-32gb-swap and 
+	#	https://access.redhat.com/documentation/en-US/Red_Hat_Enterprise_Linux/7/html/Installation_Guide/sect-disk-partitioning-setup-x86.html#sect-recommended-partitioning-scheme-x86
+	return run_async(async_module().create_swap_disk, linode_id)
 
 
 
@@ -468,30 +1459,8 @@ def create_disk_from_distribution(linode_id, distribution, disk_size, root_passw
 	if distribution_id is None:
 		return (False, ['Invalid distribution'])
 		
-	public_key = ''
-	if root_ssh_key_file:
-		with open(root_ssh_key_file, 'r') as idfile:
-			public_key = idfile.read()
-			
-		public_key = public_key.replace('\n', '')
-	
-	# From https://www.linode.com/api/linode/linode.disk.createfromdistribution
-	params={
-		'LinodeID' : linode_id,
-		'DistributionID' : distribution_id,
-		'rootPass' : root_password, 
-		'rootSSHKey' : public_key,
-		'Label' : distribution_label,
-		'Size' : disk_size
-	}
-	resp = linode_request('linode.disk.createfromdistribution', params)
-	iserr, errors = is_error(resp)
-	if iserr:
-		return (False, errors)
-	
-	job_id = resp['DATA']['JobID']
-	disk_id = resp['DATA']['DiskID']
-	return (True, (disk_id, job_id) )
+	return run_async(async_module().create_disk_from_distribution, linode_id, distribution_id,
+		distribution_label, disk_size, root_password, root_ssh_key_file)
 
 
 def create_disk_from_stackscript(linode_id, stackscript_id, distribution, root_password, root_ssh_key_file):
@@ -525,22 +1494,8 @@ def create_disk_from_stackscript(linode_id, stackscript_id, distribution, root_p
 	print resp
 
 
-def create_diskimage(linode_id, disk_id, image_label):
-	# https://www.linode.com/api/linode/linode.disk.imagize
-	resp=linode_request('linode.disk.imagize', 
-		{
-			'LinodeID' : linode_id,
-			'DiskID' : disk_id,
-			'Label' : image_label
-		}
-	)
-	iserr, errors = is_error(resp)
-	if iserr:
-		return (False, errors)
-	
-	job_id = resp['DATA']['JobID']
-	image_id = resp['DATA']['ImageID']
-	return (True, (image_id, job_id))
+def create_diskimage(linode_id, disk_id, image_label, description=''):
+	return run_async(async_module().create_diskimage, linode_id, disk_id, image_label, description)
 
 
 def list_diskimages():
@@ -551,34 +1506,91 @@ def list_diskimages():
 
 def image_stats():
 	# https://www.linode.com/api/image/image.list
-	response = linode_request('image.list', None)
-	images = response['DATA']
-	image_count = len(images)
+	image_count = 0
 	total_image_size = 0
-	for i in images:
+	for i in RecordStream('image.list', None, ('MINSIZE',)):
+		image_count += 1
 		total_image_size += i['MINSIZE']
 	return image_count,total_image_size
 
 
 
+# Looks up an image by ID or label, or by description if 'by_description' is True, in the 
+# cached image.list. Images that aren't in the cache may have been created since it was cached,
+# so on a miss it's fetched again.
+# Returns: The image's record, or None.
+def find_image_record(image, by_description=False):
+	resp = catalog_request('image.list')
+	iserr, errors = is_error(resp)
+	if iserr:
+		return None
+	
+	find = lambda: (catalog_index('image.list').find_description(image) if by_description 
+		else catalog_index('image.list').find(image))
+	img = find()
+	if img is None:
+		invalidate_catalog_cache('image.list')
+		img = find()
+	return img
+
+
 # This returns the image id and image label given its label or just the ID itself.
 def find_image(image):
-	images = linode_request('image.list', None)['DATA']
-	if image.isdigit():
-		image = int(image)
-		for img in images:
-			if img['IMAGEID'] == image:
-				# It's a valid image.
-				return (image, img['LABEL'])
-				
+	img = find_image_record(image)
+	if img is None:
 		return (None, None)
+		
+	return (img['IMAGEID'], img['LABEL'])
+
+
+# Finds an available image built from inputs with the given fingerprint. Since the image
+# may have been deleted since image.list was cached, a cached match is checked with the API.
+# Returns: The image's record, or None if there's no such image.
+def find_image_by_fingerprint(fingerprint):
+	description = IMAGE_FINGERPRINT_PREFIX + fingerprint
+	img = find_image_record(description, True)
+	if img is None:
+		return None
 	
-	image = image.lower()
-	for img in images:
-		if img['LABEL'].lower() == image:
-			return (img['IMAGEID'], img['LABEL'])
+	resp = linode_request('image.list', {'ImageID' : img['IMAGEID']})
+	iserr, errors = is_error(resp)
+	if iserr or not resp['DATA'] or resp['DATA'][0].get('DESCRIPTION') != description:
+		invalidate_catalog_cache('image.list')
+		img = catalog_index('image.list').find_description(description)
+	return img
+
+
+# Deletes least recently used images with fingerprints, until all images and a new image 
+# of 'needed_size' MB fit within IMAGE_GC_THRESHOLD of 'quota' MB. Images without fingerprints
+# weren't built by the cluster scripts, and are never deleted. Neither are images with IDs in
+# 'in_use', like the images recorded in image status files that clusters are created from.
+# Returns: (list of (image ID, label, size) of images deleted, or that would be deleted if
+# 'dry_run' is True, and a list of errors).
+def gc_images(needed_size, quota=IMAGE_QUOTA_MB, dry_run=False, in_use=()):
+	images = list(RecordStream('image.list', None, 
+		('IMAGEID', 'LABEL', 'DESCRIPTION', 'MINSIZE', 'CREATE_DT', 'LAST_USED_DT')))
+	total_size = sum(img['MINSIZE'] for img in images)
+	limit = quota * IMAGE_GC_THRESHOLD
+	
+	# Images that have never been used count as used when they were created.
+	candidates = [img for img in images if img.get('DESCRIPTION', '').startswith(IMAGE_FINGERPRINT_PREFIX)
+		and img['IMAGEID'] not in in_use]
+	candidates.sort(key=lambda img: img.get('LAST_USED_DT') or img.get('CREATE_DT', ''))
+	
+	evicted = []
+	all_errors = []
+	for img in candidates:
+		if total_size + needed_size <= limit:
+			break
+		if not dry_run:
+			success, data = delete_image(img['IMAGEID'])
+			if not success:
+				all_errors.append(data)
+				continue
+		evicted.append((img['IMAGEID'], img['LABEL'], img['MINSIZE']))
+		total_size -= img['MINSIZE']
 	
-	return (None, None)
+	return (evicted, all_errors)
 
 
 def delete_image(image_id):
@@ -587,57 +1599,43 @@ def delete_image(image_id):
 	if iserr:
 		return (False, errors)
 	
+	invalidate_catalog_cache('image.list')
 	return (True, image_id)
 	
 
 def delete_all_images():
-	images = linode_request('image.list', None)['DATA']
+	images = RecordStream('image.list', None, ('IMAGEID',))
+	image_ids = [img['IMAGEID'] for img in images]
+	
+	results = batch_request([('image.delete', {'ImageID' : img_id}) for img_id in image_ids])
+	invalidate_catalog_cache('image.list')
 	
 	deleted_images = []
 	all_errors = []
 	
-	for img in images:
-		img_id = img['IMAGEID']
-		resp = linode_request('image.delete', {'ImageID' : img_id})
-		
-		iserr, errors = is_error(resp)
-		if iserr:
-			all_errors.append(errors)
-		else:	
+	for img_id, (success, data) in zip(image_ids, results):
+		if success:
 			deleted_images.append(img_id)
+		else:
+			all_errors.append(data)
 	
 	return (deleted_images, all_errors)
 
 
-def create_disk_from_image(linode_id, image_id, label, disk_size, root_password, root_ssh_key_file):
-	# Note: This assumes the image_id is valid.
-	
+def read_public_key(root_ssh_key_file):
 	public_key = ''
 	if root_ssh_key_file:
 		with open(root_ssh_key_file, 'r') as idfile:
 			public_key = idfile.read()
 		
 		public_key = public_key.replace('\n', '')
-	
+	return public_key
 
-	# From https://www.linode.com/api/linode/linode.disk.createfromimage
-	params={
-		'ImageID' : image_id,
-		'LinodeID' : linode_id,
-		'rootPass' : root_password,
-		'rootSSHKey' : public_key,
-		'Label' : label,
-		'Size' : disk_size
-	}
-	resp = linode_request('linode.disk.createfromimage', params)
-	iserr, errors = is_error(resp)
-	if iserr:
-		return (False, errors)
-	
-	# For 'creatediskfromimage', the returned keys are uppercase, not lowercase.
-	job_id = resp['DATA']['JOBID']
-	disk_id = resp['DATA']['DISKID']
-	return (True, (disk_id, job_id) )
+
+def create_disk_from_image(linode_id, image_id, label, disk_size, root_password, root_ssh_key_file):
+	# Note: This assumes the image_id is valid.
+	return run_async(async_module().create_disk_from_image, linode_id, image_id, label, disk_size,
+		root_password, root_ssh_key_file)
 
 
 def create_config(linode_id, kernel, disks, config_label, do_validations=True):
@@ -648,21 +1646,7 @@ def create_config(linode_id, kernel, disks, config_label, do_validations=True):
 	else:
 		kernel_id = kernel
 	
-	linode_id = int(linode_id)
-	
-	params={
-		'LinodeID' : linode_id,
-		'KernelID' : kernel_id, 
-		'Label' : config_label,
-		'DiskList' : disks
-	}
-	resp = linode_request('linode.config.create', params)
-	iserr, errors = is_error(resp)
-	if iserr:
-		return (False, errors)
-	
-	config_id = resp['DATA']['ConfigID']
-	return (True, config_id )
+	return run_async(async_module().create_config, linode_id, kernel_id, disks, config_label)
 
 	
 
@@ -686,490 +1670,1776 @@ def create_stackscript(script_file):
 
 
 def boot_node(linode_id, config_id=None):
-	params = {'LinodeID':linode_id}
-	if config_id:
-		params['ConfigID'] = config_id
-		
-	resp = linode_request('linode.boot', params)
+	return run_async(async_module().boot_node, linode_id, config_id)
+
+
+
+
+def shutdown_node(linode_id):
+	return run_async(async_module().shutdown_node, linode_id)
+
+
+
+# Clones a linode, with all its disks and configuration profiles, into a new linode with the
+# given plan in the given datacenter. The new linode is ready once its pending jobs finish.
+# Returns: (True, new linode ID) on success, or (False, errors) on failure.
+def clone_node(linode_id, plan_id, datacenter_id):
+	params={
+		'LinodeID' : linode_id,
+		'PlanID' : plan_id,
+		'DatacenterID' : datacenter_id # It's possible to clone a linode to a different datacenter.
+	}
+	resp=linode_request('linode.clone', params)
 	iserr, errors = is_error(resp)
 	if iserr:
 		return (False, errors)
 	
-	job_id = resp['DATA']['JobID']
-	return (True, job_id)
+	return (True, resp['DATA']['LinodeID'])
 
 
 
-
-def shutdown_node(linode_id):
-	resp = linode_request('linode.shutdown', {'LinodeID':linode_id})
+# Returns: (True, IDs of jobs of a linode that haven't finished) on success, or (False, errors) on failure.
+def pending_job_ids(linode_id):
+	resp = linode_request('linode.job.list', {'LinodeID':linode_id, 'pendingOnly':1})
 	iserr, errors = is_error(resp)
 	if iserr:
 		return (False, errors)
 	
-	job_id = resp['DATA']['JobID']
-	return (True, job_id)
+	return (True, [job['JOBID'] for job in resp['DATA']])
 
 
 
-def clone_node(linode_id):
-	params={
-		'LinodeID' : linode_id,
-		'DatacenterID' : 9, # Note: It seems it's possible to clone a linode to a different datacenter.
-		'PlanID' : 1
-	}
-	resp=linode_request('linode.clone', params)
-	print resp
-#=============================================================
-
-if len(sys.argv) <= 1:
-	print "No command"
-	sys.exit(0)
-
-api_key = os.getenv('LINODE_KEY', None)
-if (api_key is None):
-	print "Error : LINODE_KEY environment var is not defined"
-	sys.exit(1)
-
-url = os.getenv('LINODE_API_URL', None)
-if (url is None):
-	print "Error : LINODE_API_URL environment var is not defined"
-	sys.exit(1)
-
-#if url == API_PRODUCTION_URL:
-	#print >> sys.stderr, "**** CAUTION: USING PRODUCTION URL"
-
-cmd=sys.argv[1]
-if (cmd == 'datacenters'):
-	format = 'raw'
-	if len(sys.argv) > 2:
-		format = sys.argv[2]
-	
-	list_datacenters(format)
-
-elif (cmd == 'datacenter-id'):
-	# Checks the input argument and returns the numeric datacenter ID
-	# if it's valid.
-	#
-	# Args: Either a numeric datacenter ID (in which case it's just checked for validity
-	#		or a datacenter name or abbreviation which should match output of avail.datacenters.
-	#		
-	# Output: The datacenter ID or nothing
-	# Returns: 0 on success or 1 on failure. Error details on stderr
-	dc_id = get_datacenter(sys.argv[2])
-	if dc_id is None:
-		print >> sys.stderr, "Invalid datacenter:", sys.argv[2]
-		sys.exit(1)
-		
-	print dc_id
-	sys.exit(0)
+# Checks that a linode can be used as a golden node to clone from. It should exist, have disks
+# and a configuration profile, and not be running, so that its disks are consistent when copied.
+# Returns: (True, linode ID) if it can be cloned, or (False, errors) if not.
+def check_golden_node(linode_id):
+	results = batch_request([('linode.list', {'LinodeID':linode_id}),
+		('linode.disk.list', {'LinodeID':linode_id}),
+		('linode.config.list', {'LinodeID':linode_id})])
+	for success, data in results:
+		if not success:
+			return (False, data)
 	
-elif (cmd == 'plans'):
-	if len(sys.argv) > 2:
-		list_plans(sys.argv[2])
-	else:
-		list_plans()
+	nodes, disks, configs = [data for success, data in results]
+	if not nodes:
+		return (False, ['No such linode: %d' % linode_id])
+	if nodes[0]['STATUS'] not in CLONEABLE_NODE_STATUSES:
+		return (False, ['Golden linode %d should be shut down before it can be cloned' % linode_id])
+	if not disks or not configs:
+		return (False, ['Golden linode %d has no disks or configuration profile to clone' % linode_id])
+	
+	return (True, linode_id)
 
-elif (cmd == 'nodes'):
-	if len(sys.argv) >= 3:
-		list_nodes(int(sys.argv[2]))
-	else:
-		list_nodes()
 
 
-elif (cmd == 'ram'):
-	mem = get_node_memory(int(sys.argv[2]))
-	if mem is None:
-		print >> sys.stderr, "Unable to get memory for linode:", sys.argv[2]
-		sys.exit(1)
-		
-	print mem
-	sys.exit(0)
-	
-elif (cmd == 'distributions'):
-	filter = None
-	if len(sys.argv) > 2:
-		filter = sys.argv[2]
-	
-	format = 'raw'
-	if len(sys.argv) > 3:
-		format = sys.argv[3]
-	
-	list_distributions(filter, format)
-
-elif (cmd == 'distribution-id'): 
-	# Checks the input argument and returns the numeric distribution ID
-	# if it's valid.
-	#
-	# Args: Either a numeric distribution ID (in which case it's just checked for validity
-	#		or a distribution label which should match output of avail.distributions.
-	#		
-	# Output: The distribution ID or nothing
-	# Returns: 0 on success or 1 on failure. Error details on stderr
-	dist_id, dist_label = find_distribution(sys.argv[2])
-	if dist_id is None:
-		print >> sys.stderr, "Invalid distribution:", sys.argv[2]
-		sys.exit(1)
-		
-	print "%d,%s" % (dist_id,dist_label)
-	sys.exit(0)
-
-	
-elif (cmd == 'kernels'):
-	filter = None
-	if len(sys.argv) > 2:
-		filter = sys.argv[2]
-		
-	format = 'raw'
-	if len(sys.argv) > 3:
-		format = sys.argv[3]
-	
-	list_kernels(filter, format)
-
-elif (cmd == 'kernel-id'): 
-	# Checks the input argument and returns the numeric kernel ID
-	# if it's valid.
-	#
-	# Args: Either a numeric kernel ID (in which case it's just checked for validity
-	#		or a partial/full kernel label which should match output of avail.kernels.
-	#		
-	# Output: The kernel ID, or nothing
-	# Returns: 0 on success or 1 on failure. Error details on stderr
-	kernel_id, kernel_label = find_kernel(sys.argv[2])
-	if kernel_id is None:
-		print >> sys.stderr, "Invalid kernel:", sys.argv[2]
-		sys.exit(1)
+# Parses a plan specification like "2GB:3 4GB:2" into a list with one plan ID per node.
+def parse_plan_spec(plan_spec):
+	plan_ids = []
+	for entry in plan_spec.split():
+		plan, count = entry.split(':')
+		if plan not in PLAN_IDS:
+			return (False, ['Invalid plan %s. It should be one of 2GB|4GB|8GB|...|120GB' % plan])
+			
+		plan_ids.extend([PLAN_IDS[plan]] * int(count))
 		
-	print "%d,%s" % (kernel_id,kernel_label)
-	sys.exit(0)
+	return (True, plan_ids)
 
-elif (cmd == 'stackscripts'):
-	if len(sys.argv) > 2:
-		list_all_stackscripts(sys.argv[2])
-	else:
-		list_all_stackscripts()
 
-elif (cmd == 'my-stackscripts'):
-	list_mystackscripts()
 
-elif (cmd == 'stackscript'):
-	stackscript(int(sys.argv[2]))
+# Calls func(*args) for each args tuple in 'args_list', using upto 'concurrency' threads.
+# on_done(result) is called with each call's return value as calls complete. Calls
+# to on_done are serialized, so it need not be thread safe.
+def run_concurrently(func, args_list, concurrency, on_done):
+	tasks = Queue.Queue()
+	for args in args_list:
+		tasks.put(args)
+	
+	done_lock = threading.Lock()
+	inherit_outputs = output_inheritor()
+	
+	def worker():
+		inherit_outputs()
+		while True:
+			try:
+				args = tasks.get_nowait()
+			except Queue.Empty:
+				return
+				
+			try:
+				result = func(*args)
+			except Exception as e:
+				result = (False, ['%s: %s' % (type(e).__name__, e)])
+				
+			with done_lock:
+				on_done(result)
+	
+	threads = [threading.Thread(target=worker) for i in range(min(concurrency, len(args_list)))]
+	for t in threads:
+		t.daemon = True
+		t.start()
+	for t in threads:
+		t.join()
 
-elif (cmd == 'jobs'):
-	list_jobs(sys.argv[2])
 
-elif (cmd == 'job'):
-	job(linode_id, int(sys.argv[2]))
 
-elif (cmd == 'job-status'):
-	# Output: 0 if not finished, 1 if finished successfully, 2 if finished but failed
-	#			No output if error
-	#
-	# Return codes: 0 on valid job id, 1 on invalid inputs data
+# Takes one new node through all the stages of creating a linode from an image:
+# create linode, set its label, create its disk from image and a swap disk, create a 
+# configuration profile with both disks, and add a private IP address.
+# Both disk jobs are queued together, since linode runs a linode's jobs one after another anyway.
+# If any stage after creating the linode fails, the linode is deleted.
+# Returns: (True, (linode_id, private_ip, public_ip)) on success, or (False, errors) on failure.
+def provision_node(plan_id, datacenter_id, image_id, kernel_id, node_label_prefix, display_group,
+		disk_label, disk_size, root_password, root_ssh_key_file):
+	return run_async(async_module().provision_node, plan_id, datacenter_id, image_id, kernel_id,
+		node_label_prefix, display_group, disk_label, disk_size, root_password, root_ssh_key_file)
+
+
+
+# Provisions a node for each plan ID in 'plan_ids' concurrently, on the shared event loop
+# with upto 'concurrency' nodes in progress at a time. All other args are as in provision_node.
+# on_provisioned(linode_id, private_ip, public_ip) is called as each node is ready. 
+# Returns: List of errors of nodes that could not be provisioned.
+def provision_nodes(plan_ids, datacenter_id, image_id, kernel_id, node_label_prefix, display_group,
+		disk_label, disk_size, root_password, root_ssh_key_file, concurrency, on_provisioned):
 	
-	finished, success = is_job_finished(int(sys.argv[2]), int(sys.argv[3]))
-	if finished is None:
-		print >> sys.stderr, "Invalid data: Linode=%s, Job=%s" % (sys.argv[2], sys.argv[3])
-		sys.exit(1)
-		
-	if finished == False:
-		print 0
-	else:
+	node_args = (datacenter_id, image_id, kernel_id, node_label_prefix, display_group,
+		disk_label, disk_size, root_password, root_ssh_key_file)
+	
+	all_errors = []
+	def handle_result(result):
+		success, data = result
 		if success:
-			print 1
+			on_provisioned(*data)
 		else:
-			print 2
-	sys.exit(0)	
+			all_errors.extend(data)
+	
+	# Results are handled on this thread, where on_provisioned's output should go.
+	calls = Queue.Queue()
+	def on_done(result):
+		calls.put((handle_result, (result,)))
+	
+	run_async(async_module().provision_nodes, plan_ids, node_args, concurrency, on_done, calls=calls)
+	return all_errors
 
-elif (cmd == 'disks'):
-	list_disks(int(sys.argv[2]))
 
 
-elif (cmd == 'ips'):
-	if len(sys.argv) >= 3:
-		list_ip_addresses(int(sys.argv[2]))
-	else:
-		list_ip_addresses(-1)
+# Takes one new node through all the stages of creating a linode by cloning a golden linode:
+# clone it with its disks and configuration profile, set its label, wait for the clone jobs,
+# and add a private IP address. The clone keeps the golden linode's disk sizes, root password
+# and SSH keys. If any stage after cloning fails, the clone is deleted.
+# Returns: (True, (linode_id, private_ip, public_ip)) on success, or (False, errors) on failure.
+def clone_provision_node(golden_linode_id, plan_id, datacenter_id, node_label_prefix, display_group):
+	success, data = clone_node(golden_linode_id, plan_id, datacenter_id)
+	if not success:
+		return (False, ['Failed to clone linode %d. Error:%s' % (golden_linode_id, data)])
+	linode_id = data
+	
+	try:
+		result = setup_clone(linode_id, node_label_prefix, display_group)
+	except Exception as e:
+		result = (False, ['Linode %d: %s: %s' % (linode_id, type(e).__name__, e)])
+	
+	# The caller gets no linode ID on failure, so the clone is deleted rather than left behind.
+	if not result[0]:
+		success, data = delete_node(linode_id, 1)
+		if not success:
+			result[1].append('Linode %d: Failed to delete it. Error:%s' % (linode_id, data))
+	return result
 
 
-elif (cmd == 'public-ip'):
-	# Output: If linode has atleast 1 public IP address, the first one
-	#		  is output.
-	# Return code: 0 if IP address was printed, 1 if there was no public IP address.
-	ipaddr = get_public_ip_address(int(sys.argv[2]))
-	if ipaddr == None:
-		sys.exit(1)
-		
-	print ipaddr
-	sys.exit(0)
+
+# Takes a just cloned linode through the rest of the stages of clone_provision_node.
+# Returns: Same as clone_provision_node.
+def setup_clone(linode_id, node_label_prefix, display_group):
+	def failed(stage, errors):
+		return (False, ['Linode %d: Failed to %s. Error:%s' % (linode_id, stage, errors)])
 	
+	success, data = update_node(linode_id, '%s-%d' % (node_label_prefix, linode_id), display_group)
+	if not success:
+		return failed('update node label', data)
 	
-elif (cmd == 'add-private-ip'):
-	# Output: The private IP address.
-	# Return code: 0 if IP address was printed. 1 on failures, errors on stderr
-	success, data = add_private_ip(int(sys.argv[2]))
+	success, data = pending_job_ids(linode_id)
 	if not success:
-		print >>sys.stderr, data
-		sys.exit(1)
+		return failed('list clone jobs', data)
+	
+	failed_jobs = []
+	def on_job_finished(job_linode_id, job_id, status):
+		if status != 1:
+			failed_jobs.append(job_id)
 		
-	ipaddr = data
-	print ipaddr
-	sys.exit(0)
-		
-elif (cmd == 'create-node'):
-	# Output: The linode ID or nothing on failure
-	# Returns: 0 on success or 1 on failure. Error details on stderr
-	plan = int(sys.argv[2])
-	datacenter = sys.argv[3]
-	do_validations = True
-	if len(sys.argv) >= 5:
-		if int(sys.argv[4]) == 0:
-			do_validations = False
-			
-	success, data = create_node(plan, datacenter, do_validations)
+	pending = wait_jobs([(linode_id, job_id) for job_id in data], PROVISION_JOB_TIMEOUT, on_job_finished)
+	if pending:
+		return failed('clone disks', 'Jobs did not complete even after %d seconds' % PROVISION_JOB_TIMEOUT)
+	if failed_jobs:
+		return failed('clone disks', 'Jobs %s failed' % failed_jobs)
+	
+	success, data = add_private_ip(linode_id)
 	if not success:
-		print >>sys.stderr, data
-		sys.exit(1)
+		return failed('add private IP address', data)
+	private_ip = data
 	
-	linode_id = data
-	print linode_id
-	sys.exit(0)
-
+	public_ip = get_public_ip_address(linode_id)
+	if public_ip is None:
+		return failed('get public IP address', 'No public IP address')
+		
+	return (True, (linode_id, private_ip, public_ip))
 
 
-elif (cmd == 'update-node'):
-	# Output: The linode ID or nothing on failure
-	# Returns: 0 on success or 1 on failure. Error details on stderr
-	linode_id = int(sys.argv[2])
-	label = sys.argv[3]
-	display_group = sys.argv[4]
 
-	success, data = update_node(linode_id, label, display_group)
-	if not success:
-		print >>sys.stderr, data
-		sys.exit(1)
+# Clones a node for each plan ID in 'plan_ids' from a golden linode concurrently, after checking
+# that the golden linode can be cloned. Other args are as in clone_provision_node, and
+# on_provisioned is as in provision_nodes.
+# Returns: List of errors of nodes that could not be provisioned.
+def clone_nodes(golden_linode_id, plan_ids, datacenter_id, node_label_prefix, display_group,
+		concurrency, on_provisioned):
 	
-	linode_id = data
-	print linode_id
-	sys.exit(0)
+	success, data = check_golden_node(golden_linode_id)
+	if not success:
+		return data
 	
+	args_list = [(golden_linode_id, plan_id, datacenter_id, node_label_prefix, display_group) 
+		for plan_id in plan_ids]
 	
+	all_errors = []
+	def on_done(result):
+		success, data = result
+		if success:
+			on_provisioned(*data)
+		else:
+			all_errors.extend(data)
+	
+	run_concurrently(clone_provision_node, args_list, concurrency, on_done)
+	return all_errors
+
+
+
+# Formats a list with one plan ID per node as a plan specification like "2GB:3 4GB:2".
+def format_plan_spec(plan_ids):
+	plan_names = dict((plan_id, plan) for plan, plan_id in PLAN_IDS.items())
+	return ' '.join(['%s:%d' % (plan_names[plan_id], plan_ids.count(plan_id))
+		for plan_id in sorted(set(plan_ids))])
+
+
+
+# Lists the linodes of a warm pool in a datacenter.
+# Returns: (True, (ready, filling, stale)) on success, where 'ready' and 'filling' are dicts of
+#	plan ID to linode IDs, and 'stale' is a list of linode IDs. 'ready' are powered off linodes in the
+#	pool that can be claimed, 'filling' are linodes still being provisioned for the pool, and 'stale'
+#	are those that were being provisioned for longer than WARM_POOL_FILLING_TIMEOUT.
+#	Returns (False, errors) on failure.
+def list_pool_nodes(pool_group, datacenter_id):
+	nodes = RecordStream('linode.list', None,
+		('LINODEID', 'LABEL', 'LPM_DISPLAYGROUP', 'PLANID', 'DATACENTERID', 'STATUS'))
+	ready = {}
+	filling = {}
+	stale = []
+	for node in nodes:
+		if node.get('DATACENTERID') != datacenter_id:
+			continue
+
+		group = node.get('LPM_DISPLAYGROUP')
+		if group == pool_group and node.get('STATUS') in CLONEABLE_NODE_STATUSES:
+			ready.setdefault(node['PLANID'], []).append(node['LINODEID'])
+		elif group == pool_group + WARM_POOL_FILLING_SUFFIX:
+			match = re.match(r'filling-(\d+)-\d+$', str(node.get('LABEL')))
+			if match and time.time() - int(match.group(1)) < WARM_POOL_FILLING_TIMEOUT:
+				filling.setdefault(node['PLANID'], []).append(node['LINODEID'])
+			else:
+				stale.append(node['LINODEID'])
+
+	if nodes.errors():
+		return (False, nodes.errors())
+	return (True, (ready, filling, stale))
+
+
+
+# Claims a linode from a warm pool for each plan ID in 'plan_ids', by moving it into
+# 'display_group' with a <node_label_prefix>-<linode ID> label. Relabelling is all that's left
+# to do for a pool linode before it's booted.
+# Returns: (claimed, missed, errors), where claimed is a list of (linode_id, private_ip, public_ip)
+#	and missed is a list of plan IDs for which the pool had no linode.
+def claim_pool_nodes(plan_ids, datacenter_id, pool_group, node_label_prefix, display_group):
+	# Claims that overlap, like those of add-nodes run twice at the same time, would pick the same
+	# ready linodes. So claims from a pool are serialized by a lock file, till they're relabelled.
+	lock_dir = os.path.expanduser(os.getenv('LINODE_API_CACHE_DIR', CATALOG_CACHE_DIR))
+	if not os.path.isdir(lock_dir):
+		os.makedirs(lock_dir, 0700)
+	with open(os.path.join(lock_dir, 'pool-%s.lock' % pool_group), 'a') as lock_file:
+		fcntl.flock(lock_file, fcntl.LOCK_EX)
+
+		success, data = list_pool_nodes(pool_group, datacenter_id)
+		if not success:
+			return ([], plan_ids, data)
+		ready, filling, stale = data
+
+		candidates = []
+		missed = []
+		for plan_id in plan_ids:
+			if ready.get(plan_id):
+				candidates.append((plan_id, ready[plan_id].pop()))
+			else:
+				missed.append(plan_id)
+
+		results = batch_request([('linode.update',
+			{
+				'LinodeID' : linode_id,
+				'Label' : '%s-%d' % (node_label_prefix, linode_id),
+				'lpm_displayGroup' : display_group
+			}) for plan_id, linode_id in candidates])
+
+	# A linode that can't be relabelled, perhaps because it was deleted after it was listed,
+	# is a miss.
+	all_errors = []
+	claimed_ids = []
+	for (plan_id, linode_id), (success, data) in zip(candidates, results):
+		if success:
+			claimed_ids.append(linode_id)
+		else:
+			missed.append(plan_id)
+			all_errors.append(data)
+
+	claimed = []
+	if claimed_ids:
+		nodes, errors = get_nodes_info(claimed_ids)
+		all_errors.extend(errors)
+		for node in nodes:
+			addresses = dict((address['ISPUBLIC'], address['IPADDRESS']) for address in node['IPADDRESSES'])
+			claimed.append((node['LINODEID'], addresses.get(0), addresses.get(1)))
+
+	return (claimed, missed, all_errors)
+
+
 
-elif (cmd == 'delete-node'):
-	# Output: Nothing
-	# Returns: 0 on success or 1 on failure. Error details on stderr
-	linode_id = int(sys.argv[2])
-	skip_checks = int(sys.argv[3])
-	success, data = delete_node(linode_id, skip_checks)
+# Provisions linodes from an image into a warm pool until it has a linode for each plan
+# ID in 'plan_ids', counting those that are still being provisioned by another fill.
+# Stale linodes left behind by interrupted fills are deleted. Pool linodes are left powered off.
+# Other args are as in provision_nodes, and on_provisioned is called as each linode is moved
+# into the pool.
+# Returns: List of errors of linodes that could not be provisioned.
+def fill_pool(plan_ids, datacenter_id, image_id, kernel_id, pool_group, disk_label, disk_size,
+		root_password, root_ssh_key_file, concurrency, on_provisioned):
+
+	success, data = list_pool_nodes(pool_group, datacenter_id)
 	if not success:
-		print >>sys.stderr, data
-		sys.exit(1)
-	
-	sys.exit(0)
+		return data
+	ready, filling, stale = data
+
+	all_errors = []
+	if stale:
+		deleted, errors = delete_nodes(stale, 1)
+		all_errors.extend(errors)
+
+	needed = []
+	for plan_id in sorted(set(plan_ids)):
+		shortfall = plan_ids.count(plan_id) - len(ready.get(plan_id, [])) - len(filling.get(plan_id, []))
+		needed.extend([plan_id] * shortfall)
+
+	def fill_node(plan_id):
+		success, data = provision_node(plan_id, datacenter_id, image_id, kernel_id,
+			'filling-%d' % time.time(), pool_group + WARM_POOL_FILLING_SUFFIX, disk_label, disk_size,
+			root_password, root_ssh_key_file)
+		if not success:
+			return (False, data)
+
+		linode_id = data[0]
+		success, errors = update_node(linode_id, 'pool-%d' % linode_id, pool_group)
+		if not success:
+			errors = ['Linode %d: Failed to move into warm pool. Error:%s' % (linode_id, errors)]
+			success, data = delete_node(linode_id, 1)
+			if not success:
+				errors.append('Linode %d: Failed to delete it. Error:%s' % (linode_id, data))
+			return (False, errors)
+		return (True, data)
+
+	def on_done(result):
+		success, data = result
+		if success:
+			on_provisioned(*data)
+		else:
+			all_errors.extend(data)
+
+	run_concurrently(fill_node, [(plan_id,) for plan_id in needed], concurrency, on_done)
+	return all_errors
 
-elif (cmd == 'delete-all-nodes'):
-	# Output: Comma separated list of deleted nodes
-	# Returns: 0 on complete success or 1 if there are any errors. Error details on stderr
-	skip_checks = sys.argv[2]
-	deleted_nodes, all_errors = delete_all_nodes(skip_checks)
+
+
+# Deletes all linodes of the warm pools whose display groups are 'pool_group_prefix' followed
+# by an image ID, including those being provisioned for them. So pools of a cluster's earlier
+# images are drained along with the pool of its current image.
+# Returns: (deleted linode IDs, errors)
+def drain_pool(pool_group_prefix):
+	def is_pool_group(group):
+		if not group.startswith(pool_group_prefix):
+			return False
+		image_id = group[len(pool_group_prefix):]
+		if image_id.endswith(WARM_POOL_FILLING_SUFFIX):
+			image_id = image_id[:-len(WARM_POOL_FILLING_SUFFIX)]
+		return image_id.isdigit()
+
+	nodes = RecordStream('linode.list', None, ('LINODEID', 'LPM_DISPLAYGROUP'))
+	linode_ids = [node['LINODEID'] for node in nodes if is_pool_group(node.get('LPM_DISPLAYGROUP') or '')]
+	if nodes.errors():
+		return ([], nodes.errors())
+
+	return delete_nodes(linode_ids, 1)
+
+
+
+# Returns the monthly price of a plan name like "2GB", or None if the plan is unknown.
+def get_plan_price(plan):
+	if plan not in PLAN_IDS:
+		return None
+	iserr, errors = is_error(catalog_request('avail.linodeplans'))
+	if iserr:
+		return None
+	record = catalog_index('avail.linodeplans').find(str(PLAN_IDS[plan]))
+	if record is None:
+		return None
+	return record['PRICE']
+
+
+
+# Returns: (True, total monthly price of linodes in 'display_group' whose labels start
+# with 'label_prefix') on success, or (False, errors) on failure.
+def get_nodes_monthly_cost(display_group, label_prefix):
+	resp = catalog_request('avail.linodeplans')
+	iserr, errors = is_error(resp)
+	if iserr:
+		return (False, errors)
+	prices = dict((plan['PLANID'], plan['PRICE']) for plan in resp['DATA'])
 	
+	nodes = RecordStream('linode.list', None, ('LABEL', 'LPM_DISPLAYGROUP', 'PLANID'))
+	cost = 0
+	for node in nodes:
+		if node.get('LPM_DISPLAYGROUP') == display_group and node.get('LABEL', '').startswith(label_prefix):
+			cost += prices.get(node.get('PLANID'), 0)
+			
+	if nodes.errors():
+		return (False, nodes.errors())
+	return (True, cost)
+
+
+
+# Returns the pct'th percentile of a list of numbers, by nearest rank.
+def percentile(values, pct):
+	if not values:
+		return 0
+	ordered = sorted(values)
+	rank = int(math.ceil(pct / 100.0 * len(ordered))) - 1
+	return ordered[max(0, min(rank, len(ordered) - 1))]
+
+
+
+# Summarizes a trace file written with LINODE_API_TRACE: count, errors, latency percentiles,
+# total time and bytes of each action, with the actions that took the most time first.
+# If 'action' is given, also prints a histogram of its latencies in power of 2 millisecond buckets.
+def trace_stats(trace_file, action=None):
+	latencies = {}
+	errors = {}
+	bytes_out = {}
+	bytes_in = {}
+	invalid = 0
+	with open(trace_file, 'r') as f:
+		for line in f:
+			try:
+				rec = json.loads(line)
+				name = rec['action']
+				ms = float(rec['ms'])
+				out = int(rec.get('out') or 0)
+				received = int(rec.get('in') or 0)
+			except (ValueError, KeyError, TypeError, AttributeError):
+				invalid += 1
+				continue
+			latencies.setdefault(name, []).append(ms)
+			errors[name] = errors.get(name, 0) + (1 if rec.get('errors') else 0)
+			bytes_out[name] = bytes_out.get(name, 0) + out
+			bytes_in[name] = bytes_in.get(name, 0) + received
+	
+	print '%-36s%8s%8s%10s%10s%10s%10s%10s%10s%10s' % ('Action', 'count', 'errors', 'p50 ms', 'p95 ms', 
+		'p99 ms', 'max ms', 'total s', 'KB out', 'KB in')
+	print '-'*122
+	for name in sorted(latencies.keys(), key=lambda n: -sum(latencies[n])):
+		values = latencies[name]
+		print '%-36s%8d%8d%10.1f%10.1f%10.1f%10.1f%10.2f%10.1f%10.1f' % (name, len(values), errors[name],
+			percentile(values, 50), percentile(values, 95), percentile(values, 99), max(values),
+			sum(values) / 1000, bytes_out[name] / 1024.0, bytes_in[name] / 1024.0)
+	
+	all_values = [ms for values in latencies.values() for ms in values]
+	print '-'*122
+	print '%-36s%8d%8d%10.1f%10.1f%10.1f%10.1f%10.2f%10.1f%10.1f' % ('all', len(all_values), sum(errors.values()),
+		percentile(all_values, 50), percentile(all_values, 95), percentile(all_values, 99), max(all_values or [0]),
+		sum(all_values) / 1000, sum(bytes_out.values()) / 1024.0, sum(bytes_in.values()) / 1024.0)
+	if invalid:
+		print '%d invalid lines skipped' % invalid
+	
+	if action is not None:
+		values = latencies.get(action, [])
+		print
+		print 'Latency histogram of %s' % action
+		buckets = {}
+		for ms in values:
+			upper = 1
+			while upper < ms:
+				upper *= 2
+			buckets[upper] = buckets.get(upper, 0) + 1
+		most = max(buckets.values() or [1])
+		for upper in sorted(buckets.keys()):
+			print '<= %6d ms%8d %s' % (upper, buckets[upper], '#' * int(round(50.0 * buckets[upper] / most)))
+
+
+
+# Measures per-request latency of 'test.echo' calls, first opening a new connection for
+# every call (which is how every API call was made before the pooled client), and then
+# reusing a single keep-alive connection.
+def benchmark_requests(count, bench_url):
+	print '%-26s%10s%10s%10s%10s%10s' % ('Mode', 'min ms', 'avg ms', 'p50 ms', 'p95 ms', 'max ms')
+	print '-'*76
+	for label, keep_alive in (('new connection per call', False), ('pooled keep-alive', True)):
+		bench_client = LinodeClient(bench_url, api_key, pool_size=1, keep_alive=keep_alive)
+		latencies = []
+		for i in range(count):
+			start = time.time()
+			bench_client.request('test.echo', {'seq' : i})
+			latencies.append((time.time() - start) * 1000)
+		bench_client.close()
+		
+		print '%-26s%10.2f%10.2f%10.2f%10.2f%10.2f' % (label, min(latencies), sum(latencies) / len(latencies),
+			percentile(latencies, 50), percentile(latencies, 95), max(latencies))
+
+
+
+# Provisions a node for each plan ID in 'plan_ids' twice, first from an image as provision-nodes does
+# and then by cloning a golden linode as clone-nodes does, and compares the time taken per node
+# and overall. Nodes are created in their own display group, all of whose nodes are deleted at the end.
+# Returns: True if all nodes of both modes were provisioned, False otherwise.
+def compare_provisioning(plan_ids, datacenter_id, image_id, kernel_id, golden_linode_id, disk_size,
+		root_password, root_ssh_key_file, concurrency):
+	display_group = 'provisioning-benchmark'
+	modes = [
+		('from image', lambda plan_id: provision_node(plan_id, datacenter_id, image_id, kernel_id, 
+			'bench-image', display_group, 'Bench', disk_size, root_password, root_ssh_key_file)),
+		('clone', lambda plan_id: clone_provision_node(golden_linode_id, plan_id, datacenter_id, 
+			'bench-clone', display_group))
+	]
+	
+	success, data = check_golden_node(golden_linode_id)
+	if not success:
+		print >>sys.stderr, data
+		return False
 	
-	print ','.join([str(id) for id in deleted_nodes])
+	print '%-12s%8s%8s%10s%10s%10s%10s' % ('Mode', 'nodes', 'failed', 'min s', 'p50 s', 'max s', 'total s')
+	print '-'*68
+	all_errors = []
+	for label, provision in modes:
+		def timed_provision(plan_id):
+			start = time.time()
+			success, data = provision(plan_id)
+			return (success, data, time.time() - start)
+		
+		seconds = []
+		def on_done(result):
+			# Exceptions are returned by run_concurrently without a time.
+			if result[0]:
+				seconds.append(result[2])
+			else:
+				all_errors.extend(result[1])
+				
+		start = time.time()
+		run_concurrently(timed_provision, [(plan_id,) for plan_id in plan_ids], concurrency, on_done)
+		total = time.time() - start
+		print '%-12s%8d%8d%10.1f%10.1f%10.1f%10.1f' % (label, len(plan_ids), len(plan_ids) - len(seconds),
+			min(seconds or [0]), percentile(seconds, 50), max(seconds or [0]), total)
+		sys.stdout.flush()
+	
+	nodes = RecordStream('linode.list', None, ('LINODEID', 'LPM_DISPLAYGROUP'))
+	linode_ids = [node['LINODEID'] for node in nodes if node.get('LPM_DISPLAYGROUP') == display_group]
+	deleted_nodes, errors = delete_nodes(linode_ids, 1)
+	all_errors.extend(nodes.errors() + errors)
 	
 	if all_errors:
 		print >>sys.stderr, all_errors
-		sys.exit(1)
+		return False
+	return True
+
+
+
+# Compares lookups in a synthetic catalog of 'count' images and kernels, by linear scans
+# (which is how all lookups were done before CatalogIndex) and by index.
+# Neither the API nor the cache is used.
+def benchmark_catalog(count, lookups):
+	images = [{'IMAGEID' : 100000 + i, 'LABEL' : 'storm-image-%d' % i, 'MINSIZE' : 1000} 
+		for i in range(count)]
+	kernels = [{'KERNELID' : i, 'LABEL' : 'Latest 64 bit (4.%d.%d-x86_64-linode%d)' % (i % 20, i % 100, i)} 
+		for i in range(count)]
+	
+	queries = [random.choice(images)['LABEL'].upper() for i in range(lookups)]
+	# Scripts look up the same few partial kernel labels, like "Latest 64 bit", over and over.
+	kernel_labels = ['linode%d)' % random.choice(kernels)['KERNELID'] for i in range(20)]
+	kernel_queries = [random.choice(kernel_labels) for i in range(lookups)]
+	kernel_filter = r'4\.1[0-9]\.'
+	
+	def linear_find(records, label_key, value):
+		value = value.lower()
+		for record in records:
+			if record[label_key].lower() == value:
+				return record
+		return None
+		
+	def linear_search(records, label_key, text):
+		text = text.lower()
+		for record in records:
+			if text in record[label_key].lower():
+				return record
+		return None
 	
-	sys.exit(0)
+	def linear_filter(records, label_key, pattern):
+		return [record for record in records if re.search(pattern, record[label_key])]
+	
+	def timed_ms(func, args_list):
+		start = time.time()
+		for args in args_list:
+			func(*args)
+		return (time.time() - start) * 1000 / len(args_list)
+	
+	start = time.time()
+	image_index = CatalogIndex(images, 'IMAGEID', ('LABEL',))
+	kernel_index = CatalogIndex(kernels, 'KERNELID', ('LABEL',))
+	build_ms = (time.time() - start) * 1000
+	
+	results = [
+		('image by label', 
+			timed_ms(linear_find, [(images, 'LABEL', q) for q in queries]),
+			timed_ms(image_index.find, [(q,) for q in queries])),
+		('kernel by partial label', 
+			timed_ms(linear_search, [(kernels, 'LABEL', q) for q in kernel_queries]),
+			timed_ms(kernel_index.search, [(q,) for q in kernel_queries])),
+		('kernel regex filter', 
+			timed_ms(linear_filter, [(kernels, 'LABEL', kernel_filter)] * 10),
+			timed_ms(kernel_index.filter, [(kernel_filter,)] * 10))
+	]
+	
+	print 'Catalog of %d images and %d kernels. Building both indexes took %.2f ms' % (count, count, build_ms)
+	print '%-26s%14s%14s%10s' % ('Lookup', 'scan ms/op', 'index ms/op', 'speedup')
+	print '-'*64
+	for label, scan_ms, index_ms in results:
+		print '%-26s%14.4f%14.4f%9.0fx' % (label, scan_ms, index_ms, scan_ms / max(index_ms, 1e-6))
+#=============================================================
 
 
-elif (cmd == 'create-disk'):
-	create_disk(linode_id)
+# Switches the shared client to a different API endpoint or key. A long running server
+# may be used by scripts that load different API environment configuration files.
+def use_api_environment(new_url, new_key):
+	global url, api_key, client
+	if new_url == url and new_key == api_key:
+		return
+		
+	if client is not None:
+		client.close()
+		client = None
+	url = new_url
+	api_key = new_key
 
-elif (cmd == 'create-disk-from-distribution'):
-	# Output: "<disk-ID>,<job-ID>" on success, or nothing on failure
-	# Returns: 0 on success or 1 on failure. Error details on stderr
-	linode_id = int(sys.argv[2])
-	distribution = sys.argv[3]
-	disk_size = int(sys.argv[4])
-	root_password = sys.argv[5]
-	root_ssh_key_file = sys.argv[6]
-	
-	success, data = create_disk_from_distribution(linode_id, distribution, disk_size, root_password, root_ssh_key_file)
-	if not success:
-		print >>sys.stderr, data
-		sys.exit(1)
-	
-	disk_id = data[0]
-	job_id = data[1]
-	print "%d,%d" % (disk_id, job_id)
-	sys.exit(0)
 
-elif (cmd == 'create-swap-disk'):
-	# Output: "<disk-ID>,<job-ID>" on success, or nothing on failure
-	# Returns: 0 on success or 1 on failure. Error details on stderr
-	linode_id = int(sys.argv[2])
-	
-	success, data = create_swap_disk(linode_id)
-	if not success:
-		print >>sys.stderr, data
-		sys.exit(1)
-	
-	disk_id = data[0]
-	job_id = data[1]
-	print "%d,%d" % (disk_id, job_id)
-	sys.exit(0)
-
-elif (cmd == 'create-disk-from-stackscript'):
-	create_disk_from_stackscript(linode_id, int(sys.argv[2]))
-
-elif (cmd == 'configs'):
-	list_configs(int(sys.argv[2]))
-
-elif (cmd == 'create-config'):
-	# Input: disks should be a single argument with comma separated list of disk IDs
-	# Output: <config-ID> on success, or nothing on failure
-	# Returns: 0 on success or 1 on failure. Error details on stderr
-	linode_id = int(sys.argv[2])
-	kernel = sys.argv[3] 
-	disks = sys.argv[4] 
-	config_label = sys.argv[5] 
-	do_validations = True
-	if len(sys.argv) >= 7:
-		if int(sys.argv[6]) == 0:
-			do_validations = False
-	
-	success, data = create_config(linode_id, kernel, disks, config_label, do_validations)
-	if not success:
-		print >>sys.stderr, data
-		sys.exit(1)
+
+# Stands in for sys.stdout or sys.stderr in a server. Whatever a thread writes goes to its
+# command's buffer if it's capturing output, or else to the stream that was replaced, so that
+# commands running concurrently in a server capture only their own output.
+class ThreadOutput(object):
+
+	def __init__(self, stream):
+		self.stream = stream
+		self.local = threading.local()
+		
+	def capture(self):
+		self.local.buffer = StringIO.StringIO()
+		
+	# Stops capturing in this thread, and returns what was captured.
+	def release(self):
+		buf = self.local.buffer
+		self.local.buffer = None
+		return buf.getvalue()
+		
+	def current(self):
+		return getattr(self.local, 'buffer', None)
+		
+	def adopt(self, buffer):
+		self.local.buffer = buffer
+		
+	def target(self):
+		return self.current() or self.stream
+		
+	def write(self, data):
+		self.target().write(data)
+		
+	def writelines(self, lines):
+		self.target().writelines(lines)
+		
+	def flush(self):
+		self.target().flush()
+		
+	# Used by the print statement, and so has to be of the target too.
+	softspace = property(lambda self: getattr(self.target(), 'softspace', 0),
+		lambda self, value: setattr(self.target(), 'softspace', value))
+		
+	def __getattr__(self, name):
+		return getattr(self.target(), name)
+
+
+# Replaces sys.stdout and sys.stderr with ThreadOutputs, if they aren't already.
+def install_thread_outputs():
+	if not isinstance(sys.stdout, ThreadOutput):
+		sys.stdout = ThreadOutput(sys.stdout)
+	if not isinstance(sys.stderr, ThreadOutput):
+		sys.stderr = ThreadOutput(sys.stderr)
+
+
+
+# Returns a function that makes the thread calling it write its output wherever the current
+# thread does, for threads started by a command run in a server.
+def output_inheritor():
+	if not isinstance(sys.stdout, ThreadOutput):
+		return lambda: None
+		
+	out = sys.stdout.current()
+	err = sys.stderr.current()
+	def inherit():
+		sys.stdout.adopt(out)
+		sys.stderr.adopt(err)
+	return inherit
+
+
+
+# Runs a single command inside this process, and returns its exit code along with
+# whatever it printed to stdout and stderr, exactly as if it had been run as a 
+# separate linode_api.py process. Other threads may run commands at the same time.
+def run_captured(args):
+	install_thread_outputs()
+	sys.stdout.capture()
+	sys.stderr.capture()
+	code = 0
+	try:
+		run_command(['linode_api.py'] + args)
+		
+	except SystemExit as e:
+		if e.code is None:
+			code = 0
+		elif isinstance(e.code, int):
+			code = e.code
+		else:
+			print >> sys.stderr, e.code
+			code = 1
+			
+	except Exception:
+		traceback.print_exc(file=sys.stderr)
+		code = 1
+		
+	finally:
+		out = sys.stdout.release()
+		err = sys.stderr.release()
+		# A server may run for a long time, so its trace is written after every command
+		# instead of only at exit.
+		flush_trace()
+		
+	return code, out, err
+
+
+
+# Request format: API URL, API key and then the command arguments, all separated by NUL 
+# characters. The client closes its writing side after sending the request.
+# Response format: a "<exit code> <stdout length> <stderr length>" header line, followed by
+# stdout and stderr contents.
+class CommandHandler(SocketServer.StreamRequestHandler):
+
+	def handle(self):
+		fields = self.rfile.read().split('\0')
+		if len(fields) < 3:
+			return
+			
+		args = fields[2:]
+		if args == ['stop-server']:
+			self.server.running = False
+			code, out, err = 0, '', ''
+		else:
+			self.server.begin_command((fields[0], fields[1]))
+			try:
+				code, out, err = run_captured(args)
+			finally:
+				self.server.end_command()
+		
+		if isinstance(out, unicode):
+			out = out.encode('utf-8')
+		if isinstance(err, unicode):
+			err = err.encode('utf-8')
+		self.wfile.write('%d %d %d\n' % (code, len(out), len(err)))
+		self.wfile.write(out)
+		self.wfile.write(err)
+
+
+
+# Each command is handled in its own thread, so that a long command like provision-nodes
+# doesn't hold up other scripts' commands. Since the API URL and key are module globals,
+# commands run concurrently only if they're in the same API environment. A command in
+# another environment waits till the running ones finish.
+class CommandServer(SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer):
+
+	# Running commands are finished before the process exits.
+	daemon_threads = False
+	
+	# Seconds between checks of whether the server should stop, when no command arrives.
+	poll_interval = 1
+	
+	def __init__(self, socket_path, idle_timeout):
+		SocketServer.UnixStreamServer.__init__(self, socket_path, CommandHandler)
+		self.timeout = self.poll_interval
+		self.idle_timeout = idle_timeout
+		self.last_active = time.time()
+		self.running = True
+		self.active = 0
+		self.environment = None
+		self.condition = threading.Condition()
+		
+	def begin_command(self, environment):
+		with self.condition:
+			while self.active and self.environment != environment:
+				self.condition.wait()
+			if self.environment != environment:
+				use_api_environment(*environment)
+				self.environment = environment
+			self.active += 1
+			
+	def end_command(self):
+		with self.condition:
+			self.active -= 1
+			self.last_active = time.time()
+			self.condition.notify_all()
+		
+	# The server isn't idle while a command is running, even if no new one arrived.
+	def handle_timeout(self):
+		with self.condition:
+			if self.idle_timeout and self.active == 0 and time.time() - self.last_active >= self.idle_timeout:
+				self.running = False
+
+
+
+# Serves commands on a UNIX socket until it's idle for 'idle_timeout' seconds (0 means
+# serve forever) or is sent a 'stop-server' command. 
+# Since it keeps the interpreter, imported modules and pooled API connections alive 
+# between commands, callers avoid the startup cost of a new linode_api.py process for 
+# every API call. linode_api_client.py is the client for this server.
+def serve(socket_path, idle_timeout):
+	# Servers started at the same time by several scripts take turns to check for a listening
+	# server and start listening, so that one of them can't take a socket file that another
+	# has created but isn't listening on yet for a stale one, and delete it.
+	old_umask = os.umask(0077)
+	lock_file = open(socket_path + '.lock', 'a')
+	os.umask(old_umask)
+	try:
+		fcntl.flock(lock_file, fcntl.LOCK_EX)
+		if os.path.exists(socket_path):
+			probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+			try:
+				probe.connect(socket_path)
+				print >> sys.stderr, "A server is already listening on", socket_path
+				return False
+			except socket.error:
+				# Stale socket file left behind by a server that was killed.
+				os.unlink(socket_path)
+			finally:
+				probe.close()
+		
+		# The socket should be accessible only to this user, because API key is sent over it.
+		old_umask = os.umask(0077)
+		try:
+			server = CommandServer(socket_path, idle_timeout if idle_timeout > 0 else None)
+		finally:
+			os.umask(old_umask)
+	finally:
+		lock_file.close()
+	
+	try:
+		while server.running:
+			server.handle_request()
+	finally:
+		server.server_close()
+		if os.path.exists(socket_path):
+			os.unlink(socket_path)
+		
+	return True
+
+
+
+# Runs the command given in argv, which is like sys.argv. Output is printed to stdout, errors to stderr, and the
+# exit code is set using sys.exit(), because that's the contract shell scripts depend on.
+def run_command(argv):
+	cmd=argv[1]
+	if (cmd == 'datacenters'):
+		format = 'raw'
+		if len(argv) > 2:
+			format = argv[2]
+	
+		list_datacenters(format)
+
+	elif (cmd == 'datacenter-id'):
+		# Checks the input argument and returns the numeric datacenter ID
+		# if it's valid.
+		#
+		# Args: Either a numeric datacenter ID (in which case it's just checked for validity
+		#		or a datacenter name or abbreviation which should match output of avail.datacenters.
+		#		
+		# Output: The datacenter ID or nothing
+		# Returns: 0 on success or 1 on failure. Error details on stderr
+		dc_id = get_datacenter(argv[2])
+		if dc_id is None:
+			print >> sys.stderr, "Invalid datacenter:", argv[2]
+			sys.exit(1)
+		
+		print dc_id
+		sys.exit(0)
 	
-	config_id = data
-	print config_id
-	sys.exit(0)
+	elif (cmd == 'plans'):
+		if len(argv) > 2:
+			list_plans(argv[2])
+		else:
+			list_plans()
 
-elif (cmd == 'create-stackscript'):
-	create_stackscript(sys.argv[2])
+	elif (cmd == 'nodes'):
+		if len(argv) >= 3:
+			list_nodes(int(argv[2]))
+		else:
+			list_nodes()
+
+
+	elif (cmd == 'ram'):
+		mem = get_node_memory(int(argv[2]))
+		if mem is None:
+			print >> sys.stderr, "Unable to get memory for linode:", argv[2]
+			sys.exit(1)
+		
+		print mem
+		sys.exit(0)
+	
+	elif (cmd == 'distributions'):
+		filter = None
+		if len(argv) > 2:
+			filter = argv[2]
+	
+		format = 'raw'
+		if len(argv) > 3:
+			format = argv[3]
+	
+		list_distributions(filter, format)
+
+	elif (cmd == 'distribution-id'): 
+		# Checks the input argument and returns the numeric distribution ID
+		# if it's valid.
+		#
+		# Args: Either a numeric distribution ID (in which case it's just checked for validity
+		#		or a distribution label which should match output of avail.distributions.
+		#		
+		# Output: The distribution ID or nothing
+		# Returns: 0 on success or 1 on failure. Error details on stderr
+		dist_id, dist_label = find_distribution(argv[2])
+		if dist_id is None:
+			print >> sys.stderr, "Invalid distribution:", argv[2]
+			sys.exit(1)
+		
+		print "%d,%s" % (dist_id,dist_label)
+		sys.exit(0)
 
-elif (cmd == 'boot'):
-	linode_id = int(sys.argv[2])
-	config_id = None
-	if len(sys.argv) >= 4:
-		config_id = int(sys.argv[3])
-	success, data = boot_node(linode_id, config_id)
-	if not success:
-		print >>sys.stderr, data
-		sys.exit(1)
 	
-	job_id = data
-	print job_id
-	sys.exit(0)
+	elif (cmd == 'kernels'):
+		filter = None
+		if len(argv) > 2:
+			filter = argv[2]
+		
+		format = 'raw'
+		if len(argv) > 3:
+			format = argv[3]
+	
+		list_kernels(filter, format)
+
+	elif (cmd == 'kernel-id'): 
+		# Checks the input argument and returns the numeric kernel ID
+		# if it's valid.
+		#
+		# Args: Either a numeric kernel ID (in which case it's just checked for validity
+		#		or a partial/full kernel label which should match output of avail.kernels.
+		#		
+		# Output: The kernel ID, or nothing
+		# Returns: 0 on success or 1 on failure. Error details on stderr
+		kernel_id, kernel_label = find_kernel(argv[2])
+		if kernel_id is None:
+			print >> sys.stderr, "Invalid kernel:", argv[2]
+			sys.exit(1)
+		
+		print "%d,%s" % (kernel_id,kernel_label)
+		sys.exit(0)
 
-elif (cmd == 'shutdown'):
-	success, data = shutdown_node(int(sys.argv[2]))
-	if not success:
-		print >>sys.stderr, data
-		sys.exit(1)
+	elif (cmd == 'stackscripts'):
+		if len(argv) > 2:
+			list_all_stackscripts(argv[2])
+		else:
+			list_all_stackscripts()
+
+	elif (cmd == 'my-stackscripts'):
+		list_mystackscripts()
+
+	elif (cmd == 'stackscript'):
+		stackscript(int(argv[2]))
+
+	elif (cmd == 'jobs'):
+		list_jobs(argv[2])
+
+	elif (cmd == 'job'):
+		job(linode_id, int(argv[2]))
+
+	elif (cmd == 'job-status'):
+		# Output: 0 if not finished, 1 if finished successfully, 2 if finished but failed
+		#			No output if error
+		#
+		# Return codes: 0 on valid job id, 1 on invalid inputs data
 	
-	job_id = data
-	print job_id
-	sys.exit(0)
+		finished, success = is_job_finished(int(argv[2]), int(argv[3]))
+		if finished is None:
+			print >> sys.stderr, "Invalid data: Linode=%s, Job=%s" % (argv[2], argv[3])
+			sys.exit(1)
+		
+		if finished == False:
+			print 0
+		else:
+			if success:
+				print 1
+			else:
+				print 2
+		sys.exit(0)	
+
+	elif (cmd == 'wait-jobs'):
+		# Waits for several jobs to finish.
+		# Args: (Optional) Timeout in seconds. Default is 480.
+		#		One or more jobs, each as <linode ID>:<job ID>
+		#
+		# Output: One "<linode ID> <job ID> <status>" line per job as it finishes, where status is
+		#			1 if finished successfully, 2 if finished but failed, 3 if job status could not be found.
+		#			Jobs that are still pending after timeout are output last with status 0.
+		#
+		# Return codes: 0 if all jobs finished successfully, 1 otherwise.
+		args = argv[2:]
+		timeout = 480
+		if args and ':' not in args[0]:
+			timeout = int(args[0])
+			args = args[1:]
+		
+		jobs = []
+		for arg in args:
+			linode_id, job_id = arg.split(':')
+			jobs.append((int(linode_id), int(job_id)))
+		
+		failures = []
+		def print_job_status(linode_id, job_id, status):
+			print linode_id, job_id, status
+			sys.stdout.flush()
+			if status != 1:
+				failures.append((linode_id, job_id))
+			
+		pending = wait_jobs(jobs, timeout, print_job_status)
+		for linode_id, job_id in pending:
+			print linode_id, job_id, 0
+		
+		if failures or pending:
+			sys.exit(1)
+		sys.exit(0)
 
-elif (cmd == 'clone'):
-	clone_node(linode_id)
+	elif (cmd == 'disks'):
+		list_disks(int(argv[2]))
 
-elif (cmd == 'create-image'):
-	linode_id = int(sys.argv[2])
-	disk_id = int(sys.argv[3])
-	image_label = sys.argv[4]
+
+	elif (cmd == 'ips'):
+		if len(argv) >= 3:
+			list_ip_addresses(int(argv[2]))
+		else:
+			list_ip_addresses(-1)
+
+
+	elif (cmd == 'public-ip'):
+		# Output: If linode has atleast 1 public IP address, the first one
+		#		  is output.
+		# Return code: 0 if IP address was printed, 1 if there was no public IP address.
+		ipaddr = get_public_ip_address(int(argv[2]))
+		if ipaddr == None:
+			sys.exit(1)
+		
+		print ipaddr
+		sys.exit(0)
 	
-	success, data = create_diskimage(linode_id, disk_id, image_label)
-	if not success:
-		print >>sys.stderr, data
-		sys.exit(1)
 	
-	image_id = data[0]
-	job_id = data[1]
-	print "%d,%d" % (image_id, job_id)
+	elif (cmd == 'add-private-ip'):
+		# Output: The private IP address.
+		# Return code: 0 if IP address was printed. 1 on failures, errors on stderr
+		success, data = add_private_ip(int(argv[2]))
+		if not success:
+			print >>sys.stderr, data
+			sys.exit(1)
+		
+		ipaddr = data
+		print ipaddr
+		sys.exit(0)
+		
+	elif (cmd == 'create-node'):
+		# Output: The linode ID or nothing on failure
+		# Returns: 0 on success or 1 on failure. Error details on stderr
+		plan = int(argv[2])
+		datacenter = argv[3]
+		do_validations = True
+		if len(argv) >= 5:
+			if int(argv[4]) == 0:
+				do_validations = False
+			
+		success, data = create_node(plan, datacenter, do_validations)
+		if not success:
+			print >>sys.stderr, data
+			sys.exit(1)
 	
-	sys.exit(0)
+		linode_id = data
+		print linode_id
+		sys.exit(0)
+
+
+
+	elif (cmd == 'update-node'):
+		# Output: The linode ID or nothing on failure
+		# Returns: 0 on success or 1 on failure. Error details on stderr
+		linode_id = int(argv[2])
+		label = argv[3]
+		display_group = argv[4]
 
-elif (cmd == 'create-disk-from-image'):
+		success, data = update_node(linode_id, label, display_group)
+		if not success:
+			print >>sys.stderr, data
+			sys.exit(1)
 	
-	linode_id = int(sys.argv[2])
-	image_id = int(sys.argv[3]) 
-	label = sys.argv[4]
-	disk_size = sys.argv[5]
-	root_password = sys.argv[6] 
-	root_ssh_key_file = sys.argv[7]
+		linode_id = data
+		print linode_id
+		sys.exit(0)
 	
-	success, data = create_disk_from_image(linode_id, image_id, label, disk_size, root_password, root_ssh_key_file)
-	if not success:
-		print >>sys.stderr, data
-		sys.exit(1)
 	
-	disk_id = data[0]
-	job_id = data[1]
-	print "%d,%d" % (disk_id, job_id)
-	sys.exit(0)
-
-elif (cmd == 'images'):
-	list_diskimages()
-
-elif (cmd == 'imagestats'):
-	image_count, total_size = image_stats()
-	print "%d,%d" % (image_count, total_size)
-	
-	sys.exit(0)
-
-elif (cmd == 'image-id'): 
-	# Checks the input argument and returns the numeric image ID
-	# if it's valid.
-	#
-	# Args: Either a numeric image ID (in which case it's just checked for validity
-	#		or a image label which should match output of "image.list"
-	#		
-	# Output: The image ID or nothing
-	# Returns: 0 on success or 1 on failure. Error details on stderr
-	image_id, image_label = find_image(sys.argv[2])
-	if image_id is None:
-		print >> sys.stderr, "Invalid image:", sys.argv[2]
-		sys.exit(1)
-		
-	print "%d,%s" % (image_id, image_label)
-	sys.exit(0)
 
-elif (cmd == 'delete-image'): 
-	# Output: Nothing
-	# Return: 0 if successfully deleted image, 1 if failed. Errors on stderr.
-	image_id = int(sys.argv[2])
-	success, data = delete_image(image_id)
-	if not success:
-		print >>sys.stderr, data
-		sys.exit(1)
+	elif (cmd == 'delete-node'):
+		# Output: Nothing
+		# Returns: 0 on success or 1 on failure. Error details on stderr
+		linode_id = int(argv[2])
+		skip_checks = int(argv[3])
+		success, data = delete_node(linode_id, skip_checks)
+		if not success:
+			print >>sys.stderr, data
+			sys.exit(1)
 	
-	sys.exit(0)
+		sys.exit(0)
+
+	elif (cmd == 'delete-all-nodes'):
+		# Output: Comma separated list of deleted nodes
+		# Returns: 0 on complete success or 1 if there are any errors. Error details on stderr
+		skip_checks = argv[2]
+		deleted_nodes, all_errors = delete_all_nodes(skip_checks)
 	
-elif (cmd == 'delete-all-images'): 
-	deleted_images, all_errors = delete_all_images()
 	
-	print ','.join([str(id) for id in deleted_images])
+		print ','.join([str(id) for id in deleted_nodes])
 	
-	if all_errors:
-		print >>sys.stderr, all_errors
-		sys.exit(1)
+		if all_errors:
+			print >>sys.stderr, all_errors
+			sys.exit(1)
 	
-	sys.exit(0)
+		sys.exit(0)
+
+
+	elif (cmd == 'delete-nodes'):
+		# Deletes several linodes using batched requests.
+		# Args: Comma separated list of linode IDs.
+		#		skip_checks should be 0 to not skip checks, or 1 to skip.
+		# Output: Comma separated list of deleted nodes
+		# Returns: 0 on complete success or 1 if there are any errors. Error details on stderr
+		linode_ids = [int(id) for id in argv[2].split(',') if id]
+		skip_checks = int(argv[3])
+		deleted_nodes, all_errors = delete_nodes(linode_ids, skip_checks)
+	
+		print ','.join([str(id) for id in deleted_nodes])
 	
-elif (cmd == 'api'):
-	# Send details direct to API.
-	# sys.argv[2] should be the api_action
-	# sys.argv[3] should be the appropriate params in JSON format. Keys and string values should be in double quotes.
-	#		Example:	./linode_api.py api test.echo  '{"foo":"bar"}'
-	params = None	
-	if len(sys.argv) > 3:
-		params = json.loads(sys.argv[3])	
+		if all_errors:
+			print >>sys.stderr, all_errors
+			sys.exit(1)
+	
+		sys.exit(0)
+
+	elif (cmd == 'node-info'):
+		# Gets details and IP addresses of several linodes using batched requests.
+		# Args: Comma separated list of linode IDs.
+		# Output: JSON list of linode details, each with an 'IPADDRESSES' list.
+		# Returns: 0 on complete success or 1 if there are any errors. Error details on stderr
+		linode_ids = [int(id) for id in argv[2].split(',') if id]
+		nodes, all_errors = get_nodes_info(linode_ids)
+		
+		print json.dumps(nodes, indent=4, separators=(',',':'))
+		
+		if all_errors:
+			print >>sys.stderr, all_errors
+			sys.exit(1)
+	
+		sys.exit(0)
+
+
+	elif (cmd == 'create-disk'):
+		create_disk(linode_id)
+
+	elif (cmd == 'create-disk-from-distribution'):
+		# Output: "<disk-ID>,<job-ID>" on success, or nothing on failure
+		# Returns: 0 on success or 1 on failure. Error details on stderr
+		linode_id = int(argv[2])
+		distribution = argv[3]
+		disk_size = int(argv[4])
+		root_password = argv[5]
+		root_ssh_key_file = argv[6]
+	
+		success, data = create_disk_from_distribution(linode_id, distribution, disk_size, root_password, root_ssh_key_file)
+		if not success:
+			print >>sys.stderr, data
+			sys.exit(1)
+	
+		disk_id = data[0]
+		job_id = data[1]
+		print "%d,%d" % (disk_id, job_id)
+		sys.exit(0)
+
+	elif (cmd == 'create-swap-disk'):
+		# Output: "<disk-ID>,<job-ID>" on success, or nothing on failure
+		# Returns: 0 on success or 1 on failure. Error details on stderr
+		linode_id = int(argv[2])
+	
+		success, data = create_swap_disk(linode_id)
+		if not success:
+			print >>sys.stderr, data
+			sys.exit(1)
+	
+		disk_id = data[0]
+		job_id = data[1]
+		print "%d,%d" % (disk_id, job_id)
+		sys.exit(0)
+
+	elif (cmd == 'create-disk-from-stackscript'):
+		create_disk_from_stackscript(linode_id, int(argv[2]))
+
+	elif (cmd == 'configs'):
+		list_configs(int(argv[2]))
+
+	elif (cmd == 'create-config'):
+		# Input: disks should be a single argument with comma separated list of disk IDs
+		# Output: <config-ID> on success, or nothing on failure
+		# Returns: 0 on success or 1 on failure. Error details on stderr
+		linode_id = int(argv[2])
+		kernel = argv[3] 
+		disks = argv[4] 
+		config_label = argv[5] 
+		do_validations = True
+		if len(argv) >= 7:
+			if int(argv[6]) == 0:
+				do_validations = False
+	
+		success, data = create_config(linode_id, kernel, disks, config_label, do_validations)
+		if not success:
+			print >>sys.stderr, data
+			sys.exit(1)
+	
+		config_id = data
+		print config_id
+		sys.exit(0)
+
+	elif (cmd == 'create-stackscript'):
+		create_stackscript(argv[2])
+
+	elif (cmd == 'boot'):
+		linode_id = int(argv[2])
+		config_id = None
+		if len(argv) >= 4:
+			config_id = int(argv[3])
+		success, data = boot_node(linode_id, config_id)
+		if not success:
+			print >>sys.stderr, data
+			sys.exit(1)
+	
+		job_id = data
+		print job_id
+		sys.exit(0)
+
+	elif (cmd == 'shutdown'):
+		success, data = shutdown_node(int(argv[2]))
+		if not success:
+			print >>sys.stderr, data
+			sys.exit(1)
+	
+		job_id = data
+		print job_id
+		sys.exit(0)
+
+	elif (cmd == 'clone'):
+		# Output: The new linode ID. It's ready when its pending jobs finish.
+		# Returns: 0 on success or 1 on failure. Error details on stderr
+		success, data = clone_node(int(argv[2]), int(argv[3]), int(argv[4]))
+		if not success:
+			print >>sys.stderr, data
+			sys.exit(1)
+	
+		linode_id = data
+		print linode_id
+		sys.exit(0)
+
+	elif (cmd == 'create-image'):
+		linode_id = int(argv[2])
+		disk_id = int(argv[3])
+		image_label = argv[4]
+		description = ''
+		if len(argv) > 5:
+			description = argv[5]
+	
+		success, data = create_diskimage(linode_id, disk_id, image_label, description)
+		if not success:
+			print >>sys.stderr, data
+			sys.exit(1)
+	
+		image_id = data[0]
+		job_id = data[1]
+		print "%d,%d" % (image_id, job_id)
+	
+		sys.exit(0)
+
+	elif (cmd == 'create-disk-from-image'):
+	
+		linode_id = int(argv[2])
+		image_id = int(argv[3]) 
+		label = argv[4]
+		disk_size = argv[5]
+		root_password = argv[6] 
+		root_ssh_key_file = argv[7]
+	
+		success, data = create_disk_from_image(linode_id, image_id, label, disk_size, root_password, root_ssh_key_file)
+		if not success:
+			print >>sys.stderr, data
+			sys.exit(1)
+	
+		disk_id = data[0]
+		job_id = data[1]
+		print "%d,%d" % (disk_id, job_id)
+		sys.exit(0)
+
+	elif (cmd == 'provision-nodes'):
+		# Creates several nodes from an image concurrently, taking each one through linode creation,
+		# labelling, disk and swap disk creation, configuration profile creation and private IP allocation.
+		#
+		# Args: Plan specification like "2GB:3 4GB:2"
+		#		Datacenter ID, Image ID, Kernel ID (all should be already validated by caller)
+		#		Label prefix for nodes. Each node's label is <prefix>-<linode ID>
+		#		Display group for nodes
+		#		Label of disk created from image. Configuration profile label is <disk label>-configuration
+		#		Disk size, root password, and root SSH public key file as in create-disk-from-image
+		#		(Optional) Maximum number of nodes provisioned concurrently. Default is 8.
+		#
+		# Output: One "<linode ID> <private IP> <public IP>" line for each node as it's provisioned.
+		# Returns: 0 if all nodes were provisioned, 1 if any failed. Error details on stderr
+		success, data = parse_plan_spec(argv[2])
+		if not success:
+			print >>sys.stderr, data
+			sys.exit(1)
+		plan_ids = data
+		
+		concurrency = PROVISION_CONCURRENCY
+		if len(argv) > 12:
+			concurrency = int(argv[12])
+		
+		def print_node(linode_id, private_ip, public_ip):
+			print linode_id, private_ip, public_ip
+			sys.stdout.flush()
+			
+		all_errors = provision_nodes(plan_ids, int(argv[3]), int(argv[4]), int(argv[5]),
+			argv[6], argv[7], argv[8], argv[9], argv[10], argv[11], 
+			concurrency, print_node)
+		
+		if all_errors:
+			print >>sys.stderr, all_errors
+			sys.exit(1)
+			
+		sys.exit(0)
+
+	elif (cmd == 'clone-nodes'):
+		# Creates several nodes concurrently by cloning a golden linode, which should be shut down.
+		# Each clone gets the golden linode's disks and configuration profile, a label, and a private IP.
+		#
+		# Args: Linode ID of golden linode
+		#		Plan specification like "2GB:3 4GB:2". Plans should have room for golden linode's disks.
+		#		Datacenter ID (should be already validated by caller)
+		#		Label prefix for nodes. Each node's label is <prefix>-<linode ID>
+		#		Display group for nodes
+		#		(Optional) Maximum number of nodes provisioned concurrently. Default is 8.
+		#
+		# Output: One "<linode ID> <private IP> <public IP>" line for each node as it's provisioned.
+		# Returns: 0 if all nodes were provisioned, 1 if any failed. Error details on stderr
+		success, data = parse_plan_spec(argv[3])
+		if not success:
+			print >>sys.stderr, data
+			sys.exit(1)
+		plan_ids = data
+		
+		concurrency = PROVISION_CONCURRENCY
+		if len(argv) > 7:
+			concurrency = int(argv[7])
+		
+		def print_node(linode_id, private_ip, public_ip):
+			print linode_id, private_ip, public_ip
+			sys.stdout.flush()
+			
+		all_errors = clone_nodes(int(argv[2]), plan_ids, int(argv[4]), argv[5], argv[6],
+			concurrency, print_node)
+		
+		if all_errors:
+			print >>sys.stderr, all_errors
+			sys.exit(1)
+			
+		sys.exit(0)
+
+	elif (cmd == 'bench-provision'):
+		# Compares provisioning nodes from an image with cloning them from a golden linode.
+		# Nodes are really created, and deleted at the end.
+		# Args: Plan specification like "2GB:3"
+		#		Datacenter ID, Image ID, Kernel ID, and disk size, root password, and root SSH 
+		#		public key file as in provision-nodes
+		#		Linode ID of golden linode, which should be shut down
+		#		(Optional) Maximum number of nodes provisioned concurrently. Default is 8.
+		# Output: Number of nodes, failures, and min/p50/max seconds per node and total seconds of each mode.
+		# Returns: 0 if all nodes were provisioned and deleted, 1 otherwise. Error details on stderr
+		if len(argv) < 10:
+			print "Usage: linode_api.py bench-provision <plan spec> <datacenter ID> <image ID> <kernel ID> " \
+				"<disk size> <root password> <root SSH public key file> <golden linode ID> [<concurrency>]"
+			sys.exit(1)
+			
+		success, data = parse_plan_spec(argv[2])
+		if not success:
+			print >>sys.stderr, data
+			sys.exit(1)
+		plan_ids = data
 		
-	resp = linode_request(sys.argv[2], params)
-	print json.dumps(resp, indent=4, separators=(',',':'))				
+		concurrency = PROVISION_CONCURRENCY
+		if len(argv) > 10:
+			concurrency = int(argv[10])
+		
+		if not compare_provisioning(plan_ids, int(argv[3]), int(argv[4]), int(argv[5]), 
+				int(argv[9]), argv[6], argv[7], argv[8], concurrency):
+			sys.exit(1)
+		sys.exit(0)
+
+	elif (cmd == 'fill-pool'):
+		# Provisions powered off nodes from an image into a warm pool, until it has as many nodes
+		# of each plan as the plan specification. Nodes already being provisioned for it are counted.
+		#
+		# Args: Plan specification like "2GB:3 4GB:2"
+		#		Datacenter ID, Image ID, Kernel ID (all should be already validated by caller)
+		#		Display group of the pool
+		#		Disk label, disk size, root password, and root SSH public key file as in provision-nodes
+		#		(Optional) Maximum number of nodes provisioned concurrently. Default is 8.
+		#
+		# Output: One "<linode ID> <private IP> <public IP>" line for each node as it's added to the pool.
+		# Returns: 0 if all nodes were provisioned, 1 if any failed. Error details on stderr
+		success, data = parse_plan_spec(argv[2])
+		if not success:
+			print >>sys.stderr, data
+			sys.exit(1)
+		plan_ids = data
+
+		concurrency = PROVISION_CONCURRENCY
+		if len(argv) > 11:
+			concurrency = int(argv[11])
+
+		def print_node(linode_id, private_ip, public_ip):
+			print linode_id, private_ip, public_ip
+			sys.stdout.flush()
+
+		all_errors = fill_pool(plan_ids, int(argv[3]), int(argv[4]), int(argv[5]),
+			argv[6], argv[7], argv[8], argv[9], argv[10], concurrency, print_node)
+
+		if all_errors:
+			print >>sys.stderr, all_errors
+			sys.exit(1)
+
+		sys.exit(0)
+
+	elif (cmd == 'claim-pool-nodes'):
+		# Claims nodes from a warm pool by relabelling them and moving them into a display group.
+		#
+		# Args: Plan specification like "2GB:3 4GB:2"
+		#		Datacenter ID
+		#		Display group of the pool
+		#		Label prefix for nodes. Each node's label is <prefix>-<linode ID>
+		#		Display group for nodes
+		#
+		# Output: One "<linode ID> <private IP> <public IP>" line for each claimed node, and
+		#		if the pool did not have enough nodes, a "missed <plan specification>" line at the end.
+		# Returns: 0 on success, even if some plans were missed, or 1 if there were any errors.
+		#		Error details on stderr
+		success, data = parse_plan_spec(argv[2])
+		if not success:
+			print >>sys.stderr, data
+			sys.exit(1)
+		plan_ids = data
+
+		claimed, missed, all_errors = claim_pool_nodes(plan_ids, int(argv[3]), argv[4],
+			argv[5], argv[6])
+		for linode_id, private_ip, public_ip in claimed:
+			print linode_id, private_ip, public_ip
+		if missed:
+			print 'missed', format_plan_spec(missed)
+
+		if all_errors:
+			print >>sys.stderr, all_errors
+			sys.exit(1)
+
+		sys.exit(0)
+
+	elif (cmd == 'pool-nodes'):
+		# Lists the number of nodes in a warm pool.
+		# Args: Display group of the pool
+		#		Datacenter ID
+		# Output: One "<plan> <ready nodes> <nodes being provisioned>" line for each plan in the pool.
+		# Returns: 0 on success or 1 on failure. Error details on stderr
+		success, data = list_pool_nodes(argv[2], int(argv[3]))
+		if not success:
+			print >>sys.stderr, data
+			sys.exit(1)
+		ready, filling, stale = data
+
+		plan_names = dict((plan_id, plan) for plan, plan_id in PLAN_IDS.items())
+		for plan_id in sorted(set(ready.keys() + filling.keys())):
+			print plan_names.get(plan_id, plan_id), len(ready.get(plan_id, [])), len(filling.get(plan_id, []))
+
+		sys.exit(0)
+
+	elif (cmd == 'drain-pool'):
+		# Deletes all nodes of the warm pools whose display groups are a prefix followed by an image ID,
+		# including those being provisioned for them.
+		# Args: Display group prefix of the pools, like "<cluster>-warm-pool-"
+		# Output: Comma separated list of deleted nodes
+		# Returns: 0 on complete success or 1 if there are any errors. Error details on stderr
+		deleted_nodes, all_errors = drain_pool(argv[2])
+
+		print ','.join([str(id) for id in deleted_nodes])
+
+		if all_errors:
+			print >>sys.stderr, all_errors
+			sys.exit(1)
+
+		sys.exit(0)
+
+	elif (cmd == 'images'):
+		list_diskimages()
+
+	elif (cmd == 'imagestats'):
+		image_count, total_size = image_stats()
+		print "%d,%d" % (image_count, total_size)
+	
+		sys.exit(0)
+
+	elif (cmd == 'image-id'): 
+		# Checks the input argument and returns the numeric image ID
+		# if it's valid.
+		#
+		# Args: Either a numeric image ID (in which case it's just checked for validity
+		#		or a image label which should match output of "image.list"
+		#		
+		# Output: The image ID or nothing
+		# Returns: 0 on success or 1 on failure. Error details on stderr
+		image_id, image_label = find_image(argv[2])
+		if image_id is None:
+			print >> sys.stderr, "Invalid image:", argv[2]
+			sys.exit(1)
+		
+		print "%d,%s" % (image_id, image_label)
+		sys.exit(0)
+
+	elif (cmd == 'find-image-fingerprint'):
+		# Finds an available image built from inputs with the given fingerprint, using the cached image.list.
+		#
+		# Output: "<image ID>,<image label>" or nothing
+		# Returns: 0 if there's such an image, 1 if not.
+		img = find_image_by_fingerprint(argv[2])
+		if img is None:
+			sys.exit(1)
+		
+		print "%d,%s" % (img['IMAGEID'], img['LABEL'])
+		sys.exit(0)
+
+	elif (cmd == 'gc-images'):
+		# Deletes least recently used images built by the cluster scripts, until a new image fits
+		# within the account's image quota.
+		#
+		# Args: Size of the new image in MB.
+		#		(Optional) Comma separated IDs of images in use, which are never deleted. Can be "".
+		#		(Optional) Image quota in MB. Default is 10240.
+		#		(Optional) 1 to only list the images that would be deleted. Default is 0.
+		# Output: One "<image ID> <size MB> <label>" line for each deleted image.
+		# Returns: 0 on success or 1 if any image couldn't be deleted. Error details on stderr
+		in_use = []
+		if len(argv) > 3:
+			in_use = [int(image_id) for image_id in argv[3].split(',') if image_id.strip()]
+		quota = IMAGE_QUOTA_MB
+		if len(argv) > 4:
+			quota = int(argv[4])
+		dry_run = len(argv) > 5 and int(argv[5]) == 1
+		
+		evicted, all_errors = gc_images(int(argv[2]), quota, dry_run, in_use)
+		for image_id, label, size in evicted:
+			print image_id, size, label
+		
+		if all_errors:
+			print >>sys.stderr, all_errors
+			sys.exit(1)
+		sys.exit(0)
+
+	elif (cmd == 'delete-image'): 
+		# Output: Nothing
+		# Return: 0 if successfully deleted image, 1 if failed. Errors on stderr.
+		image_id = int(argv[2])
+		success, data = delete_image(image_id)
+		if not success:
+			print >>sys.stderr, data
+			sys.exit(1)
+	
+		sys.exit(0)
+	
+	elif (cmd == 'delete-all-images'): 
+		deleted_images, all_errors = delete_all_images()
+	
+		print ','.join([str(id) for id in deleted_images])
+	
+		if all_errors:
+			print >>sys.stderr, all_errors
+			sys.exit(1)
+	
+		sys.exit(0)
+	
+	elif (cmd == 'benchmark'):
+		# Compares per-request latency with and without connection reuse, using 'test.echo' calls.
+		# Args: (Optional) Number of requests per mode. Default is 100.
+		#		(Optional) API URL to benchmark against. Default is the local simulator, so that
+		#		production API is not loaded by mistake.
+		count = 100
+		if len(argv) > 2:
+			count = int(argv[2])
+	
+		bench_url = API_SIMULATOR_URL
+		if len(argv) > 3:
+			bench_url = argv[3]
+	
+		benchmark_requests(count, bench_url)
+		sys.exit(0)
+
+	elif (cmd == 'bench-catalog'):
+		# Compares linear scans with indexed lookups on a synthetic catalog.
+		# Args: (Optional) Number of images and kernels in catalog. Default is 10000.
+		#		(Optional) Number of lookups of each kind. Default is 1000.
+		count = 10000
+		if len(argv) > 2:
+			count = int(argv[2])
+			
+		lookups = 1000
+		if len(argv) > 3:
+			lookups = int(argv[3])
+			
+		benchmark_catalog(count, lookups)
+		sys.exit(0)
+
+	elif (cmd == 'invalidate-cache'):
+		# Deletes the cached avail.* catalogs of the current API URL, so that they're
+		# fetched again on next use.
+		# Output: Nothing
+		# Returns: 0 on success or 1 on failure.
+		invalidate_catalog_cache()
+		sys.exit(0)
+		
+	elif (cmd == 'api-counters'):
+		# Output: One "<counter> <value>" line for each of the counters of requests, retries, 
+		#			rate limiter waits and requests that were given up.
+		#			These are cumulative for a server when run through linode_api_client.py, 
+		#			else only for this process.
+		# Args: (Optional) 'reset' to reset counters after printing them.
+		with counters_lock:
+			for name in sorted(counters.keys()):
+				print name, counters[name]
+				if len(argv) > 2 and argv[2] == 'reset':
+					counters[name] = 0
+		sys.exit(0)
+
+	elif (cmd == 'api'):
+		# Send details direct to API.
+		# argv[2] should be the api_action
+		# argv[3] should be the appropriate params in JSON format. Keys and string values should be in double quotes.
+		#		Example:	./linode_api.py api test.echo  '{"foo":"bar"}'
+		params = None	
+		if len(argv) > 3:
+			params = json.loads(argv[3])	
+		
+		resp = linode_request(argv[2], params)
+		print json.dumps(resp, indent=4, separators=(',',':'))				
+
+
+def main():
+	global api_key, url
+	
+	if len(sys.argv) <= 1:
+		print "No command"
+		sys.exit(0)
+
+	if sys.argv[1] == 'stats':
+		# Summarizes a trace file. It doesn't need an API environment.
+		# Args: Path of trace file written with LINODE_API_TRACE.
+		#		(Optional) An action, like 'linode.job.list', for a histogram of its latencies.
+		# Output: Count, errors, p50/p95/p99/max latency, total time and bytes of each action.
+		# Returns: 0 on success or 1 if trace file can't be read.
+		if len(sys.argv) < 3:
+			print "Usage: linode_api.py stats <trace file> [<action>]"
+			sys.exit(1)
+		try:
+			trace_stats(sys.argv[2], sys.argv[3] if len(sys.argv) > 3 else None)
+		except IOError as e:
+			print >> sys.stderr, "Unable to read trace file:", e
+			sys.exit(1)
+		sys.exit(0)
+
+	api_key = os.getenv('LINODE_KEY', None)
+	if (api_key is None):
+		print "Error : LINODE_KEY environment var is not defined"
+		sys.exit(1)
+
+	url = os.getenv('LINODE_API_URL', None)
+	if (url is None):
+		print "Error : LINODE_API_URL environment var is not defined"
+		sys.exit(1)
+
+	#if url == API_PRODUCTION_URL:
+		#print >> sys.stderr, "**** CAUTION: USING PRODUCTION URL"
+
+	if sys.argv[1] == 'serve':
+		# Runs as a long running server for linode_api_client.py.
+		# Args: Path of UNIX socket to listen on.
+		#		(Optional) Idle timeout in seconds after which server exits. Default is 600. 0 means never.
+		# Returns: 0 after server exits normally, 1 if another server is already listening on the socket.
+		idle_timeout = 600
+		if len(sys.argv) > 3:
+			idle_timeout = int(sys.argv[3])
+		
+		if not serve(sys.argv[2], idle_timeout):
+			sys.exit(1)
+		sys.exit(0)
+		
+	run_command(sys.argv)
+
+
 
+if __name__ == '__main__':
+	# linode_api_async imports this module as linode_api. It should get this same module, rather
+	# than a second copy with its own client, rate limiter, tracer and counters.
+	sys.modules.setdefault('linode_api', sys.modules[__name__])
+	main()
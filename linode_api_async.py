@@ -0,0 +1,976 @@
+#!/usr/bin/python
+
+# Non-blocking variant of the linode_api.py operations, so that a single thread can drive
+# hundreds of in-flight linode operations and job polls.
+#
+# These scripts run on Python 2, which has no asyncio. So this module has its own small
+# event loop based on select(), with coroutines written as generators in the same style
+# as asyncio's original generator based coroutines:
+#	- A coroutine yields a Future, another coroutine, or a list of them, to wait for its result.
+#	- A coroutine returns a value by raising Return(value).
+#
+# Example:
+#	api = AsyncLinodeClient(url, api_key)
+#	results = run(gather(get_event_loop(), [create_node(api, 1, 2) for i in range(10)]))
+#
+# Synchronous code can call any of the operations below with run(), which runs a coroutine
+# to completion on the default event loop. The operations of the same name in linode_api.py
+# are such wrappers, which all threads run on one LoopThread with a shared client.
+#
+# Requests are paced by the same token bucket and retried on the same errors as linode_api.py.
+
+import socket
+import ssl
+import errno
+import select
+import heapq
+import itertools
+import collections
+import types
+import urllib
+import urllib2
+import urlparse
+import httplib
+import json
+import time
+import os
+import sys
+import threading
+import Queue
+
+import linode_api
+
+
+class Return(Exception):
+	def __init__(self, value=None):
+		Exception.__init__(self)
+		self.value = value
+
+
+
+class Future(object):
+
+	def __init__(self, loop):
+		self.loop = loop
+		self.done = False
+		self.value = None
+		self.exc_info = None
+		self.callbacks = []
+
+
+	def set_result(self, value):
+		if self.done:
+			return
+		self.done = True
+		self.value = value
+		self._schedule_callbacks()
+
+
+	def set_exception(self, exc_info):
+		if self.done:
+			return
+		self.done = True
+		self.exc_info = exc_info
+		self._schedule_callbacks()
+
+
+	# Callbacks are always run by the loop, never directly, so that a long chain
+	# of completed futures doesn't grow the stack.
+	def add_done_callback(self, callback):
+		if self.done:
+			self.loop.call_soon(callback, self)
+		else:
+			self.callbacks.append(callback)
+
+
+	def result(self):
+		if self.exc_info is not None:
+			raise self.exc_info[0], self.exc_info[1], self.exc_info[2]
+		return self.value
+
+
+	def _schedule_callbacks(self):
+		for callback in self.callbacks:
+			self.loop.call_soon(callback, self)
+		self.callbacks = []
+
+
+
+# Runs a generator coroutine, resuming it with the result of each Future it yields.
+# The Task itself is a Future of the coroutine's return value.
+class Task(Future):
+
+	def __init__(self, loop, coro):
+		Future.__init__(self, loop)
+		self.coro = coro
+		loop.call_soon(self._step, None, None)
+
+
+	def _step(self, value, exc_info):
+		try:
+			if exc_info is not None:
+				yielded = self.coro.throw(*exc_info)
+			else:
+				yielded = self.coro.send(value)
+
+		except Return as r:
+			self.set_result(r.value)
+			return
+		except StopIteration:
+			self.set_result(None)
+			return
+		except Exception:
+			self.set_exception(sys.exc_info())
+			return
+
+		if isinstance(yielded, types.GeneratorType):
+			yielded = Task(self.loop, yielded)
+		elif isinstance(yielded, list):
+			yielded = gather(self.loop, yielded)
+		yielded.add_done_callback(self._wakeup)
+
+
+	def _wakeup(self, future):
+		if future.exc_info is not None:
+			self._step(None, future.exc_info)
+		else:
+			self._step(future.value, None)
+
+
+
+# Returns a Future of the list of results of 'items', which may be futures or coroutines.
+# If any of them fails, the returned future fails with its exception.
+def gather(loop, items):
+	futures = [item if isinstance(item, Future) else Task(loop, item) for item in items]
+	result = Future(loop)
+	if not futures:
+		result.set_result([])
+		return result
+
+	remaining = [len(futures)]
+	def on_done(future):
+		if future.exc_info is not None:
+			result.set_exception(future.exc_info)
+			return
+		remaining[0] -= 1
+		if remaining[0] == 0:
+			result.set_result([f.value for f in futures])
+
+	for future in futures:
+		future.add_done_callback(on_done)
+	return result
+
+
+
+class EventLoop(object):
+
+	def __init__(self):
+		self.ready = collections.deque()
+		self.timers = []
+		self.sequence = itertools.count()
+		self.readers = {}
+		self.writers = {}
+
+
+	def call_soon(self, callback, *args):
+		self.ready.append((callback, args))
+
+
+	def call_later(self, delay, callback, *args):
+		timer = [time.time() + delay, next(self.sequence), callback, args, False]
+		heapq.heappush(self.timers, timer)
+		return timer
+
+
+	def cancel_timer(self, timer):
+		timer[4] = True
+
+
+	def spawn(self, coro):
+		return Task(self, coro)
+
+
+	def sleep(self, delay):
+		future = Future(self)
+		self.call_later(delay, future.set_result, None)
+		return future
+
+
+	# Returns a Future that's done when 'sock' is readable, or fails with socket.timeout.
+	def wait_readable(self, sock, timeout=None):
+		return self._wait_io(self.readers, sock, timeout)
+
+
+	def wait_writable(self, sock, timeout=None):
+		return self._wait_io(self.writers, sock, timeout)
+
+
+	def _wait_io(self, waiters, sock, timeout):
+		future = Future(self)
+		fd = sock.fileno()
+		timer = None
+		if timeout is not None:
+			def on_timeout():
+				waiters.pop(fd, None)
+				future.set_exception((socket.timeout, socket.timeout('timed out'), None))
+			timer = self.call_later(timeout, on_timeout)
+
+		def on_ready():
+			if timer is not None:
+				self.cancel_timer(timer)
+			future.set_result(None)
+		waiters[fd] = on_ready
+		return future
+
+
+	def run_until_complete(self, coro):
+		task = coro if isinstance(coro, Future) else Task(self, coro)
+		while not task.done:
+			self._run_once()
+		return task.result()
+
+
+	def _run_once(self):
+		timeout = None
+		if self.ready:
+			timeout = 0
+		elif self.timers:
+			timeout = max(0, self.timers[0][0] - time.time())
+		elif not self.readers and not self.writers:
+			raise RuntimeError('Event loop has nothing to wait for')
+
+		if self.readers or self.writers:
+			try:
+				readable, writable, _ = select.select(self.readers.keys(), self.writers.keys(), [], timeout)
+			except select.error as e:
+				if e.args[0] != errno.EINTR:
+					raise
+				readable, writable = [], []
+			for fd in readable:
+				self.ready.append((self.readers.pop(fd), ()))
+			for fd in writable:
+				self.ready.append((self.writers.pop(fd), ()))
+		elif timeout:
+			time.sleep(timeout)
+
+		now = time.time()
+		while self.timers and self.timers[0][0] <= now:
+			due, seq, callback, args, cancelled = heapq.heappop(self.timers)
+			if not cancelled:
+				self.ready.append((callback, args))
+
+		for i in range(len(self.ready)):
+			callback, args = self.ready.popleft()
+			callback(*args)
+
+
+
+default_loop = None
+
+# Returns the default event loop of this process, creating it on first use.
+def get_event_loop():
+	global default_loop
+	if default_loop is None:
+		default_loop = EventLoop()
+	return default_loop
+
+
+
+# An event loop that runs on its own daemon thread, so that synchronous code on any number
+# of threads can run coroutines on it, and share the connections of a client on it.
+class LoopThread(object):
+
+	def __init__(self):
+		self.loop = EventLoop()
+		self.submitted = collections.deque()
+		# Other threads wake up the loop from select() by writing to this socket pair.
+		self.wake_reader, self.wake_writer = socket.socketpair()
+		self.wake_reader.setblocking(0)
+		self.wake_writer.setblocking(0)
+		self.thread = threading.Thread(target=self._run, name='event-loop')
+		self.thread.daemon = True
+		self.thread.start()
+
+
+	def _run(self):
+		self._listen()
+		while True:
+			self.loop._run_once()
+
+
+	def _listen(self):
+		self.loop.wait_readable(self.wake_reader).add_done_callback(self._on_wake)
+
+
+	def _on_wake(self, future):
+		try:
+			while self.wake_reader.recv(4096):
+				pass
+		except socket.error as e:
+			if e.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+				raise
+		self._listen()
+		while self.submitted:
+			callback, args = self.submitted.popleft()
+			self.loop.call_soon(callback, *args)
+
+
+	# Schedules 'callback' on the loop from any thread.
+	def call_soon_threadsafe(self, callback, *args):
+		self.submitted.append((callback, args))
+		try:
+			self.wake_writer.send('.')
+		except socket.error as e:
+			# A full socket buffer means the loop has a wake up pending anyway.
+			if e.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+				raise
+
+
+	# Runs 'coro' on the loop and waits for its result, from a thread other than the loop's.
+	# While waiting, this thread calls each (function, args) put in the 'calls' queue by the
+	# coroutine, so that callbacks run on the thread that's waiting for them, with its output.
+	def run(self, coro, calls=None):
+		results = calls or Queue.Queue()
+		def start():
+			Task(self.loop, coro).add_done_callback(results.put)
+		self.call_soon_threadsafe(start)
+
+		while True:
+			# Waiting with a timeout keeps the thread interruptible by signals.
+			try:
+				item = results.get(True, 1)
+			except Queue.Empty:
+				continue
+			if isinstance(item, Future):
+				return item.result()
+			func, args = item
+			func(*args)
+
+
+
+# A non-blocking HTTP/1.1 connection that supports keep-alive, and responses with
+# Content-Length, chunked transfer encoding, or a body that ends when the connection closes.
+# 'address' is the resolved IP address of 'host', since resolving it would block the loop.
+class AsyncConnection(object):
+
+	def __init__(self, loop, scheme, host, port, timeout, address):
+		self.loop = loop
+		self.scheme = scheme
+		self.host = host
+		self.port = port or (443 if scheme == 'https' else 80)
+		self.timeout = timeout
+		self.address = address
+		self.sock = None
+		self.buf = ''
+
+
+	def connect(self):
+		sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+		sock.setblocking(0)
+		err = sock.connect_ex((self.address, self.port))
+		if err not in (0, errno.EINPROGRESS, errno.EWOULDBLOCK):
+			sock.close()
+			raise socket.error(err, os.strerror(err))
+
+		yield self.loop.wait_writable(sock, self.timeout)
+		err = sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+		if err != 0:
+			sock.close()
+			raise socket.error(err, os.strerror(err))
+
+		if self.scheme == 'https':
+			context = ssl.create_default_context()
+			sock = context.wrap_socket(sock, server_hostname=self.host, do_handshake_on_connect=False)
+			while True:
+				try:
+					sock.do_handshake()
+					break
+				except ssl.SSLWantReadError:
+					yield self.loop.wait_readable(sock, self.timeout)
+				except ssl.SSLWantWriteError:
+					yield self.loop.wait_writable(sock, self.timeout)
+
+		self.sock = sock
+
+
+	def close(self):
+		if self.sock is not None:
+			self.sock.close()
+			self.sock = None
+
+
+	def _send_all(self, data):
+		while data:
+			try:
+				sent = self.sock.send(data)
+				data = data[sent:]
+			except ssl.SSLWantWriteError:
+				yield self.loop.wait_writable(self.sock, self.timeout)
+			except ssl.SSLWantReadError:
+				yield self.loop.wait_readable(self.sock, self.timeout)
+			except socket.error as e:
+				if e.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+					raise
+				yield self.loop.wait_writable(self.sock, self.timeout)
+
+
+	# Reads more data into the buffer. Returns False on end of stream.
+	def _fill(self):
+		while True:
+			try:
+				data = self.sock.recv(65536)
+				break
+			except ssl.SSLWantReadError:
+				yield self.loop.wait_readable(self.sock, self.timeout)
+			except ssl.SSLWantWriteError:
+				yield self.loop.wait_writable(self.sock, self.timeout)
+			except socket.error as e:
+				if e.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+					raise
+				yield self.loop.wait_readable(self.sock, self.timeout)
+
+		self.buf += data
+		raise Return(len(data) > 0)
+
+
+	def _read_until(self, delimiter):
+		while delimiter not in self.buf:
+			more = yield self._fill()
+			if not more:
+				raise httplib.IncompleteRead(self.buf)
+		i = self.buf.index(delimiter) + len(delimiter)
+		data, self.buf = self.buf[:i], self.buf[i:]
+		raise Return(data)
+
+
+	def _read_exact(self, size):
+		while len(self.buf) < size:
+			more = yield self._fill()
+			if not more:
+				raise httplib.IncompleteRead(self.buf, size - len(self.buf))
+		data, self.buf = self.buf[:size], self.buf[size:]
+		raise Return(data)
+
+
+	def _read_to_eof(self):
+		while True:
+			more = yield self._fill()
+			if not more:
+				break
+		data, self.buf = self.buf, ''
+		raise Return(data)
+
+
+	# Sends a POST request and returns (status, reason, headers, body, will_close).
+	# Header names are in title case, like 'Content-Length'.
+	def post(self, path, body, headers):
+		if self.sock is None:
+			yield self.connect()
+
+		lines = ['POST %s HTTP/1.1' % path, 'Host: %s' % self.host, 'Content-Length: %d' % len(body)]
+		lines.extend(['%s: %s' % (name, value) for name, value in headers.items()])
+		yield self._send_all('\r\n'.join(lines) + '\r\n\r\n' + body)
+
+		# A keep-alive connection closed by the server shows up as an empty status line.
+		if not self.buf:
+			more = yield self._fill()
+			if not more:
+				raise httplib.BadStatusLine('')
+
+		head = yield self._read_until('\r\n\r\n')
+		head_lines = head.split('\r\n')
+		parts = head_lines[0].split(' ', 2)
+		if len(parts) < 2 or not parts[0].startswith('HTTP/'):
+			raise httplib.BadStatusLine(head_lines[0])
+		version, status, reason = parts[0], int(parts[1]), parts[2] if len(parts) > 2 else ''
+
+		response_headers = {}
+		for line in head_lines[1:]:
+			if ':' in line:
+				name, value = line.split(':', 1)
+				response_headers[name.strip().title()] = value.strip()
+
+		connection = response_headers.get('Connection', '').lower()
+		will_close = connection == 'close' or (version == 'HTTP/1.0' and connection != 'keep-alive')
+
+		if response_headers.get('Transfer-Encoding', '').lower() == 'chunked':
+			chunks = []
+			while True:
+				size_line = yield self._read_until('\r\n')
+				size = int(size_line.split(';')[0].strip(), 16)
+				if size == 0:
+					# Skip trailers
+					while (yield self._read_until('\r\n')) != '\r\n':
+						pass
+					break
+				chunk = yield self._read_exact(size + 2)
+				chunks.append(chunk[:-2])
+			response_body = ''.join(chunks)
+
+		elif 'Content-Length' in response_headers:
+			response_body = yield self._read_exact(int(response_headers['Content-Length']))
+
+		else:
+			response_body = yield self._read_to_eof()
+			will_close = True
+
+		raise Return((status, reason, response_headers, response_body, will_close))
+
+
+
+# Asynchronous equivalent of linode_api.LinodeClient, with a pool of upto 'pool_size'
+# keep-alive connections shared by all coroutines on the loop. Coroutines beyond that
+# wait for a connection to be released.
+# The API host is resolved once when the client is created, instead of by every connection
+# on the loop, where a slow DNS lookup would hold up all coroutines.
+class AsyncLinodeClient(object):
+
+	def __init__(self, api_url, key, pool_size=linode_api.POOL_SIZE,
+			timeout=linode_api.TIMEOUT, retries=linode_api.RETRIES, loop=None):
+		self.loop = loop or get_event_loop()
+		self.api_url = api_url
+		self.key = key
+		self.pool_size = pool_size
+		self.timeout = timeout
+		self.retries = retries
+
+		parts = urlparse.urlsplit(api_url)
+		self.scheme = parts.scheme
+		self.host = parts.hostname
+		self.port = parts.port
+		self.path = parts.path or '/'
+		self.address = socket.gethostbyname(self.host)
+
+		self.idle = []
+		self.active = 0
+		self.waiters = collections.deque()
+
+
+	def _acquire(self):
+		if self.idle:
+			self.active += 1
+			return self.idle.pop(), True
+		if self.active < self.pool_size:
+			self.active += 1
+			return AsyncConnection(self.loop, self.scheme, self.host, self.port, self.timeout,
+				self.address), False
+		return None, False
+
+
+	def _wait_for_connection(self):
+		while True:
+			conn, reused = self._acquire()
+			if conn is not None:
+				raise Return((conn, reused))
+			waiter = Future(self.loop)
+			self.waiters.append(waiter)
+			yield waiter
+
+
+	def _release(self, conn, reusable):
+		self.active -= 1
+		if reusable:
+			self.idle.append(conn)
+		else:
+			conn.close()
+		if self.waiters:
+			self.waiters.popleft().set_result(None)
+
+
+	# Sends an already urlencoded request body and returns the raw response body.
+	# Failures due to a closed or reset connection are retried like in LinodeClient.send().
+	def send(self, body):
+		headers = {
+			'Content-Type' : 'application/x-www-form-urlencoded',
+			'Connection' : 'keep-alive'
+		}
+		attempt = 0
+		while True:
+			conn, reused = yield self._wait_for_connection()
+			try:
+				status, reason, response_headers, data, will_close = yield conn.post(self.path, body, headers)
+
+			except (httplib.BadStatusLine, httplib.IncompleteRead, socket.error) as e:
+				self._release(conn, False)
+				if attempt >= self.retries or not linode_api.is_connection_reset(e, reused):
+					raise
+				attempt += 1
+				continue
+
+			except:
+				self._release(conn, False)
+				raise
+
+			self._release(conn, not will_close)
+
+			if status != 200:
+				raise urllib2.HTTPError(self.api_url, status, reason, response_headers, None)
+
+			raise Return(data)
+
+
+	# Sends an API request, paced by the shared rate limiter, and retries it like
+	# linode_api.linode_request() if it's throttled. Returns the parsed JSON response.
+	def request(self, action, params):
+		data = {
+			'api_key' : self.key,
+			'api_action' : action
+		}
+		if params is not None:
+			data.update(params)
+		body = urllib.urlencode(data)
+
+		attempt = 0
+		while True:
+			linode_api.count('requests')
+			limiter = linode_api.get_rate_limiter()
+			if limiter:
+				wait = limiter.reserve()
+				if wait > 0:
+					linode_api.count('throttle_waits')
+					linode_api.count('throttle_wait_seconds', wait)
+					yield self.loop.sleep(wait)
+
+			http_error = None
+			start = time.time()
+			try:
+				data = yield self.send(body)
+			except Exception as e:
+				linode_api.trace(action, params, start, len(body), 0, [linode_api.exception_error_code(e)])
+				if not linode_api.is_retryable_http_error(e, action, params):
+					raise
+				http_error = e
+			else:
+				resp = json.loads(data)
+				linode_api.trace(action, params, start, len(body), len(data), linode_api.response_error_codes(resp))
+
+			if http_error is None and not linode_api.is_throttled(resp):
+				raise Return(resp)
+
+			delay = linode_api.retry_delay(attempt, http_error)
+			if delay is None:
+				linode_api.count('give_ups')
+				if http_error is not None:
+					raise http_error
+				raise Return(resp)
+
+			linode_api.count('retries')
+			yield self.loop.sleep(delay)
+			attempt += 1
+
+
+	def close(self):
+		for conn in self.idle:
+			conn.close()
+		self.idle = []
+
+
+
+# Runs a coroutine to completion on the default event loop, for use from synchronous code.
+def run(coro):
+	return get_event_loop().run_until_complete(coro)
+
+
+
+# Operations. Each returns the same values as the function of the same name in linode_api.py.
+
+def create_node(api, plan, datacenter):
+	resp = yield api.request('linode.create', {'PLANID' : plan, 'DATACENTERID' : datacenter})
+	iserr, errors = linode_api.is_error(resp)
+	if iserr:
+		raise Return((False, errors))
+	raise Return((True, resp['DATA']['LinodeID']))
+
+
+def update_node(api, linode_id, label, display_group):
+	resp = yield api.request('linode.update',
+		{'LinodeID' : linode_id, 'Label' : label, 'lpm_displayGroup' : display_group})
+	iserr, errors = linode_api.is_error(resp)
+	if iserr:
+		raise Return((False, errors))
+	raise Return((True, resp['DATA']['LinodeID']))
+
+
+def delete_node(api, linode_id, skip_checks):
+	resp = yield api.request('linode.delete', {'LinodeID' : linode_id, 'skipChecks' : skip_checks})
+	iserr, errors = linode_api.is_error(resp)
+	if iserr:
+		raise Return((False, errors))
+	raise Return((True, resp['DATA']['LinodeID']))
+
+
+def get_node_memory(api, linode_id):
+	resp = yield api.request('linode.list', {'LinodeID' : linode_id})
+	nodes = resp['DATA']
+	if nodes:
+		raise Return(nodes[0]['TOTALRAM'])
+	raise Return(None)
+
+
+def create_disk_from_image(api, linode_id, image_id, label, disk_size, root_password, root_ssh_key_file):
+	params = {
+		'ImageID' : image_id,
+		'LinodeID' : linode_id,
+		'rootPass' : root_password,
+		'rootSSHKey' : linode_api.read_public_key(root_ssh_key_file),
+		'Label' : label,
+		'Size' : disk_size
+	}
+	resp = yield api.request('linode.disk.createfromimage', params)
+	iserr, errors = linode_api.is_error(resp)
+	if iserr:
+		raise Return((False, errors))
+
+	# For 'creatediskfromimage', the returned keys are uppercase, not lowercase.
+	raise Return((True, (resp['DATA']['DISKID'], resp['DATA']['JOBID'])))
+
+
+# Unlike linode_api.create_disk_from_distribution, the distribution should be an already
+# validated distribution ID, and its label is used as the disk label.
+def create_disk_from_distribution(api, linode_id, distribution_id, distribution_label, disk_size,
+		root_password, root_ssh_key_file):
+	params = {
+		'LinodeID' : linode_id,
+		'DistributionID' : distribution_id,
+		'rootPass' : root_password,
+		'rootSSHKey' : linode_api.read_public_key(root_ssh_key_file),
+		'Label' : distribution_label,
+		'Size' : disk_size
+	}
+	resp = yield api.request('linode.disk.createfromdistribution', params)
+	iserr, errors = linode_api.is_error(resp)
+	if iserr:
+		raise Return((False, errors))
+	raise Return((True, (resp['DATA']['DiskID'], resp['DATA']['JobID'])))
+
+
+def create_swap_disk(api, linode_id):
+	ram_mb = yield get_node_memory(api, linode_id)
+	params = {
+		'LinodeID' : linode_id,
+		'Type' : 'swap',
+		'Size' : linode_api.swap_disk_size(int(ram_mb)),
+		'Label' : 'swapdisk'
+	}
+	resp = yield api.request('linode.disk.create', params)
+	iserr, errors = linode_api.is_error(resp)
+	if iserr:
+		raise Return((False, errors))
+	raise Return((True, (resp['DATA']['DiskID'], resp['DATA']['JobID'])))
+
+
+# Unlike linode_api.create_config, the kernel should be an already validated kernel ID.
+def create_config(api, linode_id, kernel_id, disks, config_label):
+	params = {
+		'LinodeID' : int(linode_id),
+		'KernelID' : kernel_id,
+		'Label' : config_label,
+		'DiskList' : disks
+	}
+	resp = yield api.request('linode.config.create', params)
+	iserr, errors = linode_api.is_error(resp)
+	if iserr:
+		raise Return((False, errors))
+	raise Return((True, resp['DATA']['ConfigID']))
+
+
+def boot_node(api, linode_id, config_id=None):
+	params = {'LinodeID' : linode_id}
+	if config_id:
+		params['ConfigID'] = config_id
+	resp = yield api.request('linode.boot', params)
+	iserr, errors = linode_api.is_error(resp)
+	if iserr:
+		raise Return((False, errors))
+	raise Return((True, resp['DATA']['JobID']))
+
+
+def shutdown_node(api, linode_id):
+	resp = yield api.request('linode.shutdown', {'LinodeID' : linode_id})
+	iserr, errors = linode_api.is_error(resp)
+	if iserr:
+		raise Return((False, errors))
+	raise Return((True, resp['DATA']['JobID']))
+
+
+def create_diskimage(api, linode_id, disk_id, image_label, description=''):
+	resp = yield api.request('linode.disk.imagize',
+		{'LinodeID' : linode_id, 'DiskID' : disk_id, 'Label' : image_label, 'Description' : description})
+	iserr, errors = linode_api.is_error(resp)
+	if iserr:
+		raise Return((False, errors))
+	linode_api.invalidate_catalog_cache('image.list')
+	raise Return((True, (resp['DATA']['ImageID'], resp['DATA']['JobID'])))
+
+
+def add_private_ip(api, linode_id):
+	resp = yield api.request('linode.ip.addprivate', {'LinodeID' : linode_id})
+	iserr, errors = linode_api.is_error(resp)
+	if iserr:
+		raise Return((False, errors))
+	raise Return((True, resp['DATA']['IPADDRESS']))
+
+
+def get_public_ip_address(api, linode_id):
+	resp = yield api.request('linode.ip.list', {'LinodeID' : linode_id})
+	for address in resp['DATA']:
+		if address['ISPUBLIC'] == 1:
+			raise Return(address['IPADDRESS'])
+	raise Return(None)
+
+
+def is_job_finished(api, linode_id, job_id):
+	resp = yield api.request('linode.job.list', {'LinodeID' : linode_id, 'JobID' : job_id})
+	jobs = resp['DATA']
+	if jobs:
+		raise Return(linode_api.job_state(jobs[0]))
+	raise Return((None, None))
+
+
+# Polls a job with the same backoff as linode_api.wait_jobs, without blocking other coroutines.
+# Returns: 0 if job is still pending after timeout, 1 if it completed, 2 if it failed,
+#	and 3 if its status could not be found, like wait_for_job in the shell scripts.
+def wait_for_job(api, linode_id, job_id, timeout=linode_api.PROVISION_JOB_TIMEOUT):
+	deadline = time.time() + timeout
+	interval = linode_api.WAIT_JOBS_FIRST_INTERVAL
+	while True:
+		finished, success = yield is_job_finished(api, linode_id, job_id)
+		if finished is None:
+			raise Return(3)
+		if finished:
+			raise Return(1 if success else 2)
+
+		remaining = deadline - time.time()
+		if remaining <= 0:
+			raise Return(0)
+		yield api.loop.sleep(min(interval, remaining))
+		interval = min(interval * 2, linode_api.WAIT_JOBS_MAX_INTERVAL)
+
+
+# Same stages as linode_api.provision_node.
+def provision_node(api, plan_id, datacenter_id, image_id, kernel_id, node_label_prefix, display_group,
+		disk_label, disk_size, root_password, root_ssh_key_file):
+
+	success, data = yield create_node(api, plan_id, datacenter_id)
+	if not success:
+		raise Return((False, ['Failed to create linode. Error:%s' % data]))
+	linode_id = data
+
+	try:
+		result = yield setup_node(api, linode_id, image_id, kernel_id, node_label_prefix, display_group,
+			disk_label, disk_size, root_password, root_ssh_key_file)
+	except Exception as e:
+		result = (False, ['Linode %d: %s: %s' % (linode_id, type(e).__name__, e)])
+
+	# The caller gets no linode ID on failure, so the linode is deleted rather than left behind.
+	if not result[0]:
+		success, data = yield delete_node(api, linode_id, 1)
+		if not success:
+			result[1].append('Linode %d: Failed to delete it. Error:%s' % (linode_id, data))
+	raise Return(result)
+
+
+# Takes a just created linode through the rest of the stages of provision_node.
+# Returns: Same as provision_node.
+def setup_node(api, linode_id, image_id, kernel_id, node_label_prefix, display_group,
+		disk_label, disk_size, root_password, root_ssh_key_file):
+
+	def failed(stage, errors):
+		return Return((False, ['Linode %d: Failed to %s. Error:%s' % (linode_id, stage, errors)]))
+
+	success, data = yield update_node(api, linode_id, '%s-%d' % (node_label_prefix, linode_id), display_group)
+	if not success:
+		raise failed('update node label', data)
+
+	success, data = yield create_disk_from_image(api, linode_id, image_id, disk_label, disk_size,
+		root_password, root_ssh_key_file)
+	if not success:
+		raise failed('create disk from image', data)
+	disk_id, disk_job_id = data
+
+	success, data = yield create_swap_disk(api, linode_id)
+	if not success:
+		raise failed('create swap disk', data)
+	swap_disk_id, swap_disk_job_id = data
+
+	statuses = yield [wait_for_job(api, linode_id, disk_job_id), wait_for_job(api, linode_id, swap_disk_job_id)]
+	if statuses != [1, 1]:
+		raise failed('create disks', 'Job statuses %s' % statuses)
+
+	success, data = yield create_config(api, linode_id, kernel_id, '%d,%d' % (disk_id, swap_disk_id),
+		disk_label + '-configuration')
+	if not success:
+		raise failed('create configuration', data)
+
+	success, data = yield add_private_ip(api, linode_id)
+	if not success:
+		raise failed('add private IP address', data)
+	private_ip = data
+
+	public_ip = yield get_public_ip_address(api, linode_id)
+	if public_ip is None:
+		raise failed('get public IP address', 'No public IP address')
+
+	raise Return((True, (linode_id, private_ip, public_ip)))
+
+
+# Provisions a node for each plan ID in 'plan_ids', with upto 'concurrency' of them in progress
+# at a time, or all at the same time if it's None. 'node_args' is a tuple of the other args
+# of provision_node. on_done(result) is called with each node's result as it completes.
+# Returns: A (success, data) tuple from provision_node for each node, in the same order.
+def provision_nodes(api, plan_ids, node_args, concurrency=None, on_done=None):
+	plan_ids = list(plan_ids)
+	results = [None] * len(plan_ids)
+	indexes = iter(range(len(plan_ids)))
+
+	# Workers take the next node from the shared iterator till there are none left.
+	def worker():
+		for i in indexes:
+			try:
+				results[i] = yield provision_node(api, plan_ids[i], *node_args)
+			except Exception as e:
+				results[i] = (False, ['%s: %s' % (type(e).__name__, e)])
+			if on_done:
+				on_done(results[i])
+
+	yield [worker() for i in range(min(concurrency or len(plan_ids), len(plan_ids)))]
+	raise Return(results)
+
+
+
+# Measures wall time of 'count' concurrent 'test.echo' requests on a single thread.
+def benchmark(count, bench_url, pool_size):
+	loop = get_event_loop()
+	api = AsyncLinodeClient(bench_url, linode_api.api_key, pool_size=pool_size)
+
+	def echo(i):
+		resp = yield api.request('test.echo', {'seq' : i})
+		raise Return(resp['DATA']['seq'] == str(i))
+
+	start = time.time()
+	results = loop.run_until_complete(gather(loop, [echo(i) for i in range(count)]))
+	elapsed = time.time() - start
+	api.close()
+	print '%d requests over %d connections in %.2f seconds (%.0f requests/second), %d correct' % (
+		count, pool_size, elapsed, count / elapsed, results.count(True))
+
+
+
+if __name__ == '__main__':
+	linode_api.api_key = os.getenv('LINODE_KEY', '')
+
+	if len(sys.argv) > 1 and sys.argv[1] == 'benchmark':
+		# Args: (Optional) Number of concurrent requests. Default is 200.
+		#		(Optional) API URL to benchmark against. Default is the local simulator.
+		#		(Optional) Number of pooled connections. Default is 20.
+		count = int(sys.argv[2]) if len(sys.argv) > 2 else 200
+		bench_url = sys.argv[3] if len(sys.argv) > 3 else linode_api.API_SIMULATOR_URL
+		pool_size = int(sys.argv[4]) if len(sys.argv) > 4 else 20
+
+		# Pacing would dominate the measurement, so it's disabled unless explicitly configured.
+		os.environ.setdefault('LINODE_API_RATE_LIMIT', '0')
+		benchmark(count, bench_url, pool_size)
+
+	else:
+		print "Usage: linode_api_async.py benchmark [count] [url] [pool size]"
+		sys.exit(1)
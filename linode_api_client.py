@@ -0,0 +1,61 @@
+#!/usr/bin/python -S
+
+# Thin client for a linode_api.py server started with "./linode_api.py serve <socket>".
+# It accepts the same arguments as linode_api.py and reproduces its stdout, stderr and
+# exit code, but avoids the cost of starting a full interpreter and importing
+# linode_api.py on every API call. "-S" skips site imports for the same reason.
+#
+# The server's UNIX socket path is read from LINODE_API_SOCKET env var. If no server
+# is listening on it, the command is run directly by linode_api.py instead.
+
+import os
+import sys
+import socket
+
+
+def run_directly():
+	linode_api = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'linode_api.py')
+	os.execv(sys.executable, [sys.executable, linode_api] + sys.argv[1:])
+
+
+def main():
+	socket_path = os.getenv('LINODE_API_SOCKET', None)
+	api_key = os.getenv('LINODE_KEY', None)
+	url = os.getenv('LINODE_API_URL', None)
+	if len(sys.argv) <= 1 or not socket_path or api_key is None or url is None:
+		# Let linode_api.py report missing command or environment the usual way.
+		run_directly()
+
+	sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+	try:
+		sock.connect(socket_path)
+	except socket.error:
+		sock.close()
+		run_directly()
+
+	sock.sendall('\0'.join([url, api_key] + sys.argv[1:]))
+	sock.shutdown(socket.SHUT_WR)
+
+	chunks = []
+	while True:
+		chunk = sock.recv(65536)
+		if not chunk:
+			break
+		chunks.append(chunk)
+	sock.close()
+
+	resp = ''.join(chunks)
+	if '\n' not in resp:
+		sys.stderr.write("Error : Invalid response from linode_api server\n")
+		sys.exit(1)
+
+	header, body = resp.split('\n', 1)
+	code, out_len, err_len = [int(f) for f in header.split()]
+	sys.stdout.write(body[:out_len])
+	sys.stdout.flush()
+	sys.stderr.write(body[out_len:out_len + err_len])
+	sys.exit(code)
+
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,945 @@
+#!/usr/bin/python
+
+# Local simulator of the Linode API v3, for developing and load testing these scripts without
+# a Linode account. It's stateful: linodes, disks, configuration profiles, IP addresses, jobs and
+# images created through it can be listed, booted, imaged and deleted like real ones, for the
+# actions that linode_api.py and linode_api_async.py use, including api.batch.
+#
+# Jobs are queued one after another on each linode, like on a real host, and each takes a
+# simulated duration that depends on its action (JOB_SECONDS), scaled by --job-scale. A linode's
+# status, a disk or an image becomes ready only when its job completes.
+#
+# Latency, HTTP errors, API errors, failed jobs and rate limiting can be injected to see how
+# callers cope with them. Random choices are made from a seeded generator, so a run with the
+# same seed and the same sequence of requests injects the same failures.
+#
+# Every connection is served by its own thread, and state is kept in memory behind one lock that's
+# never held while sleeping, so thousands of concurrent requests can be served.
+#
+# Usage: linode_api_simulator.py [<option> <value> ...]
+#	--host <address>			: Address to listen on. Default is 127.0.0.1.
+#	--port <port>				: Port to listen on. Default is 5000, the port of linode_api.API_SIMULATOR_URL.
+#	--latency <ms>				: Latency added to every request. Default is 0.
+#	--jitter <ms>				: Maximum random variation of latency, either way. Default is 0.
+#	--error-rate <fraction>		: Fraction of requests that fail with HTTP 503. Default is 0.
+#	--api-error-rate <fraction>	: Fraction of actions that fail with an API error in ERRORARRAY. Default is 0.
+#	--rate-limit <requests/s>	: Average rate of requests allowed, beyond which they're rejected with
+#								  a rate limit error (API error 14). Default is 0, which means unlimited.
+#	--rate-burst <requests>		: Maximum burst of requests allowed by the rate limit. Default is 10.
+#	--throttle-http <0|1>		: 1 to reject rate limited requests with HTTP 429 and Retry-After
+#								  instead of API error 14. Default is 0.
+#	--job-scale <factor>		: Multiplier of job durations. Default is 1. Use 0.01 for quick runs.
+#	--job-failure-rate <fraction>	: Fraction of jobs that fail. Default is 0.
+#	--api-key <key>				: Only this API key is accepted. Default is to accept any non empty key.
+#	--loopback-ips <0|1>		: 1 to give linodes addresses in 127.0.0.0/8, so that local services like
+#								  an SSH daemon can answer for them. Default is 0.
+#	--seed <number>				: Seed of the random generator. Default is 0.
+#
+# Example:
+#	./linode_api_simulator.py --latency 100 --jitter 50 --job-scale 0.1 &
+#	export LINODE_API_URL=http://localhost:5000/ LINODE_KEY=anything
+#
+# Output: Address the simulator listens on, and counts of requests and injected failures when
+#		it's stopped with Ctrl+C or SIGTERM.
+
+import BaseHTTPServer
+import SocketServer
+import threading
+import urlparse
+import random
+import signal
+import heapq
+import json
+import time
+import sys
+
+import linode_api
+
+OPTIONS = {
+	'host' : '127.0.0.1',
+	'port' : 5000,
+	'latency' : 0.0,
+	'jitter' : 0.0,
+	'error-rate' : 0.0,
+	'api-error-rate' : 0.0,
+	'rate-limit' : 0.0,
+	'rate-burst' : 10.0,
+	'throttle-http' : 0,
+	'job-scale' : 1.0,
+	'job-failure-rate' : 0.0,
+	'api-key' : '',
+	'loopback-ips' : 0,
+	'seed' : 0
+}
+
+# Simulated seconds taken by the job of each action, before scaling.
+JOB_SECONDS = {
+	'linode.boot' : 20,
+	'linode.reboot' : 25,
+	'linode.shutdown' : 10,
+	'linode.clone' : 60,
+	'linode.disk.create' : 5,
+	'linode.disk.createfromdistribution' : 45,
+	'linode.disk.createfromimage' : 30,
+	'linode.disk.createfromstackscript' : 60,
+	'linode.disk.imagize' : 90,
+	'linode.disk.delete' : 5
+}
+
+# Maximum number of actions in an api.batch request.
+BATCH_LIMIT = 25
+
+# Threads of connections need only small stacks, and thousands of them are started.
+THREAD_STACK_SIZE = 256 * 1024
+LISTEN_BACKLOG = 4096
+
+# Linode status values.
+BEING_CREATED = -1
+BRAND_NEW = 0
+RUNNING = 1
+POWERED_OFF = 2
+
+DATACENTERS = [
+	{'DATACENTERID' : 2, 'LOCATION' : 'Dallas, TX, USA', 'ABBR' : 'dallas'},
+	{'DATACENTERID' : 3, 'LOCATION' : 'Fremont, CA, USA', 'ABBR' : 'fremont'},
+	{'DATACENTERID' : 4, 'LOCATION' : 'Atlanta, GA, USA', 'ABBR' : 'atlanta'},
+	{'DATACENTERID' : 6, 'LOCATION' : 'Newark, NJ, USA', 'ABBR' : 'newark'},
+	{'DATACENTERID' : 7, 'LOCATION' : 'London, England, UK', 'ABBR' : 'london'},
+	{'DATACENTERID' : 8, 'LOCATION' : 'Tokyo, JP', 'ABBR' : 'tokyo'},
+	{'DATACENTERID' : 9, 'LOCATION' : 'Singapore, SG', 'ABBR' : 'singapore'},
+	{'DATACENTERID' : 10, 'LOCATION' : 'Frankfurt, DE', 'ABBR' : 'frankfurt'}
+]
+
+DISTRIBUTIONS = [
+	{'DISTRIBUTIONID' : 124, 'LABEL' : 'Ubuntu 14.04 LTS', 'IS64BIT' : 1, 'MINIMAGESIZE' : 1500, 'REQUIRESPVOPSKERNEL' : 1},
+	{'DISTRIBUTIONID' : 146, 'LABEL' : 'Ubuntu 16.04 LTS', 'IS64BIT' : 1, 'MINIMAGESIZE' : 2000, 'REQUIRESPVOPSKERNEL' : 1},
+	{'DISTRIBUTIONID' : 130, 'LABEL' : 'Debian 7', 'IS64BIT' : 1, 'MINIMAGESIZE' : 600, 'REQUIRESPVOPSKERNEL' : 1},
+	{'DISTRIBUTIONID' : 140, 'LABEL' : 'Debian 8', 'IS64BIT' : 1, 'MINIMAGESIZE' : 900, 'REQUIRESPVOPSKERNEL' : 1},
+	{'DISTRIBUTIONID' : 129, 'LABEL' : 'CentOS 7', 'IS64BIT' : 1, 'MINIMAGESIZE' : 750, 'REQUIRESPVOPSKERNEL' : 1}
+]
+
+KERNELS = [
+	{'KERNELID' : 138, 'LABEL' : 'Latest 64 bit (4.1.5-x86_64-linode61)', 'ISXEN' : 1, 'ISKVM' : 1, 'ISPVOPS' : 1},
+	{'KERNELID' : 137, 'LABEL' : 'Latest 32 bit (4.1.5-x86-linode80)', 'ISXEN' : 1, 'ISKVM' : 1, 'ISPVOPS' : 1},
+	{'KERNELID' : 210, 'LABEL' : 'GRUB 2', 'ISXEN' : 0, 'ISKVM' : 1, 'ISPVOPS' : 1},
+	{'KERNELID' : 92, 'LABEL' : 'pv-grub-x86_64', 'ISXEN' : 1, 'ISKVM' : 0, 'ISPVOPS' : 0}
+]
+
+# (RAM MB, disk GB, monthly price) of each plan, keyed by the plan names of linode_api.PLAN_IDS.
+PLAN_SPECS = {
+	'2GB' : (2048, 24, 10.0),
+	'4GB' : (4096, 48, 20.0),
+	'8GB' : (8192, 96, 40.0),
+	'12GB' : (12288, 192, 80.0),
+	'24GB' : (24576, 384, 160.0),
+	'48GB' : (49152, 768, 320.0),
+	'64GB' : (65536, 1152, 480.0),
+	'80GB' : (81920, 1536, 640.0),
+	'120GB' : (122880, 1920, 960.0)
+}
+
+PLANS = sorted([{'PLANID' : linode_api.PLAN_IDS[name], 'LABEL' : 'Linode %d' % ram, 'RAM' : ram, 'DISK' : disk,
+	'XFER' : 2000, 'PRICE' : price, 'HOURLY' : round(price / 720, 4), 'CORES' : max(1, ram / 2048),
+	'AVAIL' : dict((str(dc['DATACENTERID']), 500) for dc in DATACENTERS)}
+	for name, (ram, disk, price) in PLAN_SPECS.items()], key=lambda plan: plan['PLANID'])
+
+
+
+class ApiError(Exception):
+
+	def __init__(self, code, message):
+		Exception.__init__(self, message)
+		self.code = code
+		self.message = message
+
+
+
+# Parameter names are case insensitive in the API, so they're looked up in lowercase, but
+# their original names are kept for test.echo.
+class Params(dict):
+
+	def __init__(self, items):
+		items = list(items)
+		dict.__init__(self, ((unicode(k).lower(), v) for k, v in items))
+		self.names = dict((unicode(k).lower(), k) for k, v in items)
+
+
+
+def now_dt(t=None):
+	return time.strftime('%Y-%m-%d %H:%M:%S.0', time.localtime(t if t is not None else time.time()))
+
+
+def int_param(params, name, required=True, default=None):
+	value = params.get(name.lower())
+	if value is None or value == '':
+		if required:
+			raise ApiError(6, 'A required property is missing: %s' % name)
+		return default
+	try:
+		return int(value)
+	except (ValueError, TypeError):
+		raise ApiError(7, 'Property invalid: %s' % name)
+
+
+def str_param(params, name, required=True, default=''):
+	value = params.get(name.lower())
+	if value is None:
+		if required:
+			raise ApiError(6, 'A required property is missing: %s' % name)
+		return default
+	return unicode(value)
+
+
+
+# Same as linode_api.TokenBucket, except that a request that finds no token is rejected
+# instead of waiting.
+class RateLimit(object):
+
+	def __init__(self, rate, burst):
+		self.rate = float(rate)
+		self.burst = float(burst)
+		self.tokens = self.burst
+		self.updated = time.time()
+
+
+	# Called with the simulator's lock held.
+	def take(self):
+		now = time.time()
+		self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+		self.updated = now
+		if self.tokens < 1:
+			return False
+		self.tokens -= 1
+		return True
+
+
+
+class Simulator(object):
+
+	def __init__(self, options):
+		self.options = options
+		self.lock = threading.Lock()
+		self.random = random.Random(options['seed'])
+		self.rate_limit = RateLimit(options['rate-limit'], options['rate-burst']) if options['rate-limit'] > 0 else None
+		self.next_id = 1000
+
+		self.linodes = {}
+		self.disks = {}
+		self.configs = {}
+		self.ips = {}
+		self.jobs = {}
+		self.images = {}
+		# (finish time, job ID) of unfinished jobs.
+		self.pending_jobs = []
+
+		self.counters = {
+			'requests' : 0,
+			'actions' : 0,
+			'http_errors' : 0,
+			'api_errors' : 0,
+			'throttled' : 0,
+			'failed_jobs' : 0
+		}
+
+		self.handlers = {
+			'test.echo' : self.test_echo,
+			'avail.datacenters' : lambda params: DATACENTERS,
+			'avail.distributions' : self.avail_distributions,
+			'avail.kernels' : self.avail_kernels,
+			'avail.linodeplans' : self.avail_linodeplans,
+			'avail.stackscripts' : lambda params: [],
+			'stackscript.list' : lambda params: [],
+			'linode.create' : self.linode_create,
+			'linode.update' : self.linode_update,
+			'linode.list' : self.linode_list,
+			'linode.delete' : self.linode_delete,
+			'linode.clone' : self.linode_clone,
+			'linode.boot' : self.linode_boot,
+			'linode.reboot' : self.linode_boot,
+			'linode.shutdown' : self.linode_shutdown,
+			'linode.disk.create' : self.disk_create,
+			'linode.disk.createfromdistribution' : self.disk_create,
+			'linode.disk.createfromimage' : self.disk_create,
+			'linode.disk.createfromstackscript' : self.disk_create,
+			'linode.disk.list' : self.disk_list,
+			'linode.disk.delete' : self.disk_delete,
+			'linode.disk.imagize' : self.disk_imagize,
+			'linode.config.create' : self.config_create,
+			'linode.config.list' : self.config_list,
+			'linode.ip.list' : self.ip_list,
+			'linode.ip.addprivate' : self.ip_addprivate,
+			'linode.job.list' : self.job_list,
+			'image.list' : self.image_list,
+			'image.update' : self.image_update,
+			'image.delete' : self.image_delete
+		}
+
+
+	def new_id(self):
+		self.next_id += 1
+		return self.next_id
+
+
+	def chance(self, rate):
+		return rate > 0 and self.random.random() < rate
+
+
+	def count(self, name):
+		with self.lock:
+			self.counters[name] += 1
+
+
+	# Returns the seconds of latency to inject into a request.
+	def latency(self):
+		with self.lock:
+			jitter = self.random.uniform(-1, 1) * self.options['jitter']
+		return max(0.0, self.options['latency'] + jitter) / 1000.0
+
+
+	# Returns None if the request is allowed, or how it should be rejected: 'throttled' or 'http_error'.
+	def admit(self):
+		with self.lock:
+			self.counters['requests'] += 1
+			if self.rate_limit is not None and not self.rate_limit.take():
+				self.counters['throttled'] += 1
+				return 'throttled'
+			if self.chance(self.options['error-rate']):
+				self.counters['http_errors'] += 1
+				return 'http_error'
+		return None
+
+
+	# Runs an action and returns its response.
+	def call(self, action, params):
+		with self.lock:
+			self.counters['actions'] += 1
+			try:
+				if self.options['api-key'] and params.get('api_key') != self.options['api-key'] or not params.get('api_key'):
+					raise ApiError(4, 'Authentication failed')
+				handler = self.handlers.get(action)
+				if handler is None:
+					raise ApiError(3, 'The requested class does not exist')
+				if self.chance(self.options['api-error-rate']):
+					self.counters['api_errors'] += 1
+					raise ApiError(8, 'A data validation error (injected)')
+
+				self.settle_jobs()
+				data = handler(params)
+				errors = []
+
+			except ApiError as e:
+				data = {}
+				errors = [{'ERRORCODE' : e.code, 'ERRORMESSAGE' : e.message}]
+
+		return {'ACTION' : action, 'DATA' : data, 'ERRORARRAY' : errors}
+
+
+	def throttled_response(self, action):
+		return {'ACTION' : action, 'DATA' : {}, 'ERRORARRAY' : [{'ERRORCODE' : 14, 'ERRORMESSAGE' : 'Rate limit exceeded'}]}
+
+
+	# Handles the parameters of one HTTP request. Returns the response object.
+	def request(self, params):
+		action = params.get('api_action', '')
+		if action != 'api.batch':
+			return self.call(action, params)
+
+		try:
+			request_array = json.loads(params.get('api_requestarray', ''))
+			if not isinstance(request_array, list):
+				raise ValueError()
+		except ValueError:
+			return {'ACTION' : action, 'DATA' : {}, 'ERRORARRAY' : [{'ERRORCODE' : 11,
+				'ERRORMESSAGE' : "RequestArray isn't valid JSON or WDDX"}]}
+
+		if len(request_array) > BATCH_LIMIT:
+			return {'ACTION' : action, 'DATA' : {}, 'ERRORARRAY' : [{'ERRORCODE' : 10,
+				'ERRORMESSAGE' : 'Too many batched requests'}]}
+
+		responses = []
+		for req in request_array:
+			req_params = Params(req.items())
+			req_params['api_key'] = params.get('api_key')
+			responses.append(self.call(req_params.get('api_action', ''), req_params))
+		return responses
+
+
+	# Jobs.
+
+	# Queues a job on a linode after the jobs already queued on it. 'on_success' is called
+	# with the lock held when the job completes successfully.
+	def add_job(self, linode, action, label, on_success=None):
+		now = time.time()
+		seconds = JOB_SECONDS.get(action, 1) * self.options['job-scale']
+		start = max(now, linode['_busy_until'])
+		finish = start + seconds
+		linode['_busy_until'] = finish
+
+		job_id = self.new_id()
+		self.jobs[job_id] = {
+			'JOBID' : job_id,
+			'LINODEID' : linode['LINODEID'],
+			'ACTION' : action,
+			'LABEL' : label,
+			'ENTERED_DT' : now_dt(now),
+			'HOST_START_DT' : '',
+			'HOST_FINISH_DT' : '',
+			'DURATION' : '',
+			'HOST_MESSAGE' : '',
+			'HOST_SUCCESS' : '',
+			'_start' : start,
+			'_finish' : finish,
+			'_on_success' : on_success
+		}
+		heapq.heappush(self.pending_jobs, (finish, job_id))
+		return job_id
+
+
+	# Completes jobs whose time is up.
+	def settle_jobs(self):
+		now = time.time()
+		while self.pending_jobs and self.pending_jobs[0][0] <= now:
+			finish, job_id = heapq.heappop(self.pending_jobs)
+			job = self.jobs.get(job_id)
+			if job is None:
+				continue
+			job['HOST_START_DT'] = now_dt(job['_start'])
+			job['HOST_FINISH_DT'] = now_dt(finish)
+			job['DURATION'] = int(round(finish - job['_start']))
+			if self.chance(self.options['job-failure-rate']):
+				self.counters['failed_jobs'] += 1
+				job['HOST_SUCCESS'] = 0
+				job['HOST_MESSAGE'] = 'Job failed (injected)'
+			else:
+				job['HOST_SUCCESS'] = 1
+				if job['_on_success'] is not None:
+					job['_on_success']()
+
+
+	def public_job(self, job):
+		return dict((k, v) for k, v in job.items() if not k.startswith('_'))
+
+
+	def job_list(self, params):
+		linode = self.get_linode(params)
+		job_id = int_param(params, 'JobID', False)
+		pending_only = int_param(params, 'pendingOnly', False, 0)
+		jobs = [job for job in self.jobs.values() if job['LINODEID'] == linode['LINODEID']
+			and (job_id is None or job['JOBID'] == job_id)
+			and (not pending_only or job['HOST_FINISH_DT'] == '')]
+		return [self.public_job(job) for job in sorted(jobs, key=lambda job: -job['JOBID'])]
+
+
+	# Catalogs.
+
+	def test_echo(self, params):
+		return dict((params.names.get(k, k), v) for k, v in params.items() if k not in ('api_key', 'api_action'))
+
+
+	def avail_distributions(self, params):
+		distribution_id = int_param(params, 'DistributionID', False)
+		return [d for d in DISTRIBUTIONS if distribution_id is None or d['DISTRIBUTIONID'] == distribution_id]
+
+
+	def avail_kernels(self, params):
+		is_xen = int_param(params, 'isXen', False)
+		is_kvm = int_param(params, 'isKVM', False)
+		return [k for k in KERNELS if (is_xen is None or k['ISXEN'] == is_xen) and (is_kvm is None or k['ISKVM'] == is_kvm)]
+
+
+	def avail_linodeplans(self, params):
+		plan_id = int_param(params, 'PlanID', False)
+		return [p for p in PLANS if plan_id is None or p['PLANID'] == plan_id]
+
+
+	# Linodes.
+
+	def get_linode(self, params):
+		linode = self.linodes.get(int_param(params, 'LinodeID'))
+		if linode is None:
+			raise ApiError(5, 'Object not found')
+		return linode
+
+
+	def public_linode(self, linode):
+		return dict((k, v) for k, v in linode.items() if not k.startswith('_'))
+
+
+	def new_linode(self, plan_id, datacenter_id):
+		plan = [p for p in PLANS if p['PLANID'] == plan_id]
+		if not plan:
+			raise ApiError(8, 'A data validation error: Invalid PlanID')
+		if datacenter_id not in [dc['DATACENTERID'] for dc in DATACENTERS]:
+			raise ApiError(8, 'A data validation error: Invalid DatacenterID')
+
+		linode_id = self.new_id()
+		linode = {
+			'LINODEID' : linode_id,
+			'LABEL' : 'linode%d' % linode_id,
+			'LPM_DISPLAYGROUP' : '',
+			'PLANID' : plan_id,
+			'DATACENTERID' : datacenter_id,
+			'TOTALRAM' : plan[0]['RAM'],
+			'TOTALHD' : plan[0]['DISK'] * 1024,
+			'TOTALXFER' : plan[0]['XFER'],
+			'STATUS' : BRAND_NEW,
+			'CREATE_DT' : now_dt(),
+			'_busy_until' : 0
+		}
+		self.linodes[linode_id] = linode
+
+		# Every linode gets a public IP address when it's created.
+		self.new_ip(linode_id, True)
+		return linode
+
+
+	def linode_create(self, params):
+		linode = self.new_linode(int_param(params, 'PlanID'), int_param(params, 'DatacenterID'))
+		return {'LinodeID' : linode['LINODEID']}
+
+
+	def linode_update(self, params):
+		linode = self.get_linode(params)
+		if 'label' in params:
+			linode['LABEL'] = str_param(params, 'Label')
+		if 'lpm_displaygroup' in params:
+			linode['LPM_DISPLAYGROUP'] = str_param(params, 'lpm_displayGroup')
+		return {'LinodeID' : linode['LINODEID']}
+
+
+	def linode_list(self, params):
+		if params.get('linodeid'):
+			linode = self.linodes.get(int_param(params, 'LinodeID'))
+			return [self.public_linode(linode)] if linode is not None else []
+		return [self.public_linode(linode) for linode_id, linode in sorted(self.linodes.items())]
+
+
+	def linode_delete(self, params):
+		linode = self.get_linode(params)
+		linode_id = linode['LINODEID']
+		has_disks = any(disk['LINODEID'] == linode_id for disk in self.disks.values())
+		if has_disks and not int_param(params, 'skipChecks', False, 0):
+			raise ApiError(41, 'Linode must have no disks before delete')
+
+		for table in (self.disks, self.configs, self.ips):
+			for key in [key for key, record in table.items() if record['_linode_id'] == linode_id]:
+				del table[key]
+		for job_id in [job_id for job_id, job in self.jobs.items() if job['LINODEID'] == linode_id]:
+			del self.jobs[job_id]
+		del self.linodes[linode_id]
+		return {'LinodeID' : linode_id}
+
+
+	# Copies a linode's disks and configuration profiles to a new linode, which is ready when
+	# the clone job completes.
+	def linode_clone(self, params):
+		source = self.get_linode(params)
+		linode = self.new_linode(int_param(params, 'PlanID'), int_param(params, 'DatacenterID'))
+		linode['STATUS'] = BEING_CREATED
+
+		disk_ids = {}
+		for disk_id, disk in sorted(self.disks.items()):
+			if disk['_linode_id'] == source['LINODEID']:
+				copy = dict(disk)
+				copy['DISKID'] = disk_ids[disk_id] = self.new_id()
+				copy['LINODEID'] = copy['_linode_id'] = linode['LINODEID']
+				self.disks[copy['DISKID']] = copy
+		for config in [c for c in self.configs.values() if c['_linode_id'] == source['LINODEID']]:
+			copy = dict(config)
+			copy['ConfigID'] = self.new_id()
+			copy['LinodeID'] = copy['_linode_id'] = linode['LINODEID']
+			copy['DiskList'] = ','.join(str(disk_ids.get(int(d), d)) for d in config['DiskList'].split(',') if d)
+			self.configs[copy['ConfigID']] = copy
+
+		def on_success():
+			linode['STATUS'] = BRAND_NEW
+		self.add_job(source, 'linode.clone', 'Linode Clone', None)
+		self.add_job(linode, 'linode.clone', 'Linode Clone', on_success)
+		return {'LinodeID' : linode['LINODEID']}
+
+
+	def linode_boot(self, params):
+		linode = self.get_linode(params)
+		config_id = int_param(params, 'ConfigID', False)
+		configs = [c for c in self.configs.values() if c['_linode_id'] == linode['LINODEID']]
+		if config_id is not None:
+			configs = [c for c in configs if c['ConfigID'] == config_id]
+		if not configs:
+			raise ApiError(8, 'A data validation error: No configuration profile to boot')
+
+		def on_success():
+			linode['STATUS'] = RUNNING
+		action = params.get('api_action', 'linode.boot')
+		return {'JobID' : self.add_job(linode, action, 'System Boot - %s' % configs[0]['Label'], on_success)}
+
+
+	def linode_shutdown(self, params):
+		linode = self.get_linode(params)
+		def on_success():
+			linode['STATUS'] = POWERED_OFF
+		return {'JobID' : self.add_job(linode, 'linode.shutdown', 'System Shutdown', on_success)}
+
+
+	# Disks.
+
+	def disk_create(self, params):
+		action = params.get('api_action')
+		linode = self.get_linode(params)
+		size = int_param(params, 'Size', action != 'linode.disk.createfromimage', None)
+		disk_type = str_param(params, 'Type', False, 'ext4')
+		label = str_param(params, 'Label', action == 'linode.disk.create', '')
+
+		if action == 'linode.disk.createfromdistribution':
+			if int_param(params, 'DistributionID') not in [d['DISTRIBUTIONID'] for d in DISTRIBUTIONS]:
+				raise ApiError(8, 'A data validation error: Invalid DistributionID')
+			str_param(params, 'rootPass')
+		elif action == 'linode.disk.createfromimage':
+			image = self.images.get(int_param(params, 'ImageID'))
+			if image is None or image['STATUS'] != 'available':
+				raise ApiError(5, 'Object not found')
+			if size is None:
+				size = image['MINSIZE']
+			label = label or image['LABEL']
+			image['LAST_USED_DT'] = now_dt()
+
+		used = sum(d['SIZE'] for d in self.disks.values() if d['_linode_id'] == linode['LINODEID'])
+		if size <= 0 or used + size > linode['TOTALHD']:
+			raise ApiError(8, 'A data validation error: Size exceeds the available storage')
+
+		disk = self.new_disk(linode, label, disk_type, size)
+		disk_id = disk['DISKID']
+
+		def on_success():
+			disk['STATUS'] = 1
+		job_id = self.add_job(linode, action, 'Create Filesystem - %s' % label, on_success)
+
+		# Like the real API, createfromimage returns uppercase keys.
+		if action == 'linode.disk.createfromimage':
+			return {'DISKID' : disk_id, 'JOBID' : job_id}
+		return {'DiskID' : disk_id, 'JobID' : job_id}
+
+
+	def new_disk(self, linode, label, disk_type, size):
+		disk_id = self.new_id()
+		disk = {
+			'DISKID' : disk_id,
+			'LINODEID' : linode['LINODEID'],
+			'LABEL' : label,
+			'TYPE' : disk_type,
+			'SIZE' : size,
+			'STATUS' : 0,
+			'ISREADONLY' : 0,
+			'CREATE_DT' : now_dt(),
+			'UPDATE_DT' : now_dt(),
+			'_linode_id' : linode['LINODEID']
+		}
+		self.disks[disk_id] = disk
+		return disk
+
+
+	def get_disk(self, params, linode):
+		disk = self.disks.get(int_param(params, 'DiskID'))
+		if disk is None or disk['_linode_id'] != linode['LINODEID']:
+			raise ApiError(5, 'Object not found')
+		return disk
+
+
+	def disk_list(self, params):
+		linode = self.get_linode(params)
+		return [self.public_linode(disk) for disk_id, disk in sorted(self.disks.items())
+			if disk['_linode_id'] == linode['LINODEID']]
+
+
+	def disk_delete(self, params):
+		linode = self.get_linode(params)
+		disk = self.get_disk(params, linode)
+		def on_success():
+			self.disks.pop(disk['DISKID'], None)
+		job_id = self.add_job(linode, 'linode.disk.delete', 'Delete Filesystem - %s' % disk['LABEL'], on_success)
+		return {'DiskID' : disk['DISKID'], 'JobID' : job_id}
+
+
+	def disk_imagize(self, params):
+		linode = self.get_linode(params)
+		disk = self.get_disk(params, linode)
+		image_id = self.new_id()
+		image = {
+			'IMAGEID' : image_id,
+			'LABEL' : str_param(params, 'Label', False, '') or disk['LABEL'],
+			'DESCRIPTION' : str_param(params, 'Description', False, ''),
+			'TYPE' : 'manual',
+			'STATUS' : 'pending_upload',
+			'ISPUBLIC' : 0,
+			'MINSIZE' : 0,
+			'FS_TYPE' : disk['TYPE'],
+			'CREATOR' : 'simulator',
+			'CREATE_DT' : now_dt(),
+			'LAST_USED_DT' : ''
+		}
+		self.images[image_id] = image
+
+		def on_success():
+			image['STATUS'] = 'available'
+			image['MINSIZE'] = disk['SIZE']
+		job_id = self.add_job(linode, 'linode.disk.imagize', 'Imagize - %s' % disk['LABEL'], on_success)
+		return {'ImageID' : image_id, 'JobID' : job_id}
+
+
+	# Configuration profiles.
+
+	def config_create(self, params):
+		linode = self.get_linode(params)
+		kernel_id = int_param(params, 'KernelID')
+		if kernel_id not in [k['KERNELID'] for k in KERNELS]:
+			raise ApiError(8, 'A data validation error: Invalid KernelID')
+		disk_list = str_param(params, 'DiskList')
+		for disk_id in [d for d in disk_list.split(',') if d]:
+			disk = self.disks.get(int(disk_id)) if disk_id.isdigit() else None
+			if disk is None or disk['_linode_id'] != linode['LINODEID']:
+				raise ApiError(8, 'A data validation error: Invalid DiskList')
+
+		return {'ConfigID' : self.new_config(linode, kernel_id, str_param(params, 'Label'), disk_list)}
+
+
+	def new_config(self, linode, kernel_id, label, disk_list):
+		config_id = self.new_id()
+		self.configs[config_id] = {
+			'ConfigID' : config_id,
+			'LinodeID' : linode['LINODEID'],
+			'KernelID' : kernel_id,
+			'Label' : label,
+			'DiskList' : disk_list,
+			'RootDeviceNum' : 1,
+			'RAMLimit' : 0,
+			'helper_network' : 1,
+			'_linode_id' : linode['LINODEID']
+		}
+		return config_id
+
+
+	def config_list(self, params):
+		linode = self.get_linode(params)
+		return [self.public_linode(config) for config_id, config in sorted(self.configs.items())
+			if config['_linode_id'] == linode['LINODEID']]
+
+
+	# IP addresses.
+
+	def new_ip(self, linode_id, public):
+		ip_id = self.new_id()
+		if self.options['loopback-ips']:
+			address = '127.%d.%d.%d' % (1 if public else 2, ip_id / 256 % 256, ip_id % 256)
+		elif public:
+			address = '100.%d.%d.%d' % (64 + ip_id / 65536 % 64, ip_id / 256 % 256, ip_id % 256)
+		else:
+			address = '192.168.%d.%d' % (ip_id / 256 % 256, ip_id % 256)
+		self.ips[ip_id] = {
+			'IPADDRESSID' : ip_id,
+			'LINODEID' : linode_id,
+			'ISPUBLIC' : 1 if public else 0,
+			'IPADDRESS' : address,
+			'RDNS_NAME' : 'li%d.members.linode.com' % ip_id if public else '',
+			'_linode_id' : linode_id
+		}
+		return self.ips[ip_id]
+
+
+	def ip_list(self, params):
+		linode_id = int_param(params, 'LinodeID', False)
+		if linode_id is not None:
+			self.get_linode(params)
+		ip_id = int_param(params, 'IPAddressID', False)
+		return [self.public_linode(ip) for i, ip in sorted(self.ips.items())
+			if (linode_id is None or ip['_linode_id'] == linode_id) and (ip_id is None or i == ip_id)]
+
+
+	def ip_addprivate(self, params):
+		linode = self.get_linode(params)
+		if any(ip['_linode_id'] == linode['LINODEID'] and not ip['ISPUBLIC'] for ip in self.ips.values()):
+			raise ApiError(8, 'A data validation error: Linode already has a private IP address')
+		ip = self.new_ip(linode['LINODEID'], False)
+		return {'IPADDRESSID' : ip['IPADDRESSID'], 'IPADDRESS' : ip['IPADDRESS']}
+
+
+	# Images.
+
+	# Adds an available image, as if it had been created earlier, so that clusters can be
+	# created from it without building it first. Returns its ID.
+	def add_image(self, label, size):
+		with self.lock:
+			image_id = self.new_id()
+			self.images[image_id] = {
+				'IMAGEID' : image_id,
+				'LABEL' : label,
+				'DESCRIPTION' : '',
+				'TYPE' : 'manual',
+				'STATUS' : 'available',
+				'ISPUBLIC' : 0,
+				'MINSIZE' : size,
+				'FS_TYPE' : 'ext4',
+				'CREATOR' : 'simulator',
+				'CREATE_DT' : now_dt(),
+				'LAST_USED_DT' : ''
+			}
+		return image_id
+
+
+	# Adds a powered off linode with a disk of 'disk_size' MB, a swap disk and a configuration
+	# profile, as if it had been provisioned and shut down earlier, so that nodes can be cloned
+	# from it. Returns its ID.
+	def add_golden_node(self, plan_id, datacenter_id, disk_size):
+		with self.lock:
+			linode = self.new_linode(plan_id, datacenter_id)
+			linode['STATUS'] = POWERED_OFF
+			disks = [self.new_disk(linode, 'Golden', 'ext4', disk_size), self.new_disk(linode, 'Swap', 'swap', 256)]
+			for disk in disks:
+				disk['STATUS'] = 1
+			self.new_config(linode, KERNELS[0]['KERNELID'], 'Golden-configuration',
+				','.join(str(disk['DISKID']) for disk in disks))
+		return linode['LINODEID']
+
+
+	def get_image(self, params):
+		image = self.images.get(int_param(params, 'ImageID'))
+		if image is None:
+			raise ApiError(5, 'Object not found')
+		return image
+
+
+	def image_list(self, params):
+		image_id = int_param(params, 'ImageID', False)
+		pending = int_param(params, 'pending', False, 0)
+		return [dict(image) for i, image in sorted(self.images.items())
+			if (image_id is None or i == image_id) and (pending or image['STATUS'] == 'available')]
+
+
+	def image_update(self, params):
+		image = self.get_image(params)
+		if 'label' in params:
+			image['LABEL'] = str_param(params, 'label')
+		if 'description' in params:
+			image['DESCRIPTION'] = str_param(params, 'description')
+		return dict(image)
+
+
+	def image_delete(self, params):
+		image = self.get_image(params)
+		del self.images[image['IMAGEID']]
+		return dict(image)
+
+
+
+class RequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+	# HTTP/1.1, so that clients can keep connections alive.
+	protocol_version = 'HTTP/1.1'
+	# Headers and body are buffered and sent together, since separate small writes on a
+	# kept alive connection are delayed by Nagle's algorithm and delayed ACKs.
+	wbufsize = -1
+	disable_nagle_algorithm = True
+
+	def log_message(self, format, *args):
+		pass
+
+
+	def send_body(self, status, body, headers=()):
+		self.send_response(status)
+		self.send_header('Content-Type', 'application/json')
+		self.send_header('Content-Length', str(len(body)))
+		for name, value in headers:
+			self.send_header(name, value)
+		self.end_headers()
+		self.wfile.write(body)
+
+
+	def handle_request(self, body):
+		sim = self.server.simulator
+		# A request has latency whether or not it succeeds.
+		latency = sim.latency()
+		if latency > 0:
+			time.sleep(latency)
+
+		params = Params(urlparse.parse_qsl(body, keep_blank_values=True))
+		rejection = sim.admit()
+		if rejection == 'http_error':
+			self.send_body(503, 'Service Unavailable (injected)\n')
+			return
+		if rejection == 'throttled':
+			if sim.options['throttle-http']:
+				self.send_body(429, 'Too Many Requests\n', [('Retry-After', '1')])
+			else:
+				self.send_body(200, json.dumps(sim.throttled_response(params.get('api_action', ''))))
+			return
+
+		self.send_body(200, json.dumps(sim.request(params)))
+
+
+	def do_POST(self):
+		length = int(self.headers.getheader('Content-Length') or 0)
+		self.handle_request(self.rfile.read(length))
+
+
+	def do_GET(self):
+		self.handle_request(urlparse.urlsplit(self.path).query)
+
+
+
+class SimulatorServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+	daemon_threads = True
+	allow_reuse_address = True
+	request_queue_size = LISTEN_BACKLOG
+
+	def __init__(self, address, simulator):
+		BaseHTTPServer.HTTPServer.__init__(self, address, RequestHandler)
+		self.simulator = simulator
+
+
+
+def parse_options(args):
+	options = dict(OPTIONS)
+	while args:
+		name = args[0][2:] if args[0].startswith('--') else None
+		if name not in options or len(args) < 2:
+			raise ValueError("Invalid option '%s'" % args[0])
+		try:
+			options[name] = type(OPTIONS[name])(args[1])
+		except ValueError:
+			raise ValueError("Invalid value '%s' of option %s" % (args[1], args[0]))
+		args = args[2:]
+	return options
+
+
+
+def main():
+	try:
+		options = parse_options(sys.argv[1:])
+	except ValueError as e:
+		print "Error: %s" % e
+		print "Usage: linode_api_simulator.py [--host <address>] [--port <port>] [--latency <ms>] [--jitter <ms>] " \
+			"[--error-rate <fraction>] [--api-error-rate <fraction>] [--rate-limit <requests/s>] [--rate-burst <requests>] " \
+			"[--throttle-http 0|1] [--job-scale <factor>] [--job-failure-rate <fraction>] [--api-key <key>] [--loopback-ips 0|1] " \
+			"[--seed <number>]"
+		sys.exit(1)
+
+	threading.stack_size(THREAD_STACK_SIZE)
+	simulator = Simulator(options)
+	server = SimulatorServer((options['host'], options['port']), simulator)
+	print "Linode API simulator listening on http://%s:%d/" % (options['host'], options['port'])
+	sys.stdout.flush()
+
+	# When run in the background, it's stopped with SIGTERM rather than Ctrl+C.
+	signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+	try:
+		server.serve_forever()
+	except (KeyboardInterrupt, SystemExit):
+		pass
+	finally:
+		server.server_close()
+
+	for name in sorted(simulator.counters.keys()):
+		print name, simulator.counters[name]
+
+
+
+if __name__ == '__main__':
+	main()
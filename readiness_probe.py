@@ -0,0 +1,183 @@
+#!/usr/bin/python
+
+# Waits until services on cluster nodes are ready, by probing all of them concurrently
+# every fraction of a second until they're ready or a deadline passes. It returns as soon
+# as every target is ready, instead of sleeping for a fixed time that's long enough for
+# the slowest case.
+#
+# Usage: readiness_probe.py <deadline in seconds> <target> [<target> ...]
+# Targets are of the form <probe>:<host>[:<port>] where probe is one of
+#	tcp 		: Port accepts connections. Port is required.
+#	closed 		: Port does not accept connections, such as after a service is stopped. Port is required.
+#	ssh 		: SSH daemon sends its banner. Default port is 22.
+#	zk 			: ZooKeeper answers "imok" to "ruok". Default port is 2181.
+#	zk-quorum	: ZooKeeper server is a leader, follower, observer or standalone server according
+#				  to "mntr", which means it's serving requests. Default port is 2181.
+#
+# It can also be run on a cluster node to probe services that are firewalled from the
+# cluster manager, with "ssh <node> python - <args> < readiness_probe.py".
+#
+# Output: A line for each target as it becomes ready, and a line for each target that's
+#		not ready at deadline.
+# Returns: 0 if all targets are ready, 1 if some were not ready at deadline, 2 on invalid arguments.
+
+import sys
+import time
+import socket
+import threading
+
+# Seconds between probes of a target that's not ready, and the maximum seconds each probe
+# waits for a connection or response.
+POLL_INTERVAL = 0.5
+PROBE_TIMEOUT = 2.0
+
+DEFAULT_PORTS = {
+	'ssh' : 22,
+	'zk' : 2181,
+	'zk-quorum' : 2181
+}
+
+ZK_SERVING_STATES = ('leader', 'follower', 'observer', 'standalone')
+
+
+def connect(host, port, timeout):
+	return socket.create_connection((host, port), timeout)
+
+
+# Sends 'request', if any, and returns everything the server sends until it closes the connection
+# or 'max_len' bytes are received.
+def exchange(host, port, timeout, request, max_len):
+	sock = connect(host, port, timeout)
+	try:
+		if request:
+			sock.sendall(request)
+		chunks = []
+		received = 0
+		while received < max_len:
+			chunk = sock.recv(max_len - received)
+			if not chunk:
+				break
+			chunks.append(chunk)
+			received += len(chunk)
+			if request is None and '\n' in chunk:
+				break
+		return ''.join(chunks)
+	finally:
+		sock.close()
+
+
+def probe_tcp(host, port, timeout):
+	connect(host, port, timeout).close()
+	return True
+
+
+def probe_closed(host, port, timeout):
+	try:
+		connect(host, port, timeout).close()
+	except (socket.error, socket.timeout):
+		return True
+	return False
+
+
+def probe_ssh(host, port, timeout):
+	return exchange(host, port, timeout, None, 256).startswith('SSH-')
+
+
+def probe_zk(host, port, timeout):
+	return exchange(host, port, timeout, 'ruok', 16) == 'imok'
+
+
+def probe_zk_quorum(host, port, timeout):
+	for line in exchange(host, port, timeout, 'mntr', 65536).splitlines():
+		fields = line.split()
+		if len(fields) == 2 and fields[0] == 'zk_server_state':
+			return fields[1] in ZK_SERVING_STATES
+	return False
+
+
+PROBES = {
+	'tcp' : probe_tcp,
+	'closed' : probe_closed,
+	'ssh' : probe_ssh,
+	'zk' : probe_zk,
+	'zk-quorum' : probe_zk_quorum
+}
+
+
+def parse_target(target):
+	fields = target.split(':')
+	kind = fields[0]
+	if kind not in PROBES or len(fields) not in (2, 3):
+		raise ValueError("Invalid target '%s'" % target)
+
+	if len(fields) == 3:
+		port = int(fields[2])
+	elif kind in DEFAULT_PORTS:
+		port = DEFAULT_PORTS[kind]
+	else:
+		raise ValueError("Target '%s' should specify a port" % target)
+
+	return (kind, fields[1], port)
+
+
+# Probes one target until it's ready or the deadline passes, and records when it became ready.
+def wait_for_target(target, deadline, start, ready_times, output_lock):
+	kind, host, port = parse_target(target)
+	probe = PROBES[kind]
+	while True:
+		remaining = deadline - time.time()
+		if remaining <= 0:
+			return
+
+		try:
+			ready = probe(host, port, min(PROBE_TIMEOUT, remaining))
+		except (socket.error, socket.timeout):
+			ready = False
+
+		if ready:
+			with output_lock:
+				ready_times[target] = time.time() - start
+				print "Ready: %s after %.1f seconds" % (target, ready_times[target])
+				sys.stdout.flush()
+			return
+
+		time.sleep(max(0, min(POLL_INTERVAL, deadline - time.time())))
+
+
+def main():
+	if len(sys.argv) < 3:
+		print "Usage: readiness_probe.py <deadline in seconds> <target> [<target> ...]"
+		sys.exit(2)
+
+	targets = sys.argv[2:]
+	try:
+		timeout = float(sys.argv[1])
+		for target in targets:
+			parse_target(target)
+	except ValueError as e:
+		print "Error: %s" % e
+		sys.exit(2)
+
+	start = time.time()
+	deadline = start + timeout
+	ready_times = {}
+	output_lock = threading.Lock()
+
+	threads = [threading.Thread(target=wait_for_target, args=(target, deadline, start, ready_times, output_lock))
+		for target in targets]
+	for t in threads:
+		t.daemon = True
+		t.start()
+	for t in threads:
+		t.join()
+
+	not_ready = [target for target in targets if target not in ready_times]
+	for target in not_ready:
+		print "Not ready: %s after %d seconds" % (target, timeout)
+
+	sys.exit(1 if not_ready else 0)
+
+
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,319 @@
+#!/usr/bin/python
+
+# Pushes files to and runs a command on many cluster nodes concurrently over SSH.
+#
+# Nodes are read from stdin, one per line, in the format of the "ipaddresses" section of a
+# cluster status file: "linode_id private_ip public_ip".
+#
+# Each node gets a single SSH session: all its files are packed into one tar stream which
+# is unpacked on the node, followed by the command. Sessions to a node share one multiplexed
+# SSH connection (ControlMaster) that's kept open for a while, so that successive invocations
+# don't pay for a new connection and key exchange every time.
+#
+# With --state, copies are incremental: hashes of the files copied to each node are recorded
+# in the cluster state, and a node gets only those files whose contents differ from what it
+# was last sent. The command is run only on nodes that got some file, so that services are
+# restarted or reloaded only where their configuration actually changed. With --plan, the
+# files that would be copied are printed, but nothing is copied or run.
+#
+# Usage: ssh_fanout.py [--state <status file> [--plan]] <user> <private key> <use public IP: true|false> <parallelism> <command> [<local path>:<remote path> ...]
+#	command : Shell command run on each node after files are pushed. Empty to only push files.
+#	local path : May contain "{linode_id}", which is replaced by each node's ID, for files that are
+#			different for each node. Nodes for which there is no such file don't get it.
+#	remote path : Destination file path on node. Relative paths are relative to user's home directory,
+#			and missing directories are created.
+# Output: Output of each node as its session completes, followed by a summary line for each node.
+#		With --plan, a line "linode:<id> IP:<ip> new|changed <remote path>" for each file that
+#		would be copied, followed by the number of nodes that would get files.
+# Returns: 0 if the session to every node succeeded, 1 otherwise.
+
+import os
+import sys
+import time
+import errno
+import hashlib
+import tarfile
+import StringIO
+import threading
+import subprocess
+import Queue
+
+import cluster_state
+
+# Directory for the control sockets of multiplexed SSH connections, and how long in seconds
+# an idle connection is kept open after its last session.
+CONTROL_DIR = '~/.storm-linode/ssh'
+CONTROL_PERSIST = 120
+
+# Seconds to wait for a connection to be established.
+CONNECT_TIMEOUT = 30
+
+# Placeholder in local paths for the node's ID.
+NODE_ID_PLACEHOLDER = '{linode_id}'
+
+
+def ssh_args(user, private_key, host, options):
+	control_dir = os.path.expanduser(CONTROL_DIR)
+	return ['ssh', '-q', '-x', '-i', private_key,
+		'-o', 'IdentitiesOnly=yes', '-o', 'UserKnownHostsFile=/dev/null', '-o', 'StrictHostKeyChecking=no',
+		'-o', 'ConnectTimeout=%d' % CONNECT_TIMEOUT, '-o', 'ControlPath=%s/%%r@%%h:%%p' % control_dir] + \
+		options + ['%s@%s' % (user, host)]
+
+
+# Starts a background master connection to a node, unless one is already open.
+# The master is started separately with its output discarded, rather than letting the first
+# session become the master, because a master left running by a session would hold that
+# session's output pipes open. If the master can't be started, sessions connect directly.
+def open_master(user, private_key, host):
+	with open(os.devnull, 'r+') as devnull:
+		if subprocess.call(ssh_args(user, private_key, host, ['-O', 'check']), 
+				stdin=devnull, stdout=devnull, stderr=devnull) == 0:
+			return
+		subprocess.call(ssh_args(user, private_key, host, ['-M', '-N', '-f', '-o', 'ControlPersist=%d' % CONTROL_PERSIST]), 
+			stdin=devnull, stdout=devnull, stderr=devnull)
+
+
+# Returns a tar archive with each local file at its remote path. Since the archive is the
+# same for every node, it's built only once.
+def pack_files(file_specs):
+	buf = StringIO.StringIO()
+	archive = tarfile.open(fileobj=buf, mode='w')
+	for local_path, remote_path in file_specs:
+		info = archive.gettarinfo(local_path)
+		# gettarinfo strips leading / from names, but absolute remote paths should stay absolute.
+		info.name = remote_path
+		info.uid = info.gid = 0
+		info.uname = info.gname = ''
+		with open(local_path, 'rb') as f:
+			archive.addfile(info, f)
+	archive.close()
+	return buf.getvalue()
+
+
+# Returns the file specs of a node, with per-node local paths resolved and the per-node files
+# that don't exist for it left out.
+def node_file_specs(file_specs, linode_id):
+	specs = []
+	for local_path, remote_path in file_specs:
+		if NODE_ID_PLACEHOLDER in local_path:
+			local_path = local_path.replace(NODE_ID_PLACEHOLDER, linode_id)
+			if not os.path.exists(local_path):
+				continue
+		specs.append((local_path, remote_path))
+	return specs
+
+
+
+def file_hash(path, hashes):
+	if path not in hashes:
+		with open(path, 'rb') as f:
+			hashes[path] = hashlib.sha1(f.read()).hexdigest()
+	return hashes[path]
+
+
+
+# Returns a dict of node IDs to (spec, hash, 'new' | 'changed') of each file that differs from
+# the one last copied to that node according to cluster state.
+def changed_files(state, nodes, node_specs):
+	hashes = {}
+	changes = {}
+	for linode_id, host in nodes:
+		copied = state.get_artifacts(linode_id)
+		for spec in node_specs[linode_id]:
+			hash = file_hash(spec[0], hashes)
+			if copied.get(spec[1]) != hash:
+				changes.setdefault(linode_id, []).append((spec, hash, 'changed' if spec[1] in copied else 'new'))
+	return changes
+
+
+
+def parse_file_spec(spec):
+	local_path, sep, remote_path = spec.partition(':')
+	if not sep or not local_path or not remote_path:
+		raise ValueError("Invalid file '%s'. It should be <local path>:<remote path>" % spec)
+	if remote_path.startswith('~/'):
+		remote_path = remote_path[2:]
+	return (local_path, remote_path)
+
+
+# Runs one node's session and returns (exit code, output, seconds).
+def run_session(user, private_key, host, archive, command):
+	remote_cmds = []
+	if archive is not None:
+		# -P keeps absolute names absolute. Files are owned by the login user like with scp.
+		remote_cmds.append('tar -x -P --no-same-owner -f -')
+	if command:
+		remote_cmds.append(command)
+
+	start = time.time()
+	open_master(user, private_key, host)
+	proc = subprocess.Popen(ssh_args(user, private_key, host, ['-o', 'ControlMaster=no']) + [' && '.join(remote_cmds)],
+		stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+	output = proc.communicate(archive or '')[0]
+	return (proc.returncode, output, time.time() - start)
+
+
+def read_nodes(use_public_ip):
+	nodes = []
+	for line in sys.stdin:
+		fields = line.split()
+		if len(fields) < 3:
+			continue
+		nodes.append((fields[0], fields[2] if use_public_ip else fields[1]))
+	return nodes
+
+
+def main():
+	args = sys.argv[1:]
+	status_file = None
+	plan = False
+	while args and args[0].startswith('--'):
+		if args[0] == '--state' and len(args) > 1:
+			status_file = args[1]
+			args = args[2:]
+		elif args[0] == '--plan' and status_file:
+			plan = True
+			args = args[1:]
+		else:
+			break
+
+	if len(args) < 5 or args[0].startswith('--'):
+		print "Usage: ssh_fanout.py [--state <status file> [--plan]] <user> <private key> <use public IP: true|false> <parallelism> <command> [<local path>:<remote path> ...]"
+		sys.exit(1)
+
+	user = args[0]
+	private_key = args[1]
+	use_public_ip = args[2] == 'true'
+	parallelism = max(1, int(args[3]))
+	command = args[4]
+
+	nodes = read_nodes(use_public_ip)
+	state = None
+	changes = None
+	try:
+		file_specs = [parse_file_spec(spec) for spec in args[5:]]
+		if not file_specs and not command:
+			raise ValueError("Nothing to do")
+
+		node_specs = dict((linode_id, node_file_specs(file_specs, linode_id)) for linode_id, host in nodes)
+
+		if status_file:
+			state = cluster_state.ClusterState(status_file)
+			if not state.open(False):
+				raise ValueError("Cluster status file %s not found" % status_file)
+			changes = changed_files(state, nodes, node_specs)
+			state.close()
+
+			# Only changed files are copied, and only nodes with changed files get a session.
+			node_specs = dict((linode_id, [spec for spec, hash, status in node_changes])
+				for linode_id, node_changes in changes.items())
+
+		# Archives are built only once for all nodes that get the same files.
+		archives = {}
+		for specs in node_specs.values():
+			if specs and tuple(specs) not in archives:
+				archives[tuple(specs)] = pack_files(specs)
+
+	except (ValueError, IOError, OSError, cluster_state.StateError, cluster_state.sqlite3.Error) as e:
+		print "Error: %s" % e
+		sys.exit(1)
+
+	if plan:
+		for linode_id, host in nodes:
+			for spec, hash, status in changes.get(linode_id, []):
+				print "linode:%s\tIP:%s\t%s\t%s" % (linode_id, host, status, spec[1])
+		print "%d of %d nodes have changed files" % (len(changes), len(nodes))
+		sys.exit(0)
+
+	# Nodes with nothing to copy and no command to run are skipped. With --state, that's
+	# every node whose files are unchanged.
+	skipped = set(linode_id for linode_id, host in nodes
+		if not node_specs.get(linode_id) and (changes is not None or not command))
+
+	control_dir = os.path.expanduser(CONTROL_DIR)
+	try:
+		os.makedirs(control_dir, 0700)
+	except OSError as e:
+		if e.errno != errno.EEXIST:
+			raise
+
+	tasks = Queue.Queue()
+	for node in nodes:
+		if node[0] not in skipped:
+			tasks.put(node)
+
+	results = {}
+	no_result = (255, 'No result', 0.0)
+	output_lock = threading.Lock()
+
+	def worker():
+		while True:
+			try:
+				linode_id, host = tasks.get_nowait()
+			except Queue.Empty:
+				return
+
+			specs = node_specs.get(linode_id)
+			try:
+				result = run_session(user, private_key, host, archives[tuple(specs)] if specs else None, command)
+			except OSError as e:
+				result = (255, 'Unable to run ssh: %s\n' % e, 0.0)
+			except Exception as e:
+				# Any other failure is reported as the node's result, so that the node isn't
+				# left without one.
+				result = (255, 'Unable to run session: %s: %s\n' % (type(e).__name__, e), 0.0)
+
+			with output_lock:
+				results[linode_id] = result
+				code, output, secs = result
+				print "---- linode:%s, IP:%s, exit code %d ----" % (linode_id, host, code)
+				if output:
+					sys.stdout.write(output if output.endswith('\n') else output + '\n')
+				sys.stdout.flush()
+
+	threads = [threading.Thread(target=worker) for i in range(min(parallelism, len(nodes) - len(skipped)))]
+	for t in threads:
+		t.daemon = True
+		t.start()
+	for t in threads:
+		t.join()
+
+	# Hashes are recorded only for nodes whose session succeeded, so that failed nodes get
+	# their files again next time.
+	if changes:
+		try:
+			state.open(True)
+			state.begin()
+			try:
+				for linode_id, node_changes in changes.items():
+					if results.get(linode_id, no_result)[0] == 0:
+						for spec, hash, status in node_changes:
+							state.set_artifact(linode_id, spec[1], hash)
+				state.commit()
+			except:
+				state.rollback()
+				raise
+		except (IOError, OSError, cluster_state.StateError, cluster_state.sqlite3.Error) as e:
+			print "Error: Unable to record copied files: %s" % e
+		finally:
+			state.close()
+
+	failed = 0
+	print "Summary:"
+	for linode_id, host in nodes:
+		if linode_id in skipped:
+			print "linode:%s\tIP:%s\t%s" % (linode_id, host, 'UNCHANGED' if changes is not None else 'SKIPPED')
+			continue
+		code, output, secs = results.get(linode_id, no_result)
+		if code != 0:
+			failed += 1
+		print "linode:%s\tIP:%s\t%s\texit code %d\t%.1fs" % (linode_id, host,
+			'OK' if code == 0 else 'FAILED', code, secs)
+	print "%d of %d nodes succeeded" % (len(nodes) - failed, len(nodes))
+
+	sys.exit(1 if failed else 0)
+
+
+
+if __name__ == '__main__':
+	main()
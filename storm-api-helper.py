@@ -3,8 +3,60 @@
 # Python helper module to extract information from the JSON responses returned by Storm UI REST API
 # See https://github.com/apache/storm/blob/master/STORM-UI-REST-API.md for API documentation
 
+import os
 import sys
 import json
+import time
+import threading
+import subprocess
+import collections
+import urllib2
+
+# Poll interval and default deadline, in seconds, while waiting for killed topologies to be removed.
+KILL_POLL_INTERVAL = 3
+KILL_DEADLINE = 180
+
+# Default interval in seconds between metrics samples, and the metrics window in seconds 
+# requested from Storm UI for bolt capacity and latencies.
+COLLECT_INTERVAL = 60
+COLLECT_WINDOW = 600
+
+# Topology counters are written as deltas from the previous sample, except on every 
+# COLLECT_FULL_EVERY'th sample where they are written in full, so that a time-series file
+# remains readable even if some lines are lost.
+COLLECT_FULL_EVERY = 60
+TOPOLOGY_COUNTERS = ('emitted', 'transferred', 'acked', 'failed')
+
+# Default capacity above which a bolt is considered hot, and the default window in seconds
+# over which samples are examined.
+HOT_BOLT_CAPACITY = 0.8
+HOT_BOLT_WINDOW = 3600
+
+# Default autoscaler settings. Each can be overridden with an environment variable of the 
+# same name, which storm-cluster-linode.sh exports from the cluster configuration file.
+# See storm-cluster-example.conf for what they mean.
+AUTOSCALE_DEFAULTS = {
+	'AUTOSCALE_PLAN'				: '2GB',
+	'AUTOSCALE_STEP'				: 1,
+	'AUTOSCALE_MIN_SUPERVISORS'		: 1,
+	'AUTOSCALE_MAX_SUPERVISORS'		: 10,
+	'AUTOSCALE_MAX_MONTHLY_COST'	: 0.0,
+	'AUTOSCALE_PLAN_PRICE'			: 0.0,
+	'AUTOSCALE_HIGH_CAPACITY'		: 0.8,
+	'AUTOSCALE_LOW_CAPACITY'		: 0.3,
+	'AUTOSCALE_MAX_FREE_SLOTS'		: 0.25,
+	'AUTOSCALE_PENDING_GROWTH'		: 0.2,
+	'AUTOSCALE_SUSTAIN'				: 3,
+	'AUTOSCALE_COOLDOWN'			: 900,
+	'AUTOSCALE_INTERVAL'			: 60
+}
+
+# Supervisor linodes are labelled with this prefix followed by their linode ID.
+SUPERVISOR_LABEL_PREFIX = 'sup-'
+
+# Reasons for holding that don't involve any pressure to scale.
+NO_PRESSURE = 'No pressure'
+WAITING_FOR_SAMPLES = 'Waiting for more samples'
 
 def print_topology_names():
 	input_text=sys.stdin.read()
@@ -22,10 +74,540 @@ def print_topology_ids():
 		print topology['id']
 
 
+def get_topology_ids(ui_url):
+	obj = json.load(urllib2.urlopen(ui_url + '/api/v1/topology/summary', timeout=30))
+	return [topology['id'] for topology in obj['topologies']]
+
+
+def kill_topology(ui_url, topology_id, wait_secs, errors):
+	try:
+		urllib2.urlopen(urllib2.Request('%s/api/v1/topology/%s/kill/%d' % (ui_url, topology_id, wait_secs), ''), 
+			timeout=30).read()
+	except (urllib2.URLError, IOError) as e:
+		errors.append('%s: %s' % (topology_id, e))
+
+
+# Kills all topologies concurrently using Storm UI REST API at the URL in sys.argv[2] 
+# (such as the local end of an SSH tunnel to client node), and then checks the list of 
+# topologies every few seconds until it's empty or the deadline passes.
+# Args: Storm UI base URL, like http://localhost:8080
+#		(Optional) Seconds for which each topology is deactivated before it's killed. Default is 30.
+#		(Optional) Deadline in seconds to wait for all topologies to be removed. Default is 180.
+# Returns: 0 if all topologies were killed, 1 if some remained at deadline, 2 if API could not be used.
+def kill_all_topologies():
+	ui_url = sys.argv[2].rstrip('/')
+	wait_secs = int(sys.argv[3]) if len(sys.argv) > 3 else 30
+	deadline = time.time() + (int(sys.argv[4]) if len(sys.argv) > 4 else KILL_DEADLINE)
+	
+	try:
+		topology_ids = get_topology_ids(ui_url)
+	except (urllib2.URLError, IOError, ValueError) as e:
+		print "Unable to get topologies: %s" % e
+		sys.exit(2)
+		
+	if not topology_ids:
+		print "No topologies to kill"
+		sys.exit(0)
+	
+	errors = []
+	threads = []
+	for topology_id in topology_ids:
+		print "Killing topology %s" % topology_id
+		t = threading.Thread(target=kill_topology, args=(ui_url, topology_id, wait_secs, errors))
+		t.start()
+		threads.append(t)
+	for t in threads:
+		t.join()
+	for error in errors:
+		print "Failed to kill topology %s" % error
+	
+	while True:
+		try:
+			remaining = get_topology_ids(ui_url)
+		except (urllib2.URLError, IOError, ValueError) as e:
+			print "Unable to get topologies: %s" % e
+			remaining = None
+			
+		if remaining == []:
+			print "All topologies are killed"
+			sys.exit(0)
+			
+		if time.time() + KILL_POLL_INTERVAL > deadline:
+			break
+		time.sleep(KILL_POLL_INTERVAL)
+	
+	print "Some topologies could not be killed in time"
+	sys.exit(1)
+
+
+def get_json(url):
+	return json.load(urllib2.urlopen(url, timeout=30))
+
+
+def to_float(value):
+	# Storm UI returns latencies and capacities as strings like "0.123", and sometimes as null.
+	try:
+		return float(value)
+	except (TypeError, ValueError):
+		return 0.0
+
+
+def get_topology_sample(ui_url, topology_id, samples, errors):
+	try:
+		obj = get_json('%s/api/v1/topology/%s?window=%d' % (ui_url, topology_id, COLLECT_WINDOW))
+	except (urllib2.URLError, IOError, ValueError) as e:
+		errors.append('%s: %s' % (topology_id, e))
+		return
+	
+	# topologyStats has an entry for each window. Counters are taken from the ":all-time" window
+	# because they only ever grow and so delta encode well, while complete latency is taken from
+	# the requested window because it's more recent.
+	windows = dict((stats.get('window'), stats) for stats in obj.get('topologyStats', []))
+	all_time = windows.get(':all-time', {})
+	recent = windows.get(str(COLLECT_WINDOW), all_time)
+	
+	# Tuples emitted by spouts in the window but not yet acked or failed approximate the 
+	# topology's pending tuples. A growing number means the topology is falling behind.
+	pending = 0
+	for spout in obj.get('spouts', []):
+		pending += int(spout.get('emitted') or 0) - int(spout.get('acked') or 0) - int(spout.get('failed') or 0)
+	
+	bolts = obj.get('bolts', [])
+	samples[topology_id] = {
+		'c'		: [int(all_time.get(counter) or 0) for counter in TOPOLOGY_COUNTERS],
+		'lat'	: to_float(recent.get('completeLatency')),
+		'pend'	: max(pending, 0),
+		'b'		: [bolt['boltId'] for bolt in bolts],
+		'cap'	: [to_float(bolt.get('capacity')) for bolt in bolts],
+		'blat'	: [to_float(bolt.get('executeLatency')) for bolt in bolts]
+	}
+
+
+# Polls Storm UI REST API once and returns a time-series record with absolute counters.
+# Per-topology stats are requested concurrently.
+def get_metrics_sample(ui_url):
+	cluster = get_json(ui_url + '/api/v1/cluster/summary')
+	supervisors = get_json(ui_url + '/api/v1/supervisor/summary').get('supervisors', [])
+	topology_ids = get_topology_ids(ui_url)
+	
+	samples = {}
+	errors = []
+	threads = []
+	for topology_id in topology_ids:
+		t = threading.Thread(target=get_topology_sample, args=(ui_url, topology_id, samples, errors))
+		t.start()
+		threads.append(t)
+	for t in threads:
+		t.join()
+	for error in errors:
+		sys.stderr.write("Unable to get stats of topology %s\n" % error)
+	
+	return {
+		't'		: int(time.time()),
+		'cl'	: [cluster.get('supervisors', 0), cluster.get('slotsTotal', 0), cluster.get('slotsUsed', 0), 
+					cluster.get('executorsTotal', 0), cluster.get('tasksTotal', 0)],
+		'sh'	: [sup.get('host') for sup in supervisors],
+		'st'	: [sup.get('slotsTotal', 0) for sup in supervisors],
+		'su'	: [sup.get('slotsUsed', 0) for sup in supervisors],
+		'tp'	: samples
+	}
+
+
+# Replaces absolute topology counters in a record with deltas from the previous record's 
+# counters, for topologies that were in the previous record. Delta counters are written 
+# under 'dc' instead of 'c'.
+def delta_encode(record, prev_counters):
+	for topology_id, sample in record['tp'].items():
+		prev = prev_counters.get(topology_id)
+		if prev is not None:
+			sample['dc'] = [cur - old for cur, old in zip(sample.pop('c'), prev)]
+
+
+# Reads a time-series file written by collect and yields its records with absolute
+# topology counters under 'c'. Incomplete or corrupt lines, such as a partially written
+# last line, are skipped.
+def read_time_series(path):
+	prev_counters = {}
+	with open(path) as f:
+		for line in f:
+			try:
+				record = json.loads(line)
+			except ValueError:
+				continue
+			counters = {}
+			for topology_id, sample in record.get('tp', {}).items():
+				if 'dc' in sample:
+					prev = prev_counters.get(topology_id)
+					if prev is None:
+						# Base of the deltas was lost. Drop the topology's samples until its next full sample.
+						del record['tp'][topology_id]
+						continue
+					sample['c'] = [old + delta for old, delta in zip(prev, sample.pop('dc'))]
+				counters[topology_id] = sample['c']
+			prev_counters = counters
+			yield record
+
+
+# Collects Storm cluster metrics from Storm UI REST API at the URL in sys.argv[2] every 
+# few seconds, and appends them to a time-series file, one compact JSON record per line.
+# Each record has:
+#	t 	: Sample time in epoch seconds.
+#	cl 	: Cluster summary [supervisors, slotsTotal, slotsUsed, executorsTotal, tasksTotal].
+#	sh, st, su : Columns of supervisor hosts, their total slots and their used slots.
+#	tp 	: Topology ID -> topology sample with
+#			c or dc : [emitted, transferred, acked, failed] counters since topology started,
+#						or their deltas from the previous record.
+#			lat		: Complete latency in ms.
+#			pend	: Approximate number of pending spout tuples.
+#			b, cap, blat : Columns of bolt IDs, their capacities and execute latencies in ms.
+# Args: Storm UI base URL, like http://localhost:8080
+#		Path of time-series file. It's created if it does not exist.
+#		(Optional) Interval in seconds between samples. Default is 60.
+#		(Optional) Number of samples to collect. Default is 0, to collect until interrupted.
+# Returns: 0 after collecting all samples, 1 if no sample could be collected.
+def collect_metrics():
+	ui_url = sys.argv[2].rstrip('/')
+	path = sys.argv[3]
+	interval = float(sys.argv[4]) if len(sys.argv) > 4 else COLLECT_INTERVAL
+	max_samples = int(sys.argv[5]) if len(sys.argv) > 5 else 0
+	
+	collected = collect_samples(ui_url, path, interval, max_samples, lambda record: None)
+	
+	print "Collected %d samples" % collected
+	sys.exit(0 if collected > 0 else 1)
+
+
+# Polls Storm UI every 'interval' seconds and appends each sample to the time-series file at 'path'.
+# on_sample(record) is called with each sample, with absolute counters, before it's written.
+# Polls that fail are reported and skipped.
+# Returns: Number of samples collected, after 'max_samples' polls or forever if it's 0.
+def collect_samples(ui_url, path, interval, max_samples, on_sample):
+	collected = 0
+	attempts = 0
+	prev_counters = {}
+	next_time = time.time()
+	with open(path, 'a') as f:
+		while max_samples <= 0 or attempts < max_samples:
+			attempts += 1
+			try:
+				record = get_metrics_sample(ui_url)
+			except (urllib2.URLError, IOError, ValueError) as e:
+				sys.stderr.write("Unable to collect metrics: %s\n" % e)
+				record = None
+			
+			if record is not None:
+				on_sample(record)
+				
+				counters = dict((topology_id, sample['c']) for topology_id, sample in record['tp'].items())
+				if collected % COLLECT_FULL_EVERY != 0:
+					delta_encode(record, prev_counters)
+				prev_counters = counters
+				
+				f.write(json.dumps(record, separators=(',', ':')) + '\n')
+				f.flush()
+				collected += 1
+			
+			if max_samples > 0 and attempts >= max_samples:
+				break
+			
+			# Keep samples on a fixed schedule regardless of how long each poll takes.
+			next_time += interval
+			delay = next_time - time.time()
+			if delay > 0:
+				time.sleep(delay)
+			else:
+				next_time = time.time()
+				
+	return collected
+
+
+# Lists bolts whose capacity exceeded a threshold in the samples of a time-series file 
+# written by collect, within a window before the last sample. A capacity close to 1 means 
+# the bolt's executors are busy almost all the time, and the topology needs more executors
+# or the cluster needs more supervisors.
+# Args: Path of time-series file.
+#		(Optional) Capacity threshold. Default is 0.8.
+#		(Optional) Window in seconds. Default is 3600.
+# Output: A line for each hot bolt, hottest first, with tab separated fields
+#			topology ID, bolt ID, hot samples/samples, average capacity, maximum capacity, 
+#			average execute latency in ms
+# Returns: 0 if there are hot bolts, 1 if there are none, 2 if the file could not be read.
+def print_hot_bolts():
+	path = sys.argv[2]
+	threshold = float(sys.argv[3]) if len(sys.argv) > 3 else HOT_BOLT_CAPACITY
+	window = int(sys.argv[4]) if len(sys.argv) > 4 else HOT_BOLT_WINDOW
+	
+	try:
+		records = list(read_time_series(path))
+	except IOError as e:
+		print "Unable to read time series: %s" % e
+		sys.exit(2)
+	
+	if not records:
+		sys.exit(1)
+	
+	start = records[-1]['t'] - window
+	
+	# (topology ID, bolt ID) -> [samples, hot samples, capacity sum, max capacity, latency sum]
+	stats = {}
+	for record in records:
+		if record['t'] < start:
+			continue
+		for topology_id, sample in record['tp'].items():
+			for bolt_id, capacity, latency in zip(sample['b'], sample['cap'], sample['blat']):
+				bolt_stats = stats.setdefault((topology_id, bolt_id), [0, 0, 0.0, 0.0, 0.0])
+				bolt_stats[0] += 1
+				if capacity > threshold:
+					bolt_stats[1] += 1
+				bolt_stats[2] += capacity
+				bolt_stats[3] = max(bolt_stats[3], capacity)
+				bolt_stats[4] += latency
+	
+	hot = [(key, s) for key, s in stats.items() if s[1] > 0]
+	hot.sort(key=lambda item: (item[1][3], item[1][2] / item[1][0]), reverse=True)
+	for (topology_id, bolt_id), s in hot:
+		print "%s\t%s\t%d/%d\t%.3f\t%.3f\t%.3f" % (topology_id, bolt_id, s[1], s[0], 
+			s[2] / s[0], s[3], s[4] / s[0])
+	
+	sys.exit(0 if hot else 1)
+
+
+def autoscale_setting(name):
+	default = AUTOSCALE_DEFAULTS[name]
+	value = os.getenv(name, '')
+	if value == '':
+		return default
+	return type(default)(value)
+
+
+# Decides from a sequence of metrics samples when supervisor nodes should be added or retired.
+#
+# The cluster is under pressure to scale out when, for AUTOSCALE_SUSTAIN consecutive samples,
+# some bolt's capacity is above AUTOSCALE_HIGH_CAPACITY or pending tuples keep growing, 
+# while less than AUTOSCALE_MAX_FREE_SLOTS of worker slots are free. Adding supervisors
+# doesn't help a cluster that has free slots; its topologies need rebalancing instead.
+#
+# It's under pressure to scale in when, for as many samples, every bolt's capacity is below
+# AUTOSCALE_LOW_CAPACITY, pending tuples are not growing, and the free slots would still be 
+# free if a supervisor was removed.
+#
+# Capacities between the low and high thresholds cause neither, so that the cluster does not
+# flap between sizes. After every decision to scale, no other decision is made for 
+# AUTOSCALE_COOLDOWN seconds, to give new nodes time to join and topologies time to be 
+# rebalanced, and pressure has to build up again over fresh samples.
+#
+# Time is taken from the samples rather than the clock, so that recorded samples can be replayed.
+class AutoscalePolicy(object):
+
+	# monthly_cost(record) should return the current monthly cost of supervisor nodes, 
+	# or None if it can't be found. It's called only if there's a cost cap.
+	def __init__(self, monthly_cost):
+		self.monthly_cost = monthly_cost
+		self.plan = autoscale_setting('AUTOSCALE_PLAN')
+		self.step = autoscale_setting('AUTOSCALE_STEP')
+		self.min_supervisors = autoscale_setting('AUTOSCALE_MIN_SUPERVISORS')
+		self.max_supervisors = autoscale_setting('AUTOSCALE_MAX_SUPERVISORS')
+		self.max_cost = autoscale_setting('AUTOSCALE_MAX_MONTHLY_COST')
+		self.plan_price = autoscale_setting('AUTOSCALE_PLAN_PRICE')
+		self.high_capacity = autoscale_setting('AUTOSCALE_HIGH_CAPACITY')
+		self.low_capacity = autoscale_setting('AUTOSCALE_LOW_CAPACITY')
+		self.max_free_slots = autoscale_setting('AUTOSCALE_MAX_FREE_SLOTS')
+		self.pending_growth = autoscale_setting('AUTOSCALE_PENDING_GROWTH')
+		self.cooldown = autoscale_setting('AUTOSCALE_COOLDOWN')
+		self.samples = collections.deque(maxlen=autoscale_setting('AUTOSCALE_SUSTAIN'))
+		self.last_action_time = None
+
+
+	# Returns: (action, number of nodes, reason) where action is one of 'out', 'in' or 'hold'.
+	def evaluate(self, record):
+		supervisors, slots_total, slots_used = record['cl'][0:3]
+		capacities = [cap for sample in record['tp'].values() for cap in sample.get('cap', [])]
+		self.samples.append({
+			't'				: record['t'],
+			'supervisors'	: supervisors,
+			'free_slots'	: slots_total - slots_used,
+			'slots_per_supervisor' : float(slots_total) / supervisors if supervisors else 0,
+			'free_ratio'	: float(slots_total - slots_used) / slots_total if slots_total else 0,
+			'capacity'		: max(capacities) if capacities else 0.0,
+			'pending'		: sum(sample.get('pend', 0) for sample in record['tp'].values())
+		})
+		
+		if len(self.samples) < self.samples.maxlen:
+			return ('hold', 0, WAITING_FOR_SAMPLES)
+		
+		first = self.samples[0]
+		last = self.samples[-1]
+		pending_growing = last['pending'] > 0 and last['pending'] > first['pending'] * (1 + self.pending_growth)
+		hot = all(s['capacity'] > self.high_capacity for s in self.samples)
+		cold = all(s['capacity'] < self.low_capacity for s in self.samples)
+		slots_short = all(s['free_ratio'] < self.max_free_slots for s in self.samples)
+		slots_spare = all(s['free_slots'] >= s['slots_per_supervisor'] > 0 for s in self.samples)
+		
+		if (hot or pending_growing) and slots_short:
+			action = 'out'
+			reason = 'Bolt capacity %.2f, pending tuples %d, free slots %d%%' % (last['capacity'], 
+				last['pending'], last['free_ratio'] * 100)
+		elif cold and not pending_growing and slots_spare:
+			action = 'in'
+			reason = 'Bolt capacity %.2f, free slots %d' % (last['capacity'], last['free_slots'])
+		else:
+			return ('hold', 0, NO_PRESSURE)
+		
+		if self.last_action_time is not None and last['t'] - self.last_action_time < self.cooldown:
+			return ('hold', 0, '%s. Cooling down for %d more seconds' % (reason, 
+				self.cooldown - (last['t'] - self.last_action_time)))
+		
+		if action == 'out':
+			count = min(self.step, self.max_supervisors - last['supervisors'])
+			if count <= 0:
+				return ('hold', 0, '%s. Already at maximum of %d supervisors' % (reason, self.max_supervisors))
+			
+			if self.max_cost > 0:
+				cost = self.monthly_cost(record)
+				if cost is None:
+					return ('hold', 0, '%s. Unable to find cost of supervisors' % reason)
+				count = min(count, int((self.max_cost - cost) // self.plan_price) if self.plan_price > 0 else 0)
+				if count <= 0:
+					return ('hold', 0, '%s. Monthly cost $%d is at the cap of $%d' % (reason, cost, self.max_cost))
+		else:
+			count = 1
+			if last['supervisors'] - count < self.min_supervisors:
+				return ('hold', 0, '%s. Already at minimum of %d supervisors' % (reason, self.min_supervisors))
+		
+		self.last_action_time = last['t']
+		self.samples.clear()
+		return (action, count, reason)
+
+
+def print_decision(record, decision):
+	action, count, reason = decision
+	print "%s\t%s\t%d\t%s" % (time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(record['t'])), 
+		action, count, reason)
+	sys.stdout.flush()
+
+
+# Sets AUTOSCALE_PLAN_PRICE from the plans catalog if there's a cost cap but no price is given.
+def find_plan_price(policy):
+	if policy.max_cost <= 0 or policy.plan_price > 0:
+		return True
+		
+	import linode_api
+	linode_api.use_api_environment(os.getenv('LINODE_API_URL'), os.getenv('LINODE_KEY'))
+	try:
+		price = linode_api.get_plan_price(policy.plan)
+	except (urllib2.URLError, IOError, ValueError, KeyError) as e:
+		print "Unable to get price of plan %s: %s" % (policy.plan, e)
+		return False
+		
+	if price is None:
+		print "Unable to get price of plan %s. Set AUTOSCALE_PLAN_PRICE" % policy.plan
+		return False
+		
+	policy.plan_price = price
+	return True
+
+
+# Runs the autoscaler. It collects metrics from Storm UI REST API at the URL in sys.argv[2]
+# every AUTOSCALE_INTERVAL seconds into the time-series file, and on each sample decides whether 
+# supervisor nodes should be added or retired. Nodes of AUTOSCALE_PLAN are added by running 
+# storm-cluster-linode.sh add-nodes. There's no flow to remove supervisors yet, so a decision
+# to retire one is only reported.
+# The cost of supervisor nodes is found from the linodes of the cluster, using the Linode API
+# environment in LINODE_KEY and LINODE_API_URL env vars.
+# Args: Storm UI base URL, like http://localhost:8080
+#		Path of time-series file.
+#		Cluster name or directory or configuration file, as passed to storm-cluster-linode.sh
+#		API environment file, as passed to storm-cluster-linode.sh
+#		Cluster name, which is the display group of its linodes
+# Output: A line for each decision, with tab separated fields
+#			time, action (out | in | hold), number of nodes, reason
+# Returns: Only if the plan price could not be found, with exit code 1.
+def autoscale():
+	ui_url = sys.argv[2].rstrip('/')
+	path = sys.argv[3]
+	cluster = sys.argv[4]
+	api_env_file = sys.argv[5]
+	cluster_name = sys.argv[6]
+	
+	import linode_api
+	linode_api.use_api_environment(os.getenv('LINODE_API_URL'), os.getenv('LINODE_KEY'))
+	
+	def monthly_cost(record):
+		try:
+			success, data = linode_api.get_nodes_monthly_cost(cluster_name, SUPERVISOR_LABEL_PREFIX)
+		except (urllib2.URLError, IOError, ValueError) as e:
+			success, data = (False, e)
+		if not success:
+			print "Unable to get cost of supervisors: %s" % data
+			return None
+		return data
+		
+	policy = AutoscalePolicy(monthly_cost)
+	if not find_plan_price(policy):
+		sys.exit(1)
+	
+	cluster_script = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'storm-cluster-linode.sh')
+	
+	def on_sample(record):
+		decision = policy.evaluate(record)
+		print_decision(record, decision)
+		
+		action, count, reason = decision
+		if action == 'out':
+			plan_spec = '%s:%d' % (policy.plan, count)
+			print "Adding supervisor nodes %s..." % plan_spec
+			sys.stdout.flush()
+			if subprocess.call([cluster_script, 'add-nodes', cluster, api_env_file, plan_spec]) != 0:
+				print "Failed to add supervisor nodes"
+		elif action == 'in':
+			print "%d supervisor node(s) can be retired. Remove them manually." % count
+		sys.stdout.flush()
+	
+	collect_samples(ui_url, path, autoscale_setting('AUTOSCALE_INTERVAL'), 0, on_sample)
+
+
+# Replays the samples of a time-series file through the autoscaler and prints its decisions,
+# without adding or removing any nodes. Since no nodes are actually added or removed, 
+# samples after a decision still show the cluster as it was.
+# The cost of supervisor nodes is estimated as the number of supervisors times the price of
+# AUTOSCALE_PLAN.
+# Args: Path of time-series file.
+# Output: A line for each decision other than holding without pressure, 
+#			with tab separated fields time, action (out | in | hold), number of nodes, reason
+# Returns: 0 on success, 1 if the plan price could not be found, 2 if the file could not be read.
+def autoscale_replay():
+	path = sys.argv[2]
+	
+	policy = AutoscalePolicy(lambda record: record['cl'][0] * policy.plan_price)
+	if not find_plan_price(policy):
+		sys.exit(1)
+	
+	counts = {'out' : 0, 'in' : 0}
+	try:
+		for record in read_time_series(path):
+			decision = policy.evaluate(record)
+			action, count, reason = decision
+			if reason not in (NO_PRESSURE, WAITING_FOR_SAMPLES):
+				print_decision(record, decision)
+			if action in counts:
+				counts[action] += count
+	except IOError as e:
+		print "Unable to read time series: %s" % e
+		sys.exit(2)
+	
+	print "Nodes added: %d, Nodes retired: %d" % (counts['out'], counts['in'])
+	sys.exit(0)
+
+
 if (len(sys.argv) > 1):
 	delegates = {
 		'topology-names' 	: print_topology_names,
 		'topology-ids'	 	: print_topology_ids,
+		'kill-all'			: kill_all_topologies,
+		'collect'			: collect_metrics,
+		'hot-bolts'			: print_hot_bolts,
+		'autoscale'			: autoscale,
+		'autoscale-replay'	: autoscale_replay,
 	}
 	func = delegates.get(sys.argv[1], lambda:"nothing")
 	func()
@@ -10,6 +10,9 @@
 SSH_AUTH_SOCK=0
 export SSH_AUTH_SOCK
 
+# Package of the Java runtime installed on images. It's part of the image fingerprint.
+JDK_PACKAGE="openjdk-7-jre-headless"
+
 # $1 -> Cluster name, or absolute or relative path of cluster directory, or
 #		absolute or relative path of cluster conf file in cluster directory.
 load_cluster_conf() {
@@ -211,10 +214,13 @@ create_new_image_conf() {
 
 
 
-# 	$1 : Name of configuration file containing base node spec, template node spec, install flags and any other
-#		 common configuration options.
+# Loads image and API environment configurations, checks that the image is not already
+# created, and creates the image status file. The image is then built by image_builder.py.
+# If an image built from the same inputs already exists, it's recorded in the image status 
+# file instead, and 2 is returned since there's nothing to build.
+# 	$1 : Name of image directory or Path of image configuration file.
 #	$2 : Name of API environment configuration file containing API endpoint and key.
-create_storm_image() {
+prepare_image_build() {
 
 	if ! load_image_conf "$1"; then
 		return 1
@@ -235,10 +241,15 @@ create_storm_image() {
 
 	local linout linerr linret
 	
+	if reuse_image; then
+		return 2
+	fi
+	
 	# There are limits on both number of images (max 3) and total size across
 	# images (10240MB). If these limits are reached or close to breaching, warn user
 	# and prevent disk imaging.
 	echo "Image prechecks"
+	gc_images
 	linode_api linout linerr linret "imagestats"
 	if [ $linret -eq 1 ]; then
 		echo "Failed to get image statistics. Continuing, but there is a chance image creation may fail due to image count and disk size limits. Error:$linerr"
@@ -261,162 +272,185 @@ create_storm_image() {
 	fi
 
 	create_image_status_file
-	
-	# Create temporary linode of lowest cost plan in specified datacenter.
-	echo "Creating temporary linode"
-	linode_api linout linerr linret "create-node" 1 "$DATACENTER_FOR_IMAGE"
-	if [ $linret -eq 1 ]; then
-		echo "Failed to create temporary linode. Error:$linerr"
-		return 1
-	fi
-	local temp_linode_id=$linout
-	echo "Created temporary linode $temp_linode_id"
+}
 
-	linode_api linout linerr linret "update-node" $temp_linode_id "stormtmp-$temp_linode_id" "temporary"
-	if [ $linret -eq 1 ]; then
-		echo "Failed to update node label $temp_linode_id. Error:$linerr"
-		return 1
-	fi
 
-	# Create a disk from distribution.
-	echo "Creating disk"
-	linode_api linout linerr linret "create-disk-from-distribution" $temp_linode_id "$DISTRIBUTION_FOR_IMAGE" \
-		$IMAGE_DISK_SIZE "$IMAGE_ROOT_PASSWORD" "$IMAGE_ROOT_SSH_PUBLIC_KEY"
-		
-	if [ $linret -eq 1 ]; then
-		echo "Failed to create disk. Error:$linerr"
-		return 1
-	fi
-	local disk_id=$(echo $linout|cut -d ',' -f1)
-	local create_disk_job_id=$(echo $linout|cut -d ',' -f2)
-	
-	local disk_result
-	wait_for_job $create_disk_job_id $temp_linode_id 
-	disk_result=$?
-	if [ $disk_result -eq 0 ]; then
-		echo "Create disk did not complete even after 4 minutes. Aborting"
-		return 1
+
+# Outputs a fingerprint of everything the loaded image is built from: the image configuration
+# values that affect what's installed, the files that are installed, the JDK package, and 
+# the functions that install them. Images with the same fingerprint are interchangeable.
+image_fingerprint() {
+	local storm_yaml_template="$STORM_YAML_TEMPLATE"
+	if [ "${storm_yaml_template:0:1}" != "/" ]; then
+		storm_yaml_template=$(readlink -m "$IMAGE_CONF_DIR/$STORM_YAML_TEMPLATE")
 	fi
-	
-	if [ $disk_result -ge 2 ]; then
-		echo "Create disk failed."
-		return 1
+	local template_supervisord_conf="$SUPERVISORD_TEMPLATE_CONF"
+	if [ "${template_supervisord_conf:0:1}" != "/" ]; then
+		template_supervisord_conf=$(readlink -m "$IMAGE_CONF_DIR/$SUPERVISORD_TEMPLATE_CONF")
 	fi
 	
-	# Create a configuration profile with that disk.
-	echo "Creating a configuration"
-	linode_api linout linerr linret "create-config" $temp_linode_id "$KERNEL_FOR_IMAGE" \
-		$disk_id "template-configuration"
-	if [ $linret -eq 1 ]; then
-		echo "Failed to create configuration. Error:$linerr"
-		return 1
-	fi
-	local config_id=$linout
+	local name
+	{
+		for name in DISTRIBUTION_FOR_IMAGE KERNEL_FOR_IMAGE IMAGE_DISK_SIZE IMAGE_ROOT_PASSWORD \
+				IMAGE_DISABLE_SSH_PASSWORD_AUTHENTICATION IMAGE_ADMIN_USER IMAGE_ADMIN_PASSWORD UPGRADE_OS \
+				STORM_INSTALL_DIRECTORY STORM_USER JDK_PACKAGE; do
+			printf '%s=%s\n' $name "${!name}"
+		done
+		cat "$IMAGE_ROOT_SSH_PUBLIC_KEY" "$INSTALL_STORM_DISTRIBUTION" "$storm_yaml_template" "$template_supervisord_conf"
+		if [ -f "$IMAGE_ADMIN_SSH_AUTHORIZED_KEYS" ]; then
+			cat "$IMAGE_ADMIN_SSH_AUTHORIZED_KEYS"
+		fi
+		declare -f setup_users_and_authentication_for_image install_software_on_node install_storm_on_node
+	} | sha1sum | cut -d ' ' -f1
+}
 
-	
-	# Boot the linode.
-	echo "Booting the linode"
-	linode_api linout linerr linret "boot" $temp_linode_id $config_id
-	if [ $linret -eq 1 ]; then
-		echo "Failed to boot. Error:$linerr"
-		return 1
-	fi
-	local boot_job_id=$linout
-	
 
-	# Wait for node to boot up.
-	local boot_result
-	wait_for_job $boot_job_id $temp_linode_id 
-	boot_result=$?
-	if [ $boot_result -eq 0 ]; then
-		echo "Boot job did not complete even after 4 minutes. Aborting"
-		return 1
-	fi
+
+# If an image built from the same inputs as the loaded image exists, records it in the
+# image status file, so that it's used instead of building another.
+# Returns 0 if an image is reused, 1 if not. 
+reuse_image() {
+	IMAGE_FINGERPRINT=$(image_fingerprint)
+	echo "Image fingerprint: $IMAGE_FINGERPRINT"
 	
-	if [ $boot_result -ge 2 ]; then
-		echo "Booting failed."
+	local linout linerr linret
+	linode_api linout linerr linret "find-image-fingerprint" $IMAGE_FINGERPRINT
+	if [ $linret -ne 0 ]; then
 		return 1
 	fi
 	
+	local image_id=$(echo $linout|cut -d ',' -f1)
+	echo "Reusing image $image_id '$(echo $linout|cut -d ',' -f2-)', which was built from the same configuration"
 	
-	# Get public IP address of node.
-	echo "Getting IP address of linode"
-	linode_api linout linerr linret "public-ip" $temp_linode_id
-	if [ $linret -eq 1 ]; then
-		echo "Failed to get IP address. Error:$linerr"
-		return 1
-	fi
+	local stfile=$(image_status_file)
+	create_image_status_file
+	add_section $stfile "image"
+	insert_bottom_of_section $stfile "image" $image_id
+	return 0
+}
 
-	local ipaddr=$linout
-	echo "IP address: $ipaddr"
-	
-	setup_users_and_authentication_for_image $ipaddr
 
-	install_software_on_node $ipaddr $NODE_USERNAME
 
-	install_storm_on_node $ipaddr $NODE_USERNAME
+# Outputs comma separated IDs of images recorded in the status files of image directories
+# in the current directory and next to this image's directory. Clusters may still be created
+# from them, so they're never deleted to make room for new images.
+image_ids_in_use() {
+	local ids=","
+	local stfile image_id
+	for stfile in ./*/*.info "$(dirname "$IMAGE_CONF_DIR")"/*/*.info; do
+		if [ ! -f "$stfile" ]; then
+			continue
+		fi
+		for image_id in $(get_section "$stfile" "image"); do
+			if [[ "$image_id" =~ ^[0-9]+$ ]] && [[ "$ids" != *",$image_id,"* ]]; then
+				ids="$ids$image_id,"
+			fi
+		done
+	done
+	ids="${ids#,}"
+	echo "${ids%,}"
+}
 
-	# Shutdown the linode.
-	echo "Shutting down the linode"
-	linode_api linout linerr linret "shutdown" $temp_linode_id
-	if [ $linret -eq 1 ]; then
-		echo "Failed to shutdown. Error:$linerr"
-		return 1
-	fi
-	local shutdown_job_id=$linout
-	
-	# Wait for linode to shutdown.
-	local shutdown_result
-	wait_for_job $shutdown_job_id $temp_linode_id 
-	shutdown_result=$?
-	if [ $shutdown_result -eq 0 ]; then
-		echo "Shutdown job did not complete even after 4 minutes. Aborting"
-		return 1
-	fi
-	
-	if [ $shutdown_result -ge 2 ]; then
-		echo "Shutdown failed."
-		return 1
+
+
+# Deletes least recently used images built earlier, if the new image wouldn't fit 
+# within the account's limit on total size of images. Images in use by local image 
+# directories are kept.
+gc_images() {
+	local linout linerr linret
+	linode_api linout linerr linret "gc-images" $IMAGE_DISK_SIZE "$(image_ids_in_use)"
+	if [ -n "$linout" ]; then
+		echo "Deleted least recently used images to make room for the new image (ID, size in MB, label):"
+		echo "$linout"
 	fi
-	
-	
-	# create image of the disk
-	echo "Creating image of disk $disk_id"
-	linode_api linout linerr linret "create-image" $temp_linode_id $disk_id "$LABEL_FOR_IMAGE"
 	if [ $linret -eq 1 ]; then
-		echo "Failed to create image of disk. Error:$linerr"
-		return 1
+		echo "Failed to delete least recently used images. Error:$linerr"
 	fi
-	local image_id=$(echo $linout|cut -d ',' -f1)
-	local image_disk_job_id=$(echo $linout|cut -d ',' -f2)
-	
-	local image_result
-	wait_for_job $image_disk_job_id $temp_linode_id 
-	image_result=$?
-	if [ $image_result -eq 0 ]; then
-		echo "Image job did not complete even after 4 minutes. Aborting"
+}
+
+
+
+# Outputs the build line of the image loaded by prepare_image_build, as expected by image_builder.py.
+image_build_spec() {
+	printf '%q ' "storm" "$(image_status_file)" "$DATACENTER_FOR_IMAGE" "$DISTRIBUTION_FOR_IMAGE" \
+		"$IMAGE_DISK_SIZE" "$IMAGE_ROOT_PASSWORD" "$IMAGE_ROOT_SSH_PUBLIC_KEY" "$KERNEL_FOR_IMAGE" "stormtmp" \
+		"$LABEL_FOR_IMAGE" "fingerprint:$IMAGE_FINGERPRINT" "bash" "./storm-cluster-linode.sh" "install-image" "$IMAGE_CONF_FILE"
+	printf '\n'
+}
+
+
+
+# 	$1 : Name of image directory or Path of image configuration file.
+#	$2 : Name of API environment configuration file containing API endpoint and key.
+create_storm_image() {
+	prepare_image_build "$1" "$2"
+	case $? in
+		0) ;;
+		2) return 0 ;;
+		*) return 1 ;;
+	esac
+
+	# The temporary linode is created, booted, installed and imaged by image_builder.py, which
+	# overlaps independent stages and prints how long each stage took.
+	image_build_spec | ./image_builder.py
+}
+
+
+
+# Creates a Storm image and a Zookeeper image at the same time.
+# 	$1 : Name of Storm image directory or Path of Storm image configuration file.
+# 	$2 : Name of Zookeeper image directory or Path of Zookeeper image configuration file.
+#	$3 : Name of API environment configuration file containing API endpoint and key.
+create_images() {
+	# The Zookeeper build line is empty if its image is reused.
+	local zk_spec
+	if ! zk_spec=$(./zookeeper-cluster-linode.sh image-build-spec "$2" "$3"); then
 		return 1
 	fi
-	
-	if [ $image_result -ge 2 ]; then
-		echo "Imaging failed."
+
+	local storm_spec
+	prepare_image_build "$1" "$3"
+	case $? in
+		0) storm_spec=$(image_build_spec) ;;
+		2) ;;
+		*)
+			# The Zookeeper image won't be built either, so its new status file is removed. Otherwise
+			# it would look like that image is being created, and the next attempt would skip it.
+			if [ -n "$zk_spec" ]; then
+				local zk_fields
+				eval "zk_fields=($zk_spec)"
+				rm -f "${zk_fields[1]}"
+			fi
+			return 1
+			;;
+	esac
+
+	if [ -z "$storm_spec" ] && [ -z "$zk_spec" ]; then
+		return 0
+	fi
+	printf '%s\n' "$storm_spec" "$zk_spec" | ./image_builder.py
+}
+
+
+
+# Installs software on the temporary linode of an image build. This is run by image_builder.py
+# once the linode is booted and SSH is available.
+# 	$1 : Path of image configuration file.
+#	$2 : IP address of the temporary linode.
+install_image_node() {
+	if ! load_image_conf "$1"; then
 		return 1
 	fi
-	echo "Template image $image_id successfully created"
 
-	add_section $stfile "image"
-	insert_bottom_of_section $stfile "image" "$image_id"
-		
-	# delete temporary linode. 'skipchecks' is 1 (true) because it's much 
-	# easier than detaching disk from config and then deleting.
-	echo "Deleting the temporary linode $temp_linode_id"
-	linode_api linout linerr linret "delete-node" $temp_linode_id 1
-	if [ $linret -eq 1 ]; then
-		echo "Failed to delete temporary linode. Error:$linerr"
+	NODE_USERNAME=root
+
+	if ! setup_users_and_authentication_for_image $2; then
 		return 1
 	fi
 
-	printf "\n\nFinished creating Storm template image $image_id\n"
+	install_software_on_node $2 $NODE_USERNAME
+
+	install_storm_on_node $2 $NODE_USERNAME
 	return 0
 }
 
@@ -533,12 +567,13 @@ create_cluster() {
 		return 1
 	fi
 
-	# Wait for sometime after nodes have booted up for SSH daemon to come up.
-	sleep 15
+	# Wait for SSH daemons of booted nodes to come up.
+	wait_until_ready 300 $(ssh_probe_targets)
 
 	# Since nodes created from an image retain the image's host keys, they should
 	# be changed to unique ones before doing anything else.
 	change_hostkeys $CLUSTER_NAME
+	clear_storm_local_dirs $CLUSTER_NAME
 
 	set_hostnames $CLUSTER_NAME
 
@@ -638,8 +673,8 @@ start_cluster() {
 		
 		start_nodes $CLUSTER_NAME
 
-		# Wait for sometime after nodes have booted up for SSH daemon to come up.
-		sleep 15
+		# Wait for SSH daemons of booted nodes to come up.
+		wait_until_ready 300 $(ssh_probe_targets)
 		
 		# If nodes were added when cluster was stopped, we need all nodes
 		# to know about all other nodes.
@@ -705,11 +740,9 @@ stop_cluster() {
 	update_cluster_status "stopping"
 
 	# First stop storm services cleanly on all nodes, so that entire cluster can save whatever state it should.
+	# This returns only after nimbus has stopped.
 	stop_storm $CLUSTER_NAME
 
-	# Wait some time before stopping the nodes.
-	sleep 20
-
 	stop_nodes $CLUSTER_NAME
 
 	update_cluster_status "stopped"
@@ -769,9 +802,8 @@ create_new_nodes() {
 	local kernel_id=$(echo $linout|cut -d ',' -f1)
 	echo "Kernel ID=$kernel_id"
 	
-	local stfile="$(status_file)"
-	add_section $stfile "nodes"
-	add_section $stfile "ipaddresses"
+	cluster_state add-section "nodes"
+	cluster_state add-section "ipaddresses"
 
 	######################################################################################
 	printf "\n\nCreating nimbus node in datacenter $dc_id based on image $image_id...\n"
@@ -784,7 +816,11 @@ create_new_nodes() {
 	fi
 	
 	local nimbus_linode_id
-	create_single_node $1 $nimbus_plan_id $dc_id $image_id $kernel_id nimbus_linode_id 'nimbus'
+	if [ -n "$NIMBUS_GOLDEN_NODE" ]; then
+		clone_single_node $1 "$NIMBUS_NODE" $dc_id $NIMBUS_GOLDEN_NODE nimbus_linode_id 'nimbus'
+	else
+		create_single_node $1 $nimbus_plan_id $dc_id $image_id $kernel_id nimbus_linode_id 'nimbus'
+	fi
 	if [ $? -eq 1 ]; then
 		echo "Nimbus node creation failed. Aborting"
 		return 1
@@ -792,7 +828,7 @@ create_new_nodes() {
 	
 	# We need to know role(nimbus/supervisor/client) of each node later on to build storm.yaml
 	# start the correct services on each node.
-	write_status "nodes" "$nimbus_linode_id:nimbus"
+	cluster_state set-node $nimbus_linode_id role=nimbus
 	#####################################################################################
 
 	create_supervisor_nodes $1 $SUPERVISOR_NODES $dc_id $image_id $kernel_id
@@ -813,13 +849,17 @@ create_new_nodes() {
 	fi
 	
 	local client_linode_id
-	create_single_node $1 $client_plan_id $dc_id $image_id $kernel_id client_linode_id 'client'
+	if [ -n "$CLIENT_GOLDEN_NODE" ]; then
+		clone_single_node $1 "$CLIENT_NODE" $dc_id $CLIENT_GOLDEN_NODE client_linode_id 'client'
+	else
+		create_single_node $1 $client_plan_id $dc_id $image_id $kernel_id client_linode_id 'client'
+	fi
 	if [ $? -eq 1 ]; then
 		echo "Client node creation failed. Aborting"
 		return 1
 	fi
 	
-	write_status "nodes" "$client_linode_id:client"
+	cluster_state set-node $client_linode_id role=client
 
 	return 0
 }
@@ -830,54 +870,90 @@ create_new_nodes() {
 # $3 : Datacenter ID
 # $4 : Image ID
 # $5 : Kernel ID
-# $6 : (Optional) Role suffix for the supervisor nodes. If not empty, it'll be appended as "supervisor:$6"
+# $6 : (Optional) "new" to mark the supervisor nodes as new, so that they're listed as "supervisor:new"
 create_supervisor_nodes() {
 	# Create the supervisor nodes.
 	printf "\n\nCreating $2 new supervisor nodes...\n"
 
-	local stfile="$(status_file)"
-
-	local role="supervisor"
-	if [ ! -z "$6" ]; then
-		role="$role:$6"
+	local new=0
+	if [ "$6" == "new" ]; then
+		new=1
 	fi
 
-	local total_sup_count=1
-	for i in $2; do
-		local plan=$(echo $i|cut -d ':' -f1)
-		local count=$(echo $i|cut -d ':' -f2)
-		
-		local plan_id
-		get_plan_id $plan
-		plan_id=$?
-		if [ $plan_id -eq -1 ]; then
-			echo "Invalid plan $plan for supervisor nodes. It should be one of 2GB|4GB|8GB|...|120GB.See https://www.linode.com/pricing for all plan names"
-			return 1
+	# All supervisor nodes are provisioned concurrently, either by cloning the golden
+	# supervisor node or from the image.
+	local linout linerr linret
+	local start_time=$SECONDS
+	local method
+	if [ -n "$SUPERVISOR_GOLDEN_NODE" ]; then
+		method="by cloning golden node $SUPERVISOR_GOLDEN_NODE"
+		linode_api linout linerr linret "clone-nodes" $SUPERVISOR_GOLDEN_NODE "$2" $3 'sup' "$CLUSTER_NAME"
+	else
+		method="from image $4"
+		linode_api linout linerr linret "provision-nodes" "$2" $3 $4 $5 'sup' "$CLUSTER_NAME" \
+			"Storm" $NODE_DISK_SIZE "$NODE_ROOT_PASSWORD" "$NODE_ROOT_SSH_PUBLIC_KEY"
+	fi
+	echo "Provisioned supervisor nodes $method in $((SECONDS - start_time)) seconds"
+	
+	# Record every node that was provisioned, even if some others failed, so that
+	# they're not left out when cluster is destroyed.
+	# All of them are recorded in a single transaction.
+	local linode_id private_ip public_ip
+	local state_cmds=''
+	while read linode_id private_ip public_ip; do
+		if [ -z "$linode_id" ]; then
+			continue
 		fi
+		echo "Created supervisor linode $linode_id with private IP $private_ip and public IP $public_ip"
+		state_cmds+="set-node $linode_id role=supervisor new=$new private_ip=$private_ip public_ip=$public_ip"$'\n'
+	done <<< "$linout"
+	printf "%s" "$state_cmds" | cluster_state apply
+	
+	if [ $linret -eq 1 ]; then
+		echo "Supervisor node creation failed. Error:$linerr"
+		echo "Aborting"
+		return 1
+	fi
+	
+	return 0
+}
 
-		echo "Creating $count supervisor linodes (plan $plan ID $plan_id)"
 
-		local sup_node_count=1
-		local supervisor_linode_id
-		while [ $sup_node_count -le $count ]; do
-			echo "Creating supervisor #$total_sup_count (plan $plan ID $plan_id)"
-			create_single_node $1 $plan_id $3 $4 $5 supervisor_linode_id 'sup'
-			if [ $? -eq 1 ]; then
-				echo "Supervisor node creation failed. Aborting"
-				return 1
-			fi
-			write_status "nodes" "$supervisor_linode_id:$role"
-			sup_node_count=$((sup_node_count+1))
-			total_sup_count=$((total_sup_count+1))
-		done
-	done
+
+
+# Creates a node by cloning a golden node, which should be shut down, instead of
+# from the image. The clone keeps the golden node's disks, root password and SSH keys.
+# $1 : Cluster name 
+# $2 : The plan name ("2GB | 4GB | 8GB ....")
+# $3 : The datacenter ID (this has to be already validated by caller)
+# $4 : Linode ID of golden node
+# $5 : Name of a variable that'll receive the created linode ID.
+# $6 : Label prefix for linode
+clone_single_node() {
+	echo "Cloning golden node $4"
+	local start_time=$SECONDS
+	
+	local linout linerr linret
+	linode_api linout linerr linret "clone-nodes" $4 "$2:1" $3 "$6" "$CLUSTER_NAME"
+	
+	local __linode_id private_ip public_ip
+	read __linode_id private_ip public_ip <<< "$linout"
+	if [ -n "$__linode_id" ]; then
+		eval $5="$__linode_id"
+		cluster_state set-node $__linode_id private_ip=$private_ip public_ip=$public_ip
+	fi
+	
+	if [ $linret -eq 1 ]; then
+		echo "Failed to clone golden node $4. Error:$linerr"
+		return 1
+	fi
 	
+	echo "Cloned linode $__linode_id with private IP $private_ip and public IP $public_ip in $((SECONDS - start_time)) seconds"
 	return 0
 }
 
 
 
-
 # $1 : The plan name ("2GB | 4GB | 8GB ....")
 get_plan_id() {
 	local plan_id
@@ -934,8 +1010,6 @@ get_plan_id() {
 # $6 : Name of a variable that'll receive the created linode ID.
 # $7 : Label prefix for linode
 create_single_node() {
-	local stfile="$(status_file)"
-	
 	local plan_id=$2
 	local dc_id=$3
 	local image_id=$4
@@ -1045,7 +1119,7 @@ create_single_node() {
 	local public_ip=$linout
 	echo "Public IP address is $public_ip for linode $__linode_id"
 	
-	insert_or_replace_in_section $stfile "ipaddresses" $__linode_id "$__linode_id $private_ip $public_ip"
+	cluster_state set-node $__linode_id private_ip=$private_ip public_ip=$public_ip
 	return 0
 }
 
@@ -1065,63 +1139,56 @@ destroy_cluster() {
 	fi
 
 
-	local stfile=$(status_file)
-
 	update_cluster_status "destroying"
 
-	local nodes=$(get_section $stfile "nodes")
+	local nodes=$(cluster_state section "nodes")
 	local failures=0
+	
+	# Shutdown all linodes first, so that their shutdown jobs run in parallel.
+	local shutdown_jobs=()
 	while read nodeentry;
 	do
 		local arr=(${nodeentry//:/ })
 		local node=${arr[0]}
-		local role=${arr[1]}
-
-		echo "Destroying $node..."
-
-		# Shutdown the linode.
-		echo "Shutting down the linode"
+		echo "Shutting down $node..."
 		linode_api linout linerr linret "shutdown" $node
 		if [ $linret -eq 1 ]; then
 			echo "Failed to shutdown. Error:$linerr"
 			return 1
 		fi
-		local shutdown_job_id=$linout
-		
-		# Wait for linode to shutdown.
-		local shutdown_result
-		wait_for_job $shutdown_job_id $node 
-		shutdown_result=$?
-		if [ $shutdown_result -eq 0 ]; then
-			echo "Shutdown job did not complete even after 4 minutes. Aborting"
-			return 1
-		fi
-		
-		if [ $shutdown_result -ge 2 ]; then
-			echo "Shutdown failed."
-			return 1
-		fi
-		
-		sleep 2
+		shutdown_jobs+=("$linout:$node")
+	done <<< "$nodes"
+	
+	if ! wait_for_jobs "shutdown" "${shutdown_jobs[@]}"; then
+		echo "Aborting"
+		return 1
+	fi
+	
+	sleep 2
 
-		# Delete node (and skip checks)
-		linode_api linout linerr linret "delete-node" $node 1
-		if [ $linret -eq 1 ]; then
-			echo "Failed to delete. Error:$linerr"
-			failures=1
-			continue
-		fi
+	# Delete all nodes (and skip checks) in batched requests.
+	local node_ids=$(IFS=','; echo "${shutdown_jobs[*]}" | sed -r 's/[0-9]+://g')
+	echo "Destroying $node_ids..."
+	linode_api linout linerr linret "delete-nodes" "$node_ids" 1
+	if [ $linret -eq 1 ]; then
+		echo "Failed to delete some nodes. Error:$linerr"
+		failures=1
+	fi
 
-		# Remove entries for this node from all sections of status file
-		delete_line $stfile "nodes" $node
-		delete_line $stfile "ipaddresses" $node
-		delete_line $stfile "hostnames" $node
-	done <<< "$nodes"
+	# Remove deleted nodes from cluster state
+	if [ ! -z "$linout" ]; then
+		cluster_state remove-node ${linout//,/ }
+	fi
 
 	# Don't delete status file if there are any failures above
 	if [ $failures -eq 0 ]; then	
+		# The lock file is left by any fill, so pools are drained even if WARM_POOL_NODES was unset since.
+		if [ -n "$WARM_POOL_NODES" ] || [ -f "$(warm_pool_lock_file)" ]; then
+			delete_warm_pool_nodes
+		fi
+
 		echo "Deleting cluster status file..."
-		rm -f $stfile
+		cluster_state delete
 
 		echo "Deleting cluster hosts file..."
 		rm -f "$CLUSTER_CONF_DIR/$CLUSTER_NAME.hosts"
@@ -1160,8 +1227,7 @@ destroy_cluster() {
 #	$1: cluster name
 #	$2: (Optional) filter for entries in "nodes" section. Only these nodes will be started.
 start_nodes() {
-	local stfile="$(status_file)"
-	local nodes=$(get_section $stfile 'nodes')
+	local nodes=$(cluster_state section 'nodes')
 	if [ ! -z "$2" ]; then
 		nodes=$(echo "$nodes"|grep "$2")
 	fi
@@ -1186,25 +1252,10 @@ start_nodes() {
 	
 	echo "Waiting for nodes to boot"
 	
-	for job in $boot_jobs
-	do
-		job_id=$(echo $job|cut -d':' -f1)
-		linode_id=$(echo $job|cut -d':' -f2)
-		
-		# Wait for node to boot up.
-		local boot_result
-		wait_for_job $job_id $linode_id 
-		boot_result=$?
-		if [ $boot_result -eq 0 ]; then
-			echo "Linode $linode_id did not boot up even after 4 minutes. Aborting"
-			return 1
-		fi
-		
-		if [ $boot_result -ge 2 ]; then
-			echo "Linode $linode_id booting failed."
-			return 1
-		fi
-	done
+	if ! wait_for_jobs "boot up" $boot_jobs; then
+		echo "Aborting"
+		return 1
+	fi
 	
 	echo "All nodes booted"
 	
@@ -1219,8 +1270,7 @@ start_nodes() {
 #	$1 : Name of the cluster 
 #	$2: (Optional) filter for entries in "nodes" section. Only these nodes will be stopped.
 stop_nodes() {
-	local stfile="$(status_file)"
-	local nodes=$(get_section $stfile "nodes")
+	local nodes=$(cluster_state section "nodes")
 	if [ ! -z "$2" ]; then
 		nodes=$(echo "$nodes"|grep "$2")
 	fi
@@ -1244,25 +1294,10 @@ stop_nodes() {
 	done <<< "$nodes"
 
 	
-	for job in $shutdown_jobs
-	do
-		job_id=$(echo $job|cut -d':' -f1)
-		linode_id=$(echo $job|cut -d':' -f2)
-		
-		# Wait for node to boot up.
-		local shutdown_result
-		wait_for_job $job_id $linode_id 
-		shutdown_result=$?
-		if [ $shutdown_result -eq 0 ]; then
-			echo "Linode $linode_id did not shutdown even after 4 minutes. Aborting"
-			return 1
-		fi
-		
-		if [ $shutdown_result -ge 2 ]; then
-			echo "Linode $linode_id shutdown failed."
-			return 1
-		fi
-	done
+	if ! wait_for_jobs "shutdown" $shutdown_jobs; then
+		echo "Aborting"
+		return 1
+	fi
 	
 	return 0
 	
@@ -1272,32 +1307,13 @@ stop_nodes() {
 #	$1 : Name of the cluster 
 #	$2: (Optional) filter for entries in "nodes" section. Only these nodes' host keys will be regenerated.
 change_hostkeys() {
-	local stfile="$(status_file)"
-
-	# Note: output of get_section is multiline, so always use it inside double quotes such as "$entries"
-	local nodes=$(get_section $stfile "nodes")	
-	if [ ! -z "$2" ]; then
-		nodes=$(echo "$nodes"|grep "$2")
-	fi
-	local ipaddrs=$(get_section $stfile "ipaddresses")
-
-	while read nodeentry; do
-		# An entry in nodes section is of the form "nodename:role"
-		local arr=(${nodeentry//:/ })
-		local linode_id=${arr[0]}
-		local role=${arr[1]}
-		
-		local private_ip=$(echo "$ipaddrs" | grep $linode_id | cut -d ' ' -f 2)
-		local public_ip=$(echo "$ipaddrs" | grep $linode_id | cut -d ' ' -f 3)
+	# Note: output of query_nodes is multiline, so always use it inside double quotes such as "$entries"
+	local nodes=$(query_nodes "linode_id,$(target_ip_field)" "$2")
 
+	local linode_id target_ip
+	while read linode_id target_ip; do
 		echo "Changing host keys of $linode_id..."
 
-		# Default ssh target is the private IP address.
-		local target_ip=$private_ip
-		if [ "$CLUSTER_MANAGER_USES_PUBLIC_IP" == "true" ]; then
-			target_ip=$public_ip
-		fi
-
 		ssh_command $target_ip $NODE_USERNAME $NODE_ROOT_SSH_PRIVATE_KEY "sh -c
 			\"rm /etc/ssh/ssh_host_*;/usr/sbin/dpkg-reconfigure openssh-server\""
 			
@@ -1306,24 +1322,45 @@ change_hostkeys() {
 
 
 
+#	$1 : Name of the cluster 
+#	$2: (Optional) filter for entries in "nodes" section. Only these nodes' Storm local directories are cleared.
+# Nodes cloned from a golden node get its Storm local directory too, with its supervisor ID and nimbus
+# state, which their daemons would take over. So it's cleared before their daemons are first started.
+# Nodes created from an image have nothing there, so there's nothing to do without golden nodes.
+clear_storm_local_dirs() {
+	if [ -z "$NIMBUS_GOLDEN_NODE$SUPERVISOR_GOLDEN_NODE$CLIENT_GOLDEN_NODE" ]; then
+		return 0
+	fi
+	
+	# The xargs at the end is to trim enclosing whitespaces.
+	local storm_yaml_template="$STORM_YAML_TEMPLATE"
+	if [ "${storm_yaml_template:0:1}" != "/" ]; then
+		storm_yaml_template=$(readlink -m "$IMAGE_CONF_DIR/$STORM_YAML_TEMPLATE")
+	fi
+	local storm_local_dir=$(grep 'storm.local.dir' $storm_yaml_template|cut -d ':' -f 2|xargs)
+	if [ -z "$storm_local_dir" ] || [ "$storm_local_dir" == "/" ]; then
+		echo "Unable to find storm.local.dir in $storm_yaml_template. Not clearing it."
+		return 1
+	fi
+	
+	local nodes=$(query_nodes "linode_id,private_ip,public_ip" "$2")
+	echo "Clearing Storm local directory $storm_local_dir of cloned nodes..."
+	fanout "$nodes" "rm -rf $storm_local_dir/*"
+}
+
+
+
 #	$1 : Name of the cluster 
 #	$2: (Optional) filter for entries in "nodes" section. Only these nodes' hostnames will be changed.
 set_hostnames() {
-	local stfile="$(status_file)"
-
-	add_section $stfile "hostnames"
+	cluster_state add-section "hostnames"
 
-	# Note: output of get_section is multiline, so always use it inside double quotes such as "$entries"
-	local nodes=$(get_section $stfile "nodes")	
-	if [ ! -z "$2" ]; then
-		nodes=$(echo "$nodes"|grep "$2")
-	fi
-	local ipaddrs=$(get_section $stfile "ipaddresses")
+	# Note: output of query_nodes is multiline, so always use it inside double quotes such as "$entries"
+	local nodes=$(query_nodes "linode_id,role,private_ip,public_ip" "$2")
 
 	# If there are existing supervisor nodes, the hostname counter should start from last counter.
 	local sup_node_counter=1
-	local existing_hostnames=$(get_section $stfile "hostnames")
-	local last_supervisor_hostname=$(echo "$existing_hostnames" | grep "$SUPERVISOR_NODES_PRIVATE_HOSTNAME_PREFIX" | tail -n1 | cut -d ' ' -f2)
+	local last_supervisor_hostname=$(query_nodes "private_hostname" ":supervisor" | grep "$SUPERVISOR_NODES_PRIVATE_HOSTNAME_PREFIX" | tail -n1)
 	if [ ! -z "$last_supervisor_hostname" ]; then
 		sup_node_counter=$(echo $last_supervisor_hostname|sed -r "s/$SUPERVISOR_NODES_PRIVATE_HOSTNAME_PREFIX//")
 		sup_node_counter=$((sup_node_counter+1))
@@ -1331,16 +1368,8 @@ set_hostnames() {
 
 	local client_node_count=1
 
-	while read nodeentry; do
-		# An entry in nodes section is of the form "nodename:role"
-		local arr=(${nodeentry//:/ })
-		local linode_id=${arr[0]}
-		local role=${arr[1]}
-		
-		local private_ip=$(echo "$ipaddrs" | grep $linode_id | cut -d ' ' -f 2)
-		local public_ip=$(echo "$ipaddrs" | grep $linode_id | cut -d ' ' -f 3)
-
-
+	local linode_id role private_ip public_ip
+	while read linode_id role private_ip public_ip; do
 		local new_public_host_name
 		local new_private_host_name
 		if [ "$role" == "nimbus" ]; then
@@ -1369,7 +1398,7 @@ set_hostnames() {
 		
 		# TODO Need to check if hostname change failed
 
-		insert_or_replace_in_section $stfile "hostnames" $linode_id "$linode_id $new_private_host_name $new_public_host_name"
+		cluster_state set-node $linode_id private_hostname=$new_private_host_name public_hostname=$new_public_host_name
 
 	done <<< "$nodes" # The "$nodes" should be in double quotes because output is multline
 }
@@ -1418,10 +1447,9 @@ set_hostname() {
 
 #	$1 : Name of the cluster 
 distribute_hostsfile() {
-	local stfile="$(status_file)"
-	# Note: output of get_section is multiline, so always use it inside double quotes such as "$entries"
-	local ipaddrs=$(get_section $stfile "ipaddresses")
-	local hostnames=$(get_section $stfile "hostnames")
+	# Note: output of cluster_state is multiline, so always use it inside double quotes such as "$entries"
+	local ipaddrs=$(cluster_state section "ipaddresses")
+	local hostnames=$(cluster_state query "linode_id,private_hostname,private_ip,public_hostname,public_ip")
 
 	local hostsfile="$CLUSTER_CONF_DIR/$1.hosts"
 	touch $hostsfile
@@ -1433,16 +1461,9 @@ distribute_hostsfile() {
 	# Distribute it to every node in cluster, along with
 	# a script which inserts those entries into the node's /etc/hosts
 	# as a section.
-	while read hostentry;
+	local linode_id private_host_name private_ip public_host_name public_ip
+	while read linode_id private_host_name private_ip public_host_name public_ip;
 	do
-		# An entry in hostnames section is of the form "linode_id   private_hostname  public_hostname"
-		local arr=($hostentry)
-		local linode_id=${arr[0]}
-		local private_host_name=${arr[1]}
-		local public_host_name=${arr[2]}
-
-		local private_ip=$(echo "$ipaddrs" | grep $linode_id | cut -d ' ' -f 2)
-		local public_ip=$(echo "$ipaddrs" | grep $linode_id | cut -d ' ' -f 3)
 		echo "Node:$linode_id , Private hostname:$private_host_name, private IP:$private_ip , Public hostname:$public_host_name, public IP:$public_ip"
 
 		echo "$public_ip $public_host_name" >> $hostsfile
@@ -1460,33 +1481,11 @@ distribute_hostsfile() {
 	# command works correctly when sh -c 'cmd' is in single quotes but not when it's in double quotes??
 	local zkhostsfile="$ZK_CLUSTER_CONF_DIR/$ZK_CLUSTER_NAME.hosts"
 
-	while read ipentry;
-	do
-		local arr=($ipentry)
-		local linode_id=${arr[0]}
-		local private_ip=${arr[1]}
-		local public_ip=${arr[2]}
-		
-		# Default ssh target is the private IP address.
-		local target_ip=$private_ip
-		if [ "$CLUSTER_MANAGER_USES_PUBLIC_IP" == "true" ]; then
-			target_ip=$public_ip
-		fi
-		
-		echo "Distributing hosts file to linode:$linode_id, IP:$target_ip"
-
-		# TODO Check how to copy multiple files. scp supports it as "scp localfile1 localfile2 .... user@dest:dir", but
-		# remote_copyfile should be changed to handle these variable number of arguments.
-		remote_copyfile ./textfileops.sh $target_ip $NODE_USERNAME $NODE_ROOT_SSH_PRIVATE_KEY textfileops.sh
-		remote_copyfile ./hostname_manager.sh $target_ip $NODE_USERNAME  $NODE_ROOT_SSH_PRIVATE_KEY hostname_manager.sh
-		
-		remote_copyfile $hostsfile $target_ip $NODE_USERNAME $NODE_ROOT_SSH_PRIVATE_KEY  "$1.hosts"
-		remote_copyfile $zkhostsfile $target_ip $NODE_USERNAME $NODE_ROOT_SSH_PRIVATE_KEY  "$ZK_CLUSTER_NAME.hosts"
-
-		ssh_command $target_ip $NODE_USERNAME $NODE_ROOT_SSH_PRIVATE_KEY sh hostname_manager.sh "hosts-file" $1 "$1.hosts"
-		ssh_command $target_ip $NODE_USERNAME $NODE_ROOT_SSH_PRIVATE_KEY sh hostname_manager.sh "hosts-file" $ZK_CLUSTER_NAME "$ZK_CLUSTER_NAME.hosts"
-		
-	done <<< "$ipaddrs"
+	echo "Distributing hosts files to all nodes..."
+	fanout "$ipaddrs" \
+		"sh hostname_manager.sh hosts-file $1 $1.hosts && sh hostname_manager.sh hosts-file $ZK_CLUSTER_NAME $ZK_CLUSTER_NAME.hosts" \
+		"./textfileops.sh:textfileops.sh" "./hostname_manager.sh:hostname_manager.sh" \
+		"$hostsfile:$1.hosts" "$zkhostsfile:$ZK_CLUSTER_NAME.hosts"
 
 	# Add the host entries to this very cluster manager machine on which this script is running.
 	echo $CLUSTER_MANAGER_NODE_PASSWORD|sudo -S sh hostname_manager.sh "hosts-file" $1 $hostsfile
@@ -1527,30 +1526,13 @@ setup_users_and_authentication_for_image() {
 		echo "Unknown value '$IMAGE_DISABLE_SSH_PASSWORD_AUTHENTICATION' for IMAGE_DISABLE_SSH_PASSWORD_AUTHENTICATION. Leaving defaults unchanged."
 	fi
 	
-	# Since SSH's been restarted wait for sometime before trying next SSH command. Otherwise next ssh/scp command sometimes fails.
-	# Also on production Linode, SSH service may take upto 60-80 seconds to become available again after restart. So keep trying
-	# to SSH until it succeeds.
-	sleep 20
-	
-	local max_checks=24
-	local wait_between_checks=10
-	local check_count=1
-	local ssh_available=0
-	while [ $check_count -le $max_checks ]; do
-		ssh_command $1 $NODE_USERNAME $IMAGE_ROOT_SSH_PRIVATE_KEY echo
-		if [ $? -eq 0 ]; then
-			echo "SSH is available after restart"
-			ssh_available=1
-			break
-		fi
-		check_count=$((check_count+1))
-		echo "Waiting for SSH to be available"
-		sleep $wait_between_checks
-	done
-	if [ $ssh_available -eq 0 ]; then
-		echo "SSH is still not available after $((max_checks*wait_between_checks/60)) minutes. Aborting image creation"
+	# Since SSH's been restarted wait for it to be available before trying next SSH command. Otherwise next ssh/scp command fails.
+	# On production Linode, SSH service may take upto 60-80 seconds to become available again after restart.
+	if ! wait_until_ready 240 "ssh:$1"; then
+		echo "SSH is still not available after 4 minutes. Aborting image creation"
 		return 1
-	fi	
+	fi
+	echo "SSH is available after restart"
 	
 	# Create IMAGE_ADMIN_USER as part of sudo group with password IMAGE_ADMIN_PASSWORD
 	if [ ! -z "$IMAGE_ADMIN_USER" ];  then
@@ -1619,8 +1601,8 @@ install_software_on_node() {
 
 
 
-	echo "Installing OpenJDK JRE 7 on $1..."
-	ssh_command $1 $2 $IMAGE_ROOT_SSH_PRIVATE_KEY apt-get -y install "openjdk-7-jre-headless"
+	echo "Installing $JDK_PACKAGE on $1..."
+	ssh_command $1 $2 $IMAGE_ROOT_SSH_PRIVATE_KEY apt-get -y install "$JDK_PACKAGE"
 
 
 
@@ -1763,8 +1745,6 @@ install_storm_on_node() {
 create_storm_configuration() {
 	echo "Creating Storm configuration file..."
 
-	local stfile="$(status_file)"
-
 	# Every node's storm.yaml should have the nimbus node hostname, and list of zookeeper nodes.
 	# Create a local copy of the template storm.yaml called <cluster>.storm.yaml and include all these entries, 
 	# then distribute that file to all nodes.
@@ -1773,42 +1753,19 @@ create_storm_configuration() {
 	if [ ${storm_yaml_template:0:1} != "/" ]; then
 		storm_yaml_template=$(readlink -m "$IMAGE_CONF_DIR/$STORM_YAML_TEMPLATE")
 	fi
-	cp $storm_yaml_template $cluster_cfg
-	chmod go-rwx $cluster_cfg
-
-	# Substitute actual cluster name in the zookeeper znode paths
-	sed -i "s/\$CLUSTER_NAME/$CLUSTER_NAME/g" $cluster_cfg
-	
-	# Insert the nimbus.host value in storm.yaml.
-	add_section $cluster_cfg "nimbus"
 	
-	local nimbus_hostname=$NIMBUS_NODE_PRIVATE_HOSTNAME
-	insert_or_replace_in_section $cluster_cfg "nimbus" "nimbus.host" "nimbus.host: '$nimbus_hostname'"
-
-	# Insert all the zookeeper nodes in storm.yaml
-	add_section $cluster_cfg "zookeeper"		
-	insert_bottom_of_section $cluster_cfg "zookeeper" "storm.zookeeper.servers:"
-
-	local zkhostnames=$(get_section "$ZK_CLUSTER_CONF_DIR/$ZK_CLUSTER_NAME.info" "hostnames")
-
-	while read zkhostentry; do
-		local hostarr=($zkhostentry)
-		local zk_private_hostname=${hostarr[1]}
-		local zk_public_hostname=${hostarr[2]}
-		
-		local use_hostname=$zk_private_hostname
-		
-		echo "Adding zookeeper host $use_hostname to $cluster_cfg"
-		insert_bottom_of_section $cluster_cfg "zookeeper" "  - '$use_hostname'"
-	done <<< "$zkhostnames"
-	
-	# Insert the zookeeper cluster's configured client port in storm.yaml.
-	# Default is 2181.
+	# The zookeeper cluster's configured client port. Default is 2181.
 	local zk_client_port=$(grep '^clientPort' "$ZK_CLUSTER_CONF_DIR/zoo.cfg"|cut -d '=' -f2|xargs)
 	if [ -z "$zk_client_port" ]; then
 		zk_client_port='2181'
 	fi
-	insert_bottom_of_section $cluster_cfg "zookeeper" "storm.zookeeper.port: $zk_client_port"
+
+	# The actual cluster name is substituted in the zookeeper znode paths, and the nimbus.host value and
+	# the zookeeper nodes are added from cluster state of both clusters.
+	render_configs <<-ENDITEMS
+		var CLUSTER_NAME "$CLUSTER_NAME"
+		storm-yaml "$cluster_cfg" "$storm_yaml_template" "$NIMBUS_NODE_PRIVATE_HOSTNAME" "$ZK_CLUSTER_CONF_DIR/$ZK_CLUSTER_NAME.info" "$zk_client_port"
+	ENDITEMS
 }
 
 
@@ -1818,36 +1775,15 @@ create_storm_configuration() {
 distribute_storm_configuration() {
 	echo "Distributing storm configuration..."
 
-	local stfile="$(status_file)"
-
-	local nodes=$(get_section $stfile "nodes")
-	if [ ! -z "$2" ]; then
-		nodes=$(echo "$nodes"|grep "$2")
-	fi
-
-	local ipaddrs=$(get_section $stfile "ipaddresses")
+	local nodes=$(query_nodes "linode_id,private_ip,public_ip" "$2")
 
 	# Now we need the STORM installation directory on a node.
 	local install_dir=$(storm_install_dir)
 	local remote_cfg_path=$install_dir/conf/storm.yaml
 	local cluster_cfg="$CLUSTER_CONF_DIR/$1.storm.yaml"
 
-	while read nodeentry;
-	do
-		local node_arr=(${nodeentry//:/ })
-		local linode_id=${node_arr[0]}
-
-		local private_ip=$(echo "$ipaddrs" | grep $linode_id | cut -d ' ' -f 2)
-		local public_ip=$(echo "$ipaddrs" | grep $linode_id | cut -d ' ' -f 3)
-
-		local use_ip=$private_ip
-		if [ "$CLUSTER_MANAGER_USES_PUBLIC_IP" == "true" ]; then
-			use_ip=$public_ip
-		fi
-		
-		echo "Copying $cluster_cfg to node $linode_id [$use_ip] $remote_cfg_path..."
-		remote_copyfile $cluster_cfg $use_ip $NODE_USERNAME $NODE_ROOT_SSH_PRIVATE_KEY $remote_cfg_path
-	done <<< "$nodes"
+	echo "Copying $cluster_cfg to nodes $remote_cfg_path..."
+	fanout_changed "$nodes" "" "$cluster_cfg:$remote_cfg_path"
 }
 
 
@@ -1863,29 +1799,11 @@ start_storm() {
 	# TODO The services to start on each type of node should be configurable.
 
 	echo "Starting storm services on cluster..."
-	local stfile="$(status_file)"
-	local nodes=$(get_section $stfile "nodes")	
-	if [ ! -z "$2" ]; then
-		nodes=$(echo "$nodes"|grep "$2")
-	fi
-
-	local ipaddrs=$(get_section $stfile "ipaddresses")	
+	local nodes=$(query_nodes "linode_id,role,$(target_ip_field)" "$2")
 
 	local nimbus_ipaddr
-	while read nodeentry; do
-		# An entry in nodes section is of the form "nodename:role"
-		local arr=(${nodeentry//:/ })
-		local node=${arr[0]}
-		local role=${arr[1]}
-		
-		local private_ip=$(echo "$ipaddrs" | grep $node | cut -d ' ' -f 2)
-		local public_ip=$(echo "$ipaddrs" | grep $node | cut -d ' ' -f 3)
-
-		local target_ip=$private_ip
-		if [ "$CLUSTER_MANAGER_USES_PUBLIC_IP" == "true" ]; then
-			target_ip=$public_ip
-		fi
-
+	local node role target_ip
+	while read node role target_ip; do
 		if [ "$role" == "nimbus" ]; then
 			
 			echo "Starting nimbus service on $node [$target_ip]..."
@@ -1910,30 +1828,13 @@ start_storm() {
 	# We wait for it to become ready by checking if it's bound to the nimbus.thrift.port (default port 6627).
 	# Do these checks only if nimbus service was actually started.
 	if [ ! -z "$nimbus_ipaddr" ]; then
-		local cluster_cfg="$CLUSTER_CONF_DIR/$1.storm.yaml"
-		local nimbus_port=$(cat $cluster_cfg | grep 'nimbus.thrift.port'|cut -d ':' -f2|xargs) # xargs trims enclosing whitespaces
-		if [ -z "$nimbus_port" ]; then
-			nimbus_port='6627'
+		local nimbus_port=$(get_nimbus_thrift_port)
+		# Nimbus thrift port is firewalled from cluster manager, so it's probed from nimbus node itself.
+		if wait_until_ready_on_node $nimbus_ipaddr 480 "tcp:localhost:$nimbus_port"; then
+			echo "Nimbus is ready"
+		else
+			echo "Nimbus is still not ready after 8 minutes. However, this is not necessarily an error. Proceeding..."
 		fi
-		# Try for upto 8 minutes (16 checks with 30 secs between checks)
-		local max_checks=16
-		local wait_between_checks=30
-		local check_count=1
-		local nimbus_ready=0
-		while [ $check_count -le $max_checks ]; do
-			ssh_command $nimbus_ipaddr $NODE_USERNAME $NODE_ROOT_SSH_PRIVATE_KEY "netstat -anp | grep java | grep $nimbus_port"
-			if [ $? -eq 0 ]; then
-				echo "Nimbus is ready"
-				nimbus_ready=1
-				break
-			fi
-			check_count=$((check_count+1))
-			echo "Waiting for Nimbus service to be ready"
-			sleep $wait_between_checks
-		done
-		if [ $nimbus_ready -eq 0 ]; then
-			echo "Nimbus is still not ready after $((max_checks*wait_between_checks/60)) minutes. However, this is not necessarily an error. Proceeding..."
-		fi	
 	fi
 }
 
@@ -1944,9 +1845,7 @@ stop_storm() {
 	# Stop the appropriate services on each node.
 
 	echo "Stopping storm services on cluster..."
-	local stfile="$(status_file)"
-	local nodes=$(get_section $stfile "nodes")	
-	local ipaddrs=$(get_section $stfile "ipaddresses")	
+	local ip_field=$(target_ip_field)
 
 	local install_dir=$(storm_install_dir)
 
@@ -1963,16 +1862,9 @@ stop_storm() {
 	kill_all_topologies
 
 	echo "Stopping supervisor service on supervisor nodes..."
-	local supervisor_nodes=$(echo "$nodes" | grep ':supervisor' | cut -d ':' -f1)
-	while read supervisor_node; do
-		local private_ip=$(echo "$ipaddrs" | grep $supervisor_node | cut -d ' ' -f 2)
-		local public_ip=$(echo "$ipaddrs" | grep $supervisor_node | cut -d ' ' -f 3)
-		
-		local target_ip=$private_ip
-		if [ "$CLUSTER_MANAGER_USES_PUBLIC_IP" == "true" ]; then
-			target_ip=$public_ip
-		fi
-		
+	local supervisor_nodes=$(query_nodes "linode_id,$ip_field" ":supervisor")
+	local supervisor_node target_ip
+	while read supervisor_node target_ip; do
 		echo "Stopping supervisor service on $supervisor_node [$target_ip]..."
 		ssh_command $target_ip $NODE_USERNAME $NODE_ROOT_SSH_PRIVATE_KEY "supervisorctl stop storm-supervisor"
 		
@@ -1982,15 +1874,7 @@ stop_storm() {
 
 
 	echo "Stopping logviewer service on supervisor nodes..."
-	while read supervisor_node; do
-		local private_ip=$(echo "$ipaddrs" | grep $supervisor_node | cut -d ' ' -f 2)
-		local public_ip=$(echo "$ipaddrs" | grep $supervisor_node | cut -d ' ' -f 3)
-		
-		local target_ip=$private_ip
-		if [ "$CLUSTER_MANAGER_USES_PUBLIC_IP" == "true" ]; then
-			target_ip=$public_ip
-		fi
-		
+	while read supervisor_node target_ip; do
 		echo "Stopping logviewer service on $supervisor_node [$target_ip]..."
 		ssh_command $target_ip $NODE_USERNAME $NODE_ROOT_SSH_PRIVATE_KEY "supervisorctl stop storm-logviewer"
 	done <<< "$supervisor_nodes"
@@ -1999,15 +1883,9 @@ stop_storm() {
 
 
 	echo "Stopping ui service on client nodes..."
-	local client_nodes=$(echo "$nodes" | grep ':client' | cut -d ':' -f1)
-	while read client_node; do
-		local private_ip=$(echo "$ipaddrs" | grep $client_node | cut -d ' ' -f 2)
-		local public_ip=$(echo "$ipaddrs" | grep $client_node | cut -d ' ' -f 3)
-		
-		local target_ip=$private_ip
-		if [ "$CLUSTER_MANAGER_USES_PUBLIC_IP" == "true" ]; then
-			target_ip=$public_ip
-		fi
+	local client_nodes=$(query_nodes "linode_id,$ip_field" ":client")
+	local client_node
+	while read client_node target_ip; do
 		echo "Stopping ui service on $client_node [$target_ip]..."
 		ssh_command $target_ip $NODE_USERNAME $NODE_ROOT_SSH_PRIVATE_KEY "supervisorctl stop storm-ui"
 	done <<< "$client_nodes"
@@ -2021,56 +1899,201 @@ stop_storm() {
 	# Wait for nimbus service to shutdown cleanly. Shutdown is quick if there are no topologies running, but
 	# slower if there are because nimbus has to first shutdown the topologies.
 	echo "Waiting for nimbus node services to stop..."
-	sleep 30	
+	if ! wait_until_ready_on_node $nimbus_ipaddr 120 "closed:localhost:$(get_nimbus_thrift_port)"; then
+		echo "Nimbus service has not stopped after 2 minutes. Proceeding..."
+	fi
 }
 
 
 
 kill_all_topologies() {
-	# Kills all topologies, and then periodically checks list of topologies until it's empty.
-
-	# We kill topologies by invoking Storm REST API. 
-	# But to invoke it from cluster manager node, cluster manager should be in client's port 80 whitelist.
-	# Instead of adding to the whitelist, we just invoke the  REST API remotely on the client itself.
+	# Kills all topologies concurrently, and then checks list of topologies every few seconds until it's empty.
+	open_client_ui_tunnel
+	
+	./storm-api-helper.py "kill-all" "http://localhost:$CLIENT_UI_TUNNEL_PORT" 30 180
+	local kill_result=$?
 	
-	# curl sometimes shows an error "(23) Failed writing body" when piping output. From observations, it seems like it happens
-	# if the target program does not read stdin (storm-api-helper.py does not read stdin if it doesn't recognize the command)
-	# To avoid this problem entirely, first read curl output to a variable and then feed that variable to helper.
+	close_client_ui_tunnel
 
-	local client_node_ssh_ip=$(get_client_node_ipaddr)
-	local topology_data=$(ssh_command $client_node_ssh_ip $NODE_USERNAME $NODE_ROOT_SSH_PRIVATE_KEY "curl -s 'http://localhost/api/v1/topology/summary'")
-	local topology_ids=$(echo $topology_data | ./storm-api-helper.py "topology-ids")
-	if [ -z "$topology_ids" ]; then
-		echo "No topologies to kill"
-		return 0
+	if [ $kill_result -ne 0 ]; then
+		echo "Some topologies could not be killed in time. Proceeding with shutdown"
 	fi
+}
 
-	while read topology; do
-		echo "Killing topology $topology"
-		ssh_command $client_node_ssh_ip $NODE_USERNAME $NODE_ROOT_SSH_PRIVATE_KEY "curl -s -X POST http://localhost/api/v1/topology/$topology/kill/30"
-		sleep 10
-	done <<< "$topology_ids"
-	
-	local max_checks=6
-	local time_between_checks=20
-	local check_count=1
-	local kill_success=0
-	while [ $check_count -le $max_checks ]; do
-		local topology_data=$(ssh_command $client_node_ssh_ip $NODE_USERNAME $NODE_ROOT_SSH_PRIVATE_KEY "curl -s 'http://localhost/api/v1/topology/summary'")
-		local topology_ids=$(echo $topology_data | ./storm-api-helper.py "topology-ids")
-		if [ -z "$topology_ids" ]; then
-			echo "All topologies are killed"
-			kill_success=1
+
+
+open_client_ui_tunnel() {
+	# Opens an SSH tunnel from a random local port to Storm UI on client node, and sets
+	# CLIENT_UI_TUNNEL_PORT and CLIENT_UI_TUNNEL_PID.
+	
+	# Storm REST API is invoked from cluster manager node, but for that, cluster manager should be in client's 
+	# port 80 whitelist. Instead of adding to the whitelist, we invoke the REST API through an SSH tunnel to the client itself.
+	local client_node_ssh_ip=$(get_client_node_ipaddr)
+	CLIENT_UI_TUNNEL_PORT=$(( 20000 + RANDOM % 10000 ))
+	ssh -q -N -x -i "$NODE_ROOT_SSH_PRIVATE_KEY" -o IdentitiesOnly=yes -o UserKnownHostsFile=/dev/null \
+		-o StrictHostKeyChecking=no -o ExitOnForwardFailure=yes \
+		-L $CLIENT_UI_TUNNEL_PORT:localhost:80 $NODE_USERNAME@$client_node_ssh_ip < /dev/null &
+	CLIENT_UI_TUNNEL_PID=$!
+	
+	local attempt
+	for attempt in {1..50}; do
+		if (echo > /dev/tcp/127.0.0.1/$CLIENT_UI_TUNNEL_PORT) 2>/dev/null; then
 			break
 		fi
-		check_count=$((check_count+1))
-		echo "Waiting for topologies to be killed..."
-		sleep $time_between_checks
+		sleep 0.2
 	done
+}
 
-	if [ $kill_success -eq 0 ]; then
-		echo "Some topologies could not be killed in time. Proceeding with shutdown"
+
+
+close_client_ui_tunnel() {
+	kill $CLIENT_UI_TUNNEL_PID 2>/dev/null
+	wait $CLIENT_UI_TUNNEL_PID 2>/dev/null
+}
+
+
+
+# Collects cluster, supervisor and topology metrics from Storm UI every few seconds, and appends
+# them to the cluster's metrics time-series file.
+# 	$1 : Name of cluster directory or Path of cluster configuration file.
+#	$2 : (Optional) Interval in seconds between samples. Default is 60.
+#	$3 : (Optional) Number of samples to collect. Default is 0, to collect until interrupted.
+collect_metrics() {
+	if ! load_cluster_conf "$1"; then
+		return 1
 	fi
+	
+	local stfile="$(status_file)"
+	if [ ! -f "$stfile" ]; then
+		echo "Cluster is not created. Metrics can be collected only from running clusters."
+		return 1
+	fi
+	
+	local cluster_status=$(get_cluster_status)
+	if [ "$cluster_status" != "running" ]; then
+		echo "Cluster is not running. Metrics can be collected only from running clusters."
+		return 1
+	fi
+	
+	local interval=${2:-60}
+	local samples=${3:-0}
+	
+	open_client_ui_tunnel
+	
+	# Close the tunnel even if collection is interrupted.
+	trap 'close_client_ui_tunnel' INT TERM
+	
+	echo "Collecting metrics into $(metrics_file)..."
+	./storm-api-helper.py "collect" "http://localhost:$CLIENT_UI_TUNNEL_PORT" "$(metrics_file)" $interval $samples
+	local collect_result=$?
+	
+	trap - INT TERM
+	close_client_ui_tunnel
+	
+	return $collect_result
+}
+
+
+
+# Lists bolts whose capacity exceeded a threshold in the collected metrics. 
+# Hot bolts indicate the cluster may need more supervisor nodes.
+# 	$1 : Name of cluster directory or Path of cluster configuration file.
+#	$2 : (Optional) Capacity threshold. Default is 0.8.
+#	$3 : (Optional) Window in seconds before the last sample. Default is 3600.
+list_hot_bolts() {
+	if ! load_cluster_conf "$1"; then
+		return 1
+	fi
+	
+	local mfile="$(metrics_file)"
+	if [ ! -f "$mfile" ]; then
+		echo "No metrics have been collected. Run collect-metrics first."
+		return 1
+	fi
+	
+	printf "Topology\tBolt\tHot/Samples\tAvg capacity\tMax capacity\tAvg execute latency(ms)\n"
+	./storm-api-helper.py "hot-bolts" "$mfile" ${2:-0.8} ${3:-3600}
+}
+
+
+
+# Runs the supervisor autoscaler until interrupted. It collects metrics from Storm UI into the 
+# cluster's metrics time-series file, and adds supervisor nodes when bolts are persistently 
+# overloaded and worker slots run short, according to the AUTOSCALE_* settings in cluster configuration.
+# 	$1 : Name of cluster directory or Path of cluster configuration file.
+#	$2 : The API environment file
+autoscale_cluster() {
+	if ! load_cluster_conf "$1"; then
+		return 1
+	fi
+	
+	if ! load_api_env_configuration "$2"; then
+		return 1
+	fi
+	
+	local stfile="$(status_file)"
+	if [ ! -f "$stfile" ]; then
+		echo "Cluster is not created. Only running clusters can be autoscaled."
+		return 1
+	fi
+	
+	local cluster_status=$(get_cluster_status)
+	if [ "$cluster_status" != "running" ]; then
+		echo "Cluster is not running. Only running clusters can be autoscaled."
+		return 1
+	fi
+	
+	# Make autoscaler settings in cluster conf visible to the autoscaler. They're exported one by one,
+	# because a bare "export" when there are none would print all exported variables, including API keys.
+	local name
+	for name in ${!AUTOSCALE_@}; do
+		export "$name"
+	done
+	
+	open_client_ui_tunnel
+	
+	trap 'close_client_ui_tunnel' INT TERM
+	
+	echo "Autoscaling cluster $CLUSTER_NAME. Metrics are collected into $(metrics_file)"
+	./storm-api-helper.py "autoscale" "http://localhost:$CLIENT_UI_TUNNEL_PORT" "$(metrics_file)" "$1" "$2" "$CLUSTER_NAME"
+	local autoscale_result=$?
+	
+	trap - INT TERM
+	close_client_ui_tunnel
+	
+	return $autoscale_result
+}
+
+
+
+# Replays the collected metrics of a cluster through the autoscaler and prints its decisions,
+# without adding or removing any nodes. Useful to tune AUTOSCALE_* settings.
+# 	$1 : Name of cluster directory or Path of cluster configuration file.
+#	$2 : (Optional) The API environment file, used only to find the price of AUTOSCALE_PLAN if 
+#		AUTOSCALE_MAX_MONTHLY_COST is set and AUTOSCALE_PLAN_PRICE is not.
+autoscale_replay() {
+	if ! load_cluster_conf "$1"; then
+		return 1
+	fi
+	
+	if [ ! -z "$2" ]; then
+		if ! load_api_env_configuration "$2"; then
+			return 1
+		fi
+	fi
+	
+	local mfile="$(metrics_file)"
+	if [ ! -f "$mfile" ]; then
+		echo "No metrics have been collected. Run collect-metrics or autoscale first."
+		return 1
+	fi
+	
+	local name
+	for name in ${!AUTOSCALE_@}; do
+		export "$name"
+	done
+	
+	./storm-api-helper.py "autoscale-replay" "$mfile"
 }
 
 
@@ -2107,6 +2130,7 @@ add_nodes() {
 	fi
 
 	echo "Adding $3 new supervisor nodes to cluster $CLUSTER_NAME..."
+	local start_time=$SECONDS
 
 	# Validate the datacenter.
 	linode_api linout linerr linret "datacenter-id" "$DATACENTER_FOR_CLUSTER"
@@ -2152,20 +2176,32 @@ add_nodes() {
 	local kernel_id=$(echo $linout|cut -d ',' -f1)
 	echo "Kernel ID=$kernel_id"
 	
-	create_supervisor_nodes $CLUSTER_NAME "$3" $dc_id $image_id $kernel_id "new"
-	if [ $? -eq 1 ]; then
-		echo "Error during Supervisor nodes creation. Aborting"
-		return 1
+	# Nodes are taken from the warm pool if there's one, and only the plans it runs short of
+	# are provisioned from the image. The pool is refilled in the background meanwhile.
+	local new_plans="$3"
+	local pool_hits=0
+	if [ -n "$WARM_POOL_NODES" ]; then
+		claim_warm_pool_nodes "$3" $dc_id $image_id new_plans pool_hits
+		refill_warm_pool $dc_id $image_id $kernel_id
+	fi
+
+	if [ -n "$new_plans" ]; then
+		create_supervisor_nodes $CLUSTER_NAME "$new_plans" $dc_id $image_id $kernel_id "new"
+		if [ $? -eq 1 ]; then
+			echo "Error during Supervisor nodes creation. Aborting"
+			return 1
+		fi
 	fi
 
 	start_nodes $CLUSTER_NAME ":supervisor:new"
 
-	# Wait for sometime after nodes have booted up for SSH daemon to come up.
-	sleep 15
+	# Wait for SSH daemons of booted nodes to come up.
+	wait_until_ready 300 $(ssh_probe_targets ":supervisor:new")
 	
 	# Since nodes created from an image retain the image's host keys, they should
 	# be changed to unique ones before doing anything else.
 	change_hostkeys $CLUSTER_NAME ":supervisor:new"
+	clear_storm_local_dirs $CLUSTER_NAME ":supervisor:new"
 
 	set_hostnames $CLUSTER_NAME ":supervisor:new"
 
@@ -2193,21 +2229,266 @@ add_nodes() {
 		# Mark security as changed, so that new configuration gets applied at next start.
 		update_security_status "changed"
 	fi
-	
-	if [ "$cluster_status" == "stopped" ]; then
-		sleep 5
-		stop_nodes $CLUSTER_NAME ":supervisor:new"
+	
+	if [ "$cluster_status" == "stopped" ]; then
+		sleep 5
+		stop_nodes $CLUSTER_NAME ":supervisor:new"
+
+	elif [ "$cluster_status" == "running" ]; then
+		start_storm $CLUSTER_NAME ":supervisor:new"
+	fi
+
+	# Unmark the newly created nodes.
+	cluster_state clear-new
+
+	# TODO Should the cluster be rebalanced?
+
+	if [ -n "$WARM_POOL_NODES" ]; then
+		record_warm_pool_stats $pool_hits "$new_plans" $((SECONDS - start_time))
+	fi
+
+	echo "Finished adding new supervisor nodes in $((SECONDS - start_time)) seconds"
+}
+
+
+
+# Claims supervisor nodes from the cluster's warm pool, and records them as new supervisor nodes.
+# $1 : Plan for supervisor nodes (ex: "2GB:1 4GB:1 8GB:1")
+# $2 : Datacenter ID
+# $3 : Image ID
+# $4 : Name of a variable that'll receive the plans the pool ran short of (ex: "4GB:1"), or empty
+#		if all nodes were claimed.
+# $5 : Name of a variable that'll receive the number of nodes claimed.
+claim_warm_pool_nodes() {
+	local linout linerr linret
+	linode_api linout linerr linret "claim-pool-nodes" "$1" $2 "$(warm_pool_group $3)" 'sup' "$CLUSTER_NAME"
+	if [ $linret -eq 1 ]; then
+		echo "Failed to claim some warm pool nodes. Error:$linerr"
+	fi
+
+	# If nothing was output, the claim failed before any node was claimed.
+	local __missed=''
+	if [ $linret -eq 1 -a -z "$linout" ]; then
+		__missed="$1"
+	fi
+
+	local linode_id private_ip public_ip
+	local claimed=0
+	local state_cmds=''
+	while read linode_id private_ip public_ip; do
+		if [ -z "$linode_id" ]; then
+			continue
+		fi
+		if [ "$linode_id" == "missed" ]; then
+			__missed=$(echo $private_ip $public_ip)
+			continue
+		fi
+		echo "Claimed supervisor linode $linode_id with private IP $private_ip and public IP $public_ip from warm pool"
+		state_cmds+="set-node $linode_id role=supervisor new=1 private_ip=$private_ip public_ip=$public_ip"$'\n'
+		claimed=$((claimed + 1))
+	done <<< "$linout"
+	printf "%s" "$state_cmds" | cluster_state apply
+
+	if [ -n "$__missed" ]; then
+		echo "Warm pool ran short of $__missed"
+	fi
+
+	eval $4="\"$__missed\""
+	eval $5=$claimed
+}
+
+
+
+# Refills the cluster's warm pool upto WARM_POOL_NODES in the background. Progress is
+# appended to the warm pool log file.
+# $1 : Datacenter ID
+# $2 : Image ID
+# $3 : Kernel ID
+refill_warm_pool() {
+	local pool_group="$(warm_pool_group $2)"
+	echo "Refilling warm pool $pool_group in the background. Progress is logged to $(warm_pool_log_file)"
+	(
+		acquire_warm_pool_lock
+		echo "$(date) Refilling warm pool $pool_group upto $WARM_POOL_NODES"
+		nohup ./linode_api.py "fill-pool" "$WARM_POOL_NODES" $1 $2 $3 "$pool_group" \
+			"Storm" $NODE_DISK_SIZE "$NODE_ROOT_PASSWORD" "$NODE_ROOT_SSH_PUBLIC_KEY"
+		echo "$(date) Finished refilling warm pool $pool_group with exit code $?"
+	) >> "$(warm_pool_log_file)" 2>&1 < /dev/null &
+}
+
+
+
+# Appends the pool hits and misses of a node addition, and the time taken for new nodes to
+# be ready, to the warm pool statistics file.
+# $1 : Number of nodes claimed from the pool
+# $2 : Plans that were provisioned because the pool ran short of them (ex: "4GB:1"), or empty
+# $3 : Seconds taken to add the nodes
+record_warm_pool_stats() {
+	local misses=0
+	local entry
+	for entry in $2; do
+		misses=$((misses + ${entry#*:}))
+	done
+
+	echo "Warm pool hits: $1, misses: $misses, new nodes ready in $3 seconds"
+	echo "$(date +%s) $1 $misses $3" >> "$(warm_pool_stats_file)"
+}
+
+
+
+# Provisions nodes into the cluster's warm pool upto WARM_POOL_NODES, and waits till they're ready.
+# 	$1 : Name of cluster directory or Path of cluster configuration file.
+#	$2 : The API environment file
+fill_warm_pool() {
+	if ! load_cluster_conf "$1"; then
+		return 1
+	fi
+
+	if ! load_api_env_configuration "$2"; then
+		return 1
+	fi
+
+	if [ -z "$WARM_POOL_NODES" ]; then
+		echo "WARM_POOL_NODES is not set in cluster configuration."
+		return 1
+	fi
+
+	local linout linerr linret
+	linode_api linout linerr linret "datacenter-id" "$DATACENTER_FOR_CLUSTER"
+	if [ $linret -eq 1 ]; then
+		echo "Failed to find datacenter. Error:$linerr"
+		return 1
+	fi
+	local dc_id=$linout
+
+	local image_id
+	if ! image_id=$(cluster_image_id); then
+		echo "Failed to find image."
+		return 1
+	fi
+
+	linode_api linout linerr linret "kernel-id" "$KERNEL_FOR_IMAGE"
+	if [ $linret -eq 1 ]; then
+		echo "Failed to find kernel. Error:$linerr"
+		return 1
+	fi
+	local kernel_id=$(echo $linout|cut -d ',' -f1)
+
+	local pool_group="$(warm_pool_group $image_id)"
+	echo "Filling warm pool $pool_group upto $WARM_POOL_NODES..."
+	local start_time=$SECONDS
+	acquire_warm_pool_lock
+	linode_api linout linerr linret "fill-pool" "$WARM_POOL_NODES" $dc_id $image_id $kernel_id "$pool_group" \
+		"Storm" $NODE_DISK_SIZE "$NODE_ROOT_PASSWORD" "$NODE_ROOT_SSH_PUBLIC_KEY"
+	release_warm_pool_lock
+
+	local linode_id private_ip public_ip
+	while read linode_id private_ip public_ip; do
+		if [ -n "$linode_id" ]; then
+			echo "Added linode $linode_id to warm pool"
+		fi
+	done <<< "$linout"
+
+	if [ $linret -eq 1 ]; then
+		echo "Failed to fill warm pool. Error:$linerr"
+		return 1
+	fi
+
+	echo "Filled warm pool in $((SECONDS - start_time)) seconds"
+	return 0
+}
+
+
+
+# Prints the number of nodes in the cluster's warm pool, and pool hits, misses and
+# time taken for new nodes to be ready in past node additions.
+# 	$1 : Name of cluster directory or Path of cluster configuration file.
+#	$2 : The API environment file
+describe_warm_pool() {
+	if ! load_cluster_conf "$1"; then
+		return 1
+	fi
+
+	if ! load_api_env_configuration "$2"; then
+		return 1
+	fi
+
+	local linout linerr linret
+	linode_api linout linerr linret "datacenter-id" "$DATACENTER_FOR_CLUSTER"
+	if [ $linret -eq 1 ]; then
+		echo "Failed to find datacenter. Error:$linerr"
+		return 1
+	fi
+	local dc_id=$linout
+
+	local image_id
+	if ! image_id=$(cluster_image_id); then
+		echo "Failed to find image."
+		return 1
+	fi
+
+	linode_api linout linerr linret "pool-nodes" "$(warm_pool_group $image_id)" $dc_id
+	if [ $linret -eq 1 ]; then
+		echo "Failed to list warm pool nodes. Error:$linerr"
+		return 1
+	fi
 
-	elif [ "$cluster_status" == "running" ]; then
-		start_storm $CLUSTER_NAME ":supervisor:new"
+	printf "\nWarm pool $(warm_pool_group $image_id), target \"$WARM_POOL_NODES\"\n"
+	printf "Plan\tReady\tProvisioning\n"
+	if [ -n "$linout" ]; then
+		echo "$linout" | tr ' ' '\t'
 	fi
 
-	# Strip out the ":new" suffix from newly created nodes.
-	sed -r -i '/#START:nodes/,/#END:nodes/ s/:new//' $stfile
+	local stats_file="$(warm_pool_stats_file)"
+	if [ -f "$stats_file" ]; then
+		printf "\nAdditions\tHits\tMisses\tHit rate\tAvg ready secs (all hits)\tAvg ready secs (with misses)\n"
+		awk '{
+				hits += $2; misses += $3
+				if ($3 == 0) { hit_secs += $4; hit_adds++ } else { miss_secs += $4; miss_adds++ }
+			}
+			END {
+				printf "%d\t%d\t%d\t%.0f%%\t%s\t%s\n", NR, hits, misses, 100 * hits / (hits + misses),
+					hit_adds ? sprintf("%.0f", hit_secs / hit_adds) : "-",
+					miss_adds ? sprintf("%.0f", miss_secs / miss_adds) : "-"
+			}' "$stats_file"
+	fi
+}
+
+
+
+# Deletes all nodes of the cluster's warm pools.
+# 	$1 : Name of cluster directory or Path of cluster configuration file.
+#	$2 : The API environment file
+drain_warm_pool() {
+	if ! load_cluster_conf "$1"; then
+		return 1
+	fi
+
+	if ! load_api_env_configuration "$2"; then
+		return 1
+	fi
+
+	delete_warm_pool_nodes
+}
 
-	# TODO Should the cluster be rebalanced?
 
-	echo "Finished adding new supervisor nodes"
+
+# Deletes all nodes of the cluster's warm pools, those of earlier images too, after waiting for 
+# any fill in progress to finish. Cluster conf and API environment should be loaded.
+delete_warm_pool_nodes() {
+	local linout linerr linret
+	acquire_warm_pool_lock
+	echo "Deleting nodes of warm pools $(warm_pool_group '*')..."
+	linode_api linout linerr linret "drain-pool" "$(warm_pool_group '')"
+	release_warm_pool_lock
+	if [ -n "$linout" ]; then
+		echo "Deleted $linout"
+	fi
+	if [ $linret -eq 1 ]; then
+		echo "Failed to delete some warm pool nodes. Error:$linerr"
+		return 1
+	fi
+	return 0
 }
 
 
@@ -2215,20 +2496,32 @@ add_nodes() {
 # Admin can modify the cluster's storm.yaml and call this to re-upload 
 # it to entire cluster and restart zookeeper services.
 # 	$1 : Name of cluster directory or Path of cluster configuration file.
+#	$2 : (Optional) "--plan" to only print the nodes whose storm.yaml would be updated.
 update_storm_yaml() {
 
 	if ! load_cluster_conf "$1"; then
 		return 1
 	fi
 	
+	if [ "$2" == "--plan" ]; then
+		FANOUT_PLAN=true distribute_storm_configuration $CLUSTER_NAME
+		return 0
+	fi
 
 	local cluster_status=$(get_cluster_status)
 	if [ "$cluster_status" == "running" ]; then
 	
+		# Storm is restarted only if some node doesn't already have this storm.yaml.
+		if ! FANOUT_PLAN=true distribute_storm_configuration $CLUSTER_NAME | grep '^linode:' > /dev/null; then
+			echo "All nodes already have this storm configuration. Not restarting storm"
+			update_conf_status "unchanged"
+			return 0
+		fi
+		
 		# Stop Storm services on all nodes.
 		stop_storm $CLUSTER_NAME
 		
-		# Distribute recreated storm configuration to all nodes.
+		# Distribute recreated storm configuration to nodes that don't have it.
 		distribute_storm_configuration $CLUSTER_NAME
 
 		# Restart Storm services on all nodes.
@@ -2275,72 +2568,32 @@ install_client_reverse_proxy() {
 
 #	$1 : Name of the cluster 
 configure_client_reverse_proxy() {
-	local stfile="$(status_file)"
-	
-	local client_node_ssh_ip=$(get_client_node_ipaddr)
 	local client_node_public_ip=$(get_client_node_public_ipaddr)
 	
 	# Create "stormproxy.conf" with reverse proxy and substitution configuration.
+	# For every supervisor node, a Substitute directive is inserted at the ###JSONREPLACE marker line
+	# to replace its URLs in the REST API JSON responses with proxied URLs, like
+	# Substitute "s|http:\/\/storm-cluster-sim1-private-supr1:8000|http:\/\/192.168.11.153\/storm-cluster-sim1-private-supr1|nq"
+	# and a proxied location is added for its logviewer app, like http://client/<supervisor_hostname>/
 	local storm_proxy_conf="$CLUSTER_CONF_DIR/$CLUSTER_NAME-stormproxy.conf"
-	cp template-stormproxy.conf $storm_proxy_conf
-	chmod go-rwx $storm_proxy_conf
 	local ui_port=$(get_ui_port)
-	sed -i "s/\$STORMUIPORT/$ui_port/g" $storm_proxy_conf
-
-	# We have to insert a Substitute directive for each supervisor node:
-	# Substitute "s|http:\/\/storm-cluster-sim1-private-supr1:8000|http:\/\/192.168.11.153\/storm-cluster-sim1-private-supr1|nq"
-	# So we need list of supervisor nodes and their private hostnames.
-	local nodes=$(get_section $stfile "nodes")
-	local hostnames=$(get_section $stfile "hostnames")
-	while read nodeentry
-	do
-		local arr=(${nodeentry//:/ })
-		local linode_id=${arr[0]}
-		local role=${arr[1]}
-		
-		if [ "$role" != "supervisor" ]; then
-			continue
-		fi
-		
-		# For every supervisor node's URL in the REST API JSON response,
-		# replace with corresponding proxied URL 
-		# like http://client/<supervisor_hostname>/
-		local sup_private_hostname=$(echo "$hostnames" | grep $linode_id | cut -d ' ' -f 2)
-		sed -i "/###JSONREPLACE/ i \\\tSubstitute \"s|http:\\\/\\\/$sup_private_hostname:8000|http:\\\/\\\/$client_node_public_ip\/$sup_private_hostname|nq\"" $storm_proxy_conf
-
-		# For every supervisor node's logviewer app, create a corresponding proxied URL 
-		# like http://client/<supervisor_hostname>/
-		#
-		# Accept-Encoding request header is unset to avoid accepting gzip, because it bypasses substitution filter. 
-		# Substitute HTML too does not work unless encoding is unset.
-		# 
-		# The Substitute directive strips the leading slashes from URLs, thus turning them into relative
-		# URLs.
-		# For example, URLs like href="/download/..." which wrongly resolves to http://client/download
-		# is substituted href="download/..." which correctly resolves to http://client/<supervisor>/download...
-		cat >> $storm_proxy_conf <<-ENDLOCATIONPARA
-			<Location "/$sup_private_hostname/">
-			    ProxyPass "http://$sup_private_hostname:8000/"
-
-			    RequestHeader unset Accept-Encoding
-			    AddOutputFilterByType SUBSTITUTE text/html
-			    Substitute 's|href="/|href="|nq'
-			</Location>
-			
-		ENDLOCATIONPARA
-	done <<< "$nodes"
-	
-	remote_copyfile $storm_proxy_conf $client_node_ssh_ip $NODE_USERNAME $NODE_ROOT_SSH_PRIVATE_KEY /etc/apache2/conf-available/stormproxy.conf
-	ssh_command $client_node_ssh_ip $NODE_USERNAME $NODE_ROOT_SSH_PRIVATE_KEY a2enconf stormproxy.conf
+	if ! render_configs <<-ENDITEMS
+		var STORMUIPORT "$ui_port"
+		stormproxy "$storm_proxy_conf" template-stormproxy.conf "$client_node_public_ip"
+	ENDITEMS
+	then
+		return 1
+	fi
 	
-	ssh_command $client_node_ssh_ip $NODE_USERNAME $NODE_ROOT_SSH_PRIVATE_KEY service apache2 restart
+	# Apache is reconfigured and restarted only if the client node doesn't already have this configuration.
+	fanout_changed "$(cluster_state query "linode_id,private_ip,public_ip" role=client)" \
+		"a2enconf stormproxy.conf && service apache2 restart" \
+		"$storm_proxy_conf:/etc/apache2/conf-available/stormproxy.conf"
 }
 	
 
 #	$1 : Name of the cluster 
 create_cluster_security_configurations() {
-	local stfile="$(status_file)"
-	
 	# The goal here is to create iptables rules and ipset files,
 	# which are uploaded to each cluster node to be loaded by the "iptables-persistent" script
 	# to configure that node's iptables firewall.
@@ -2361,26 +2614,11 @@ create_cluster_security_configurations() {
 	# 6. Create "$CLUSTER_NAME-rules.v6" from "template-storm-rules.v6", with placeholders substituted.
 	
 	local storm_cluster_whitelist_file="$CLUSTER_CONF_DIR/$CLUSTER_NAME-whitelist.ipsets"
-	local storm_cluster_whitelist_name="$CLUSTER_NAME-wl"
-	echo "create $storm_cluster_whitelist_name hash:ip family inet hashsize 1024 maxelem 65536" > $storm_cluster_whitelist_file
-	chmod go-rwx $storm_cluster_whitelist_file
-	local ipaddrs=$(get_section $stfile "ipaddresses")
-	while read ipentry 
-	do
-		local arr=($ipentry)
-		local linode_id=${arr[0]}
-		local private_ip=${arr[1]}
-
-		echo "add $storm_cluster_whitelist_name $private_ip" >> $storm_cluster_whitelist_file
-	done <<< "$ipaddrs"
 
 	./zookeeper-cluster-linode.sh "create-cluster-whitelist" "$ZK_CLUSTER_CONF_FILE"
 	local zk_cluster_whitelist_file="$ZK_CLUSTER_CONF_DIR/$ZK_CLUSTER_NAME-whitelist.ipsets"
 	
 	local ipsets_file_for_all_nodes="$CLUSTER_CONF_DIR/$CLUSTER_NAME-rules.ipsets"
-	cat $storm_cluster_whitelist_file $zk_cluster_whitelist_file > $ipsets_file_for_all_nodes
-	
-	chmod go-rwx $ipsets_file_for_all_nodes
 	
 	# The client user whitelist file contains user editable whitelists of users who're allowed
 	# to access the web UI interface on client node.
@@ -2410,44 +2648,40 @@ create_cluster_security_configurations() {
 	fi
 
 	local ipsets_file_for_client_node="$CLUSTER_CONF_DIR/$CLUSTER_NAME-client-rules.ipsets"
-	cat $storm_cluster_whitelist_file $zk_cluster_whitelist_file $storm_client_user_whitelist_file > $ipsets_file_for_client_node
-	chmod go-rwx $ipsets_file_for_client_node
 	
 	local template_v4_rules=$IPTABLES_V4_RULES_TEMPLATE
 	if [ ${template_v4_rules:0:1} != "/" ]; then
 		template_v4_rules=$(readlink -m "$CLUSTER_CONF_DIR/$IPTABLES_V4_RULES_TEMPLATE")
 	fi
 	local storm_iptables_v4_rules_file="$CLUSTER_CONF_DIR/$CLUSTER_NAME-rules.v4"
-	cp $template_v4_rules $storm_iptables_v4_rules_file
-	chmod go-rwx $storm_iptables_v4_rules_file
-	sed -i "s/\$CLUSTER_NAME/$CLUSTER_NAME/g" $storm_iptables_v4_rules_file
-	sed -i "s/\$ZK_CLUSTER_NAME/$ZK_CLUSTER_NAME/g" $storm_iptables_v4_rules_file
 
 	local template_v6_rules=$IPTABLES_V6_RULES_TEMPLATE
 	if [ ${template_v6_rules:0:1} != "/" ]; then
 		template_v6_rules=$(readlink -m "$CLUSTER_CONF_DIR/$IPTABLES_V6_RULES_TEMPLATE")
 	fi
 	local storm_iptables_v6_rules_file="$CLUSTER_CONF_DIR/$CLUSTER_NAME-rules.v6"
-	cp $template_v6_rules $storm_iptables_v6_rules_file
-	chmod go-rwx $storm_iptables_v6_rules_file
-	sed -i "s/\$CLUSTER_NAME/$CLUSTER_NAME/g" $storm_iptables_v6_rules_file
-	sed -i "s/\$ZK_CLUSTER_NAME/$ZK_CLUSTER_NAME/g" $storm_iptables_v6_rules_file
 	
 	local template_client_v4_rules=$IPTABLES_CLIENT_V4_RULES_TEMPLATE
 	if [ ${template_client_v4_rules:0:1} != "/" ]; then
 		template_client_v4_rules=$(readlink -m "$CLUSTER_CONF_DIR/$IPTABLES_CLIENT_V4_RULES_TEMPLATE")
 	fi
 	local storm_client_iptables_v4_rules_file="$CLUSTER_CONF_DIR/$CLUSTER_NAME-client-rules.v4"
-	cp $template_client_v4_rules $storm_client_iptables_v4_rules_file
-	chmod go-rwx $storm_client_iptables_v4_rules_file
-	sed -i "s/\$CLUSTER_NAME/$CLUSTER_NAME/g" $storm_client_iptables_v4_rules_file
-	sed -i "s/\$ZK_CLUSTER_NAME/$ZK_CLUSTER_NAME/g" $storm_client_iptables_v4_rules_file
+
+	# An ipset name shouldn't be >31 characters. So minimize any suffix.
+	render_configs <<-ENDITEMS
+		var CLUSTER_NAME "$CLUSTER_NAME"
+		var ZK_CLUSTER_NAME "$ZK_CLUSTER_NAME"
+		whitelist "$storm_cluster_whitelist_file" "$CLUSTER_NAME-wl"
+		concat "$ipsets_file_for_all_nodes" "$storm_cluster_whitelist_file" "$zk_cluster_whitelist_file"
+		concat "$ipsets_file_for_client_node" "$storm_cluster_whitelist_file" "$zk_cluster_whitelist_file" "$storm_client_user_whitelist_file"
+		text "$storm_iptables_v4_rules_file" "$template_v4_rules"
+		text "$storm_iptables_v6_rules_file" "$template_v6_rules"
+		text "$storm_client_iptables_v4_rules_file" "$template_client_v4_rules"
+	ENDITEMS
 }
 
 #	$1 : Name of the cluster 
 distribute_cluster_security_configurations() { 
-	local stfile="$(status_file)"
-
 	local ipsets_file_for_all_nodes="$CLUSTER_CONF_DIR/$CLUSTER_NAME-rules.ipsets"
 	local ipsets_file_for_client_node="$CLUSTER_CONF_DIR/$CLUSTER_NAME-client-rules.ipsets"
 	
@@ -2455,67 +2689,55 @@ distribute_cluster_security_configurations() {
 	local storm_client_iptables_v4_rules_file="$CLUSTER_CONF_DIR/$CLUSTER_NAME-client-rules.v4"
 	local storm_iptables_v6_rules_file="$CLUSTER_CONF_DIR/$CLUSTER_NAME-rules.v6"
 	
-	local nodes=$(get_section $stfile "nodes")
-	local ipaddrs=$(get_section $stfile "ipaddresses")
-	while read nodeentry 
-	do
-		local node_arr=(${nodeentry//:/ })
-		local linode_id=${node_arr[0]}
-		local role=${node_arr[1]}
-	
-		local private_ip=$(echo "$ipaddrs" | grep $linode_id | cut -d ' ' -f 2)
-		local public_ip=$(echo "$ipaddrs" | grep $linode_id | cut -d ' ' -f 3)
-		
-		local target_ip=$private_ip
-		if [ "$CLUSTER_MANAGER_USES_PUBLIC_IP" == "true" ]; then
-			target_ip=$public_ip
-		fi
-		
-		remote_copyfile $storm_iptables_v6_rules_file $target_ip $NODE_USERNAME $NODE_ROOT_SSH_PRIVATE_KEY /etc/iptables/rules.v6
-		
-		if [ "$role" == "client" ]; then
-			remote_copyfile $storm_client_iptables_v4_rules_file $target_ip $NODE_USERNAME $NODE_ROOT_SSH_PRIVATE_KEY /etc/iptables/rules.v4
-			remote_copyfile $ipsets_file_for_client_node $target_ip $NODE_USERNAME $NODE_ROOT_SSH_PRIVATE_KEY /etc/iptables/rules.ipsets
-		
-		else
-			remote_copyfile $storm_iptables_v4_rules_file $target_ip $NODE_USERNAME $NODE_ROOT_SSH_PRIVATE_KEY /etc/iptables/rules.v4
-			remote_copyfile $ipsets_file_for_all_nodes $target_ip $NODE_USERNAME $NODE_ROOT_SSH_PRIVATE_KEY /etc/iptables/rules.ipsets
-		
-		fi
-		
-		# Apply the firewall configuration immediately.
-		# One complication here is that ipset restore does not *overwrite* an existing set, but instead loads
-		# the file as new sets (ipset supports duplicate sets with same name).
-		# So for correct reloading, we have to "ipset destroy" all sets, and then reload.
-		# But "ipset destroy" is not allowed as long as a set is in use by iptables rule.
-		# So iptables has to be flushed first.
-		# ssh_command $target_ip $NODE_USERNAME "sh -c \"iptables -F;ipset destroy;/etc/init.d/iptables-persistent reload\""
-		#
-		# On Debian 8 + systemd, 'apt-get install iptables-persistent' no longer installs
-		# "iptables-persistent" script but instead calls it "/usr/bin/netfilter-persistent".
-		# A wrapper which calls "/usr/bin/netfilter-persistent" is installed in "/etc/init.d/netfilter-persistent"
-		# "service netfilter-persistent cmd" executes "/etc/init.d/netfilter-persistent" which inturn executes
-		# "/usr/bin/netfilter-persistent".
-		ssh_command $target_ip $NODE_USERNAME $NODE_ROOT_SSH_PRIVATE_KEY sh -c \
-			"\"if [ -f '/etc/init.d/iptables-persistent' ]; then
-			     /etc/init.d/iptables-persistent flush;
-			     /etc/init.d/iptables-persistent reload;
-			 elif [ -f '/usr/sbin/netfilter-persistent' ]; then
-				 service netfilter-persistent flush;
-			     service netfilter-persistent reload;
-			 fi\""
-
-		
-	done <<< "$nodes"
+	# Apply the firewall configuration immediately.
+	# One complication here is that ipset restore does not *overwrite* an existing set, but instead loads
+	# the file as new sets (ipset supports duplicate sets with same name).
+	# So for correct reloading, we have to "ipset destroy" all sets, and then reload.
+	# But "ipset destroy" is not allowed as long as a set is in use by iptables rule.
+	# So iptables has to be flushed first.
+	# ssh_command $target_ip $NODE_USERNAME "sh -c \"iptables -F;ipset destroy;/etc/init.d/iptables-persistent reload\""
+	#
+	# On Debian 8 + systemd, 'apt-get install iptables-persistent' no longer installs
+	# "iptables-persistent" script but instead calls it "/usr/bin/netfilter-persistent".
+	# A wrapper which calls "/usr/bin/netfilter-persistent" is installed in "/etc/init.d/netfilter-persistent"
+	# "service netfilter-persistent cmd" executes "/etc/init.d/netfilter-persistent" which inturn executes
+	# "/usr/bin/netfilter-persistent".
+	local reload_firewall="if [ -f '/etc/init.d/iptables-persistent' ]; then
+			/etc/init.d/iptables-persistent flush;
+			/etc/init.d/iptables-persistent reload;
+		elif [ -f '/usr/sbin/netfilter-persistent' ]; then
+			service netfilter-persistent flush;
+			service netfilter-persistent reload;
+		fi"
+	
+	# Only nodes whose files have changed get them, and only they reload their firewalls.
+	echo "Distributing security files to client nodes..."
+	fanout_changed "$(cluster_state query "linode_id,private_ip,public_ip" role=client)" "$reload_firewall" \
+		"$storm_iptables_v6_rules_file:/etc/iptables/rules.v6" \
+		"$storm_client_iptables_v4_rules_file:/etc/iptables/rules.v4" \
+		"$ipsets_file_for_client_node:/etc/iptables/rules.ipsets"
+	
+	echo "Distributing security files to other nodes..."
+	fanout_changed "$(cluster_state query "linode_id,private_ip,public_ip" role!=client)" "$reload_firewall" \
+		"$storm_iptables_v6_rules_file:/etc/iptables/rules.v6" \
+		"$storm_iptables_v4_rules_file:/etc/iptables/rules.v4" \
+		"$ipsets_file_for_all_nodes:/etc/iptables/rules.ipsets"
 	
 	# Tell the zookeeper cluster to add this storm cluster's nodes to *its* whitelist.
 	# It expects the path to be relative to scripts directory. example: storm-cluster1/storm-cluster1-whitelist.ipsets
+	# When planning, just show what would change on zookeeper nodes, including this cluster's whitelist
+	# if it's not added yet.
 	local storm_cluster_whitelist_file="$(basename $CLUSTER_CONF_DIR)/$CLUSTER_NAME-whitelist.ipsets"
-	./zookeeper-cluster-linode.sh "add-whitelist" "$ZK_CLUSTER_CONF_FILE" "$storm_cluster_whitelist_file"
+	if [ "$FANOUT_PLAN" == "true" ]; then
+		./zookeeper-cluster-linode.sh "update-firewall" "$ZK_CLUSTER_CONF_FILE" "--plan" "$storm_cluster_whitelist_file"
+	else
+		./zookeeper-cluster-linode.sh "add-whitelist" "$ZK_CLUSTER_CONF_FILE" "$storm_cluster_whitelist_file"
+	fi
 }
 
 
 # 	$1 : Name of cluster directory or Path of cluster configuration file.
+#	$2 : (Optional) "--plan" to only print the files that would be copied to each node.
 update_firewall() {
 	if ! load_cluster_conf "$1"; then
 		return 1
@@ -2523,6 +2745,11 @@ update_firewall() {
 	
 	create_cluster_security_configurations $CLUSTER_NAME
 	
+	if [ "$2" == "--plan" ]; then
+		FANOUT_PLAN=true distribute_cluster_security_configurations $CLUSTER_NAME
+		return 0
+	fi
+	
 	local cluster_status=$(get_cluster_status)
 	if [ "$cluster_status" == "running" ]; then
 		distribute_cluster_security_configurations $CLUSTER_NAME
@@ -2557,28 +2784,28 @@ update_client_user_whitelist() {
 	
 	local ipsets_file_for_client_node="$CLUSTER_CONF_DIR/$CLUSTER_NAME-client-rules.ipsets"
 	
-	cat $storm_cluster_whitelist_file $zk_cluster_whitelist_file $storm_client_user_whitelist_file > $ipsets_file_for_client_node
-	
-	local client_node_ip=$(get_client_node_ipaddr)
-	remote_copyfile $ipsets_file_for_client_node $client_node_ip $NODE_USERNAME $NODE_ROOT_SSH_PRIVATE_KEY /etc/iptables/rules.ipsets
+	if ! render_configs <<-ENDITEMS
+		concat "$ipsets_file_for_client_node" "$storm_cluster_whitelist_file" "$zk_cluster_whitelist_file" "$storm_client_user_whitelist_file"
+	ENDITEMS
+	then
+		return 1
+	fi
 	
 	# Apply the firewall configuration immediately.
-	#ssh_command $client_node_ip $NODE_USERNAME $NODE_ROOT_SSH_PRIVATE_KEY \
-	#	"sh -c \"/etc/init.d/iptables-persistent flush;/etc/init.d/iptables-persistent reload\""
-	
 	# On Debian 8 + systemd, 'apt-get install iptables-persistent' no longer installs
 	# "iptables-persistent" script but instead calls it "/usr/bin/netfilter-persistent".
 	# A wrapper which calls "/usr/bin/netfilter-persistent" is installed in "/etc/init.d/netfilter-persistent"
 	# "service netfilter-persistent cmd" executes "/etc/init.d/netfilter-persistent" which inturn executes
 	# "/usr/bin/netfilter-persistent".
-	ssh_command $client_node_ip $NODE_USERNAME $NODE_ROOT_SSH_PRIVATE_KEY sh -c \
-		"\"if [ -f '/etc/init.d/iptables-persistent' ]; then
-			 /etc/init.d/iptables-persistent flush;
-			 /etc/init.d/iptables-persistent reload;
-		 elif [ -f '/usr/sbin/netfilter-persistent' ]; then
-			 service netfilter-persistent flush;
-			 service netfilter-persistent reload;
-		 fi\""
+	local reload_firewall="if [ -f '/etc/init.d/iptables-persistent' ]; then
+			/etc/init.d/iptables-persistent flush;
+			/etc/init.d/iptables-persistent reload;
+		elif [ -f '/usr/sbin/netfilter-persistent' ]; then
+			service netfilter-persistent flush;
+			service netfilter-persistent reload;
+		fi"
+	fanout_changed "$(cluster_state query "linode_id,private_ip,public_ip" role=client)" "$reload_firewall" \
+		"$ipsets_file_for_client_node:/etc/iptables/rules.ipsets"
 	
 	echo "Finished updating client user whitelist"
 	
@@ -2605,19 +2832,12 @@ describe_cluster() {
 	local cluster_status=$(get_cluster_status)
 	printf "\nStatus: $cluster_status\n\n"
 	
-	local nodes=$(get_section $stfile "nodes")
-	local hostnames=$(get_section $stfile "hostnames")
-	local ipaddrs=$(get_section $stfile "ipaddresses")
-
-	local nimbus_linode_id=$(echo "$nodes"|grep 'nimbus'|cut -d ':' -f1)
-	local nimbus_ipline=$(echo "$ipaddrs"|grep "$nimbus_linode_id")
-	local nimbus_iparr=($nimbus_ipline)
-	local nimbus_private_ip=${nimbus_iparr[1]}
-	local nimbus_public_ip=${nimbus_iparr[2]}
-	local nimbus_hostsline=$(echo "$hostnames"|grep "$nimbus_linode_id")
-	local nimbus_hostsarr=($nimbus_hostsline)
-	local nimbus_private_host=${nimbus_hostsarr[1]}
-	local nimbus_public_host=${nimbus_hostsarr[2]}
+	# Hostnames and IP addresses that are not yet assigned are shown as '-'.
+	local fields="linode_id,private_ip?,private_hostname?,public_ip?,public_hostname?"
+
+	local nimbus_linode_id nimbus_private_ip nimbus_private_host nimbus_public_ip nimbus_public_host
+	read nimbus_linode_id nimbus_private_ip nimbus_private_host nimbus_public_ip nimbus_public_host \
+		<<< "$(cluster_state query "$fields" role=nimbus)"
 		
 	cat <<-ENDSTANZA
 		Nimbus:
@@ -2629,15 +2849,9 @@ describe_cluster() {
 		  
 	ENDSTANZA
 	
-	local client_linode_id=$(echo "$nodes"|grep 'client'|cut -d ':' -f1)
-	local client_ipline=$(echo "$ipaddrs"|grep "$client_linode_id")
-	local client_iparr=($client_ipline)
-	local client_private_ip=${client_iparr[1]}
-	local client_public_ip=${client_iparr[2]}
-	local client_hostsline=$(echo "$hostnames"|grep "$client_linode_id")
-	local client_hostsarr=($client_hostsline)
-	local client_private_host=${client_hostsarr[1]}
-	local client_public_host=${client_hostsarr[2]}
+	local client_linode_id client_private_ip client_private_host client_public_ip client_public_host
+	read client_linode_id client_private_ip client_private_host client_public_ip client_public_host \
+		<<< "$(cluster_state query "$fields" role=client)"
 		
 	cat <<-ENDSTANZA
 		Client:
@@ -2651,18 +2865,9 @@ describe_cluster() {
 
 	echo 'Supervisors:'
 	
-	while read node;
+	local sup_linode_id sup_private_ip sup_private_host sup_public_ip sup_public_host
+	while read sup_linode_id sup_private_ip sup_private_host sup_public_ip sup_public_host;
 	do
-		local sup_linode_id=$(echo "$node"|cut -d ':' -f1)
-		local sup_ipline=$(echo "$ipaddrs"|grep "$sup_linode_id")
-		local sup_iparr=($sup_ipline)
-		local sup_private_ip=${sup_iparr[1]}
-		local sup_public_ip=${sup_iparr[2]}
-		local sup_hostsline=$(echo "$hostnames"|grep "$sup_linode_id")
-		local sup_hostsarr=($sup_hostsline)
-		local sup_private_host=${sup_hostsarr[1]}
-		local sup_public_host=${sup_hostsarr[2]}
-
 		cat <<-ENDSTANZA
 			  Linode ID:        $sup_linode_id
 			  Private IP:       $sup_private_ip
@@ -2672,7 +2877,7 @@ describe_cluster() {
 			  
 		ENDSTANZA
 	
-	done <<< "$(echo "$nodes" | grep 'supervisor')"
+	done <<< "$(cluster_state query "$fields" role=supervisor)"
 }
 
 
@@ -2697,26 +2902,10 @@ run_cmd() {
 		return 1
 	fi
 	
-	local ipaddrs=$(get_section $stfile "ipaddresses")
-	
-	while read ipentry;
-	do
-		local arr=($ipentry)
-		local linode_id=${arr[0]}
-		local private_ip=${arr[1]}
-		local public_ip=${arr[2]}
-		
-		# Default ssh target is the private IP address.
-		local target_ip=$private_ip
-		if [ "$CLUSTER_MANAGER_USES_PUBLIC_IP" == "true" ]; then
-			target_ip=$public_ip
-		fi
-		
-		echo "Executing command on linode:$linode_id, IP:$target_ip"
-
-		ssh_command $target_ip $NODE_USERNAME $NODE_ROOT_SSH_PRIVATE_KEY "${@:2}"
-	done <<< "$ipaddrs"
+	local ipaddrs=$(cluster_state section "ipaddresses")
 	
+	echo "Executing command on all nodes"
+	fanout "$ipaddrs" "${*:2}"
 }
 
 
@@ -2744,28 +2933,16 @@ copy_files() {
 		return 1
 	fi
 	
-	local ipaddrs=$(get_section $stfile "ipaddresses")
+	local ipaddrs=$(cluster_state section "ipaddresses")
 	
-	while read ipentry;
-	do
-		local arr=($ipentry)
-		local linode_id=${arr[0]}
-		local private_ip=${arr[1]}
-		local public_ip=${arr[2]}
-		
-		# Default ssh target is the private IP address.
-		local target_ip=$private_ip
-		if [ "$CLUSTER_MANAGER_USES_PUBLIC_IP" == "true" ]; then
-			target_ip=$public_ip
-		fi
-		
-		for localfile in "${@:3}"; do
-			local destfile="$2"/$(basename "$localfile")
-			echo "Copying $localfile to linode:$linode_id, IP:$target_ip $destfile"
-			remote_copyfile "$localfile" $target_ip $NODE_USERNAME $NODE_ROOT_SSH_PRIVATE_KEY "$destfile"
-		done
-	done <<< "$ipaddrs"
+	local file_specs=()
+	for localfile in "${@:3}"; do
+		local destfile="$2"/$(basename "$localfile")
+		echo "Copying $localfile to all nodes $destfile"
+		file_specs+=("$localfile:$destfile")
+	done
 	
+	fanout "$ipaddrs" "" "${file_specs[@]}"
 }
 
 
@@ -3199,12 +3376,49 @@ create_status_file() {
 
 
 
-# 	$1: section name
-#	$2: line data to write
-write_status() {
-	local stfile=$(status_file)
-	add_section $stfile $1
-	insert_bottom_of_section $stfile $1 "$2"
+# Runs a cluster_state.py command on this cluster's state.
+#	$1... : Command and its args, as described in cluster_state.py.
+cluster_state() {
+	./cluster_state.py "$(status_file)" "$@"
+}
+
+
+
+# Renders configuration files of this cluster with config_renderer.py. Items to render are read from stdin,
+# as described in config_renderer.py.
+# Output: Paths of files that changed.
+# Returns: 0 on success, 1 on error.
+render_configs() {
+	./config_renderer.py "$(status_file)" | sed 's/^/Updated /'
+	return ${PIPESTATUS[0]}
+}
+
+
+
+#	$1 : Comma separated node fields, as described in cluster_state.py.
+#	$2 : (Optional) filter for entries in "nodes" section, of the form ":role" or ":role:new".
+# Output: Fields of matching nodes, one node per line.
+query_nodes() {
+	local filters=()
+	if [ ! -z "$2" ]; then
+		local arr=(${2//:/ })
+		filters+=("role=${arr[0]}")
+		if [ "${arr[1]}" == "new" ]; then
+			filters+=("new=1")
+		fi
+	fi
+	cluster_state query "$1" "${filters[@]}"
+}
+
+
+
+# Output: Name of the node field with the IP address that cluster manager uses to connect to nodes.
+target_ip_field() {
+	if [ "$CLUSTER_MANAGER_USES_PUBLIC_IP" == "true" ]; then
+		echo "public_ip"
+	else
+		echo "private_ip"
+	fi
 }
 
 
@@ -3212,52 +3426,40 @@ write_status() {
 
 # 	$1: New status of cluster "creating | created | starting | running | stopping | stopped"
 update_cluster_status() {
-	local stfile=$(status_file)
-	add_section $stfile "status"
-	# The 3rd arg "status:" is because insert or replace needs a search string to search and replace.
-	insert_or_replace_in_section $stfile "status" "status:" "status:$1"
+	cluster_state set "status" "status" "$1"
 }
 
 
 
 
 get_cluster_status() {
-	local stfile=$(status_file)
-	echo $(get_section $stfile "status" | cut -d ':' -f2)
+	echo $(cluster_state get "status" "status")
 }
 
 
 # 	$1: New status of security configuration "changed | unchanged"
 update_security_status() {
-	local stfile=$(status_file)
-	add_section $stfile "security"
-	# The 3rd arg "status:" is because insert or replace needs a search string to search and replace.
-	insert_or_replace_in_section $stfile "security" "status:" "status:$1"
+	cluster_state set "security" "status" "$1"
 }
 
 
 
 
 get_security_status() {
-	local stfile=$(status_file)
-	echo $(get_section $stfile "security" | cut -d ':' -f2)
+	echo $(cluster_state get "security" "status")
 }
 
 
 # 	$1: New status of security configuration "changed | unchanged"
 update_conf_status() {
-	local stfile=$(status_file)
-	add_section $stfile "conf"
-	# The 3rd arg "status:" is because insert or replace needs a search string to search and replace.
-	insert_or_replace_in_section $stfile "conf" "status:" "status:$1"
+	cluster_state set "conf" "status" "$1"
 }
 
 
 
 
 get_conf_status() {
-	local stfile=$(status_file)
-	echo $(get_section $stfile "conf" | cut -d ':' -f2)
+	echo $(cluster_state get "conf" "status")
 }
 
 
@@ -3270,30 +3472,25 @@ create_image_status_file() {
 
 
 get_nimbus_node_ipaddr() {
-	local stfile=$(status_file)
-	local nimbus_node=$(get_section $stfile "nodes" | grep ':nimbus' | cut -d ':' -f1)
-	if [ "$CLUSTER_MANAGER_USES_PUBLIC_IP" == "true" ]; then
-		get_section $stfile "ipaddresses" | grep $nimbus_node | cut -d ' ' -f3
-	else
-		get_section $stfile "ipaddresses" | grep $nimbus_node | cut -d ' ' -f2
-	fi
+	cluster_state query "$(target_ip_field)" role=nimbus | head -1
 }
 
 
-get_client_node_ipaddr() {
-	local stfile=$(status_file)
-	local nimbus_node=$(get_section $stfile "nodes" | grep ':client' | cut -d ':' -f1)
-	if [ "$CLUSTER_MANAGER_USES_PUBLIC_IP" == "true" ]; then
-		get_section $stfile "ipaddresses" | grep $nimbus_node | cut -d ' ' -f3
-	else
-		get_section $stfile "ipaddresses" | grep $nimbus_node | cut -d ' ' -f2
+get_nimbus_thrift_port() {
+	local cluster_cfg="$CLUSTER_CONF_DIR/$CLUSTER_NAME.storm.yaml"
+	local nimbus_port=$(cat $cluster_cfg | grep 'nimbus.thrift.port'|cut -d ':' -f2|xargs) # xargs trims enclosing whitespaces
+	if [ -z "$nimbus_port" ]; then
+		nimbus_port='6627'
 	fi
+	echo $nimbus_port
+}
+
+get_client_node_ipaddr() {
+	cluster_state query "$(target_ip_field)" role=client | head -1
 }
 
 get_client_node_public_ipaddr() {
-	local stfile=$(status_file)
-	local nimbus_node=$(get_section $stfile "nodes" | grep ':client' | cut -d ':' -f1)
-	get_section $stfile "ipaddresses" | grep $nimbus_node | cut -d ' ' -f3
+	cluster_state query "public_ip" role=client | head -1
 }
 
 
@@ -3320,11 +3517,117 @@ status_file() {
 
 
 
+metrics_file() {
+	echo "$CLUSTER_CONF_DIR/$CLUSTER_NAME-metrics.jsonl"
+}
+
+
+
+warm_pool_stats_file() {
+	echo "$CLUSTER_CONF_DIR/$CLUSTER_NAME-pool-stats"
+}
+
+
+
+warm_pool_log_file() {
+	echo "$CLUSTER_CONF_DIR/$CLUSTER_NAME-pool.log"
+}
+
+
+
+# Prints the display group of the cluster's warm pool. Pool nodes are created from the
+# cluster's image, so a rebuilt image gets a new pool.
+# $1 : Image ID. Empty for the prefix of the display groups of all the cluster's pools.
+warm_pool_group() {
+	echo "$CLUSTER_NAME-warm-pool-$1"
+}
+
+
+
+warm_pool_lock_file() {
+	echo "$CLUSTER_CONF_DIR/$CLUSTER_NAME-pool.lock"
+}
+
+
+
+# Waits till no fill or drain of the cluster's warm pools is in progress, and holds off others
+# till release_warm_pool_lock. A refill started in the background by add-nodes holds it till it's 
+# done, so that destroying the cluster meanwhile waits for it instead of leaving behind the nodes 
+# it's still provisioning.
+acquire_warm_pool_lock() {
+	exec 9> "$(warm_pool_lock_file)"
+	if ! flock -n 9; then
+		echo "Waiting for warm pool fill in progress to finish..."
+		flock 9
+	fi
+}
+
+
+
+release_warm_pool_lock() {
+	exec 9>&-
+}
+
+
+
+# Prints the ID of the cluster's image, from the image info file or else by searching
+# for the image's label.
+cluster_image_id() {
+	local image_id
+	local img_stfile="$(image_status_file)"
+	if [ -f "$img_stfile" ]; then
+		image_id=$(get_section $img_stfile "image")
+	fi
+
+	if [ -z "$image_id" ]; then
+		local linout linerr linret
+		linode_api linout linerr linret "image-id" "$LABEL_FOR_IMAGE"
+		if [ $linret -eq 1 ]; then
+			return 1
+		fi
+		image_id=$(echo $linout|cut -d ',' -f1)
+	fi
+
+	if [ -z "$image_id" ]; then
+		return 1
+	fi
+	echo $image_id
+}
+
+
+
 image_status_file() {
 	echo "$IMAGE_CONF_DIR/$IMAGE_NAME.info"
 }
 
 
+# Starts a linode_api.py server on $LINODE_API_SOCKET, if one is not already running.
+# The server exits on its own after 10 minutes without requests.
+start_linode_api_server() {
+	if [ -S "$LINODE_API_SOCKET" ]; then
+		return 0
+	fi
+	
+	# Scripts that find no server at the same time take turns, so that only the first one starts
+	# a server and the others wait for it. The server itself doesn't hold the turn.
+	(
+		flock 9
+		if [ ! -S "$LINODE_API_SOCKET" ]; then
+			./linode_api.py serve "$LINODE_API_SOCKET" 600 > /dev/null 2>&1 9>&- &
+		fi
+		
+		local attempt
+		for attempt in {1..50}; do
+			if [ -S "$LINODE_API_SOCKET" ]; then
+				exit 0
+			fi
+			sleep 0.1
+		done
+		exit 1
+	) 9> "$LINODE_API_SOCKET.start"
+}
+
+
 # $1 -> name of variable which receives output of command
 # $2 -> name of variable which receives stderr of command
 # $3 -> name of variable which receives return code of command (0=success, >0 are failures)
@@ -3337,7 +3640,14 @@ linode_api() {
 	# as explained in http://stackoverflow.com/questions/4421257/why-does-local-sweep-the-return-code-of-a-command
 	# and http://mywiki.wooledge.org/BashPitfalls#local_varname.3D.24.28command.29
 	local __out
-	__out=$(./linode_api.py "${@:4}" 2>$error_file)
+	# When LINODE_API_SOCKET is set, commands are sent to a long running linode_api.py
+	# server, which avoids Python startup and module import costs on every API call.
+	# The client falls back to running linode_api.py directly if the server is not available.
+	if [ -n "$LINODE_API_SOCKET" ] && start_linode_api_server; then
+		__out=$(./linode_api_client.py "${@:4}" 2>$error_file)
+	else
+		__out=$(./linode_api.py "${@:4}" 2>$error_file)
+	fi
 	local __ret=$?
 	local __err="$(< $error_file)"
 
@@ -3396,6 +3706,38 @@ wait_for_job() {
 	return $job_status
 }
 
+# Waits for several jobs together using a single "wait-jobs" command, instead of
+# waiting for each job one after another.
+# $1 : Description of what the jobs do, for messages. Example: "boot up"
+# $2... : The jobs, each as "<Job ID>:<linode ID>"
+# Return: 	0 -> all jobs completed
+#			1 -> some jobs failed, remained pending even after timeout, or their status could not be found
+wait_for_jobs() {
+	local description="$1"
+	local job_args=()
+	local job
+	for job in "${@:2}"; do
+		job_args+=("${job##*:}:${job%%:*}")
+	done
+	
+	local linout linerr linret
+	linode_api linout linerr linret "wait-jobs" 480 "${job_args[@]}"
+	
+	local linode_id job_id job_status
+	while read linode_id job_id job_status; do
+		if [ "$job_status" == "0" ]; then
+			echo "Linode $linode_id did not $description even after 8 minutes."
+		elif [ "$job_status" == "2" ]; then
+			echo "Linode $linode_id $description failed."
+		elif [ "$job_status" == "3" ]; then
+			echo "Failed to find status of job $job_id on linode $linode_id."
+		fi
+	done <<< "$linout"
+	
+	return $linret
+}
+
+
 #	$1 -> Path of local file to copy
 #	$2 -> IP address or hostname of node
 #	$3 -> SSH login username for node
@@ -3433,6 +3775,61 @@ ssh_command() {
 }
 
 
+#	$1 -> Nodes, as lines of "linode_id private_ip public_ip" like in ipaddresses section of status file.
+#	$2 -> Command run on every node after files are copied. Empty to only copy files.
+#	$3... -> Files to copy to every node, as "<local path>:<remote path>". Remote paths are
+#			relative to home directory unless absolute.
+fanout() {
+	# All nodes are handled concurrently by ssh_fanout.py, upto SSH_PARALLELISM nodes at a time, and each
+	# node's files are copied in a single transfer over a connection that's reused by later calls.
+	echo "$1" | ./ssh_fanout.py "$NODE_USERNAME" "$NODE_ROOT_SSH_PRIVATE_KEY" "${CLUSTER_MANAGER_USES_PUBLIC_IP:-false}" \
+		${SSH_PARALLELISM:-10} "$2" "${@:3}"
+}
+
+
+
+#	Same args as fanout.
+# Files are copied only to nodes whose copies differ from them, according to hashes of files copied
+# earlier that are recorded in cluster state, and the command is run only on those nodes.
+# If FANOUT_PLAN is "true", the files that would be copied are printed instead.
+fanout_changed() {
+	local plan_opt=
+	if [ "$FANOUT_PLAN" == "true" ]; then
+		plan_opt="--plan"
+	fi
+	echo "$1" | ./ssh_fanout.py --state "$(status_file)" $plan_opt "$NODE_USERNAME" "$NODE_ROOT_SSH_PRIVATE_KEY" \
+		"${CLUSTER_MANAGER_USES_PUBLIC_IP:-false}" ${SSH_PARALLELISM:-10} "$2" "${@:3}"
+}
+
+
+
+#	$1 : (Optional) filter for entries in "nodes" section.
+# Output: readiness_probe.py targets for SSH daemons of those nodes.
+ssh_probe_targets() {
+	query_nodes "$(target_ip_field)" "$1" | sed 's/^/ssh:/'
+}
+
+
+
+#	$1 : Deadline in seconds.
+#	$2... : Targets, as described in readiness_probe.py.
+# Returns: 0 as soon as all targets are ready, 1 if some are not ready at deadline.
+wait_until_ready() {
+	./readiness_probe.py "$@"
+}
+
+
+
+# Same as wait_until_ready, but probes from a cluster node, for services that are firewalled from cluster manager.
+#	$1 : IP address of node on which to run the probes.
+#	$2 : Deadline in seconds.
+#	$3... : Targets, as described in readiness_probe.py.
+wait_until_ready_on_node() {
+	ssh -q -x -i "$NODE_ROOT_SSH_PRIVATE_KEY" -o IdentitiesOnly=yes -o UserKnownHostsFile=/dev/null -o StrictHostKeyChecking=no \
+		$NODE_USERNAME@$1 python - "${@:2}" < ./readiness_probe.py
+}
+
+
 
 
 case $1 in
@@ -3443,6 +3840,24 @@ case $1 in
 	create-image)
 	create_storm_image "$2" "$3"
 	;;
+
+	create-images)
+	create_images "$2" "$3" "$4"
+	;;
+
+	image-build-spec)
+	# Outputs nothing if an existing image is reused.
+	prepare_image_build "$2" "$3" >&2
+	case $? in
+		0) image_build_spec ;;
+		2) ;;
+		*) exit 1 ;;
+	esac
+	;;
+
+	install-image)
+	install_image_node "$2" "$3"
+	;;
 	
 	delete-image)
 	delete_storm_image "$2" "$3"
@@ -3471,13 +3886,25 @@ case $1 in
 	add-nodes)
 	add_nodes "$2" "$3" "$4"
 	;;
+
+	fill-pool)
+	fill_warm_pool "$2" "$3"
+	;;
+
+	pool-status)
+	describe_warm_pool "$2" "$3"
+	;;
+
+	drain-pool)
+	drain_warm_pool "$2" "$3"
+	;;
 	
 	update-storm-yaml)
-	update_storm_yaml "$2"
+	update_storm_yaml "$2" "$3"
 	;;
 	
 	update-firewall)
-	update_firewall "$2"
+	update_firewall "$2" "$3"
 	;;
 	
 	update-user-whitelist)
@@ -3488,6 +3915,22 @@ case $1 in
 	describe_cluster "$2"
 	;;
 	
+	collect-metrics)
+	collect_metrics "$2" "$3" "$4"
+	;;
+	
+	hot-bolts)
+	list_hot_bolts "$2" "$3" "$4"
+	;;
+	
+	autoscale)
+	autoscale_cluster "$2" "$3"
+	;;
+	
+	autoscale-replay)
+	autoscale_replay "$2" "$3"
+	;;
+	
 	run)
 	run_cmd "$2" "${@:3}"
 	;;
@@ -0,0 +1,196 @@
+# Tests of cluster_state.py, the SQLite backed cluster state that's exported to the .info
+# status files read by the shell scripts and cluster_info.sh.
+#
+# Usage: python -m unittest discover tests   (from the repository directory)
+
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import unittest
+
+import cluster_state
+
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# A status file as written by the shell functions of textfileops.sh, before there was a database.
+LEGACY_INFO = '''
+
+#START:nodes
+1001:nimbus
+1002:client
+1003:supervisor
+1004:supervisor:new
+#END:nodes
+
+
+#START:ipaddresses
+1001 192.168.0.1 203.0.113.1
+1002 192.168.0.2 203.0.113.2
+1003 192.168.0.3 203.0.113.3
+1004 192.168.0.4 203.0.113.4
+#END:ipaddresses
+
+
+#START:hostnames
+1001 test-private-nimbus test-public-nimbus
+1002 test-private-client test-public-client
+1003 test-private-supervisor1 test-public-supervisor1
+1004 test-private-supervisor2 test-public-supervisor2
+#END:hostnames
+
+
+#START:status
+status:running
+#END:status
+'''
+
+
+
+class ClusterStateTestCase(unittest.TestCase):
+
+	def setUp(self):
+		self.dir = tempfile.mkdtemp()
+		self.status_file = os.path.join(self.dir, 'test.info')
+		with open(self.status_file, 'w') as f:
+			f.write(LEGACY_INFO)
+
+
+
+	def tearDown(self):
+		shutil.rmtree(self.dir)
+
+
+
+	def open_state(self, write=False):
+		state = cluster_state.ClusterState(self.status_file)
+		self.assertTrue(state.open(write))
+		self.addCleanup(state.close)
+		return state
+
+
+
+	# Runs cluster_state.py like the shell scripts do, and returns (exit code, stdout).
+	def run_cli(self, args, stdin=''):
+		process = subprocess.Popen([sys.executable, os.path.join(REPO_DIR, 'cluster_state.py'),
+			self.status_file] + args, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+			stderr=subprocess.PIPE)
+		out, err = process.communicate(stdin)
+		return (process.returncode, out)
+
+
+
+	# Returns lines of a section of the status file, as read by textfileops.sh get_section.
+	def get_section(self, section):
+		out = subprocess.check_output(['bash', '-c', '. ./textfileops.sh; get_section "$1" "$2"',
+			'bash', self.status_file, section], cwd=REPO_DIR)
+		return out.splitlines()
+
+
+
+	def test_import_legacy_info(self):
+		state = self.open_state()
+		self.assertTrue(os.path.getsize(state.db_file) > 0)
+
+		self.assertEqual(state.query_nodes(('linode_id', 'role', 'new'), []), [
+			('1001', 'nimbus', 0),
+			('1002', 'client', 0),
+			('1003', 'supervisor', 0),
+			('1004', 'supervisor', 1)])
+		self.assertEqual(state.query_nodes(('private_ip', 'public_hostname'), [('linode_id', '=', '1004')]),
+			[('192.168.0.4', 'test-public-supervisor2')])
+		self.assertEqual(state.get_setting('status', 'status'), 'running')
+		self.assertEqual(state.section_lines('nodes'),
+			['1001:nimbus', '1002:client', '1003:supervisor', '1004:supervisor:new'])
+
+
+
+	def test_query_filters(self):
+		state = self.open_state()
+
+		self.assertEqual(state.query_nodes(('linode_id',), [('role', '=', 'supervisor')]),
+			[('1003',), ('1004',)])
+		self.assertEqual(state.query_nodes(('linode_id',), [('role', '!=', 'supervisor')]),
+			[('1001',), ('1002',)])
+		self.assertEqual(state.query_nodes(('linode_id',), [('role', '=', 'supervisor'), ('new', '=', '1')]),
+			[('1004',)])
+
+		# Nodes without a required field are skipped, but an optional field is only None.
+		self.assertEqual(state.query_nodes(('linode_id', 'myid'), []), [])
+		self.assertEqual(state.query_nodes(('linode_id', 'myid?'), [('role', '=', 'nimbus')]),
+			[('1001', None)])
+
+		self.assertRaises(cluster_state.StateError, state.query_nodes, ('linode_id',), [('bogus', '=', '1')])
+
+
+
+	def test_query_cli(self):
+		self.assertEqual(self.run_cli(['query', 'linode_id,private_ip,myid?', 'role!=supervisor']),
+			(0, '1001 192.168.0.1 -\n1002 192.168.0.2 -\n'))
+		self.assertEqual(self.run_cli(['query', 'linode_id', 'role=supervisor', 'new=1']), (0, '1004\n'))
+
+		# A node without a role is in the 'nodes' section, and matches 'role!=' filters.
+		self.assertEqual(self.run_cli(['apply'], 'list-node 1005\n'), (0, ''))
+		self.assertEqual(self.run_cli(['query', 'linode_id', 'role!=supervisor']), (0, '1001\n1002\n1005\n'))
+
+
+
+	def test_apply_commits_all_or_nothing(self):
+		with open(self.status_file, 'r') as f:
+			before = f.read()
+
+		code, out = self.run_cli(['apply'],
+			'set-node 1005 role=supervisor new=1\n'
+			'set status status running\n'
+			'bogus-command\n')
+		self.assertEqual(code, 1)
+		with open(self.status_file, 'r') as f:
+			self.assertEqual(f.read(), before)
+		self.assertEqual(self.run_cli(['query', 'linode_id', 'linode_id=1005']), (0, ''))
+
+		code, out = self.run_cli(['apply'],
+			'set-node 1005 role=supervisor new=1 private_ip=192.168.0.5 public_ip=203.0.113.5\n'
+			'set-node 1004 new=\n'
+			'set status status "adding nodes"\n')
+		self.assertEqual(code, 0)
+		self.assertEqual(self.run_cli(['query', 'linode_id', 'new=1']), (0, '1005\n'))
+		self.assertEqual(self.run_cli(['get', 'status', 'status']), (0, 'adding nodes\n'))
+
+
+
+	# cluster_info.sh reads the status file with get_section, so the regenerated file should
+	# have the same sections and line formats as the one it was imported from.
+	def test_regenerated_info(self):
+		code, out = self.run_cli(['apply'],
+			'set-node 1005 role=supervisor new=1 private_ip=192.168.0.5 public_ip=203.0.113.5 '
+			'private_hostname=test-private-supervisor3 public_hostname=test-public-supervisor3\n'
+			'remove-node 1003\n'
+			'set status status running\n')
+		self.assertEqual(code, 0)
+
+		self.assertEqual(self.get_section('nodes'),
+			['1001:nimbus', '1002:client', '1004:supervisor:new', '1005:supervisor:new'])
+		self.assertEqual(self.get_section('ipaddresses'), [
+			'1001 192.168.0.1 203.0.113.1',
+			'1002 192.168.0.2 203.0.113.2',
+			'1004 192.168.0.4 203.0.113.4',
+			'1005 192.168.0.5 203.0.113.5'])
+		self.assertEqual(self.get_section('hostnames')[-1],
+			'1005 test-private-supervisor3 test-public-supervisor3')
+		self.assertEqual(self.get_section('status'), ['status:running'])
+
+		# The regenerated file imports back to the same state.
+		with open(self.status_file, 'r') as f:
+			text = f.read()
+		state = self.open_state(True)
+		state.begin()
+		state.import_text(text)
+		self.assertEqual(state.export_text(), text)
+		state.rollback()
+
+
+
+if __name__ == '__main__':
+	unittest.main()
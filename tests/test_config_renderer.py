@@ -0,0 +1,176 @@
+# Tests of config_renderer.py, which renders cluster configuration files from templates and
+# the cluster state.
+#
+# Usage: python -m unittest discover tests   (from the repository directory)
+
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import unittest
+
+import cluster_state
+
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+STORM_INFO = '''
+
+#START:nodes
+1001:nimbus
+1002:client
+1003:supervisor
+1004:supervisor:new
+#END:nodes
+
+
+#START:hostnames
+1001 test-private-nimbus test-public-nimbus
+1002 test-private-client test-public-client
+1003 test-private-supervisor1 test-public-supervisor1
+1004 test-private-supervisor2 test-public-supervisor2
+#END:hostnames
+'''
+
+ZK_INFO = '''
+
+#START:nodes
+2001
+2002
+2003
+#END:nodes
+
+
+#START:hostnames
+2001 test-private-zk1 test-public-zk1
+2002 test-private-zk2 test-public-zk2
+2003 test-private-zk3 test-public-zk3
+#END:hostnames
+
+
+#START:myids
+2001 1
+2002 2
+2003 3
+#END:myids
+'''
+
+STORMPROXY_TEMPLATE = '''<Location "/api/">
+    ProxyPass "http://$NIMBUS_HOST:8080/api/"
+###JSONREPLACE
+</Location>
+'''
+
+ZOO_CFG_TEMPLATE = '''tickTime=2000
+clientPort=$ZK_CLIENT_PORT
+'''
+
+
+
+class ConfigRendererTestCase(unittest.TestCase):
+
+	def setUp(self):
+		self.dir = tempfile.mkdtemp()
+		self.write('stormproxy.conf.template', STORMPROXY_TEMPLATE)
+		self.write('zoo.cfg.template', ZOO_CFG_TEMPLATE)
+
+
+
+	def tearDown(self):
+		shutil.rmtree(self.dir)
+
+
+
+	def path(self, name):
+		return os.path.join(self.dir, name)
+
+
+
+	def write(self, name, text):
+		with open(self.path(name), 'w') as f:
+			f.write(text)
+
+
+
+	def read(self, name):
+		with open(self.path(name), 'r') as f:
+			return f.read()
+
+
+
+	# Runs config_renderer.py like the shell scripts do, and returns (exit code, stdout).
+	def render(self, status_file, items):
+		process = subprocess.Popen([sys.executable, os.path.join(REPO_DIR, 'config_renderer.py'),
+			self.path(status_file)], stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+			stderr=subprocess.PIPE)
+		out, err = process.communicate(items)
+		return (process.returncode, out)
+
+
+
+	def test_stormproxy(self):
+		self.write('storm.info', STORM_INFO)
+		items = ('var NIMBUS_HOST test-private-nimbus\n'
+			'stormproxy "%s" "%s" 203.0.113.2\n' % (self.path('stormproxy.conf'),
+				self.path('stormproxy.conf.template')))
+		self.assertEqual(self.render('storm.info', items), (0, self.path('stormproxy.conf') + '\n'))
+
+		lines = self.read('stormproxy.conf').splitlines()
+		marker = lines.index('###JSONREPLACE')
+		self.assertEqual(lines[:marker], [
+			'<Location "/api/">',
+			'    ProxyPass "http://test-private-nimbus:8080/api/"',
+			'\tSubstitute "s|http:\\/\\/test-private-supervisor1:8000|http:\\/\\/203.0.113.2/test-private-supervisor1|nq"',
+			'\tSubstitute "s|http:\\/\\/test-private-supervisor2:8000|http:\\/\\/203.0.113.2/test-private-supervisor2|nq"'])
+		self.assertEqual(lines[marker + 1], '</Location>')
+
+		# A proxied location for each supervisor follows the template.
+		self.assertEqual([line for line in lines if line.startswith('<Location "/test-')], [
+			'<Location "/test-private-supervisor1/">',
+			'<Location "/test-private-supervisor2/">'])
+		self.assertTrue('    ProxyPass "http://test-private-supervisor2:8000/"' in lines)
+
+		# Unchanged outputs aren't written again.
+		self.assertEqual(self.render('storm.info', items), (0, ''))
+
+
+
+	def test_zoo_cfg(self):
+		self.write('zk.info', ZK_INFO)
+		items = ('var ZK_CLIENT_PORT 2181\n'
+			'zoo-cfg "%s" "%s" 2888 3888\n' % (self.path('zoo.cfg'), self.path('zoo.cfg.template')))
+		self.assertEqual(self.render('zk.info', items), (0, self.path('zoo.cfg') + '\n'))
+
+		self.assertEqual(self.read('zoo.cfg'), 'tickTime=2000\nclientPort=2181\n' +
+			'\n\n#START:nodes\n'
+			'server.1=test-private-zk1:2888:3888\n'
+			'server.2=test-private-zk2:2888:3888\n'
+			'server.3=test-private-zk3:2888:3888\n'
+			'#END:nodes\n')
+
+		# Removing a node removes its server line from the next render.
+		state = cluster_state.ClusterState(self.path('zk.info'))
+		state.open(True)
+		try:
+			state.begin()
+			state.remove_node('2002')
+			state.commit()
+		finally:
+			state.close()
+		self.assertEqual(self.render('zk.info', items), (0, self.path('zoo.cfg') + '\n'))
+		self.assertFalse('server.2=' in self.read('zoo.cfg'))
+
+
+
+	def test_invalid_item_writes_nothing(self):
+		self.write('zk.info', ZK_INFO)
+		items = ('zoo-cfg "%s" "%s" 2888 3888\n'
+			'zoo-cfg "%s"\n' % (self.path('zoo.cfg'), self.path('zoo.cfg.template'), self.path('other.cfg')))
+		self.assertEqual(self.render('zk.info', items), (1, ''))
+		self.assertFalse(os.path.exists(self.path('zoo.cfg')))
+
+
+
+if __name__ == '__main__':
+	unittest.main()
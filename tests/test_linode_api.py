@@ -0,0 +1,328 @@
+# Tests of the linode operations of linode_api.py, which run the coroutines of linode_api_async,
+# against an in-process linode_api_simulator.
+#
+# Usage: python -m unittest discover tests   (from the repository directory)
+
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+
+# Pacing would only slow tests down, and catalogs shouldn't be cached across them.
+os.environ['LINODE_API_RATE_LIMIT'] = '0'
+os.environ['LINODE_API_CACHE_TTL'] = '0'
+
+import linode_api
+import linode_api_async
+import linode_api_simulator
+
+
+PLAN_ID = linode_api.PLAN_IDS['2GB']
+DATACENTER_ID = 6
+KERNEL_ID = 138
+
+
+
+class SimulatorTestCase(unittest.TestCase):
+
+	def setUp(self):
+		options = dict(linode_api_simulator.OPTIONS)
+		options['job-scale'] = 0.01
+		self.simulator = linode_api_simulator.Simulator(options)
+		self.server = linode_api_simulator.SimulatorServer(('127.0.0.1', 0), self.simulator)
+		thread = threading.Thread(target=self.server.serve_forever)
+		thread.daemon = True
+		thread.start()
+
+		self.cache_dir = tempfile.mkdtemp()
+		os.environ['LINODE_API_CACHE_DIR'] = self.cache_dir
+		linode_api.use_api_environment('http://127.0.0.1:%d/' % self.server.server_address[1], 'test-key')
+		self.image_id = self.simulator.add_image('test-image', 1500)
+
+
+	def tearDown(self):
+		# Closing the client's keep-alive connections lets the simulator's connection threads end.
+		linode_api.get_async_client().close()
+		linode_api.use_api_environment(None, None)
+		self.server.shutdown()
+		self.server.server_close()
+		shutil.rmtree(self.cache_dir)
+
+
+	def linodes(self):
+		with self.simulator.lock:
+			return dict((linode_id, dict(linode)) for linode_id, linode in self.simulator.linodes.items())
+
+
+	def provision_args(self):
+		return (DATACENTER_ID, self.image_id, KERNEL_ID, 'test-node', 'test-group',
+			'test-disk', 2000, '', None)
+
+
+
+class OperationsTest(SimulatorTestCase):
+
+	def test_create_update_delete_node(self):
+		success, linode_id = linode_api.create_node(PLAN_ID, 'newark')
+		self.assertTrue(success)
+		self.assertEqual(self.linodes()[linode_id]['DATACENTERID'], DATACENTER_ID)
+
+		self.assertEqual(linode_api.update_node(linode_id, 'renamed', 'group'), (True, linode_id))
+		self.assertEqual(self.linodes()[linode_id]['LABEL'], 'renamed')
+		self.assertEqual(self.linodes()[linode_id]['LPM_DISPLAYGROUP'], 'group')
+
+		self.assertEqual(linode_api.delete_node(linode_id, 1), (True, linode_id))
+		self.assertNotIn(linode_id, self.linodes())
+
+
+	def test_validations(self):
+		self.assertEqual(linode_api.create_node(PLAN_ID, 'nowhere'), (False, ['Invalid datacenter']))
+		self.assertEqual(self.linodes(), {})
+
+		success, linode_id = linode_api.create_node(PLAN_ID, DATACENTER_ID, False)
+		self.assertTrue(success)
+		self.assertEqual(linode_api.create_config(linode_id, 'no such kernel', '', 'config'),
+			(False, ['Invalid kernel']))
+		self.assertEqual(linode_api.create_disk_from_distribution(linode_id, 'no such distribution',
+			2000, '', None), (False, ['Invalid distribution']))
+
+
+	def test_api_errors_are_returned(self):
+		success, errors = linode_api.update_node(12345, 'label', 'group')
+		self.assertFalse(success)
+		self.assertTrue(errors)
+		self.assertEqual(linode_api.get_node_memory(12345), None)
+
+
+	def test_disks_and_jobs(self):
+		success, linode_id = linode_api.create_node(PLAN_ID, DATACENTER_ID, False)
+		self.assertEqual(linode_api.get_node_memory(linode_id), 2048)
+
+		success, (disk_id, job_id) = linode_api.create_disk_from_image(linode_id, self.image_id,
+			'disk', 2000, '', None)
+		self.assertTrue(success)
+		self.assertEqual(linode_api.is_job_finished(linode_id, 999999), (None, None))
+
+		success, (swap_disk_id, swap_job_id) = linode_api.create_swap_disk(linode_id)
+		self.assertTrue(success)
+		self.assertEqual(self.simulator.disks[swap_disk_id]['SIZE'], linode_api.swap_disk_size(2048))
+
+
+	def test_provision_node(self):
+		success, (linode_id, private_ip, public_ip) = linode_api.provision_node(PLAN_ID, *self.provision_args())
+		self.assertTrue(success)
+
+		linode = self.linodes()[linode_id]
+		self.assertEqual(linode['LABEL'], 'test-node-%d' % linode_id)
+		self.assertEqual(linode['LPM_DISPLAYGROUP'], 'test-group')
+		self.assertEqual(linode_api.get_public_ip_address(linode_id), public_ip)
+
+		disks = [disk for disk in self.simulator.disks.values() if disk['_linode_id'] == linode_id]
+		self.assertEqual(sorted(disk['TYPE'] for disk in disks), ['ext4', 'swap'])
+		self.assertTrue(all(disk['STATUS'] == 1 for disk in disks))
+		configs = [config for config in self.simulator.configs.values() if config['_linode_id'] == linode_id]
+		self.assertEqual([config['Label'] for config in configs], ['test-disk-configuration'])
+
+		ips = [ip for ip in self.simulator.ips.values() if ip['_linode_id'] == linode_id]
+		self.assertEqual(sorted(ip['IPADDRESS'] for ip in ips), sorted([private_ip, public_ip]))
+
+
+	def test_provision_nodes(self):
+		provisioned = []
+		errors = linode_api.provision_nodes([PLAN_ID] * 5, *(self.provision_args() +
+			(2, lambda *node: provisioned.append(node))))
+
+		self.assertEqual(errors, [])
+		self.assertEqual(sorted(node[0] for node in provisioned), sorted(self.linodes().keys()))
+		self.assertEqual(len(provisioned), 5)
+
+
+	def test_provision_nodes_failures(self):
+		self.simulator.options['job-failure-rate'] = 1.0
+		provisioned = []
+		errors = linode_api.provision_nodes([PLAN_ID] * 3, *(self.provision_args() +
+			(3, lambda *node: provisioned.append(node))))
+
+		self.assertEqual(provisioned, [])
+		self.assertEqual(len(errors), 3)
+		self.assertTrue(all('Failed to create disks' in error for error in errors))
+		self.assertEqual(self.linodes(), {})
+
+
+	def test_provision_node_deletes_linode_on_failure(self):
+		success, errors = linode_api.provision_node(PLAN_ID, DATACENTER_ID, 999999, KERNEL_ID,
+			'test-node', 'test-group', 'test-disk', 2000, '', None)
+
+		self.assertFalse(success)
+		self.assertIn('Failed to create disk from image', errors[0])
+		self.assertEqual(self.linodes(), {})
+		self.assertEqual(self.simulator.disks, {})
+
+
+	def test_clone_provision_node_deletes_clone_on_failure(self):
+		golden_linode_id = self.simulator.add_golden_node(PLAN_ID, DATACENTER_ID, 2000)
+		self.simulator.options['job-failure-rate'] = 1.0
+		success, errors = linode_api.clone_provision_node(golden_linode_id, PLAN_ID, DATACENTER_ID,
+			'test-node', 'test-group')
+
+		self.assertFalse(success)
+		self.assertIn('Failed to clone disks', errors[0])
+		self.assertEqual(self.linodes().keys(), [golden_linode_id])
+
+
+
+class WarmPoolTest(SimulatorTestCase):
+
+	def add_node(self, label, group):
+		success, linode_id = linode_api.create_node(PLAN_ID, DATACENTER_ID, False)
+		linode_api.update_node(linode_id, label % linode_id, group)
+		return linode_id
+
+
+	def fill(self, plan_ids):
+		provisioned = []
+		errors = linode_api.fill_pool(plan_ids, DATACENTER_ID, self.image_id, KERNEL_ID, 'c-warm-pool-5',
+			'disk', 2000, '', None, 4, lambda *node: provisioned.append(node[0]))
+		return provisioned, errors
+
+
+	def test_fill_and_claim(self):
+		provisioned, errors = self.fill([PLAN_ID] * 2)
+		self.assertEqual(errors, [])
+		self.assertEqual(len(provisioned), 2)
+
+		claimed, missed, errors = linode_api.claim_pool_nodes([PLAN_ID] * 3, DATACENTER_ID, 'c-warm-pool-5',
+			'sup', 'c')
+		self.assertEqual(errors, [])
+		self.assertEqual(sorted(node[0] for node in claimed), sorted(provisioned))
+		self.assertEqual(missed, [PLAN_ID])
+		for linode_id in provisioned:
+			self.assertEqual(self.linodes()[linode_id]['LABEL'], 'sup-%d' % linode_id)
+			self.assertEqual(self.linodes()[linode_id]['LPM_DISPLAYGROUP'], 'c')
+
+
+	def test_concurrent_claims_get_different_nodes(self):
+		provisioned, errors = self.fill([PLAN_ID] * 4)
+		claims = []
+		def claim():
+			claims.append(linode_api.claim_pool_nodes([PLAN_ID] * 2, DATACENTER_ID, 'c-warm-pool-5', 'sup', 'c'))
+
+		threads = [threading.Thread(target=claim) for i in range(3)]
+		for t in threads:
+			t.start()
+		for t in threads:
+			t.join()
+
+		claimed_ids = [node[0] for claimed, missed, errors in claims for node in claimed]
+		self.assertEqual(sorted(claimed_ids), sorted(provisioned))
+		self.assertEqual(sum(len(missed) for claimed, missed, errors in claims), 2)
+
+
+	def test_stale_filling_nodes_are_replaced(self):
+		stale_id = self.add_node('filling-%d-%%d' % (time.time() - linode_api.WARM_POOL_FILLING_TIMEOUT - 1),
+			'c-warm-pool-5-filling')
+		filling_id = self.add_node('filling-%d-%%d' % time.time(), 'c-warm-pool-5-filling')
+
+		success, (ready, filling, stale) = linode_api.list_pool_nodes('c-warm-pool-5', DATACENTER_ID)
+		self.assertEqual(filling, {PLAN_ID : [filling_id]})
+		self.assertEqual(stale, [stale_id])
+
+		provisioned, errors = self.fill([PLAN_ID] * 2)
+		self.assertEqual(errors, [])
+		self.assertEqual(len(provisioned), 1)
+		self.assertNotIn(stale_id, self.linodes())
+
+
+	def test_drain_all_pools_of_cluster(self):
+		pool_ids = [self.add_node('pool-%d', 'c-warm-pool-5'), self.add_node('pool-%d', 'c-warm-pool-4'),
+			self.add_node('filling-1-%d', 'c-warm-pool-5-filling')]
+		other_ids = [self.add_node('sup-%d', 'c'), self.add_node('pool-%d', 'c-warm-pool-x-warm-pool-5'),
+			self.add_node('pool-%d', 'cc-warm-pool-5')]
+
+		deleted, errors = linode_api.drain_pool('c-warm-pool-')
+		self.assertEqual(errors, [])
+		self.assertEqual(sorted(deleted), sorted(pool_ids))
+		self.assertEqual(sorted(self.linodes().keys()), sorted(other_ids))
+
+
+
+class ImageTest(SimulatorTestCase):
+
+	def add_fingerprinted_image(self, label, size, fingerprint, created):
+		image_id = self.simulator.add_image(label, size)
+		with self.simulator.lock:
+			self.simulator.images[image_id]['DESCRIPTION'] = linode_api.IMAGE_FINGERPRINT_PREFIX + fingerprint
+			self.simulator.images[image_id]['CREATE_DT'] = created
+		return image_id
+
+
+	def test_labels_and_descriptions_are_looked_up_separately(self):
+		image_id = self.add_fingerprinted_image('storm-image', 1500, 'abc', '2016-01-01 00:00:00.0')
+		other_id = self.simulator.add_image('fingerprint:abc', 1500)
+
+		self.assertEqual(linode_api.find_image('fingerprint:abc'), (other_id, 'fingerprint:abc'))
+		self.assertEqual(linode_api.find_image('storm-image'), (image_id, 'storm-image'))
+		self.assertEqual(linode_api.find_image_by_fingerprint('abc')['IMAGEID'], image_id)
+		self.assertEqual(linode_api.find_image_by_fingerprint('storm-image'), None)
+
+
+	def test_gc_images_keeps_images_in_use(self):
+		oldest_id = self.add_fingerprinted_image('oldest', 3000, 'a', '2016-01-01 00:00:00.0')
+		older_id = self.add_fingerprinted_image('older', 3000, 'b', '2016-01-02 00:00:00.0')
+		newer_id = self.add_fingerprinted_image('newer', 3000, 'c', '2016-01-03 00:00:00.0')
+
+		evicted, errors = linode_api.gc_images(1000, 10240, False, [oldest_id])
+		self.assertEqual(errors, [])
+		self.assertEqual([image_id for image_id, label, size in evicted], [older_id])
+		self.assertEqual(sorted(self.simulator.images.keys()), sorted([self.image_id, oldest_id, newer_id]))
+
+
+
+class AsyncClientTest(SimulatorTestCase):
+
+	def test_same_module(self):
+		self.assertIs(linode_api_async.linode_api, linode_api)
+
+
+	def test_client_shared_by_threads(self):
+		clients = []
+		def use_client():
+			linode_api.create_node(PLAN_ID, DATACENTER_ID, False)
+			clients.append(linode_api.get_async_client())
+
+		threads = [threading.Thread(target=use_client) for i in range(3)]
+		for t in threads:
+			t.start()
+		for t in threads:
+			t.join()
+
+		self.assertEqual(len(self.linodes()), 3)
+		self.assertEqual(len(set(id(api) for api in clients)), 1)
+		# Connections outlive the threads that used them, for the next operations.
+		api = clients[0]
+		self.assertTrue(api.idle)
+		self.assertEqual(api.active, 0)
+		self.assertEqual(api.address, '127.0.0.1')
+
+
+	def test_client_follows_api_environment(self):
+		api = linode_api.get_async_client()
+		self.assertIs(linode_api.get_async_client(), api)
+
+		linode_api.use_api_environment(linode_api.url, 'other-key')
+		self.assertIsNot(linode_api.get_async_client(), api)
+		self.assertEqual(linode_api.get_async_client().key, 'other-key')
+
+
+	def test_callbacks_run_on_calling_thread(self):
+		threads = []
+		linode_api.provision_nodes([PLAN_ID] * 2, *(self.provision_args() +
+			(2, lambda *node: threads.append(threading.current_thread()))))
+		self.assertEqual(threads, [threading.current_thread()] * 2)
+
+
+
+if __name__ == '__main__':
+	unittest.main()
@@ -5,6 +5,9 @@
 SSH_AUTH_SOCK=0
 export SSH_AUTH_SOCK
 
+# Package of the Java runtime installed on images. It's part of the image fingerprint.
+JDK_PACKAGE="openjdk-7-jre-headless"
+
 # $1 -> Cluster name, or absolute or relative path of cluster directory, or
 #		absolute or relative path of cluster conf file in cluster directory.
 load_cluster_conf() {
@@ -130,9 +133,13 @@ create_new_image_conf() {
 
 
 
+# Loads image and API environment configurations, checks that the image is not already
+# created, and creates the image status file. The image is then built by image_builder.py.
+# If an image built from the same inputs already exists, it's recorded in the image status 
+# file instead, and 2 is returned since there's nothing to build.
 # 	$1 : Name of image directory or Path of image configuration file.
 #	$2 : Name of API environment configuration file containing API endpoint and key.
-create_zk_image() {
+prepare_image_build() {
 	
 	
 	if ! load_image_conf "$1"; then
@@ -154,10 +161,15 @@ create_zk_image() {
 	
 	local linout linerr linret
 
+	if reuse_image; then
+		return 2
+	fi
+
 	# There are limits on both number of images (max 3) and total size across
 	# images (10240MB). If these limits are reached or close to breaching, warn user
 	# and prevent disk imaging.
 	echo "Image prechecks"
+	gc_images
 	
 	linode_api linout linerr linret "imagestats"
 	if [ $linret -eq 1 ]; then
@@ -183,165 +195,141 @@ create_zk_image() {
 	
 
 	create_image_status_file
+}
 
-	# Create temporary linode of lowest cost plan in specified datacenter.
-	echo "Creating temporary linode"
-	linode_api linout linerr linret "create-node" 1 "$DATACENTER_FOR_IMAGE"
-	if [ $linret -eq 1 ]; then
-		echo "Failed to create temporary linode. Error:$linerr"
-		return 1
-	fi
-	local temp_linode_id=$linout
-	echo "Created temporary linode $temp_linode_id"
-	
-	linode_api linout linerr linret "update-node" $temp_linode_id "zktmp-$temp_linode_id" "temporary"
-	if [ $linret -eq 1 ]; then
-		echo "Failed to update node label $temp_linode_id. Error:$linerr"
-		return 1
-	fi
-	
-	# Create a disk from distribution.
-	echo "Creating disk"
-	linode_api linout linerr linret "create-disk-from-distribution" $temp_linode_id "$DISTRIBUTION_FOR_IMAGE" \
-		$IMAGE_DISK_SIZE "$IMAGE_ROOT_PASSWORD" "$IMAGE_ROOT_SSH_PUBLIC_KEY"
-		
-	if [ $linret -eq 1 ]; then
-		echo "Failed to create disk. Error:$linerr"
-		return 1
-	fi
-	local disk_id=$(echo $linout|cut -d ',' -f1)
-	local create_disk_job_id=$(echo $linout|cut -d ',' -f2)
-	
-	local disk_result
-	wait_for_job $create_disk_job_id $temp_linode_id 
-	disk_result=$?
-	if [ $disk_result -eq 0 ]; then
-		echo "Create disk did not complete even after 4 minutes. Aborting"
-		return 1
-	fi
-	
-	if [ $disk_result -ge 2 ]; then
-		echo "Create disk failed."
-		return 1
-	fi
-	
-	# Create a configuration profile with that disk.
-	echo "Creating a configuration"
-	linode_api linout linerr linret "create-config" $temp_linode_id "$KERNEL_FOR_IMAGE" \
-		$disk_id "template-configuration"
-	if [ $linret -eq 1 ]; then
-		echo "Failed to create configuration. Error:$linerr"
-		return 1
-	fi
-	local config_id=$linout
 
-	
-	# Boot the linode.
-	echo "Booting the linode"
-	linode_api linout linerr linret "boot" $temp_linode_id $config_id
-	if [ $linret -eq 1 ]; then
-		echo "Failed to boot. Error:$linerr"
-		return 1
-	fi
-	local boot_job_id=$linout
-	
 
-	# Wait for node to boot up.
-	local boot_result
-	wait_for_job $boot_job_id $temp_linode_id 
-	boot_result=$?
-	if [ $boot_result -eq 0 ]; then
-		echo "Boot job did not complete even after 4 minutes. Aborting"
-		return 1
-	fi
-	
-	if [ $boot_result -ge 2 ]; then
-		echo "Booting failed."
-		return 1
-	fi
-	
-	
-	# Get public IP address of node.
-	echo "Getting IP address of linode"
-	linode_api linout linerr linret "public-ip" $temp_linode_id
-	if [ $linret -eq 1 ]; then
-		echo "Failed to get IP address. Error:$linerr"
-		return 1
-	fi
+# Outputs a fingerprint of everything the loaded image is built from: the image configuration
+# values that affect what's installed, the files that are installed, the JDK package, and 
+# the functions that install them. Images with the same fingerprint are interchangeable.
+image_fingerprint() {
+	local name
+	{
+		for name in DISTRIBUTION_FOR_IMAGE KERNEL_FOR_IMAGE IMAGE_DISK_SIZE IMAGE_ROOT_PASSWORD \
+				IMAGE_DISABLE_SSH_PASSWORD_AUTHENTICATION IMAGE_ADMIN_USER IMAGE_ADMIN_PASSWORD UPGRADE_OS \
+				ZOOKEEPER_INSTALL_DIRECTORY ZOOKEEPER_USER ZOOKEEPER_MAX_HEAP_SIZE ZOOKEEPER_MIN_HEAP_SIZE JDK_PACKAGE; do
+			printf '%s=%s\n' $name "${!name}"
+		done
+		cat "$IMAGE_ROOT_SSH_PUBLIC_KEY" "$INSTALL_ZOOKEEPER_DISTRIBUTION" "$IMAGE_CONF_DIR/zoo.cfg" \
+			"$IMAGE_CONF_DIR/log4j.properties" "$IMAGE_CONF_DIR/zk-supervisord.conf"
+		if [ -f "$IMAGE_ADMIN_SSH_AUTHORIZED_KEYS" ]; then
+			cat "$IMAGE_ADMIN_SSH_AUTHORIZED_KEYS"
+		fi
+		declare -f setup_users_and_authentication_for_image install_software_on_node install_zookeeper_on_node
+	} | sha1sum | cut -d ' ' -f1
+}
 
-	local ipaddr=$linout
-	echo "IP address: $ipaddr"
-	
-	setup_users_and_authentication_for_image $ipaddr
 
-	#echo "Installing prerequisite software"
-	install_software_on_node $ipaddr $NODE_USERNAME
 
-	#echo "Installing Zookeeper software"
-	install_zookeeper_on_node $ipaddr $NODE_USERNAME
+# If an image built from the same inputs as the loaded image exists, records it in the
+# image status file, so that it's used instead of building another.
+# Returns 0 if an image is reused, 1 if not. 
+reuse_image() {
+	IMAGE_FINGERPRINT=$(image_fingerprint)
+	echo "Image fingerprint: $IMAGE_FINGERPRINT"
 	
-	# Shutdown the linode.
-	echo "Shutting down the linode"
-	linode_api linout linerr linret "shutdown" $temp_linode_id
-	if [ $linret -eq 1 ]; then
-		echo "Failed to shutdown. Error:$linerr"
+	local linout linerr linret
+	linode_api linout linerr linret "find-image-fingerprint" $IMAGE_FINGERPRINT
+	if [ $linret -ne 0 ]; then
 		return 1
 	fi
-	local shutdown_job_id=$linout
 	
-	# Wait for linode to shutdown.
-	local shutdown_result
-	wait_for_job $shutdown_job_id $temp_linode_id 
-	shutdown_result=$?
-	if [ $shutdown_result -eq 0 ]; then
-		echo "Shutdown job did not complete even after 4 minutes. Aborting"
-		return 1
-	fi
+	local image_id=$(echo $linout|cut -d ',' -f1)
+	echo "Reusing image $image_id '$(echo $linout|cut -d ',' -f2-)', which was built from the same configuration"
 	
-	if [ $shutdown_result -ge 2 ]; then
-		echo "Shutdown failed."
-		return 1
+	local stfile=$(image_status_file)
+	create_image_status_file
+	add_section $stfile "image"
+	insert_bottom_of_section $stfile "image" $image_id
+	return 0
+}
+
+
+
+# Outputs comma separated IDs of images recorded in the status files of image directories
+# in the current directory and next to this image's directory. Clusters may still be created
+# from them, so they're never deleted to make room for new images.
+image_ids_in_use() {
+	local ids=","
+	local stfile image_id
+	for stfile in ./*/*.info "$(dirname "$IMAGE_CONF_DIR")"/*/*.info; do
+		if [ ! -f "$stfile" ]; then
+			continue
+		fi
+		for image_id in $(get_section "$stfile" "image"); do
+			if [[ "$image_id" =~ ^[0-9]+$ ]] && [[ "$ids" != *",$image_id,"* ]]; then
+				ids="$ids$image_id,"
+			fi
+		done
+	done
+	ids="${ids#,}"
+	echo "${ids%,}"
+}
+
+
+
+# Deletes least recently used images built earlier, if the new image wouldn't fit 
+# within the account's limit on total size of images. Images in use by local image 
+# directories are kept.
+gc_images() {
+	local linout linerr linret
+	linode_api linout linerr linret "gc-images" $IMAGE_DISK_SIZE "$(image_ids_in_use)"
+	if [ -n "$linout" ]; then
+		echo "Deleted least recently used images to make room for the new image (ID, size in MB, label):"
+		echo "$linout"
 	fi
-	
-	
-	# create image of the disk
-	echo "Creating image of disk $disk_id"
-	linode_api linout linerr linret "create-image" $temp_linode_id $disk_id "$LABEL_FOR_IMAGE"
 	if [ $linret -eq 1 ]; then
-		echo "Failed to create image of disk. Error:$linerr"
-		return 1
+		echo "Failed to delete least recently used images. Error:$linerr"
 	fi
-	local image_id=$(echo $linout|cut -d ',' -f1)
-	local image_disk_job_id=$(echo $linout|cut -d ',' -f2)
-	
-	local image_result
-	wait_for_job $image_disk_job_id $temp_linode_id 
-	image_result=$?
-	if [ $image_result -eq 0 ]; then
-		echo "Image job did not complete even after 4 minutes. Aborting"
-		return 1
-	fi
-	
-	if [ $image_result -ge 2 ]; then
-		echo "Imaging failed."
+}
+
+
+
+# Outputs the build line of the image loaded by prepare_image_build, as expected by image_builder.py.
+image_build_spec() {
+	printf '%q ' "zookeeper" "$(image_status_file)" "$DATACENTER_FOR_IMAGE" "$DISTRIBUTION_FOR_IMAGE" \
+		"$IMAGE_DISK_SIZE" "$IMAGE_ROOT_PASSWORD" "$IMAGE_ROOT_SSH_PUBLIC_KEY" "$KERNEL_FOR_IMAGE" "zktmp" \
+		"$LABEL_FOR_IMAGE" "fingerprint:$IMAGE_FINGERPRINT" "bash" "./zookeeper-cluster-linode.sh" "install-image" "$IMAGE_CONF_FILE"
+	printf '\n'
+}
+
+
+
+# 	$1 : Name of image directory or Path of image configuration file.
+#	$2 : Name of API environment configuration file containing API endpoint and key.
+create_zk_image() {
+	prepare_image_build "$1" "$2"
+	case $? in
+		0) ;;
+		2) return 0 ;;
+		*) return 1 ;;
+	esac
+
+	# The temporary linode is created, booted, installed and imaged by image_builder.py, which
+	# overlaps independent stages and prints how long each stage took.
+	image_build_spec | ./image_builder.py
+}
+
+
+
+# Installs software on the temporary linode of an image build. This is run by image_builder.py
+# once the linode is booted and SSH is available.
+# 	$1 : Path of image configuration file.
+#	$2 : IP address of the temporary linode.
+install_image_node() {
+	if ! load_image_conf "$1"; then
 		return 1
 	fi
-	echo "Template image $image_id successfully created"
 
-	add_section $stfile "image"
-	insert_bottom_of_section $stfile "image" "$image_id"
-	
-	# delete temporary linode. 'skipchecks' is 1 (true) because it's much 
-	# easier than detaching disk from config and then deleting.
-	echo "Deleting the temporary linode $temp_linode_id"
-	linode_api linout linerr linret "delete-node" $temp_linode_id 1
-	if [ $linret -eq 1 ]; then
-		echo "Failed to delete temporary linode. Error:$linerr"
+	NODE_USERNAME=root
+
+	if ! setup_users_and_authentication_for_image $2; then
 		return 1
 	fi
-	
 
-	printf "\n\nFinished creating Zookeeper template image $image_id\n"
+	install_software_on_node $2 $NODE_USERNAME
+
+	install_zookeeper_on_node $2 $NODE_USERNAME
 	return 0
 }
 
@@ -446,8 +434,8 @@ create_cluster() {
 
 	start_nodes $CLUSTER_NAME
 
-	# Wait for sometime after nodes have booted up for SSH daemon to come up.
-	sleep 15
+	# Wait for SSH daemons of booted nodes to come up.
+	wait_until_ready 300 $(ssh_probe_targets)
 	
 	# Since nodes created from an image retain the image's host keys, they should
 	# be changed to unique ones before doing anything else.
@@ -547,8 +535,8 @@ start_cluster() {
 		# and distribute hosts file.
 		start_nodes $CLUSTER_NAME
 		
-		# Wait for sometime after nodes have booted up for SSH daemon to come up.
-		sleep 15
+		# Wait for SSH daemons of booted nodes to come up.
+		wait_until_ready 300 $(ssh_probe_targets)
 		
 		# The cluster zoo.cfg may have been changed by admin.
 		# If so, it should  be distributed.
@@ -576,6 +564,13 @@ start_cluster() {
 	# zoo.cfg need not be updated even if node IP addresses have changed, because it uses hostnames, not IP addresses.
 	start_zookeeper $CLUSTER_NAME
 
+	# Wait for the ensemble to form, so that storm clusters can use it right away.
+	# Zookeeper port is firewalled from cluster manager, so it's probed from a node.
+	echo "Waiting for zookeeper ensemble to start serving..."
+	if ! wait_until_ready_on_node $(get_any_node_ipaddr) 180 $(zk_probe_targets "zk-quorum"); then
+		echo "Zookeeper ensemble is still not serving after 3 minutes. However, this is not necessarily an error. Proceeding..."
+	fi
+
 	update_cluster_status "running"
 	
 	echo "Zookeeper cluster $CLUSTER_NAME is running"
@@ -604,8 +599,10 @@ stop_cluster() {
 	# First stop zookeeper on all nodes, so that entire ensemble can save whatever state it should.
 	stop_zookeeper $CLUSTER_NAME
 
-	# Wait some time before stopping the nodes.
-	sleep 10
+	# Wait for zookeeper to stop on all nodes before stopping the nodes.
+	if ! wait_until_ready_on_node $(get_any_node_ipaddr) 60 $(zk_probe_targets "closed"); then
+		echo "Zookeeper has not stopped on all nodes after 1 minute. Proceeding..."
+	fi
 
 	stop_nodes $CLUSTER_NAME
 
@@ -619,8 +616,7 @@ stop_cluster() {
 
 #	$1: cluster name
 start_nodes() {
-	local stfile="$(status_file)"
-	local nodes=$(get_section $stfile nodes)
+	local nodes=$(cluster_state section "nodes")
 	local boot_jobs=''
 	
 	for node in $nodes
@@ -638,25 +634,10 @@ start_nodes() {
 	
 	echo "Waiting for nodes to boot"
 	
-	for job in $boot_jobs
-	do
-		job_id=$(echo $job|cut -d':' -f1)
-		linode_id=$(echo $job|cut -d':' -f2)
-		
-		# Wait for node to boot up.
-		local boot_result
-		wait_for_job $job_id $linode_id 
-		boot_result=$?
-		if [ $boot_result -eq 0 ]; then
-			echo "Linode $linode_id did not boot up even after 4 minutes. Aborting"
-			return 1
-		fi
-		
-		if [ $boot_result -ge 2 ]; then
-			echo "Linode $linode_id booting failed."
-			return 1
-		fi
-	done
+	if ! wait_for_jobs "boot up" $boot_jobs; then
+		echo "Aborting"
+		return 1
+	fi
 	
 	echo "All nodes booted"
 	
@@ -714,177 +695,45 @@ create_new_nodes() {
 	local kernel_id=$(echo $linout|cut -d ',' -f1)
 	echo "Kernel ID=$kernel_id"
 	
-	local stfile="$(status_file)"
-	add_section $stfile "nodes"
-	add_section $stfile "ipaddresses"
+	cluster_state add-section "nodes"
+	cluster_state add-section "ipaddresses"
 
 	echo "Creating $CLUSTER_SIZE new nodes in datacenter $dc_id based on image $image_id..."
 	
 	
-	for i in $CLUSTER_SIZE; do
-		plan=$(echo $i|cut -d ':' -f1)
-		count=$(echo $i|cut -d ':' -f2)
-		
-		local plan_id
-		case $plan in
-			"2GB")
-				plan_id=1
-				;;
-				
-			"4GB")
-				plan_id=2
-				;;
-				
-			"8GB")
-				plan_id=4
-				;;
-				
-			"12GB")
-				plan_id=6
-				;;
-				
-			"24GB")
-				plan_id=7
-				;;
-				
-			"48GB")
-				plan_id=8
-				;;
-				
-			"64GB")
-				plan_id=9
-				;;
-				
-			"80GB")
-				plan_id=10
-				;;				
-
-			"120GB")
-				plan_id=12
-				;;
-				
-			*)
-				echo "Invalid plan $plan. Aborting..."
-				return 1
-				;;
-		esac
-		
-		echo "Creating $count $plan linodes (plan ID $plan_id)"
-		
-		local node_count=1
-		while [ $node_count -le $count ]; do
-			# Create linode with specified plan and datacenter. The 0 at the end
-			# avoids validating datacenter id for every iteration. 
-			linode_api linout linerr linret "create-node" $plan_id $dc_id 0
-			if [ $linret -eq 1 ]; then
-				echo "Failed to create $plan linode #$node_count. Error:$linerr"
-				return 1
-			fi
-			local linode_id=$linout
-			
-			printf "\n\nCreated linode $linode_id\n"
-
-			# Store created linode's instance ID in status file.
-			# No need to store additional data like plan ID or datacenter ID
-			# because both are available from "linode.list" if required
-			write_status "nodes" $linode_id
-			node_count=$((node_count+1))
-
-			linode_api linout linerr linret "update-node" $linode_id "zk-$linode_id" "$CLUSTER_NAME"
-			if [ $linret -eq 1 ]; then
-				echo "Failed to update node label $linode_id. Error:$linerr"
-				return 1
-			fi
-			
-			# Create a disk from distribution.
-			echo "Creating disk from Zookeeper image for linode $linode_id"
-			linode_api linout linerr linret "create-disk-from-image" $linode_id $image_id \
-				"Zookeeper" $NODE_DISK_SIZE "$NODE_ROOT_PASSWORD" "$NODE_ROOT_SSH_PUBLIC_KEY"
-				
-			if [ $linret -eq 1 ]; then
-				echo "Failed to create image. Error:$linerr"
-				return 1
-			fi
-			local disk_id=$(echo $linout|cut -d ',' -f1)
-			local create_disk_job_id=$(echo $linout|cut -d ',' -f2)
-			
-			local disk_result
-			wait_for_job $create_disk_job_id $linode_id 
-			disk_result=$?
-			if [ $disk_result -eq 0 ]; then
-				echo "Create disk did not complete even after 4 minutes. Aborting"
-				return 1
-			fi
-			
-			if [ $disk_result -ge 2 ]; then
-				echo "Create disk failed."
-				return 1
-			fi
-			echo "Finished creating disk $disk_id from Zookeeper image for linode $linode_id"
-			
-			
-			# Create a swap disk sized according to the linode's RAM.
-			# The linode distributions are configured to expect /dev/sdb block device
-			# as swap space. If a swap disk is not part of the configuration, everything
-			# still succeeds but the dashboard shows a misconfiguration warning, and
-			# performance may also suffer.
-			echo "Creating swap disk"
-			linode_api linout linerr linret "create-swap-disk" $linode_id 
-				
-			if [ $linret -eq 1 ]; then
-				echo "Failed to create swap disk. Error:$linerr"
-				return 1
-			fi
-			local swap_disk_id=$(echo $linout|cut -d ',' -f1)
-			local create_swap_disk_job_id=$(echo $linout|cut -d ',' -f2)
-
-			local disk_result
-			wait_for_job $create_swap_disk_job_id $linode_id 
-			disk_result=$?
-			if [ $disk_result -eq 0 ]; then
-				echo "Create swap disk did not complete even after 4 minutes. Aborting"
-				return 1
-			fi
-
-			if [ $disk_result -ge 2 ]; then
-				echo "Create swap disk failed."
-				return 1
-			fi
-			
-			# Create a configuration profile with that disk. The 0 at the end
-			# avoids validating kernel id for every iteration.
-			echo "Creating a configuration"
-			linode_api linout linerr linret "create-config" $linode_id $kernel_id \
-				"$disk_id,$swap_disk_id" "Zookeeper-configuration" 0
-			if [ $linret -eq 1 ]; then
-				echo "Failed to create configuration. Error:$linerr"
-				return 1
-			fi
-			local config_id=$linout
-			echo "Finished creating configuration $config_id for linode $linode_id"
-			
-			# Add a private IP for this linode.
-			echo "Creating private IP for linode"
-			linode_api linout linerr linret "add-private-ip" $linode_id
-			if [ $linret -eq 1 ]; then
-				echo "Failed to add private IP address. Error:$linerr"
-				return 1
-			fi
-			local private_ip=$linout
-			echo "Private IP address $private_ip created for linode $linode_id"
-
-			# Get its public IP
-			linode_api linout linerr linret "public-ip" $linode_id
-			if [ $linret -eq 1 ]; then
-				echo "Failed to get public IP address. Error:$linerr"
-				return 1
-			fi
-			local public_ip=$linout
-			echo "Public IP address is $public_ip for linode $linode_id"
-			
-			insert_or_replace_in_section $stfile "ipaddresses" $linode_id "$linode_id $private_ip $public_ip"
-		done
-	done
+	# All nodes are provisioned concurrently, either by cloning the golden node or from the image.
+	local start_time=$SECONDS
+	local method
+	if [ -n "$GOLDEN_NODE" ]; then
+		method="by cloning golden node $GOLDEN_NODE"
+		linode_api linout linerr linret "clone-nodes" $GOLDEN_NODE "$CLUSTER_SIZE" $dc_id 'zk' "$CLUSTER_NAME"
+	else
+		method="from image $image_id"
+		linode_api linout linerr linret "provision-nodes" "$CLUSTER_SIZE" $dc_id $image_id $kernel_id 'zk' "$CLUSTER_NAME" \
+			"Zookeeper" $NODE_DISK_SIZE "$NODE_ROOT_PASSWORD" "$NODE_ROOT_SSH_PUBLIC_KEY"
+	fi
+	echo "Provisioned nodes $method in $((SECONDS - start_time)) seconds"
+	
+	# Store created linodes' instance IDs in status file, even if some others failed, 
+	# so that they're not left out when cluster is destroyed.
+	# No need to store additional data like plan ID or datacenter ID
+	# because both are available from "linode.list" if required
+	# All of them are recorded in a single transaction.
+	local linode_id private_ip public_ip
+	local state_cmds=''
+	while read linode_id private_ip public_ip; do
+		if [ -z "$linode_id" ]; then
+			continue
+		fi
+		echo "Created linode $linode_id with private IP $private_ip and public IP $public_ip"
+		state_cmds+="list-node $linode_id"$'\n'"set-node $linode_id private_ip=$private_ip public_ip=$public_ip"$'\n'
+	done <<< "$linout"
+	printf "%s" "$state_cmds" | cluster_state apply
+	
+	if [ $linret -eq 1 ]; then
+		echo "Failed to create nodes. Error:$linerr"
+		return 1
+	fi
 	
 }
 
@@ -919,66 +768,56 @@ destroy_cluster() {
 	fi
 
 	
-	local stfile=$(status_file)
-	
 	update_cluster_status "destroying"
 
-	local nodes=$(get_section $stfile "nodes")
+	local nodes=$(cluster_state section "nodes")
 	local failures=0
+	
+	# Shutdown all linodes first, so that their shutdown jobs run in parallel.
+	local shutdown_jobs=()
 	while read node;
 	do
-		echo "Destroying $node..."
-
-		# Shutdown the linode.
-		echo "Shutting down the linode"
+		echo "Shutting down $node..."
 		linode_api linout linerr linret "shutdown" $node
 		if [ $linret -eq 1 ]; then
 			echo "Failed to shutdown. Error:$linerr"
 			return 1
 		fi
-		local shutdown_job_id=$linout
-		
-		# Wait for linode to shutdown.
-		local shutdown_result
-		wait_for_job $shutdown_job_id $node 
-		shutdown_result=$?
-		if [ $shutdown_result -eq 0 ]; then
-			echo "Shutdown job did not complete even after 4 minutes. Aborting"
-			return 1
-		fi
-		
-		if [ $shutdown_result -ge 2 ]; then
-			echo "Shutdown failed."
-			return 1
-		fi
-		
-		sleep 2
+		shutdown_jobs+=("$linout:$node")
+	done <<< "$nodes"
+	
+	if ! wait_for_jobs "shutdown" "${shutdown_jobs[@]}"; then
+		echo "Aborting"
+		return 1
+	fi
+	
+	sleep 2
 
-		# Delete node (and skip checks)
-		linode_api linout linerr linret "delete-node" $node 1
-		if [ $linret -eq 1 ]; then
-			echo "Failed to delete. Error:$linerr"
-			failures=1
-			continue
-		fi
+	# Delete all nodes (and skip checks) in batched requests.
+	local node_ids=$(IFS=','; echo "${shutdown_jobs[*]}" | sed -r 's/[0-9]+://g')
+	echo "Destroying $node_ids..."
+	linode_api linout linerr linret "delete-nodes" "$node_ids" 1
+	if [ $linret -eq 1 ]; then
+		echo "Failed to delete some nodes. Error:$linerr"
+		failures=1
+	fi
 
-		# Remove entries for this node from all sections of status file
-		delete_line $stfile "nodes" $node
-		delete_line $stfile "ipaddresses" $node
-		delete_line $stfile "hostnames" $node
-		delete_line $stfile "myids" $node
-	done <<< "$nodes"
+	# Remove deleted nodes from cluster state
+	if [ ! -z "$linout" ]; then
+		cluster_state remove-node ${linout//,/ }
+	fi
 
 	# Don't delete status file if there are any failures above
 	if [ $failures -eq 0 ]; then	
 		echo "Deleting cluster status file..."
-		rm -f $stfile
+		cluster_state delete
 
 		echo "Deleting cluster hosts file..."
 		rm -f "$CLUSTER_CONF_DIR/$CLUSTER_NAME.hosts"
 
 		echo "Deleting cluster ZK cfg file..."
 		rm -f "$CLUSTER_CONF_DIR/zoo.cfg"
+		rm -f "$CLUSTER_CONF_DIR"/java-*.env
 		
 		echo "Deleting security configuration files..."
 		rm -f "$CLUSTER_CONF_DIR/$CLUSTER_NAME-all-whitelists.ipsets"  
@@ -1001,8 +840,7 @@ destroy_cluster() {
 
 #	$1 : Name of cluster as in cluster conf file.
 stop_nodes() {
-	local stfile="$(status_file)"
-	local nodes=$(get_section $stfile "nodes")
+	local nodes=$(cluster_state section "nodes")
 	local shutdown_jobs=''
 
 	for node in $nodes
@@ -1017,25 +855,10 @@ stop_nodes() {
 		shutdown_jobs="$shutdown_jobs $shutdown_job_id:$node"
 	done
 	
-	for job in $shutdown_jobs
-	do
-		job_id=$(echo $job|cut -d':' -f1)
-		linode_id=$(echo $job|cut -d':' -f2)
-		
-		# Wait for node to boot up.
-		local shutdown_result
-		wait_for_job $job_id $linode_id 
-		shutdown_result=$?
-		if [ $shutdown_result -eq 0 ]; then
-			echo "Linode $linode_id did not shutdown even after 4 minutes. Aborting"
-			return 1
-		fi
-		
-		if [ $shutdown_result -ge 2 ]; then
-			echo "Linode $linode_id shutdown failed."
-			return 1
-		fi
-	done
+	if ! wait_for_jobs "shutdown" $shutdown_jobs; then
+		echo "Aborting"
+		return 1
+	fi
 	
 	return 0
 }
@@ -1044,9 +867,7 @@ stop_nodes() {
 
 #	$1 : Name of the cluster 
 change_hostkeys() {
-	local stfile="$(status_file)"
-
-	local ipaddrs=$(get_section $stfile "ipaddresses")
+	local ipaddrs=$(cluster_state section "ipaddresses")
 
 	while read entry;
 	do
@@ -1074,11 +895,10 @@ change_hostkeys() {
 
 #	$1 : Name of the cluster 
 set_hostnames() {
-	local stfile="$(status_file)"
-	# Note: output of get_section is multiline, so always use it inside double quotes such as "$entries"
-	local entries=$(get_section $stfile "ipaddresses")
+	# Note: output of cluster_state is multiline, so always use it inside double quotes such as "$entries"
+	local entries=$(cluster_state section "ipaddresses")
 
-	add_section $stfile "hostnames"
+	cluster_state add-section "hostnames"
 
 	local node_count=1
 
@@ -1099,7 +919,7 @@ set_hostnames() {
 		# as explained in http://stackoverflow.com/questions/346445/bash-while-read-loop-breaking-early
 		set_hostname $new_private_host_name $private_ip $new_public_host_name $public_ip $NODE_USERNAME $1
 		
-		insert_or_replace_in_section $stfile "hostnames" $linode_id "$linode_id $new_private_host_name $new_public_host_name"
+		cluster_state set-node $linode_id private_hostname=$new_private_host_name public_hostname=$new_public_host_name
 		node_count=$((node_count+1))
 	done <<< "$entries" # The "$entries" should be in double quotes because output is multline
 }
@@ -1147,10 +967,9 @@ set_hostname() {
 
 #	$1 : Name of the cluster 
 distribute_hostsfile() {
-	local stfile="$(status_file)"
-	# Note: output of get_section is multiline, so always use it inside double quotes such as "$entries"
-	local ipaddrs=$(get_section $stfile "ipaddresses")
-	local hostnames=$(get_section $stfile "hostnames")
+	# Note: output of cluster_state is multiline, so always use it inside double quotes such as "$entries"
+	local ipaddrs=$(cluster_state section "ipaddresses")
+	local hostnames=$(cluster_state query "linode_id,private_hostname,private_ip,public_hostname,public_ip")
 
 	local hostsfile="$CLUSTER_CONF_DIR/$1.hosts"
 	touch $hostsfile
@@ -1163,16 +982,9 @@ distribute_hostsfile() {
 	# Distribute it to every node in cluster, along with
 	# a script which inserts those entries into the node's /etc/hosts
 	# as a section.
-	while read hostentry;
+	local linode_id private_host_name private_ip public_host_name public_ip
+	while read linode_id private_host_name private_ip public_host_name public_ip;
 	do
-		# An entry in hostnames section is of the form "linode_id   private_hostname  public_hostname"
-		local arr=($hostentry)
-		local linode_id=${arr[0]}
-		local private_host_name=${arr[1]}
-		local public_host_name=${arr[2]}
-
-		local private_ip=$(echo "$ipaddrs" | grep $linode_id | cut -d ' ' -f 2)
-		local public_ip=$(echo "$ipaddrs" | grep $linode_id | cut -d ' ' -f 3)
 		echo "Node:$linode_id , Private hostname:$private_host_name, private IP:$private_ip , Public hostname:$public_host_name, public IP:$public_ip"
 
 		echo "$public_ip $public_host_name" >> $hostsfile
@@ -1180,28 +992,9 @@ distribute_hostsfile() {
 
 	done <<< "$hostnames" # The "$entries" should be in double quotes because output is multline
 
-	while read ipentry;
-	do
-		local arr=($ipentry)
-		local linode_id=${arr[0]}
-		local private_ip=${arr[1]}
-		local public_ip=${arr[2]}
-		
-		# Default ssh target is the private IP address.
-		local target_ip=$private_ip
-		if [ "$CLUSTER_MANAGER_USES_PUBLIC_IP" == "true" ]; then
-			target_ip=$public_ip
-		fi
-		
-		echo "Distributing hosts file to linode:$linode_id, IP:$target_ip"
-
-		remote_copyfile ./textfileops.sh $target_ip $NODE_USERNAME $NODE_ROOT_SSH_PRIVATE_KEY textfileops.sh
-		remote_copyfile ./hostname_manager.sh $target_ip $NODE_USERNAME  $NODE_ROOT_SSH_PRIVATE_KEY hostname_manager.sh
-		remote_copyfile $hostsfile $target_ip $NODE_USERNAME  $NODE_ROOT_SSH_PRIVATE_KEY "$CLUSTER_NAME.hosts"
-
-		ssh_command $target_ip $NODE_USERNAME $NODE_ROOT_SSH_PRIVATE_KEY sh hostname_manager.sh "hosts-file" $1 "$CLUSTER_NAME.hosts"
-		
-	done <<< "$ipaddrs"
+	echo "Distributing hosts file to all nodes..."
+	fanout "$ipaddrs" "sh hostname_manager.sh hosts-file $1 $CLUSTER_NAME.hosts" \
+		"./textfileops.sh:textfileops.sh" "./hostname_manager.sh:hostname_manager.sh" "$hostsfile:$CLUSTER_NAME.hosts"
 
 	# Add the host entries to this very cluster manager machine on which this script is running.
 	echo "$CLUSTER_MANAGER_NODE_PASSWORD"|sudo -S sh hostname_manager.sh "hosts-file" $1 $hostsfile
@@ -1242,30 +1035,13 @@ setup_users_and_authentication_for_image() {
 		echo "Unknown value '$IMAGE_DISABLE_SSH_PASSWORD_AUTHENTICATION' for IMAGE_DISABLE_SSH_PASSWORD_AUTHENTICATION. Leaving defaults unchanged."
 	fi
 	
-	# Since SSH's been restarted wait for sometime before trying next SSH command. Otherwise next ssh/scp command sometimes fails.
-	# Also on production Linode, SSH service may take upto 60-80 seconds to become available again after restart. So keep trying
-	# to SSH until it succeeds.
-	sleep 20
-	
-	local max_checks=24
-	local wait_between_checks=10
-	local check_count=1
-	local ssh_available=0
-	while [ $check_count -le $max_checks ]; do
-		ssh_command $1 $NODE_USERNAME $IMAGE_ROOT_SSH_PRIVATE_KEY echo
-		if [ $? -eq 0 ]; then
-			echo "SSH is available after restart"
-			ssh_available=1
-			break
-		fi
-		check_count=$((check_count+1))
-		echo "Waiting for SSH to be available"
-		sleep $wait_between_checks
-	done
-	if [ $ssh_available -eq 0 ]; then
-		echo "SSH is still not available after $((max_checks*wait_between_checks/60)) minutes. Aborting image creation"
+	# Since SSH's been restarted wait for it to be available before trying next SSH command. Otherwise next ssh/scp command fails.
+	# On production Linode, SSH service may take upto 60-80 seconds to become available again after restart.
+	if ! wait_until_ready 240 "ssh:$1"; then
+		echo "SSH is still not available after 4 minutes. Aborting image creation"
 		return 1
-	fi	
+	fi
+	echo "SSH is available after restart"
 	
 	# Create IMAGE_ADMIN_USER as part of sudo group with password IMAGE_ADMIN_PASSWORD
 	if [ ! -z "$IMAGE_ADMIN_USER" ];  then
@@ -1332,8 +1108,8 @@ install_software_on_node() {
 
 
 
-	echo "Installing OpenJDK JRE 7 on $1..."
-	ssh_command $1 $2 $IMAGE_ROOT_SSH_PRIVATE_KEY apt-get -y install openjdk-7-jre-headless
+	echo "Installing $JDK_PACKAGE on $1..."
+	ssh_command $1 $2 $IMAGE_ROOT_SSH_PRIVATE_KEY apt-get -y install "$JDK_PACKAGE"
 
 
 
@@ -1502,11 +1278,9 @@ install_zookeeper_on_node() {
 assign_zk_node_ids() {
 	echo "Assigning unique 'myid' to all nodes in zookeeper cluster..."
 
-	local stfile="$(status_file)"
-
-	local ipaddrs=$(get_section $stfile "ipaddresses")
+	local ipaddrs=$(cluster_state section "ipaddresses")
 
-	add_section $stfile "myids"
+	cluster_state add-section "myids"
 	
 	# We need the zk datadir from image's zoo.cfg.
 	local dataDir=$(grep 'dataDir=' "$IMAGE_CONF_DIR/zoo.cfg"|cut -d '=' -f 2)
@@ -1524,10 +1298,12 @@ assign_zk_node_ids() {
 			target_ip=$public_ip
 		fi
 
+		# A node cloned from a golden node also has its snapshots and transaction logs, which
+		# are from another ensemble. They're removed before zookeeper is first started on the node.
 		echo "Creating myid=$zk_node_id in linode:$linode_id, IP:$target_ip"
-		ssh_command $target_ip $NODE_USERNAME $NODE_ROOT_SSH_PRIVATE_KEY "printf $zk_node_id > $dataDir/myid"
+		ssh_command $target_ip $NODE_USERNAME $NODE_ROOT_SSH_PRIVATE_KEY "rm -rf $dataDir/version-2; printf $zk_node_id > $dataDir/myid"
 
-		insert_or_replace_in_section $stfile "myids" $linode_id "$linode_id $zk_node_id"
+		cluster_state set-node $linode_id myid=$zk_node_id
 		
 		zk_node_id=$((zk_node_id+1))
 
@@ -1539,49 +1315,27 @@ assign_zk_node_ids() {
 create_zk_configuration() {
 	echo "Creating zookeeper configuration file..."
 
-	local stfile="$(status_file)"
-
-	local hostnames=$(get_section $stfile "hostnames")
-	local myids=$(get_section $stfile "myids")
-
 	# Every node's zoo.cfg should list all the other nodes in the format 
 	# server.<myid>=<host>:<port_to_connect_to_leader>:<leader_election_port>
-	# Create a local copy of the image's zoo.cfg called <cluster>.zoo.cfg and include all these entries.
+	# Create a local copy of the image's zoo.cfg and include all these entries.
 	local cluster_cfg="$CLUSTER_CONF_DIR/zoo.cfg"
 	local zk_conf_template="$IMAGE_CONF_DIR/zoo.cfg"
-	cp "$zk_conf_template" "$cluster_cfg"
-	chmod go-rwx "$cluster_cfg"
-	
-	add_section $cluster_cfg "nodes"
-
-	# Assign a unique myid to each node in cluster.
-	while read hostentry;
-	do
-		# An entry in hostnames section is of the form "linode_id private_hostname public_hostname"
-		local arr=($hostentry)
-		local linode_id=${arr[0]}
-		local private_host_name=${arr[1]}
-		local public_host_name=${arr[2]}
-
-		local use_host_name=$private_host_name
-		
-		# An entry in myids section is of the form "linode_id myid"
-		local zk_node_id=$(echo "$myids" | grep $linode_id | cut -d ' ' -f 2)
-		
-		local cfg_entry="server.$zk_node_id=$use_host_name:$ZOOKEEPER_LEADER_CONNECTION_PORT:$ZOOKEEPER_LEADER_ELECTION_PORT"
-		insert_bottom_of_section $cluster_cfg "nodes" $cfg_entry
-
-	done <<< "$hostnames"
+	render_configs <<-ENDITEMS
+		zoo-cfg "$cluster_cfg" "$zk_conf_template" "$ZOOKEEPER_LEADER_CONNECTION_PORT" "$ZOOKEEPER_LEADER_ELECTION_PORT"
+	ENDITEMS
 }
 
 
 #	$1 : Name of the cluster 
+#	$2 : (Optional) Command run on nodes after they get changed configuration files.
+#	$3 : (Optional) Linode ID of the only node to distribute configuration to.
 distribute_zk_configuration() {
 	echo "Distributing zookeeper configuration..."
 
-	local stfile="$(status_file)"
-
-	local ipaddrs=$(get_section $stfile "ipaddresses")
+	local ipaddrs=$(cluster_state section "ipaddresses")
+	if [ -n "$3" ]; then
+		ipaddrs=$(echo "$ipaddrs" | awk -v id="$3" '$1 == id')
+	fi
 
 	local cluster_cfg="$CLUSTER_CONF_DIR/zoo.cfg"
 	
@@ -1603,31 +1357,28 @@ distribute_zk_configuration() {
 		calc_max_heap=1
 	fi
 
-	local linout linerr linret
-	
 	# Now we need the ZK installation directory on a node.
 	local install_dir=$(zk_install_dir)
 	local remote_cfg_path=$install_dir/conf/zoo.cfg
-	while read entry;
-	do
-		local arr=($entry)
-		local linode_id=${arr[0]}
-		local private_ip=${arr[1]}
-		local public_ip=${arr[2]}
+	local file_specs=("$cluster_cfg:$remote_cfg_path")
 
-		local target_ip=$private_ip
-		if [ "$CLUSTER_MANAGER_USES_PUBLIC_IP" == "true" ]; then
-			target_ip=$public_ip
-		fi
-
-		echo "Copying $cluster_cfg to node $linode_id [$target_ip] $remote_cfg_path..."
-		remote_copyfile $cluster_cfg $target_ip $NODE_USERNAME $NODE_ROOT_SSH_PRIVATE_KEY $remote_cfg_path
+	if [ $calc_min_heap -eq 1 -o $calc_max_heap -eq 1 ]; then
+		# Each node's java.env is created locally as java-<linode_id>.env, so that it's copied only
+		# if that node's heap sizes have changed.
+		file_specs+=("$CLUSTER_CONF_DIR/java-{linode_id}.env:$install_dir/conf/java.env")
 		
-		if [ $calc_min_heap -eq 1 -o $calc_max_heap -eq 1 ]; then
+		local linout linerr linret
+		while read entry;
+		do
+			local arr=($entry)
+			local linode_id=${arr[0]}
+			local java_env_file="$CLUSTER_CONF_DIR/java-$linode_id.env"
+
 			linode_api linout linerr linret "ram" $linode_id
 			if [ $linret -eq 1 ]; then
 				# It's not a fatal error, because the image has a valid heap size.
 				echo "Failed to get RAM of linode $linode_id. Heap settings are unchanged. Error:$linerr"
+				rm -f "$java_env_file"
 				continue
 			fi
 			
@@ -1644,11 +1395,12 @@ distribute_zk_configuration() {
 				max_heap=$((ram * img_max_heap_value / 100))
 			fi
 			
-			local java_env_contents="export JVMFLAGS=\'-Xms${min_heap}M -Xmx${max_heap}M\'"
-			ssh_command $target_ip $NODE_USERNAME $NODE_ROOT_SSH_PRIVATE_KEY "sh -c \"echo $java_env_contents > $install_dir/conf/java.env\""
-		fi
-		
-	done <<< "$ipaddrs"
+			echo "export JVMFLAGS='-Xms${min_heap}M -Xmx${max_heap}M'" > "$java_env_file"
+		done <<< "$ipaddrs"
+	fi
+
+	echo "Copying $cluster_cfg to nodes $remote_cfg_path..."
+	fanout_changed "$ipaddrs" "$2" "${file_specs[@]}"
 }
 
 
@@ -1656,13 +1408,48 @@ distribute_zk_configuration() {
 # Admin can modify the cluster's zoo.cfg and call this to re-upload 
 # it to entire cluster and restart zookeeper services.
 # 	$1 : Name of cluster directory or Path of cluster configuration file.
+#	$2 : (Optional) "--plan" to only print the files that would be copied to each node.
 update_zk_configuration() {
 	if ! load_cluster_conf "$1"; then
 		return 1
 	fi
 
+	if [ "$2" == "--plan" ]; then
+		FANOUT_PLAN=true distribute_zk_configuration $CLUSTER_NAME
+		return 0
+	fi
+
 	local cluster_status=$(get_cluster_status)
 	if [ "$cluster_status" == "running" ]; then
+		# Zookeeper is restarted only on nodes that don't already have this configuration.
+		local changed_ids=$(FANOUT_PLAN=true distribute_zk_configuration $CLUSTER_NAME | grep '^linode:' | cut -f1 | uniq | cut -d ':' -f2)
+		local changed=$(echo $changed_ids | wc -w)
+		local total=$(cluster_state section "ipaddresses" | wc -l)
+		if [ $changed -eq 0 ]; then
+			echo "All nodes already have this zookeeper configuration. Not restarting zookeeper"
+			update_conf_status "unchanged"
+			return 0
+		fi
+		
+		if [ $changed -lt $total ]; then
+			# Only some nodes have changed, such as their heap sizes. They're restarted one at a time,
+			# and the ensemble should be serving again before the next one is restarted, so that it 
+			# keeps its quorum. Nodes that aren't restarted keep their changes for the next update.
+			echo "Restarting zookeeper on $changed of $total nodes..."
+			local linode_id
+			for linode_id in $changed_ids; do
+				distribute_zk_configuration $CLUSTER_NAME "supervisorctl restart zookeeper" $linode_id
+				
+				echo "Waiting for zookeeper ensemble to start serving..."
+				if ! wait_until_ready_on_node $(get_any_node_ipaddr) 180 $(zk_probe_targets "zk-quorum"); then
+					echo "Zookeeper ensemble is not serving 3 minutes after restarting zookeeper on $linode_id. Aborting"
+					return 1
+				fi
+			done
+			update_conf_status "unchanged"
+			return 0
+		fi
+		
 		# First stop zookeeper on all nodes, so that entire ensemble can save whatever state it should.
 		stop_zookeeper $CLUSTER_NAME
 
@@ -1684,9 +1471,9 @@ update_zk_configuration() {
 
 
 #	$1 : Name of the cluster 
+#	$2 : (Optional) Path of another cluster's whitelist file, relative to script directory, to include
+#		 as if it were whitelisted.
 create_cluster_security_configurations() {
-	local stfile="$(status_file)"
-	
 	# Zookeeper whitelists are of 2 types
 	# 1) the whitelist consisting of nodes of zk cluster itself
 	# 2) the whitelists of other clusters which use this zk cluster
@@ -1702,27 +1489,17 @@ create_cluster_security_configurations() {
 	local zk_cluster_whitelist_file="$CLUSTER_CONF_DIR/$CLUSTER_NAME-whitelist.ipsets"
 	
 	local ipsets_file="$CLUSTER_CONF_DIR/$CLUSTER_NAME-rules.ipsets"
-	cat $zk_cluster_whitelist_file > $ipsets_file
-	chmod go-rwx "$ipsets_file"
-	
 	local all_whitelists_file="$CLUSTER_CONF_DIR/$CLUSTER_NAME-all-whitelists.ipsets"
-	echo "create all-whitelists list:set size 32" > $all_whitelists_file
-	echo "add all-whitelists $CLUSTER_NAME-wl" >> $all_whitelists_file
-	chmod go-rwx "$all_whitelists_file"
 	
-	local other_cluster_whitelists=$(get_section $stfile "whitelisted-clusters")
-	if [ "$other_cluster_whitelists" != "" ]; then
-		while read other_cluster_whitelist_file
+	# Paths of whitelist files of other clusters, relative to scripts directory, on a single line.
+	local other_cluster_whitelists=$(cluster_state section "whitelisted-clusters" | while read other_cluster_whitelist_file
 		do
-			local whitelist_name=$(cat $other_cluster_whitelist_file|grep create|cut -d ' ' -f2)
-			echo "add all-whitelists $whitelist_name" >> $all_whitelists_file
-			
-			cat $other_cluster_whitelist_file >> $ipsets_file
-		done <<< "$other_cluster_whitelists"
+			printf ' "%s"' "$other_cluster_whitelist_file"
+		done)
+	if [ -n "$2" ] && ! cluster_state section "whitelisted-clusters" | grep -qxF "$2"; then
+		other_cluster_whitelists="$other_cluster_whitelists \"$2\""
 	fi
 	
-	cat $all_whitelists_file >> $ipsets_file
-	
 	# Make a copy of the referred v4 rules file into the cluster conf directory.
 	local template_v4_rules_file="$IPTABLES_V4_RULES_TEMPLATE"
 	if [ "${template_v4_rules_file:0:1}" != "/" ]; then
@@ -1731,11 +1508,6 @@ create_cluster_security_configurations() {
 	
 	local cluster_v4_rules_file="$CLUSTER_CONF_DIR/$CLUSTER_NAME-rules.v4"
 	
-	cp "$template_v4_rules_file" "$cluster_v4_rules_file"
-	chmod go-rwx "$cluster_v4_rules_file"
-	
-	sed -i "s/\$CLUSTER_NAME/$CLUSTER_NAME/g" "$cluster_v4_rules_file"
-
 	# Make a copy of the referred v6 rules file into the cluster conf directory.
 	local template_v6_rules_file="$IPTABLES_V6_RULES_TEMPLATE"
 	if [ "${template_v6_rules_file:0:1}" != "/" ]; then
@@ -1744,59 +1516,47 @@ create_cluster_security_configurations() {
 	
 	local cluster_v6_rules_file="$CLUSTER_CONF_DIR/$CLUSTER_NAME-rules.v6"
 	
-	cp "$template_v6_rules_file" "$cluster_v6_rules_file"
-	chmod go-rwx "$cluster_v6_rules_file"
-	sed -i "s/\$CLUSTER_NAME/$CLUSTER_NAME/g" "$cluster_v6_rules_file"
+	render_configs <<-ENDITEMS
+		var CLUSTER_NAME "$CLUSTER_NAME"
+		ipset-list "$all_whitelists_file" all-whitelists "$zk_cluster_whitelist_file" $other_cluster_whitelists
+		concat "$ipsets_file" "$zk_cluster_whitelist_file" $other_cluster_whitelists "$all_whitelists_file"
+		text "$cluster_v4_rules_file" "$template_v4_rules_file"
+		text "$cluster_v6_rules_file" "$template_v6_rules_file"
+	ENDITEMS
 
 }
 
 
 #	$1 : Name of the cluster 
 distribute_cluster_security_configurations() { 
-	local stfile="$(status_file)"
-
 	local ipsets_file="$CLUSTER_CONF_DIR/$CLUSTER_NAME-rules.ipsets"
 	
 	local zk_iptables_v4_rules_file="$CLUSTER_CONF_DIR/$CLUSTER_NAME-rules.v4"
 	local zk_iptables_v6_rules_file="$CLUSTER_CONF_DIR/$CLUSTER_NAME-rules.v6"
 	
-	local ipaddrs=$(get_section $stfile "ipaddresses")
-	while read ipentry;
-	do
-		local arr=($ipentry)
-		local linode_id=${arr[0]}
-		local private_ip=${arr[1]}
-		local public_ip=${arr[2]}
-		
-		# Default ssh target is the private IP address.
-		local target_ip=$private_ip
-		if [ "$CLUSTER_MANAGER_USES_PUBLIC_IP" == "true" ]; then
-			target_ip=$public_ip
-		fi
-		
-		echo "Distributing security files to linode:$linode_id, IP:$target_ip"
-		
-		remote_copyfile $ipsets_file $target_ip $NODE_USERNAME $NODE_ROOT_SSH_PRIVATE_KEY /etc/iptables/rules.ipsets
-		remote_copyfile $zk_iptables_v4_rules_file $target_ip $NODE_USERNAME $NODE_ROOT_SSH_PRIVATE_KEY /etc/iptables/rules.v4
-		remote_copyfile $zk_iptables_v6_rules_file $target_ip $NODE_USERNAME $NODE_ROOT_SSH_PRIVATE_KEY /etc/iptables/rules.v6
-		
-		# Apply the firewall configuration immediately.
-		# The flush is to remove iptables rule that refer to a ipset, because we can't delete ipset otherwise.
-		# On Debian 8 + systemd, 'apt-get install iptables-persistent' no longer installs
-		# "iptables-persistent" script but instead calls it "/usr/bin/netfilter-persistent".
-		# A wrapper which calls "/usr/bin/netfilter-persistent" is installed in "/etc/init.d/netfilter-persistent"
-		# "service netfilter-persistent cmd" executes "/etc/init.d/netfilter-persistent" which inturn executes
-		# "/usr/bin/netfilter-persistent".
-		ssh_command $target_ip $NODE_USERNAME $NODE_ROOT_SSH_PRIVATE_KEY sh -c \
-			"\"if [ -f '/etc/init.d/iptables-persistent' ]; then
-			     /etc/init.d/iptables-persistent flush;
-			     /etc/init.d/iptables-persistent reload;
-			 elif [ -f '/usr/sbin/netfilter-persistent' ]; then
-				 service netfilter-persistent flush;
-			     service netfilter-persistent reload;
-			 fi\""
-		
-	done <<< "$ipaddrs"
+	local ipaddrs=$(cluster_state section "ipaddresses")
+	
+	# Apply the firewall configuration immediately.
+	# The flush is to remove iptables rule that refer to a ipset, because we can't delete ipset otherwise.
+	# On Debian 8 + systemd, 'apt-get install iptables-persistent' no longer installs
+	# "iptables-persistent" script but instead calls it "/usr/bin/netfilter-persistent".
+	# A wrapper which calls "/usr/bin/netfilter-persistent" is installed in "/etc/init.d/netfilter-persistent"
+	# "service netfilter-persistent cmd" executes "/etc/init.d/netfilter-persistent" which inturn executes
+	# "/usr/bin/netfilter-persistent".
+	local reload_firewall="if [ -f '/etc/init.d/iptables-persistent' ]; then
+			/etc/init.d/iptables-persistent flush;
+			/etc/init.d/iptables-persistent reload;
+		elif [ -f '/usr/sbin/netfilter-persistent' ]; then
+			service netfilter-persistent flush;
+			service netfilter-persistent reload;
+		fi"
+	
+	# Only nodes whose files have changed get them, and only they reload their firewalls.
+	echo "Distributing security files to all nodes..."
+	fanout_changed "$ipaddrs" "$reload_firewall" \
+		"$ipsets_file:/etc/iptables/rules.ipsets" \
+		"$zk_iptables_v4_rules_file:/etc/iptables/rules.v4" \
+		"$zk_iptables_v6_rules_file:/etc/iptables/rules.v6"
 }
 
 
@@ -1813,8 +1573,6 @@ create_cluster_whitelist() {
 
 #	$1 : the cluster name as in the cluster conf file.
 create_cluster_whitelist_internal() {
-	local stfile="$(status_file)"
-	
 	local zk_cluster_whitelist_file="$CLUSTER_CONF_DIR/$1-whitelist.ipsets"
 	
 	if [ -f "$zk_cluster_whitelist_file" ]; then
@@ -1822,17 +1580,9 @@ create_cluster_whitelist_internal() {
 	fi
 	
 	# An ipset name shouldn't be >31 characters.So minimize any suffix.
-	local zk_cluster_whitelist_name="$1-wl"
-	echo "create $zk_cluster_whitelist_name hash:ip family inet hashsize 1024 maxelem 65536" > $zk_cluster_whitelist_file
-	local ipaddrs=$(get_section $stfile "ipaddresses")
-	while read ipentry 
-	do
-		local arr=($ipentry)
-		local linode_id=${arr[0]}
-		local private_ip=${arr[1]}
-
-		echo "add $zk_cluster_whitelist_name $private_ip" >> $zk_cluster_whitelist_file
-	done <<< "$ipaddrs"	
+	render_configs <<-ENDITEMS
+		whitelist "$zk_cluster_whitelist_file" "$1-wl"
+	ENDITEMS
 }
 
 
@@ -1856,7 +1606,7 @@ add_to_whitelist() {
 		return 1
 	fi
 	
-	add_section $stfile "whitelisted-clusters"
+	cluster_state add-section "whitelisted-clusters"
 	
 	# A ZK cluster may be shared by multiple storm or other clusters.
 	# Each client cluster should tell this ZK cluster to whitelist client
@@ -1864,7 +1614,7 @@ add_to_whitelist() {
 	# 
 	# This script should maintain a list of all such client clusters
 	# who tell it to whitelist them.
-	insert_or_replace_in_section $stfile "whitelisted-clusters" $2 "$2"
+	cluster_state put-line "whitelisted-clusters" "$2" "$2"
 
 	create_cluster_security_configurations $CLUSTER_NAME
 	
@@ -1903,7 +1653,7 @@ remove_from_whitelist() {
 	fi
 	
 	
-	delete_line $stfile "whitelisted-clusters" "$2"
+	cluster_state delete-line "whitelisted-clusters" "$2"
 
 	create_cluster_security_configurations $CLUSTER_NAME
 	
@@ -1922,14 +1672,27 @@ remove_from_whitelist() {
 
 
 # 	$1 : Name of cluster directory or Path of cluster configuration file.
+#	$2 : (Optional) "--plan" to only print the files that would be copied to each node.
+#	$3 : (Optional) With "--plan", the path of another cluster's whitelist file, relative to script
+#		 directory, that's planned as if it had been added with "add-whitelist".
 update_firewall() {
 	if ! load_cluster_conf "$1"; then
 		return 1
 	fi
 
-
+	if [ "$2" == "--plan" ]; then
+		create_cluster_security_configurations $CLUSTER_NAME "$3"
+		FANOUT_PLAN=true distribute_cluster_security_configurations $CLUSTER_NAME
+		
+		# The planned whitelist isn't actually added, so configuration files shouldn't include it.
+		if [ -n "$3" ]; then
+			create_cluster_security_configurations $CLUSTER_NAME
+		fi
+		return 0
+	fi
 
 	create_cluster_security_configurations $CLUSTER_NAME
+	
 	local cluster_status=$(get_cluster_status)
 	if [ "$cluster_status" == "running" ]; then
 		distribute_cluster_security_configurations $CLUSTER_NAME
@@ -1946,9 +1709,8 @@ update_firewall() {
 start_zookeeper() {
 	echo "Starting zookeeper service on cluster..."
 
-	local stfile="$(status_file)"
-	# Note: output of get_section is multiline, so always use it inside double quotes such as "$entries"
-	local ipaddrs=$(get_section $stfile "ipaddresses")
+	# Note: output of cluster_state is multiline, so always use it inside double quotes such as "$entries"
+	local ipaddrs=$(cluster_state section "ipaddresses")
 
 	while read ipentry;
 	do
@@ -1976,9 +1738,8 @@ start_zookeeper() {
 stop_zookeeper() {
 	echo "Stopping zookeeper service on cluster..."
 	
-	local stfile="$(status_file)"
-	# Note: output of get_section is multiline, so always use it inside double quotes such as "$entries"
-	local ipaddrs=$(get_section $stfile "ipaddresses")
+	# Note: output of cluster_state is multiline, so always use it inside double quotes such as "$entries"
+	local ipaddrs=$(cluster_state section "ipaddresses")
 
 	while read ipentry;
 	do
@@ -2018,28 +1779,14 @@ describe_cluster() {
 		return 1
 	fi
 	
-	printf "\nStatus: $(get_section $stfile "status" | cut -d ':' -f2)\n\n"
+	printf "\nStatus: $(get_cluster_status)\n\n"
 	
-	local nodes=$(get_section $stfile "nodes")
-	local hostnames=$(get_section $stfile "hostnames")
-	local ipaddrs=$(get_section $stfile "ipaddresses")
-	local zkids=$(get_section $stfile "myids")
+	# Hostnames, IP addresses and IDs that are not yet assigned are shown as '-'.
+	local zknodes=$(cluster_state query "linode_id,private_ip?,private_hostname?,public_ip?,public_hostname?,myid?")
 
-	while read node;
+	local zk_linode_id zk_private_ip zk_private_host zk_public_ip zk_public_host zk_id
+	while read zk_linode_id zk_private_ip zk_private_host zk_public_ip zk_public_host zk_id;
 	do
-		local zk_linode_id=$(echo "$node")
-		local zk_ipline=$(echo "$ipaddrs"|grep "$zk_linode_id")
-		local zk_iparr=($zk_ipline)
-		local zk_private_ip=${zk_iparr[1]}
-		local zk_public_ip=${zk_iparr[2]}
-		local zk_hostsline=$(echo "$hostnames"|grep "$zk_linode_id")
-		local zk_hostsarr=($zk_hostsline)
-		local zk_private_host=${zk_hostsarr[1]}
-		local zk_public_host=${zk_hostsarr[2]}
-		local zk_idline=$(echo "$zkids"|grep "$zk_linode_id")
-		local zk_idarr=($zk_idline)
-		local zk_id=${zk_idarr[1]}
-
 		cat <<-ENDSTANZA
 			  Linode ID:        $zk_linode_id
 			  Private IP:       $zk_private_ip
@@ -2050,7 +1797,7 @@ describe_cluster() {
 
 		ENDSTANZA
 	
-	done <<< "$(echo "$nodes")"
+	done <<< "$zknodes"
 	
 	return 0
 }
@@ -2078,26 +1825,10 @@ run_cmd() {
 		return 1
 	fi
 	
-	local ipaddrs=$(get_section $stfile "ipaddresses")
-	
-	while read ipentry;
-	do
-		local arr=($ipentry)
-		local linode_id=${arr[0]}
-		local private_ip=${arr[1]}
-		local public_ip=${arr[2]}
-		
-		# Default ssh target is the private IP address.
-		local target_ip=$private_ip
-		if [ "$CLUSTER_MANAGER_USES_PUBLIC_IP" == "true" ]; then
-			target_ip=$public_ip
-		fi
-		
-		echo "Executing command on linode:$linode_id, IP:$target_ip"
-
-		ssh_command $target_ip $NODE_USERNAME $NODE_ROOT_SSH_PRIVATE_KEY "${@:2}"
-	done <<< "$ipaddrs"
+	local ipaddrs=$(cluster_state section "ipaddresses")
 	
+	echo "Executing command on all nodes"
+	fanout "$ipaddrs" "${*:2}"
 }
 
 
@@ -2123,28 +1854,16 @@ copy_files() {
 		return 1
 	fi
 	
-	local ipaddrs=$(get_section $stfile "ipaddresses")
+	local ipaddrs=$(cluster_state section "ipaddresses")
 	
-	while read ipentry;
-	do
-		local arr=($ipentry)
-		local linode_id=${arr[0]}
-		local private_ip=${arr[1]}
-		local public_ip=${arr[2]}
-		
-		# Default ssh target is the private IP address.
-		local target_ip=$private_ip
-		if [ "$CLUSTER_MANAGER_USES_PUBLIC_IP" == "true" ]; then
-			target_ip=$public_ip
-		fi
-		
-		for localfile in "${@:3}"; do
-			local destfile="$2"/$(basename "$localfile")
-			echo "Copying $localfile to linode:$linode_id, IP:$target_ip $destfile"
-			remote_copyfile "$localfile" $target_ip $NODE_USERNAME $NODE_ROOT_SSH_PRIVATE_KEY "$destfile"
-		done
-	done <<< "$ipaddrs"
+	local file_specs=()
+	for localfile in "${@:3}"; do
+		local destfile="$2"/$(basename "$localfile")
+		echo "Copying $localfile to all nodes $destfile"
+		file_specs+=("$localfile:$destfile")
+	done
 	
+	fanout "$ipaddrs" "" "${file_specs[@]}"
 }
 
 
@@ -2570,6 +2289,33 @@ zk_install_dir() {
 }
 
 
+# Starts a linode_api.py server on $LINODE_API_SOCKET, if one is not already running.
+# The server exits on its own after 10 minutes without requests.
+start_linode_api_server() {
+	if [ -S "$LINODE_API_SOCKET" ]; then
+		return 0
+	fi
+	
+	# Scripts that find no server at the same time take turns, so that only the first one starts
+	# a server and the others wait for it. The server itself doesn't hold the turn.
+	(
+		flock 9
+		if [ ! -S "$LINODE_API_SOCKET" ]; then
+			./linode_api.py serve "$LINODE_API_SOCKET" 600 > /dev/null 2>&1 9>&- &
+		fi
+		
+		local attempt
+		for attempt in {1..50}; do
+			if [ -S "$LINODE_API_SOCKET" ]; then
+				exit 0
+			fi
+			sleep 0.1
+		done
+		exit 1
+	) 9> "$LINODE_API_SOCKET.start"
+}
+
+
 # $1 -> name of variable which receives output of command
 # $2 -> name of variable which receives stderr of command
 # $3 -> name of variable which receives return code of command (0=success, >0 are failures)
@@ -2582,7 +2328,14 @@ linode_api() {
 	# as explained in http://stackoverflow.com/questions/4421257/why-does-local-sweep-the-return-code-of-a-command
 	# and http://mywiki.wooledge.org/BashPitfalls#local_varname.3D.24.28command.29
 	local __out
-	__out=$(./linode_api.py "${@:4}" 2>$error_file)
+	# When LINODE_API_SOCKET is set, commands are sent to a long running linode_api.py
+	# server, which avoids Python startup and module import costs on every API call.
+	# The client falls back to running linode_api.py directly if the server is not available.
+	if [ -n "$LINODE_API_SOCKET" ] && start_linode_api_server; then
+		__out=$(./linode_api_client.py "${@:4}" 2>$error_file)
+	else
+		__out=$(./linode_api.py "${@:4}" 2>$error_file)
+	fi
 	local __ret=$?
 	local __err="$(< $error_file)"
 
@@ -2640,6 +2393,38 @@ wait_for_job() {
 	return $job_status
 }
 
+# Waits for several jobs together using a single "wait-jobs" command, instead of
+# waiting for each job one after another.
+# $1 : Description of what the jobs do, for messages. Example: "boot up"
+# $2... : The jobs, each as "<Job ID>:<linode ID>"
+# Return: 	0 -> all jobs completed
+#			1 -> some jobs failed, remained pending even after timeout, or their status could not be found
+wait_for_jobs() {
+	local description="$1"
+	local job_args=()
+	local job
+	for job in "${@:2}"; do
+		job_args+=("${job##*:}:${job%%:*}")
+	done
+	
+	local linout linerr linret
+	linode_api linout linerr linret "wait-jobs" 480 "${job_args[@]}"
+	
+	local linode_id job_id job_status
+	while read linode_id job_id job_status; do
+		if [ "$job_status" == "0" ]; then
+			echo "Linode $linode_id did not $description even after 8 minutes."
+		elif [ "$job_status" == "2" ]; then
+			echo "Linode $linode_id $description failed."
+		elif [ "$job_status" == "3" ]; then
+			echo "Failed to find status of job $job_id on linode $linode_id."
+		fi
+	done <<< "$linout"
+	
+	return $linret
+}
+
+
 
 create_status_file() {
 	local stfile=$(status_file)
@@ -2654,12 +2439,21 @@ create_status_file() {
 
 
 
-# 	$1: section name
-#	$2: line data to write
-write_status() {
-	local stfile=$(status_file)
-	add_section $stfile $1
-	insert_bottom_of_section $stfile $1 "$2"
+# Runs a cluster_state.py command on this cluster's state.
+#	$1... : Command and its args, as described in cluster_state.py.
+cluster_state() {
+	./cluster_state.py "$(status_file)" "$@"
+}
+
+
+
+# Renders configuration files of this cluster with config_renderer.py. Items to render are read from stdin,
+# as described in config_renderer.py.
+# Output: Paths of files that changed.
+# Returns: 0 on success, 1 on error.
+render_configs() {
+	./config_renderer.py "$(status_file)" | sed 's/^/Updated /'
+	return ${PIPESTATUS[0]}
 }
 
 
@@ -2667,34 +2461,26 @@ write_status() {
 
 # 	$1: New status of cluster "creating | created | starting | running | stopping | stopped"
 update_cluster_status() {
-	local stfile=$(status_file)
-	add_section $stfile "status"
-	# The 3rd arg "status:" is because insert or replace needs a search string to search and replace.
-	insert_or_replace_in_section $stfile "status" "status:" "status:$1"
+	cluster_state set "status" "status" "$1"
 }
 
 
 
 
 get_cluster_status() {
-	local stfile=$(status_file)
-	echo $(get_section $stfile "status" | cut -d ':' -f2)
+	echo $(cluster_state get "status" "status")
 }
 
 
 update_conf_status() {
-	local stfile=$(status_file)
-	add_section $stfile "conf"
-	# The 3rd arg "status:" is because insert or replace needs a search string to search and replace.
-	insert_or_replace_in_section $stfile "conf" "status:" "status:$1"
+	cluster_state set "conf" "status" "$1"
 }
 
 
 
 
 get_conf_status() {
-	local stfile=$(status_file)
-	echo $(get_section $stfile "conf" | cut -d ':' -f2)
+	echo $(cluster_state get "conf" "status")
 }
 
 
@@ -2703,18 +2489,14 @@ get_conf_status() {
 
 # 	$1: New status of security configuration "changed | unchanged"
 update_security_status() {
-	local stfile=$(status_file)
-	add_section $stfile "security"
-	# The 3rd arg "status:" is because insert or replace needs a search string to search and replace.
-	insert_or_replace_in_section $stfile "security" "status:" "status:$1"
+	cluster_state set "security" "status" "$1"
 }
 
 
 
 
 get_security_status() {
-	local stfile=$(status_file)
-	echo $(get_section $stfile "security" | cut -d ':' -f2)
+	echo $(cluster_state get "security" "status")
 }
 
 
@@ -2776,6 +2558,91 @@ ssh_command() {
 }
 
 
+#	$1 -> Nodes, as lines of "linode_id private_ip public_ip" like in ipaddresses section of status file.
+#	$2 -> Command run on every node after files are copied. Empty to only copy files.
+#	$3... -> Files to copy to every node, as "<local path>:<remote path>". Remote paths are
+#			relative to home directory unless absolute.
+fanout() {
+	# All nodes are handled concurrently by ssh_fanout.py, upto SSH_PARALLELISM nodes at a time, and each
+	# node's files are copied in a single transfer over a connection that's reused by later calls.
+	echo "$1" | ./ssh_fanout.py "$NODE_USERNAME" "$NODE_ROOT_SSH_PRIVATE_KEY" "${CLUSTER_MANAGER_USES_PUBLIC_IP:-false}" \
+		${SSH_PARALLELISM:-10} "$2" "${@:3}"
+}
+
+
+
+#	Same args as fanout.
+# Files are copied only to nodes whose copies differ from them, according to hashes of files copied
+# earlier that are recorded in cluster state, and the command is run only on those nodes.
+# If FANOUT_PLAN is "true", the files that would be copied are printed instead.
+fanout_changed() {
+	local plan_opt=
+	if [ "$FANOUT_PLAN" == "true" ]; then
+		plan_opt="--plan"
+	fi
+	echo "$1" | ./ssh_fanout.py --state "$(status_file)" $plan_opt "$NODE_USERNAME" "$NODE_ROOT_SSH_PRIVATE_KEY" \
+		"${CLUSTER_MANAGER_USES_PUBLIC_IP:-false}" ${SSH_PARALLELISM:-10} "$2" "${@:3}"
+}
+
+
+
+# Output: Name of the node field with the IP address that cluster manager uses to connect to nodes.
+target_ip_field() {
+	if [ "$CLUSTER_MANAGER_USES_PUBLIC_IP" == "true" ]; then
+		echo "public_ip"
+	else
+		echo "private_ip"
+	fi
+}
+
+
+
+# Output: readiness_probe.py targets for SSH daemons of all nodes.
+ssh_probe_targets() {
+	cluster_state query "$(target_ip_field)" | sed 's/^/ssh:/'
+}
+
+
+
+#	$1 : Probe type, as described in readiness_probe.py.
+# Output: readiness_probe.py targets of that type for zookeeper client port on private IP addresses of all nodes.
+zk_probe_targets() {
+	local zk_client_port=$(grep '^clientPort' "$CLUSTER_CONF_DIR/zoo.cfg"|cut -d '=' -f2|xargs)
+	if [ -z "$zk_client_port" ]; then
+		zk_client_port='2181'
+	fi
+	cluster_state query "private_ip" | awk -v t=$1 -v p=$zk_client_port '{ print t ":" $1 ":" p }'
+}
+
+
+
+#	$1 : Deadline in seconds.
+#	$2... : Targets, as described in readiness_probe.py.
+# Returns: 0 as soon as all targets are ready, 1 if some are not ready at deadline.
+wait_until_ready() {
+	./readiness_probe.py "$@"
+}
+
+
+
+# Same as wait_until_ready, but probes from a cluster node, for services that are firewalled from cluster manager.
+#	$1 : IP address of node on which to run the probes.
+#	$2 : Deadline in seconds.
+#	$3... : Targets, as described in readiness_probe.py.
+wait_until_ready_on_node() {
+	ssh -q -x -i "$NODE_ROOT_SSH_PRIVATE_KEY" -o IdentitiesOnly=yes -o UserKnownHostsFile=/dev/null -o StrictHostKeyChecking=no \
+		$NODE_USERNAME@$1 python - "${@:2}" < ./readiness_probe.py
+}
+
+
+
+# Output: IP address of a node which cluster manager uses for SSH.
+get_any_node_ipaddr() {
+	cluster_state query "$(target_ip_field)" | head -1
+}
+
+
+
 
 case $1 in
 	new-image-conf)
@@ -2786,6 +2653,20 @@ case $1 in
 	create_zk_image "$2" "$3"
 	;;
 
+	image-build-spec)
+	# Outputs nothing if an existing image is reused.
+	prepare_image_build "$2" "$3" >&2
+	case $? in
+		0) image_build_spec ;;
+		2) ;;
+		*) exit 1 ;;
+	esac
+	;;
+
+	install-image)
+	install_image_node "$2" "$3"
+	;;
+
 	delete-image)
 	delete_zk_image "$2" "$3"
 	;;
@@ -2811,11 +2692,11 @@ case $1 in
 	;;
 
 	update-zoo-cfg)
-	update_zk_configuration "$2"
+	update_zk_configuration "$2" "$3"
 	;;
 	
 	update-firewall)
-	update_firewall "$2"
+	update_firewall "$2" "$3" "$4"
 	;;
 	
 	create-cluster-whitelist)